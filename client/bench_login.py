@@ -0,0 +1,98 @@
+"""Đo thời gian từ lúc đăng nhập tới khi client có đủ dữ liệu ban đầu (phòng, bạn bè, lời mời).
+
+    python bench_login.py <username> <password> [số lần chạy]
+
+So sánh 3 cách nạp dữ liệu sau login: tuần tự (chờ từng reply), pipelined (3 request có
+req_id gửi cùng lúc) và batch (1 frame, tuần tự và song song). Cần server đang chạy.
+"""
+import json
+import socket
+import statistics
+import sys
+import time
+
+from client import HOST, PORT
+from wire import FrameDecoder, negotiate_request
+
+
+class Conn:
+    def __init__(self):
+        self.sock = socket.create_connection((HOST, PORT))
+        self.buf = b""
+        self.decoder = FrameDecoder()
+        self.seq = 0
+
+    def send(self, payload):
+        self.seq += 1
+        self.sock.sendall((json.dumps({**payload, "req_id": self.seq}) + "\n").encode("utf-8"))
+        return self.seq
+
+    def recv_obj(self):
+        while b"\n" not in self.buf:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("server closed")
+            self.buf += chunk
+        line, self.buf = self.buf.split(b"\n", 1)
+        return json.loads(self.decoder.decode(line.decode("utf-8")))
+
+    def wait_for(self, req_ids):
+        pending = set(req_ids)
+        while pending:
+            obj = self.recv_obj()
+            if obj.get("action") == "negotiate_result":
+                self.decoder.configure(obj)
+            pending.discard(obj.get("req_id"))
+
+    def close(self):
+        self.sock.close()
+
+
+def initial_requests(user_id):
+    return [
+        {"action": "show_chat_rooms", "user_id": user_id},
+        {"action": "show_friends", "user_id": user_id},
+        {"action": "show_friend_requests", "user_id": user_id},
+    ]
+
+
+def run_once(username, password, mode):
+    t0 = time.perf_counter()
+    c = Conn()
+    try:
+        c.wait_for([c.send(negotiate_request())])
+        rid = c.send({"action": "login", "username": username, "password": password})
+        while True:
+            obj = c.recv_obj()
+            if obj.get("req_id") == rid:
+                break
+        if not obj.get("ok"):
+            raise SystemExit(f"login failed: {obj}")
+        user_id = obj["user_id"]
+        reqs = initial_requests(user_id)
+        if mode == "serial":
+            for r in reqs:
+                c.wait_for([c.send(r)])
+        elif mode == "pipelined":
+            c.wait_for([c.send(r) for r in reqs])
+        else:
+            c.wait_for([c.send({"action": "batch", "requests": reqs, "concurrent": mode == "batch-concurrent"})])
+        return time.perf_counter() - t0
+    finally:
+        c.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    user, pwd = sys.argv[1], sys.argv[2]
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    for mode in ("serial", "pipelined", "batch", "batch-concurrent"):
+        samples = []
+        for _ in range(runs):
+            samples.append(run_once(user, pwd, mode))
+            time.sleep(0.2)   # giữ dưới giới hạn tốc độ chung "*" của user trên server
+        samples.sort()
+        print(f"{mode:17s} median={statistics.median(samples) * 1e3:7.1f}ms  "
+              f"p90={samples[int(len(samples) * 0.9) - 1] * 1e3:7.1f}ms  n={runs}")
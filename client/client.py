@@ -1,13 +1,24 @@
-import socket
-import threading
-import json
+import mimetypes
+import os
 import queue
+import re
+import threading
 import tkinter as tk
 from contextlib import suppress
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
+from local_cache import LocalCache, room_key, dm_key
+from conversation_buffers import ConversationBuffers
+from wire import expand_history
+from network import NetworkClient
+import transfer
 
 HOST = "127.0.0.1"   # đổi thành IP của server nếu chạy khác máy
 PORT = 5000
+HISTORY_FORMAT = "columnar"   # lịch sử dạng cột (gọn hơn); "rows" = dạng cũ
+UPLOAD_RETRIES = 3            # số lần tự upload tiếp khi kênh truyền tệp bị ngắt
+
+# Tham chiếu tệp trong dòng chat: "[Tệp] tên (cỡ) <12 ký tự đầu sha256>", bấm vào để tải
+_FILE_REF = re.compile(r"<([0-9a-f]{12})>")
 
 class ChatClient:
     def __init__(self, root):
@@ -15,11 +26,13 @@ class ChatClient:
         self.root.title("Python Socket Chat — Client")
         self.root.geometry("980x640")
 
-        # Networking
-        self.sock = None
-        self.receiver_thread = None
-        self.running = False
+        # incoming queue (thread mạng -> UI thread)
+        self.incoming = queue.Queue()
+
+        # Networking: kết nối / đọc / ghi chạy trên thread riêng, UI thread chỉ xếp hàng request
+        self.net = NetworkClient(HOST, PORT, self.incoming)
         self._shutting_down = False
+        self._pending_username = None
 
         # State
         self.user_id = None
@@ -32,22 +45,40 @@ class ChatClient:
         self.friend_map = {}               # id -> name
         self.presence = {}                 # id -> 'online'/'offline'
         self.unread = {}                   # id -> int (tin nhắn chưa đọc)
-
-        # Local DM buffers: peer_id -> list[str]
-        self.dm_buffers = {}
+        self.rooms = []                    # [{room_id, room_name}]
+        self.room_unread = {}              # room_id -> int (server đếm, cập nhật theo push)
+        self._marked = {}                  # conv_key -> id đã báo server là đã đọc
+        self._mark_timer = None
+        self._search_next = 0              # offset trang kết quả tìm kiếm tiếp theo
+
+        # Buffer hội thoại trong RAM (room + DM): giới hạn số dòng, tổng dung lượng, bỏ LRU
+        self.buffers = ConversationBuffers()
+        self._loading_older = set()        # conv_key đang chờ trang tin cũ hơn
+        self._view_oldest_id = None        # id cũ nhất đang hiển thị trong txt_chat
+
+        # Cache tin nhắn trên đĩa (mở sau khi đăng nhập)
+        self.cache = None
+
+        # Giao tin offline: server gửi bù DM theo lô, client ack theo id
+        self._draining = False             # đang nhận các lô gửi bù sau khi đăng nhập
+        self._ack_up_to = 0                # id DM lớn nhất đã nhận nhưng chưa ack
+        self._ack_timer = None
+
+        # Tệp đính kèm: ref (12 ký tự đầu sha256) -> meta; upload/download đang chạy theo sha256
+        self._files = {}
+        self._uploads = {}
+        self._downloads = {}
 
         # UI holders
         self.login_frame = None
         self.main_frame = None
 
-        # incoming queue (receiver thread -> UI thread)
-        self.incoming = queue.Queue()
-
         # Build UI
         self._build_login_ui()
 
         # pump
         self.root.after(100, self._process_incoming)
+        self.root.protocol("WM_DELETE_WINDOW", self._on_close)
 
     # ========================= UI BUILDERS =========================
     def _clear_root_children(self):
@@ -106,6 +137,10 @@ class ChatClient:
         btns_r = ttk.Frame(tab_register); btns_r.pack(pady=8)
         ttk.Button(btns_r, text="Đăng ký", command=self.register).grid(row=0, column=1, padx=6)
 
+        # Trạng thái kết nối (không dùng popup để UI không bị chặn khi đang thử kết nối lại)
+        self.lbl_net = ttk.Label(self.login_frame, text="", foreground="gray")
+        self.lbl_net.pack(pady=(8, 0))
+
     def _build_main_ui(self):
         if self.login_frame is not None:
             with suppress(Exception):
@@ -121,6 +156,8 @@ class ChatClient:
         self.lbl_user.pack(side=tk.LEFT, padx=10, pady=6)
 
         ttk.Button(top, text="Đăng xuất", command=self.logout).pack(side=tk.RIGHT, padx=10)
+        self.lbl_net = ttk.Label(top, text="", foreground="gray")
+        self.lbl_net.pack(side=tk.RIGHT, padx=10)
 
         # Notebook
         self.nb = ttk.Notebook(self.main_frame)
@@ -162,12 +199,22 @@ class ChatClient:
         self.lbl_chat_target = ttk.Label(header, text="Chưa chọn phòng / người để chat")
         self.lbl_chat_target.pack(side=tk.LEFT)
 
-        self.txt_chat = tk.Text(right, height=24, state=tk.DISABLED)
-        self.txt_chat.pack(fill=tk.BOTH, expand=True, pady=6)
+        frm_chat = ttk.Frame(right); frm_chat.pack(fill=tk.BOTH, expand=True, pady=6)
+        self.scr_chat = ttk.Scrollbar(frm_chat, orient=tk.VERTICAL)
+        self.scr_chat.pack(side=tk.RIGHT, fill=tk.Y)
+        # Cuộn lên đầu -> tải dần tin cũ hơn
+        self.txt_chat = tk.Text(frm_chat, height=24, state=tk.DISABLED, yscrollcommand=self._on_chat_scroll)
+        self.txt_chat.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scr_chat.config(command=self.txt_chat.yview)
 
         entry = ttk.Frame(right); entry.pack(fill=tk.X)
         self.ent_message = ttk.Entry(entry); self.ent_message.pack(side=tk.LEFT, fill=tk.X, expand=True)
         ttk.Button(entry, text="Gửi", command=self.send_message).pack(side=tk.LEFT, padx=6)
+        ttk.Button(entry, text="Tệp...", command=self.send_file).pack(side=tk.LEFT)
+        self.txt_chat.tag_config("file", foreground="blue", underline=True)
+        self.txt_chat.tag_bind("file", "<Button-1>", self._on_file_click)
+        self.txt_chat.tag_bind("file", "<Enter>", lambda _: self.txt_chat.config(cursor="hand2"))
+        self.txt_chat.tag_bind("file", "<Leave>", lambda _: self.txt_chat.config(cursor=""))
 
         # --- Tab: Phòng ---
         self.tab_rooms = ttk.Frame(self.nb)
@@ -185,6 +232,12 @@ class ChatClient:
         self.ent_join_room_id = ttk.Entry(frm_join, width=12); self.ent_join_room_id.grid(row=0, column=1, padx=6, pady=6)
         ttk.Button(frm_join, text="Tham gia", command=self.join_chat_room).grid(row=0, column=2, padx=6, pady=6)
 
+        frm_retention = ttk.LabelFrame(self.tab_rooms, text="Lưu giữ tin của phòng đang chọn (admin)")
+        frm_retention.pack(fill=tk.X, padx=8, pady=8)
+        ttk.Label(frm_retention, text="Số ngày (0 = giữ mãi)").grid(row=0, column=0, padx=6, pady=6)
+        self.ent_retention_days = ttk.Entry(frm_retention, width=12); self.ent_retention_days.grid(row=0, column=1, padx=6, pady=6)
+        ttk.Button(frm_retention, text="Lưu", command=self.set_room_retention).grid(row=0, column=2, padx=6, pady=6)
+
         # --- Tab: Bạn bè ---
         self.tab_friends = ttk.Frame(self.nb)
         self.nb.add(self.tab_friends, text="Bạn bè")
@@ -220,131 +273,82 @@ class ChatClient:
         self.txt_messages = tk.Text(self.tab_messages, height=24, state=tk.DISABLED)
         self.txt_messages.pack(fill=tk.BOTH, expand=True, padx=8, pady=8)
 
-        # Load lists initially
-        self.show_chat_rooms()
-        self.show_friends()
-        self.show_friend_requests()
+        # --- Tab: Tìm kiếm ---
+        self.tab_search = ttk.Frame(self.nb)
+        self.nb.add(self.tab_search, text="Tìm kiếm")
+
+        frm_q = ttk.Frame(self.tab_search); frm_q.pack(fill=tk.X, padx=8, pady=8)
+        self.ent_search = ttk.Entry(frm_q); self.ent_search.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.ent_search.bind("<Return>", lambda _: self.search_messages())
+        ttk.Button(frm_q, text="Tìm", command=self.search_messages).pack(side=tk.LEFT, padx=6)
+        self.btn_search_more = ttk.Button(frm_q, text="Trang sau", state=tk.DISABLED,
+                                          command=lambda: self.search_messages(self._search_next))
+        self.btn_search_more.pack(side=tk.LEFT)
+        self.lst_search = tk.Listbox(self.tab_search, exportselection=False)
+        self.lst_search.pack(fill=tk.BOTH, expand=True, padx=8, pady=8)
+
+        # Load lists initially: 1 round trip "batch" thay cho 3 request riêng lẻ
+        self._load_lists()
 
         # Poll presence/unread dự phòng
         self.root.after(5000, self._poll_every_5s)
 
     # ========================= NETWORK =========================
-    def connect_server(self):
-        if self.sock:
-            messagebox.showinfo("Thông báo", "Đã kết nối rồi")
-            return
-        try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((HOST, PORT))
-        except Exception as e:
-            self.sock = None
-            messagebox.showerror("Lỗi", f"Không thể kết nối server: {e}")
+    def _send(self, payload: dict, kind: str = None):
+        """Xếp 1 request vào hàng đợi gửi của thread mạng (không bao giờ chặn UI).
 
-    def _send(self, payload: dict):
-        """Gửi 1 JSON + newline; dùng sendall để đảm bảo gửi hết."""
-        if not self.sock:
-            messagebox.showwarning("Chưa kết nối", "Hãy kết nối tới server trước")
-            return False
-        try:
-            wire = json.dumps(payload, ensure_ascii=False) + "\n"
-            self.sock.sendall(wire.encode("utf-8"))
-            return True
-        except Exception as e:
+        `kind`: tên loại reply mong đợi, để định tuyến reply theo req_id thay vì đoán theo khóa.
+        Mất kết nối thì request chờ trong hàng đợi và được gửi sau khi kết nối lại.
+        """
+        if not self.net.send(payload, kind):
             if not self._shutting_down:
-                messagebox.showerror("Lỗi", f"Mất kết nối server: {e}")
+                messagebox.showwarning("Chưa kết nối", "Không gửi được: chưa kết nối hoặc hàng đợi gửi đã đầy")
             return False
+        return True
+
+    def _send_batch(self, items, concurrent=False):
+        """Gửi nhiều request trong 1 frame "batch"; items: list (payload, kind).
+
+        Server trả 1 frame batch_result, từng reply con được định tuyến như reply thường.
+        """
+        return self.net.send_batch(items, concurrent)
+
+    def _load_lists(self):
+        self._send_batch([
+            ({"action": "show_chat_rooms", "user_id": self.user_id}, "rooms"),
+            ({"action": "show_friends", "user_id": self.user_id}, "friends"),
+            ({"action": "show_friend_requests", "user_id": self.user_id}, "friend_requests"),
+            ({"action": "get_unread"}, None),   # mọi badge chưa đọc trong 1 query
+        ])
+
+    def _on_reconnected(self):
+        """Đã tự đăng nhập lại sau khi mất kết nối: tải lại danh sách và phần tin bị lỡ."""
+        self._loading_older.clear()
+        self._load_lists()
+        key = self._current_key()
+        if key and key in self.buffers:
+            if key.startswith("room:"):
+                req = {"action": "get_room_history", "room_id": self.current_room_id}
+            else:
+                req = {"action": "get_dm_history", "user_id": self.user_id, "peer_id": self.current_dm_user_id}
+            after = self.buffers.newest_id(key)
+            req.update({"after_id": after} if after else {"latest": True})
+            self._send({**req, "format": HISTORY_FORMAT})
 
-    def _start_receiver(self):
-        if self.receiver_thread and self.receiver_thread.is_alive():
-            return
-        self.running = True
-        self.receiver_thread = threading.Thread(target=self._receiver_loop, daemon=True)
-        self.receiver_thread.start()
-
-    def _recv_line_once(self) -> str:
-        """Đọc 1 dòng (kết thúc bằng \\n) đồng bộ – dùng cho login/register."""
-        buf = b""
-        while b"\n" not in buf:
-            chunk = self.sock.recv(4096)
-            if not chunk:
-                break
-            buf += chunk
-        line = buf.decode("utf-8", errors="ignore")
-        if "\n" in line:
-            line = line.split("\n", 1)[0]
-        return line
-
-    def _receiver_loop(self):
-        """Đọc stream theo dòng: mỗi dòng là 1 JSON hoặc text."""
-        buffer = ""
-        while self.running:
-            try:
-                data = self.sock.recv(4096)
-                if not data:
-                    if not self._shutting_down:
-                        self.incoming.put(("status", "Mất kết nối từ server"))
-                    break
-
-                buffer += data.decode("utf-8", errors="ignore")
-
-                # Xử lý từng dòng
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    if not line.strip():
-                        continue
-                    try:
-                        obj = json.loads(line)
-
-                        if isinstance(obj, list):
-                            self.incoming.put(("history", obj))
-
-                        elif isinstance(obj, dict):
-                            action = obj.get("action")
-                            if action == "receive_message":
-                                self.incoming.put(("chat", obj))
-                            elif action in ("send_message_result", "send_private_result"):
-                                self.incoming.put(("send_result", obj))
-                            elif action == "presence_update":
-                                self.incoming.put(("presence", obj))
-                            elif action == "room_history":
-                                self.incoming.put(("room_history", obj))
-                            elif action == "dm_history":
-                                self.incoming.put(("dm_history", obj))
-                            elif "chat_rooms" in obj:
-                                self.incoming.put(("rooms", obj["chat_rooms"]))
-                            elif "friends" in obj:
-                                self.incoming.put(("friends", obj["friends"]))
-                            elif "requests" in obj:
-                                self.incoming.put(("friend_requests", obj["requests"]))
-                            elif action == "friend_request":
-                                self.incoming.put(("friend_request_notify", obj))
-                            elif action == "remove_friend_result":
-                                self.incoming.put(("remove_friend_result", obj))
-                            elif action == "leave_room_result":
-                                self.incoming.put(("leave_room_result", obj))
-                            elif action == "friend_removed_notify":
-                                self.incoming.put(("friend_removed_notify", obj))
-                            else:
-                                self.incoming.put(("status", line))
-                        else:
-                            self.incoming.put(("status", line))
-
-                    except json.JSONDecodeError:
-                        self.incoming.put(("status", line))
-
-            except Exception as e:
-                if not self._shutting_down:
-                    self.incoming.put(("status", f"Lỗi nhận dữ liệu: {e}"))
-                break
+    def _set_net_status(self, text):
+        with suppress(Exception):
+            self.lbl_net.config(text=text)
 
-        self.running = False
+    def _on_close(self):
+        self._shutting_down = True
+        self.net.logout()
+        if self.cache:
+            self.cache.close()
+        self.root.destroy()
 
     # ========================= AUTH =========================
     def register(self):
-        if not self.sock:
-            self.connect_server()
-            if not self.sock:
-                return
+        self.net.start()
         full_name = self.reg_fullname.get().strip()
         username  = self.reg_username.get().strip()
         password  = self.reg_password.get().strip()
@@ -357,90 +361,355 @@ class ChatClient:
             messagebox.showwarning("Thiếu dữ liệu", "Nhập đủ username, mật khẩu và email")
             return
 
-        if self._send({
+        # Không chờ reply ở đây: kết quả về qua _process_incoming ("register_result")
+        self._send({
             "action": "register",
             "full_name": full_name,
             "username": username,
             "password": password,
             "email": email
-        }):
-            try:
-                resp = self._recv_line_once()
-                messagebox.showinfo("Phản hồi", resp)
-            except Exception as e:
-                messagebox.showerror("Lỗi", f"Không nhận được phản hồi: {e}")
+        }, kind="register_result")
 
     def login(self):
-        if not self.sock:
-            self.connect_server()
-            if not self.sock:
-                return
         username = self.lg_username.get().strip()
         password = self.lg_password.get().strip()
         if not username or not password:
             messagebox.showwarning("Thiếu dữ liệu", "Nhập đủ username và password")
             return
 
-        if not self._send({"action": "login", "username": username, "password": password}):
+        self._pending_username = username
+        # Kết nối (nếu chưa) và đăng nhập trên thread mạng; kết quả về qua "login_result"
+        self.net.login(username, password)
+        self._set_net_status("Đang đăng nhập...")
+
+    def _on_login_result(self, resp):
+        if resp.get("ok"):
+            self._draining = True          # lô gửi bù đầu tiên đến ngay sau login_result
+        if self.user_id:
+            # Đăng nhập lại tự động sau khi mất kết nối
+            if resp.get("ok"):
+                self._set_net_status("")
+                self._on_reconnected()
+            else:
+                self._reset_session()
+                messagebox.showerror("Mất phiên đăng nhập", f"Không đăng nhập lại được: {resp.get('error')}")
             return
-
-        try:
-            resp_raw = self._recv_line_once()
-            try:
-                resp = json.loads(resp_raw)
-            except json.JSONDecodeError:
-                messagebox.showerror("Đăng nhập thất bại", f"Phản hồi không hợp lệ: {resp_raw}")
+        if resp.get("ok"):
+            self.user_id = resp.get("user_id")
+            self.username = resp.get("username") or self._pending_username
+            if not self.user_id:
+                messagebox.showerror("Lỗi", "Server không trả user_id")
                 return
-
-            if resp.get("action") == "login_result" and resp.get("ok"):
-                self.user_id = resp.get("user_id")
-                self.username = resp.get("username") or username
-                if not self.user_id:
-                    messagebox.showerror("Lỗi", "Server không trả user_id")
-                    return
-                self._start_receiver()
-                self._build_main_ui()
+            self._open_cache()
+            self._build_main_ui()
+        else:
+            self._set_net_status("")
+            err = resp.get("error", "unknown_error")
+            if err == "invalid_credentials":
+                messagebox.showerror("Đăng nhập thất bại", "Sai username hoặc password")
+            elif err == "db_connect_failed":
+                messagebox.showerror("Đăng nhập thất bại", "Không kết nối được Database trên server")
             else:
-                err = resp.get("error", "unknown_error")
-                if err == "invalid_credentials":
-                    messagebox.showerror("Đăng nhập thất bại", "Sai username hoặc password")
-                elif err == "db_connect_failed":
-                    messagebox.showerror("Đăng nhập thất bại", "Không kết nối được Database trên server")
-                else:
-                    messagebox.showerror("Đăng nhập thất bại", f"Lỗi: {err}")
-        except Exception as e:
-            messagebox.showerror("Lỗi", f"Không nhận được phản hồi: {e}")
+                messagebox.showerror("Đăng nhập thất bại", f"Lỗi: {err}")
 
     def logout(self):
         self._shutting_down = True
         try:
-            with suppress(Exception):
-                if self.sock:
-                    self._send({"action": "logout"})
-        finally:
-            self.running = False
-            if self.sock:
-                with suppress(Exception): self.sock.shutdown(socket.SHUT_RDWR)
-                with suppress(Exception): self.sock.close()
-            self.sock = None
-
-            # Dọn queue
-            with suppress(queue.Empty):
-                while True:
-                    self.incoming.get_nowait()
-
-            # Reset state
-            self.user_id = None
-            self.username = None
-            self.current_room_id = None
-            self.current_dm_user_id = None
-            self.friends.clear(); self.friend_map.clear()
-            self.presence.clear(); self.unread.clear(); self.dm_buffers.clear()
-
-            self._build_login_ui()
+            self._reset_session()
             messagebox.showinfo("Đăng xuất", "Bạn đã đăng xuất.")
+        finally:
             self._shutting_down = False
 
+    def _reset_session(self):
+        """Dừng thread mạng (không tự kết nối lại), xóa state và về màn hình đăng nhập."""
+        self.net.logout()
+
+        # Dọn queue
+        with suppress(queue.Empty):
+            while True:
+                self.incoming.get_nowait()
+
+        # Reset state
+        self.user_id = None
+        self.username = None
+        self.current_room_id = None
+        self.current_dm_user_id = None
+        self.friends.clear(); self.friend_map.clear()
+        self.presence.clear(); self.unread.clear()
+        self.rooms = []; self.room_unread.clear(); self._marked.clear()
+        self.buffers.clear(); self._loading_older.clear(); self._view_oldest_id = None
+        self._draining = False; self._ack_up_to = 0
+        self._files.clear(); self._uploads.clear(); self._downloads.clear()
+        if self.cache:
+            self.cache.close()
+            self.cache = None
+
+        self._build_login_ui()
+
+    # ========================= LOCAL CACHE =========================
+    def _open_cache(self):
+        try:
+            self.cache = LocalCache(self.user_id, server=f"{HOST}_{PORT}")
+        except Exception as e:
+            print("local cache disabled:", e)
+            self.cache = None
+
+    def _cache_load(self, key):
+        if not self.cache:
+            return []
+        with suppress(Exception):
+            return self.cache.load(key)
+        return []
+
+    def _cache_store(self, key, msgs):
+        if self.cache:
+            with suppress(Exception):
+                self.cache.store(key, msgs)
+
+    @staticmethod
+    def _max_id(msgs):
+        return max((m["id"] for m in msgs if m.get("id") is not None), default=0)
+
+    def _body(self, m):
+        """Nội dung hiển thị của 1 tin; tin có tệp thêm tham chiếu bấm được để tải."""
+        content = m.get("content")
+        meta = m.get("attachment")
+        if not meta:
+            return content
+        self._files[meta["sha256"][:12]] = meta
+        label = f"[Tệp] {meta.get('name')} ({_human_size(meta.get('size') or 0)}) <{meta['sha256'][:12]}>"
+        return label if not content or content == meta.get("name") else f"{content} {label}"
+
+    def _format_room_line(self, m):
+        sid = m.get("sender_id")
+        sname = m.get("sender_name", sid)
+        if sid == self.user_id:
+            return f"[{m.get('sent_at')}] Tôi: {self._body(m)}"
+        return f"[{m.get('sent_at')}] {sname}: {self._body(m)}"
+
+    def _format_dm_line(self, m, peer):
+        s = m.get("sender_id")
+        if s == self.user_id:
+            return f"[{m.get('sent_at')}] Tôi -> {self.friend_map.get(peer, peer)}: {self._body(m)}"
+        return f"[{m.get('sent_at')}] {self.friend_map.get(s, s)}: {self._body(m)}"
+
+    def _conv_of(self, payload):
+        """(conv_key, hàm format, request lịch sử) của một payload room_history/dm_history."""
+        if payload.get("action") == "room_history":
+            rid = payload.get("room_id")
+            return room_key(rid), self._format_room_line, {"action": "get_room_history", "room_id": rid}
+        peer = payload.get("peer_id")
+        return (dm_key(peer), lambda m: self._format_dm_line(m, peer),
+                {"action": "get_dm_history", "user_id": self.user_id, "peer_id": peer})
+
+    # ========================= CONVERSATION BUFFERS =========================
+    def _open_conversation(self, key, fmt, history_req):
+        """Hiển thị hội thoại từ buffer RAM (hoặc cache đĩa), rồi xin server phần còn thiếu."""
+        self._clear_chat_area()
+        if key in self.buffers:
+            self.buffers.open(key)
+            for line in self.buffers.lines(key):
+                self._append_to_chat(line)
+            after = self.buffers.newest_id(key) or 0
+        else:
+            self.buffers.open(key)
+            cached = self._cache_load(key)
+            for m in cached:
+                line = fmt(m)
+                if self.buffers.append(key, m.get("id"), line):
+                    self._append_to_chat(line)
+            after = self._max_id(cached)
+        self._view_oldest_id = self.buffers.oldest_id(key)
+        req = dict(history_req)
+        if after:
+            req["after_id"] = after        # chỉ lấy tin mới hơn những gì đã có
+        else:
+            req["latest"] = True           # chưa có gì: lấy trang mới nhất, tin cũ tải dần khi cuộn
+        self._send({**req, "format": HISTORY_FORMAT})
+
+    def _current_key(self):
+        if self.current_room_id:
+            return room_key(self.current_room_id)
+        if self.current_dm_user_id:
+            return dm_key(self.current_dm_user_id)
+        return None
+
+    def _close_conversation(self, key):
+        self.buffers.pop(key)
+        self._loading_older.discard(key)
+
+    def _on_history(self, payload):
+        key, fmt, history_req = self._conv_of(payload)
+        msgs = expand_history(payload)
+        if payload.get("action") == "room_history":
+            for m in msgs:
+                m.setdefault("room_id", payload.get("room_id"))
+        self._cache_store(key, msgs)
+        full = len(msgs) >= payload.get("limit", len(msgs) + 1)
+
+        if payload.get("before_id"):
+            # Trang tin cũ hơn (cuộn lên đầu)
+            self._loading_older.discard(key)
+            if key not in self.buffers:
+                return
+            if not full:
+                self.buffers.set_exhausted(key)
+            self._show_older(key, msgs, fmt)
+            return
+
+        if key not in self.buffers:
+            return   # hội thoại đã bị bỏ khỏi RAM, dữ liệu vẫn nằm trong cache đĩa
+        for m in msgs:
+            line = fmt(m)
+            if self.buffers.append(key, m.get("id"), line) and self.buffers.active == key:
+                self._append_to_chat(line)
+        if self.buffers.active == key:
+            if self._view_oldest_id is None:
+                self._view_oldest_id = self.buffers.oldest_id(key)
+            self._schedule_mark_read()
+        if payload.get("latest"):
+            if not full:
+                self.buffers.set_exhausted(key)
+        elif full:
+            # Đủ 1 trang -> còn tin mới hơn, xin tiếp
+            self._send({**history_req, "after_id": self._max_id(msgs), "format": HISTORY_FORMAT})
+
+    def _on_chat_scroll(self, first, last):
+        self.scr_chat.set(first, last)
+        if float(first) <= 0.0:
+            self._load_older()
+
+    def _load_older(self):
+        """Nạp trang tin cũ hơn cho hội thoại đang mở: ưu tiên cache đĩa, sau đó server."""
+        key = self.buffers.active
+        if not key or key != self._current_key():
+            return
+        if key in self._loading_older or self.buffers.is_exhausted(key):
+            return
+        oldest = self._view_oldest_id or self.buffers.oldest_id(key)
+        if not oldest:
+            return
+        if self.cache:
+            older = []
+            with suppress(Exception):
+                older = self.cache.load_before(key, oldest)
+            if older:
+                fmt = self._format_room_line if key.startswith("room:") else (
+                    lambda m, peer=int(key.split(":", 1)[1]): self._format_dm_line(m, peer))
+                # Hoãn lại để không chèn dòng ngay trong callback cuộn của Text
+                self.root.after_idle(lambda: self._show_older(key, older, fmt))
+                self._loading_older.add(key)
+                return
+        self._loading_older.add(key)
+        if key.startswith("room:"):
+            req = {"action": "get_room_history", "room_id": int(key.split(":", 1)[1])}
+        else:
+            req = {"action": "get_dm_history", "user_id": self.user_id, "peer_id": int(key.split(":", 1)[1])}
+        self._send({**req, "before_id": oldest, "format": HISTORY_FORMAT})
+
+    def _show_older(self, key, msgs, fmt):
+        self._loading_older.discard(key)
+        if self.buffers.active != key or not msgs:
+            return
+        items = [(m.get("id"), fmt(m)) for m in msgs]
+        self.buffers.prepend(key, items)
+        ids = [mid for mid, _ in items if mid is not None]
+        if ids:
+            self._view_oldest_id = min(ids)
+        self._prepend_to_chat([line for _, line in items])
+
+    # ========================= OFFLINE DELIVERY =========================
+    def _receive_dm(self, msg) -> bool:
+        """Hiển thị / đếm unread cho 1 DM đến; False nếu đã có (trùng id)."""
+        sender_id = msg.get("sender_id")
+        if self.buffers.seen(dm_key(sender_id), msg.get("id")):
+            return False
+        name = self.friend_map.get(sender_id, sender_id)
+        line = f"[{msg.get('sent_at', '')}] {name}: {self._body(msg)}"
+        self.buffers.append(dm_key(sender_id), msg.get("id"), line)
+        if self.current_dm_user_id == sender_id:
+            self._append_to_chat(line)
+        else:
+            self.unread[sender_id] = self.unread.get(sender_id, 0) + 1
+        return True
+
+    def _on_offline_batch(self, payload):
+        """1 lô DM gửi bù: hiển thị rồi ack ngay (kèm "next" nếu còn lô sau)."""
+        msgs = payload.get("messages") or []
+        for m in msgs:
+            self._receive_dm(m)
+        if msgs:
+            self._render_friend_list()
+        more = bool(payload.get("more"))
+        self._draining = more
+        ids = [m["id"] for m in msgs if m.get("id")]
+        if not more:
+            # Lô cuối mới ack kèm tin realtime: id realtime thường lớn hơn các tin còn chờ ở lô sau,
+            # server GREATEST(last_delivered_id, ...) sẽ đẩy con trỏ qua chúng
+            ids.append(self._ack_up_to)
+            self._ack_up_to = 0
+        up_to = max(ids, default=0)
+        if up_to:
+            self._send({"action": "ack_delivery", "up_to": up_to, "next": more})
+
+    def _schedule_ack(self, mid):
+        """DM realtime: gom ack lại, gửi 1 lần sau vài giây."""
+        if not mid:
+            return
+        self._ack_up_to = max(self._ack_up_to, mid)
+        if self._ack_timer is None:
+            self._ack_timer = self.root.after(2000, self._flush_ack)
+
+    def _flush_ack(self):
+        self._ack_timer = None
+        # Đang nhận lô gửi bù thì chưa ack tin realtime (id lớn hơn sẽ "nhảy qua" tin chưa nhận);
+        # lô cuối sẽ ack luôn phần này
+        if self._draining or not self._ack_up_to or not self.user_id:
+            return
+        up_to, self._ack_up_to = self._ack_up_to, 0
+        self._send({"action": "ack_delivery", "up_to": up_to})
+
+    # ========================= UNREAD / READ MARKERS =========================
+    def _on_unread_counts(self, counts):
+        """Số chưa đọc do server đếm, khóa "room:<id>" / "dm:<peer>" (thay hẳn số đếm cục bộ)."""
+        self.unread = {fid: 0 for fid in self.unread}
+        self.room_unread = {}
+        active = self.buffers.active
+        for key, n in counts.items():
+            if key == active:
+                continue   # đang mở: sắp được mark_read
+            kind, _, ident = key.partition(":")
+            if not ident.isdigit():
+                continue
+            if kind == "dm":
+                self.unread[int(ident)] = n
+            elif kind == "room":
+                self.room_unread[int(ident)] = n
+        self._render_friend_list()
+        self._render_rooms()
+
+    def _schedule_mark_read(self):
+        """Gom các lần đọc hội thoại đang mở, báo server 1 lần sau 1 giây."""
+        if self._mark_timer is None:
+            self._mark_timer = self.root.after(1000, self._flush_mark_read)
+
+    def _flush_mark_read(self):
+        self._mark_timer = None
+        key = self.buffers.active
+        if not key or not self.user_id or key != self._current_key():
+            return
+        newest = self.buffers.newest_id(key)
+        if newest and newest > self._marked.get(key, 0):
+            self._marked[key] = newest
+            self._send({"action": "mark_read", "conv": key, "up_to": newest})
+
+    def _render_rooms(self):
+        self.lst_rooms.delete(0, tk.END)
+        for room in self.rooms:
+            n = self.room_unread.get(room["room_id"], 0)
+            suffix = f" ({n})" if n > 0 else ""
+            self.lst_rooms.insert(tk.END, f"{room['room_id']} - {room['room_name']}{suffix}")
+
     # ========================= CHAT (ROOM / DM) =========================
     def _on_select_room(self, _):
         sel = self.lst_rooms.curselection()
@@ -453,10 +722,17 @@ class ChatClient:
             room_id = None
         self.current_room_id = room_id
         self.current_dm_user_id = None
-        self.lbl_chat_target.config(text=f"Chat phòng: {item}")
+        if self.room_unread.pop(room_id, 0):
+            self._render_rooms()
+            self.lst_rooms.selection_set(sel[0])
+        self.lbl_chat_target.config(text=f"Chat phòng: {item.rsplit(' (', 1)[0]}")
         self._clear_chat_area()
         if room_id:
-            self._send({"action": "get_room_history", "room_id": room_id})
+            self._open_conversation(room_key(room_id), self._format_room_line,
+                                    {"action": "get_room_history", "room_id": room_id})
+            self._schedule_mark_read()
+        else:
+            self.buffers.active = None
 
     def _on_select_friend(self, _):
         sel = self.lst_friends.curselection()
@@ -475,12 +751,9 @@ class ChatClient:
         name = self.friend_map.get(uid, f"User {uid}")
         sta = (self.presence.get(uid, "offline").lower() == "online")
         self.lbl_chat_target.config(text=f"Chat riêng với: {name} ({'ON' if sta else 'OFF'})")
-        self._clear_chat_area()
-        if uid in self.dm_buffers:
-            for line in self.dm_buffers[uid]:
-                self._append_to_chat(line)
-        else:
-            self._send({"action": "get_dm_history", "user_id": self.user_id, "peer_id": uid})
+        self._open_conversation(dm_key(uid), lambda m: self._format_dm_line(m, uid),
+                                {"action": "get_dm_history", "user_id": self.user_id, "peer_id": uid})
+        self._schedule_mark_read()
 
     def _clear_chat_area(self):
         self.txt_chat.configure(state=tk.NORMAL)
@@ -489,10 +762,30 @@ class ChatClient:
 
     def _append_to_chat(self, text):
         self.txt_chat.configure(state=tk.NORMAL)
+        start = self.txt_chat.index("end-1c")
         self.txt_chat.insert(tk.END, text + "\n")
+        self._tag_files(start, tk.END)
         self.txt_chat.see(tk.END)
         self.txt_chat.configure(state=tk.DISABLED)
 
+    def _prepend_to_chat(self, lines):
+        """Chèn các dòng cũ lên đầu, giữ nguyên dòng người dùng đang xem."""
+        self.txt_chat.configure(state=tk.NORMAL)
+        self.txt_chat.insert("1.0", "".join(line + "\n" for line in lines))
+        self._tag_files("1.0", f"{len(lines) + 1}.0")
+        self.txt_chat.yview(f"{len(lines) + 1}.0")
+        self.txt_chat.configure(state=tk.DISABLED)
+
+    def _tag_files(self, start, end):
+        """Đánh dấu các tham chiếu tệp vừa chèn để bấm vào được."""
+        count = tk.IntVar()
+        while True:
+            pos = self.txt_chat.search("\\[Tệp\\] [^\n]*?<[0-9a-f]{12}>", start, end, regexp=True, count=count)
+            if not pos or not count.get():
+                return
+            start = f"{pos}+{count.get()}c"
+            self.txt_chat.tag_add("file", pos, start)
+
     def send_message(self):
         if not self.user_id:
             messagebox.showwarning("Chưa đăng nhập", "Bạn chưa đăng nhập")
@@ -522,14 +815,132 @@ class ChatClient:
                 "content": content
             })
             if ok:
-                line = f"[Tôi -> {self.friend_map.get(peer, peer)}]: {content}"
-                self._append_to_chat(line)
-                self.dm_buffers.setdefault(peer, []).append(line)
+                # Chỉ hiện tạm trên màn hình; dòng chính thức (có id) vào buffer khi server xác nhận
+                self._append_to_chat(f"[Tôi -> {self.friend_map.get(peer, peer)}]: {content}")
                 self.ent_message.delete(0, tk.END)
             return
 
         messagebox.showinfo("Chưa chọn mục tiêu", "Hãy chọn phòng hoặc một người bạn để chat")
 
+    # ========================= FILES =========================
+    def send_file(self):
+        """Chọn tệp -> băm sha256 (thread nền) -> attach_begin -> upload qua kênh riêng -> gửi tin."""
+        if not self.user_id:
+            messagebox.showwarning("Chưa đăng nhập", "Bạn chưa đăng nhập")
+            return
+        if self.current_room_id:
+            target = {"action": "send_message", "sender_id": self.user_id, "room_id": self.current_room_id}
+        elif self.current_dm_user_id:
+            target = {"action": "send_private_message", "sender_id": self.user_id,
+                      "receiver_id": self.current_dm_user_id}
+        else:
+            messagebox.showinfo("Chưa chọn mục tiêu", "Hãy chọn phòng hoặc một người bạn để chat")
+            return
+        path = filedialog.askopenfilename(title="Chọn tệp để gửi")
+        if not path:
+            return
+        caption = self.ent_message.get().strip()
+        self.ent_message.delete(0, tk.END)
+        self._set_net_status(f"Đang chuẩn bị {os.path.basename(path)}...")
+
+        def work():
+            try:
+                info = {"path": path, "size": os.path.getsize(path), "sha256": transfer.sha256_file(path),
+                        "target": {**target, "content": caption}}
+                self.incoming.put(("file_hashed", info))
+            except OSError as e:
+                self.incoming.put(("file_failed", {"name": os.path.basename(path), "error": str(e)}))
+
+        threading.Thread(target=work, name="file-hash", daemon=True).start()
+
+    def _on_file_hashed(self, info):
+        info["attempts"] = 0
+        self._uploads[info["sha256"]] = info
+        self._send({"action": "attach_begin", "sha256": info["sha256"], "size": info["size"]})
+
+    def _on_attach_begin(self, payload):
+        info = self._uploads.get(payload.get("sha256"))
+        if info is None:
+            return
+        if not payload.get("ok"):
+            self._on_file_failed({"sha256": info["sha256"], "error": payload.get("error"), "retry": False})
+            return
+        if payload.get("exists"):
+            self._send_file_message(info["sha256"])     # server đã có nội dung này: không cần upload
+            return
+        name = os.path.basename(info["path"])
+
+        def progress(done, total):
+            self.incoming.put(("net", f"Đang gửi {name}: {done * 100 // total}%"))
+
+        def work():
+            try:
+                transfer.upload(HOST, payload["port"], payload["ticket"], info["path"], payload.get("offset", 0),
+                                info["size"], payload.get("chunk", 1024 * 1024), progress)
+                self.incoming.put(("file_uploaded", info["sha256"]))
+            except (OSError, ValueError, transfer.TransferError) as e:
+                self.incoming.put(("file_failed", {"sha256": info["sha256"], "error": str(e),
+                                                   "retry": getattr(e, "error", None) != "hash_mismatch"}))
+
+        threading.Thread(target=work, name="file-upload", daemon=True).start()
+
+    def _on_file_failed(self, payload):
+        info = self._uploads.get(payload.get("sha256"))
+        if info is not None and payload.get("retry") and info["attempts"] < UPLOAD_RETRIES:
+            # Kênh truyền bị ngắt: hỏi lại server đã nhận tới đâu rồi gửi tiếp
+            info["attempts"] += 1
+            self._send({"action": "attach_begin", "sha256": info["sha256"], "size": info["size"]})
+            return
+        if info is not None:
+            self._uploads.pop(info["sha256"], None)
+        name = os.path.basename(info["path"]) if info else payload.get("name", "")
+        self._set_net_status("")
+        messagebox.showerror("Gửi tệp", f"Không gửi được {name}: {payload.get('error')}")
+
+    def _send_file_message(self, sha):
+        info = self._uploads.pop(sha, None)
+        if info is None:
+            return
+        name = os.path.basename(info["path"])
+        mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self._set_net_status(f"Đã gửi {name}")
+        self._send({**info["target"], "attachment": {"sha256": sha, "name": name, "mime": mime}})
+
+    def _on_file_click(self, event):
+        index = self.txt_chat.index(f"@{event.x},{event.y}")
+        rng = self.txt_chat.tag_prevrange("file", f"{index}+1c")
+        m = _FILE_REF.search(self.txt_chat.get(*rng)) if rng else None
+        meta = self._files.get(m.group(1)) if m else None
+        if meta is None:
+            return
+        dest = filedialog.asksaveasfilename(title="Lưu tệp", initialfile=meta.get("name") or meta["sha256"][:12])
+        if not dest:
+            return
+        self._downloads[meta["sha256"]] = dest
+        self._send({"action": "attach_ticket", "sha256": meta["sha256"]})
+
+    def _on_attach_ticket(self, payload):
+        dest = self._downloads.pop(payload.get("sha256"), None)
+        if dest is None:
+            return
+        if not payload.get("ok"):
+            messagebox.showerror("Tải tệp", f"Không tải được: {payload.get('error')}")
+            return
+        name = os.path.basename(dest)
+
+        def progress(done, total):
+            self.incoming.put(("net", f"Đang tải {name}: {done * 100 // total}%"))
+
+        def work():
+            try:
+                transfer.download(HOST, payload["port"], payload["ticket"], dest, payload["size"], progress)
+                self.incoming.put(("file_downloaded", dest))
+            except (OSError, ValueError, transfer.TransferError) as e:
+                # Phần đã tải giữ ở <dest>.part: bấm tải lại sẽ tiếp tục từ đó
+                self.incoming.put(("status", f"Tải {name} bị gián đoạn ({e}), bấm lại để tải tiếp."))
+
+        threading.Thread(target=work, name="file-download", daemon=True).start()
+
     def receive_messages(self):
         if not self.user_id:
             return
@@ -549,10 +960,32 @@ class ChatClient:
             return
         self._send({"action": "join_chat_room", "room_name": room_name, "user_id": self.user_id})
 
+    def search_messages(self, offset=0):
+        """Tìm trong mọi phòng + DM của mình (không phân biệt dấu); offset > 0 = trang sau."""
+        query = self.ent_search.get().strip()
+        if not query or not self.user_id:
+            return
+        self._send({"action": "search_messages", "query": query, "offset": offset})
+
+    def _on_search_result(self, payload):
+        if payload.get("offset", 0) == 0:
+            self.lst_search.delete(0, tk.END)
+        for m in payload.get("results", []):
+            if m.get("room_id"):
+                where = f"phòng {m['room_id']}"
+            else:
+                peer = m.get("receiver_id") if m.get("sender_id") == self.user_id else m.get("sender_id")
+                where = f"DM {self.friend_map.get(peer, peer)}"
+            self.lst_search.insert(tk.END, f"[{m.get('sent_at')}] ({where}) {m.get('sender_name')}: {m.get('content')}")
+        if payload.get("error"):
+            self.lst_search.insert(tk.END, f"Lỗi tìm kiếm: {payload['error']}")
+        self._search_next = payload.get("offset", 0) + len(payload.get("results", []))
+        self.btn_search_more.config(state=tk.NORMAL if payload.get("more") else tk.DISABLED)
+
     def show_chat_rooms(self):
         if not self.user_id:
             return
-        self._send({"action": "show_chat_rooms", "user_id": self.user_id})
+        self._send({"action": "show_chat_rooms", "user_id": self.user_id}, kind="rooms")
 
     def leave_selected_room(self):
         sel = self.lst_rooms.curselection()
@@ -575,6 +1008,16 @@ class ChatClient:
             return
         self._send({"action": "leave_chat_room", "user_id": self.user_id, "room_id": room_id})
 
+    def set_room_retention(self):
+        if not self.current_room_id:
+            messagebox.showwarning("Chưa chọn", "Mở phòng ở tab Chat trước khi đặt thời gian lưu giữ.")
+            return
+        txt = self.ent_retention_days.get().strip() or "0"
+        if not txt.isdigit():
+            messagebox.showwarning("Sai dữ liệu", "Số ngày phải là số nguyên >= 0")
+            return
+        self._send({"action": "set_room_retention", "room_id": self.current_room_id, "days": int(txt)})
+
     # ========================= FRIENDS / REQUESTS =========================
     def send_friend_request(self):
         name_txt = self.ent_add_friend_name.get().strip()
@@ -593,7 +1036,7 @@ class ChatClient:
     def show_friend_requests(self):
         if not self.user_id:
             return
-        self._send({"action": "show_friend_requests", "user_id": self.user_id})
+        self._send({"action": "show_friend_requests", "user_id": self.user_id}, kind="friend_requests")
 
     def accept_selected_request(self):
         sel = self.lst_friend_requests.curselection()
@@ -615,7 +1058,7 @@ class ChatClient:
     def show_friends(self):
         if not self.user_id:
             return
-        self._send({"action": "show_friends", "user_id": self.user_id})
+        self._send({"action": "show_friends", "user_id": self.user_id}, kind="friends")
 
     def remove_selected_friend(self):
         # Cố lấy từ selection
@@ -669,26 +1112,44 @@ class ChatClient:
                     if not self._shutting_down:
                         messagebox.showinfo("Server", payload)
 
+                elif kind == "net":
+                    self._set_net_status(payload)
+
+                elif kind == "login_result":
+                    self._on_login_result(payload)
+
+                elif kind == "register_result":
+                    messagebox.showinfo("Phản hồi", payload)
+
                 elif kind == "chat":
                     msg = payload
                     sender_id = msg.get("sender_id")
                     sender_name = msg.get("sender_name", sender_id)
-                    content = msg.get("content")
+                    content = self._body(msg)
                     sent_at = msg.get("sent_at", "")
                     room_id = msg.get("room_id")
 
                     if room_id:
-                        if self.current_room_id == room_id:
-                            self._append_to_chat(f"[{sent_at}] {sender_name}: {content}")
-                    else:
-                        name = self.friend_map.get(sender_id, sender_id)
-                        line = f"[{sent_at}] {name}: {content}"
-                        self.dm_buffers.setdefault(sender_id, []).append(line)
-                        if self.current_dm_user_id == sender_id:
+                        line = f"[{sent_at}] {sender_name}: {content}"
+                        key = room_key(room_id)
+                        # Hội thoại chưa mở (không có buffer) sẽ lấy tin này qua delta khi mở
+                        if self.buffers.append(key, msg.get("id"), line) and self.buffers.active == key:
                             self._append_to_chat(line)
+                        if self.current_room_id == room_id:
+                            self._schedule_mark_read()
                         else:
-                            self.unread[sender_id] = self.unread.get(sender_id, 0) + 1
-                            self._render_friend_list()
+                            self.room_unread[room_id] = self.room_unread.get(room_id, 0) + 1
+                            self._render_rooms()
+                    else:
+                        if self._receive_dm(msg):
+                            if self.current_dm_user_id == msg.get("sender_id"):
+                                self._schedule_mark_read()
+                            else:
+                                self._render_friend_list()
+                        self._schedule_ack(msg.get("id"))
+
+                elif kind == "offline":
+                    self._on_offline_batch(payload)
 
                 elif kind == "send_result":
                     msg = payload
@@ -696,20 +1157,50 @@ class ChatClient:
                         sent_at = msg.get("sent_at", "")
                         receiver_id = msg.get("receiver_id")
                         room_id = msg.get("room_id")
-                        content = msg.get("content", "")
+                        content = self._body(msg)
+                        # Dòng tạm đã hiện lúc gửi; ở đây chỉ ghi dòng chính thức (có id) vào buffer
                         if room_id:
-                            if self.current_room_id == room_id:
-                                self._append_to_chat(f"[{sent_at}] Tôi -> Room {room_id}: {content}")
-                        elif receiver_id:
+                            key, line = room_key(room_id), f"[{sent_at}] Tôi: {content}"
+                        else:
+                            key = dm_key(receiver_id)
                             line = f"[{sent_at}] Tôi -> {self.friend_map.get(receiver_id, receiver_id)}: {content}"
-                            self.dm_buffers.setdefault(receiver_id, []).append(line)
-                            if self.current_dm_user_id == receiver_id:
-                                self._append_to_chat(line)
+                        # Tin gửi tệp không có dòng tạm: hiện dòng chính thức (bấm được để tải)
+                        if (room_id or receiver_id) and self.buffers.append(key, msg.get("id"), line) \
+                                and msg.get("attachment") and self.buffers.active == key:
+                            self._append_to_chat(line)
+                    elif msg.get("error") == "attachment_missing":
+                        messagebox.showerror("Gửi tệp", "Tệp chưa được tải lên xong, hãy gửi lại.")
+
+                elif kind == "attach_begin":
+                    self._on_attach_begin(payload)
+
+                elif kind == "attach_ticket":
+                    self._on_attach_ticket(payload)
+
+                elif kind == "file_hashed":
+                    self._on_file_hashed(payload)
+
+                elif kind == "file_uploaded":
+                    self._send_file_message(payload)
+
+                elif kind == "file_failed":
+                    self._on_file_failed(payload)
+
+                elif kind == "file_downloaded":
+                    self._set_net_status(f"Đã tải xong {os.path.basename(payload)}")
 
                 elif kind == "rooms":
-                    self.lst_rooms.delete(0, tk.END)
-                    for room in payload:
-                        self.lst_rooms.insert(tk.END, f"{room['room_id']} - {room['room_name']}")
+                    self.rooms = payload or []
+                    self._render_rooms()
+
+                elif kind == "unread":
+                    self._on_unread_counts(payload)
+
+                elif kind == "search":
+                    self._on_search_result(payload)
+
+                elif kind == "mark_read_result":
+                    pass   # badge đã được xóa ở client lúc mở hội thoại
 
                 elif kind == "friends":
                     self.friends = payload or []
@@ -755,38 +1246,8 @@ class ChatClient:
                                 break
                         self._render_friend_list()
 
-                elif kind == "room_history":
-                    room_id = payload.get("room_id")
-                    msgs = payload.get("messages", [])
-                    if self.current_room_id == room_id:
-                        self._clear_chat_area()
-                        for m in msgs:
-                            sid = m.get("sender_id")
-                            sname = m.get("sender_name", sid)
-                            c = m.get("content")
-                            t = m.get("sent_at")
-                            if sid == self.user_id:
-                                self._append_to_chat(f"[{t}] Tôi: {c}")
-                            else:
-                                self._append_to_chat(f"[{t}] {sname}: {c}")
-
-                elif kind == "dm_history":
-                    peer = payload.get("peer_id")
-                    msgs = payload.get("messages", [])
-                    lines = []
-                    for m in msgs:
-                        s = m.get("sender_id"); r = m.get("receiver_id")
-                        c = m.get("content"); t = m.get("sent_at")
-                        if s == self.user_id:
-                            lines.append(f"[{t}] Tôi -> {self.friend_map.get(peer, peer)}: {c}")
-                        else:
-                            name = self.friend_map.get(s, s)
-                            lines.append(f"[{t}] {name}: {c}")
-                    self.dm_buffers[peer] = lines
-                    if self.current_dm_user_id == peer:
-                        self._clear_chat_area()
-                        for ln in lines:
-                            self._append_to_chat(ln)
+                elif kind in ("room_history", "dm_history"):
+                    self._on_history(payload)
 
                 elif kind == "remove_friend_result":
                     if payload.get("ok"):
@@ -794,7 +1255,7 @@ class ChatClient:
                         if fid is not None:
                             self.friend_map.pop(fid, None)
                             self.unread.pop(fid, None)
-                            self.dm_buffers.pop(fid, None)
+                            self._close_conversation(dm_key(fid))
                             self.friends = [f for f in self.friends if f["id"] != fid]
                             if self.current_dm_user_id == fid:
                                 self.current_dm_user_id = None
@@ -811,7 +1272,7 @@ class ChatClient:
                     if by_uid is not None:
                         self.friend_map.pop(by_uid, None)
                         self.unread.pop(by_uid, None)
-                        self.dm_buffers.pop(by_uid, None)
+                        self._close_conversation(dm_key(by_uid))
                         self.friends = [f for f in self.friends if f["id"] != by_uid]
                         if self.current_dm_user_id == by_uid:
                             self.current_dm_user_id = None
@@ -820,9 +1281,27 @@ class ChatClient:
                         self._render_friend_list()
                         self.show_friends()
 
+                elif kind == "rate_limited":
+                    # Server từ chối vì gửi quá nhanh
+                    action = payload.get("for")
+                    wait = payload.get("retry_after", 1)
+                    if action in ("get_room_history", "get_dm_history"):
+                        self._loading_older.clear()
+                    elif action in ("send_message", "send_private_message"):
+                        messagebox.showwarning("Gửi quá nhanh", f"Tin nhắn chưa được gửi, thử lại sau {wait:.1f} giây.")
+
+                elif kind == "retention_result":
+                    days = payload.get("days")
+                    if payload.get("ok"):
+                        msg = f"Phòng {payload.get('room_id')}: " + (f"chỉ giữ tin {days} ngày gần nhất." if days else "giữ mọi tin.")
+                        messagebox.showinfo("Lưu giữ tin", msg)
+                    else:
+                        messagebox.showerror("Lưu giữ tin", f"Thất bại: {payload.get('error')}")
+
                 elif kind == "leave_room_result":
                     if payload.get("ok"):
                         rid = payload.get("room_id")
+                        self._close_conversation(room_key(rid))
                         if self.current_room_id == rid:
                             self.current_room_id = None
                             self.lbl_chat_target.config(text="Chưa chọn phòng / người để chat")
@@ -839,11 +1318,18 @@ class ChatClient:
 
     # ========================= POLL =========================
     def _poll_every_5s(self):
-        if self.user_id and self.sock:
+        if self.user_id and self.net.ready:
             self.show_friends()
             self.show_friend_requests()
         self.root.after(5000, self._poll_every_5s)
 
+def _human_size(n) -> str:
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
 # ---------------- Main ----------------
 def main():
     root = tk.Tk()
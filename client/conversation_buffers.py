@@ -0,0 +1,150 @@
+from collections import OrderedDict, deque
+
+# Giới hạn bộ nhớ cho các buffer hội thoại
+MAX_LINES_PER_CONVERSATION = 500
+MEMORY_BUDGET_BYTES = 4 * 1024 * 1024
+
+
+def _line_size(line: str) -> int:
+    # Ước lượng: chuỗi Python + tuple + entry trong deque/set
+    return 100 + len(line)
+
+
+class _Buffer:
+    __slots__ = ("items", "ids", "size", "exhausted")
+
+    def __init__(self):
+        self.items = deque()     # (message_id | None, line) theo thứ tự cũ -> mới
+        self.ids = set()
+        self.size = 0
+        self.exhausted = False   # đã tải hết tin cũ từ server
+
+
+class ConversationBuffers:
+    """Buffer dòng chat theo hội thoại (khóa "room:<id>" / "dm:<peer>").
+
+    - Mỗi hội thoại giữ tối đa `max_lines` dòng (bỏ dòng cũ nhất khi vượt).
+    - Tổng dung lượng vượt `budget_bytes` thì bỏ cả hội thoại ít dùng nhất (LRU),
+      trừ hội thoại đang mở. Hội thoại bị bỏ sẽ được nạp lại từ cache/server khi mở.
+    """
+
+    def __init__(self, max_lines=MAX_LINES_PER_CONVERSATION, budget_bytes=MEMORY_BUDGET_BYTES):
+        self.max_lines = max_lines
+        self.budget_bytes = budget_bytes
+        self.active = None
+        self.total = 0
+        self._bufs = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._bufs
+
+    def open(self, key):
+        """Đánh dấu hội thoại đang mở; tạo buffer rỗng nếu chưa có."""
+        self.active = key
+        buf = self._bufs.get(key)
+        if buf is None:
+            buf = self._bufs[key] = _Buffer()
+        self._bufs.move_to_end(key)
+        return buf
+
+    def lines(self, key) -> list:
+        buf = self._bufs.get(key)
+        if buf is None:
+            return []
+        self._bufs.move_to_end(key)
+        return [line for _, line in buf.items]
+
+    def oldest_id(self, key):
+        buf = self._bufs.get(key)
+        if buf is None:
+            return None
+        return next((mid for mid, _ in buf.items if mid is not None), None)
+
+    def newest_id(self, key):
+        buf = self._bufs.get(key)
+        if buf is None:
+            return None
+        return next((mid for mid, _ in reversed(buf.items) if mid is not None), None)
+
+    def is_exhausted(self, key) -> bool:
+        buf = self._bufs.get(key)
+        return bool(buf and buf.exhausted)
+
+    def set_exhausted(self, key, value=True):
+        buf = self._bufs.get(key)
+        if buf is not None:
+            buf.exhausted = value
+
+    def seen(self, key, mid) -> bool:
+        buf = self._bufs.get(key)
+        return bool(buf and mid is not None and mid in buf.ids)
+
+    def append(self, key, mid, line) -> bool:
+        """Thêm dòng mới vào cuối. Trả False nếu hội thoại chưa có buffer hoặc trùng id."""
+        buf = self._bufs.get(key)
+        if buf is None or (mid is not None and mid in buf.ids):
+            return False
+        self._push(buf, mid, line, left=False)
+        while len(buf.items) > self.max_lines:
+            self._drop(buf, left=True)
+            buf.exhausted = False
+        self._enforce_budget()
+        return True
+
+    def prepend(self, key, items) -> list:
+        """Chèn các dòng cũ hơn (theo thứ tự cũ -> mới) vào đầu; trả về các dòng thực sự thêm."""
+        buf = self._bufs.get(key)
+        if buf is None:
+            return []
+        added = []
+        for mid, line in reversed(items):
+            if mid is not None and mid in buf.ids:
+                continue
+            if len(buf.items) >= self.max_lines:
+                break
+            self._push(buf, mid, line, left=True)
+            added.append(line)
+        added.reverse()
+        self._enforce_budget()
+        return added
+
+    def pop(self, key):
+        buf = self._bufs.pop(key, None)
+        if buf is not None:
+            self.total -= buf.size
+        if self.active == key:
+            self.active = None
+
+    def clear(self):
+        self._bufs.clear()
+        self.total = 0
+        self.active = None
+
+    # ---------- nội bộ ----------
+    def _push(self, buf, mid, line, left):
+        if left:
+            buf.items.appendleft((mid, line))
+        else:
+            buf.items.append((mid, line))
+        if mid is not None:
+            buf.ids.add(mid)
+        size = _line_size(line)
+        buf.size += size
+        self.total += size
+
+    def _drop(self, buf, left):
+        mid, line = buf.items.popleft() if left else buf.items.pop()
+        buf.ids.discard(mid)
+        size = _line_size(line)
+        buf.size -= size
+        self.total -= size
+
+    def _enforce_budget(self):
+        if self.total <= self.budget_bytes:
+            return
+        for key in list(self._bufs):
+            if self.total <= self.budget_bytes:
+                break
+            if key == self.active:
+                continue
+            self.pop(key)
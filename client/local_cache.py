@@ -0,0 +1,175 @@
+import json
+import os
+import sqlite3
+import time
+
+# Thư mục cache cục bộ (mỗi user 1 file SQLite)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".python_socket_chat", "cache")
+CACHE_MAX_BYTES = 20 * 1024 * 1024   # vượt ngưỡng này thì xóa bớt hội thoại cũ nhất
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    conv_key    TEXT    NOT NULL,
+    id          INTEGER NOT NULL,
+    sender_id   INTEGER,
+    sender_name TEXT,
+    receiver_id INTEGER,
+    room_id     INTEGER,
+    content     TEXT,
+    sent_at     TEXT,
+    PRIMARY KEY (conv_key, id)
+);
+-- Tệp đính kèm của tin (ít tin có tệp -> bảng riêng, meta dạng JSON)
+CREATE TABLE IF NOT EXISTS attachments (
+    conv_key    TEXT    NOT NULL,
+    id          INTEGER NOT NULL,
+    meta        TEXT    NOT NULL,
+    PRIMARY KEY (conv_key, id)
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    conv_key    TEXT PRIMARY KEY,
+    last_access REAL    NOT NULL,
+    size_bytes  INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+_COLUMNS = ("id", "sender_id", "sender_name", "receiver_id", "room_id", "content", "sent_at")
+
+
+def room_key(room_id) -> str:
+    return f"room:{room_id}"
+
+
+def dm_key(peer_id) -> str:
+    return f"dm:{peer_id}"
+
+
+def _row_size(m: dict) -> int:
+    """Ước lượng số byte 1 tin nhắn chiếm trên đĩa (đủ dùng cho eviction)."""
+    return 64 + len((m.get("content") or "").encode("utf-8")) + len(str(m.get("sender_name") or ""))
+
+
+class LocalCache:
+    """Cache tin nhắn trên đĩa theo từng hội thoại, khóa theo message id.
+
+    Chỉ dùng trên UI thread (sqlite3 mặc định không chia sẻ giữa các thread).
+    """
+
+    def __init__(self, user_id, server=None, base_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        os.makedirs(base_dir, exist_ok=True)
+        tag = f"{server}_" if server else ""
+        self.path = os.path.join(base_dir, f"{tag}{user_id}.sqlite3".replace(":", "_"))
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(_SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        try:
+            self.db.close()
+        except Exception:
+            pass
+
+    # ---------- đọc ----------
+    def load(self, conv_key: str, limit: int = 300) -> list:
+        """Trả về `limit` tin mới nhất của hội thoại, sắp theo id tăng dần."""
+        rows = self.db.execute(
+            "SELECT id, sender_id, sender_name, receiver_id, room_id, content, sent_at "
+            "FROM messages WHERE conv_key = ? ORDER BY id DESC LIMIT ?",
+            (conv_key, limit),
+        ).fetchall()
+        self.touch(conv_key)
+        return self._with_attachments(conv_key, [dict(zip(_COLUMNS, r)) for r in reversed(rows)])
+
+    def load_before(self, conv_key: str, before_id: int, limit: int = 100) -> list:
+        """Trả về tối đa `limit` tin có id < before_id (tin cũ hơn), sắp theo id tăng dần."""
+        rows = self.db.execute(
+            "SELECT id, sender_id, sender_name, receiver_id, room_id, content, sent_at "
+            "FROM messages WHERE conv_key = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (conv_key, before_id, limit),
+        ).fetchall()
+        return self._with_attachments(conv_key, [dict(zip(_COLUMNS, r)) for r in reversed(rows)])
+
+    def _with_attachments(self, conv_key: str, msgs: list) -> list:
+        if not msgs:
+            return msgs
+        rows = self.db.execute(
+            "SELECT id, meta FROM attachments WHERE conv_key = ? AND id BETWEEN ? AND ?",
+            (conv_key, msgs[0]["id"], msgs[-1]["id"]),
+        ).fetchall()
+        metas = {i: json.loads(meta) for i, meta in rows}
+        for m in msgs:
+            if m["id"] in metas:
+                m["attachment"] = metas[m["id"]]
+        return msgs
+
+    def last_id(self, conv_key: str) -> int:
+        row = self.db.execute("SELECT MAX(id) FROM messages WHERE conv_key = ?", (conv_key,)).fetchone()
+        return row[0] or 0
+
+    # ---------- ghi ----------
+    def store(self, conv_key: str, messages: list):
+        """Lưu các tin có id (bỏ qua tin không có id), rồi dọn cache nếu quá lớn."""
+        msgs = [m for m in messages if m.get("id") is not None]
+        if not msgs:
+            self.touch(conv_key)
+            return
+        # Chỉ cộng kích thước tin thực sự được chèn (tin đã có trong cache bị IGNORE -> rowcount 0)
+        added = 0
+        for m in msgs:
+            cur = self.db.execute("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  (conv_key,) + tuple(m.get(c) for c in _COLUMNS))
+            if cur.rowcount > 0:
+                added += _row_size(m)
+        self.db.executemany(
+            "INSERT OR IGNORE INTO attachments VALUES (?, ?, ?)",
+            [(conv_key, m["id"], json.dumps(m["attachment"])) for m in msgs if m.get("attachment")],
+        )
+        self.db.execute(
+            "INSERT INTO conversations (conv_key, last_access, size_bytes) VALUES (?, ?, ?) "
+            "ON CONFLICT(conv_key) DO UPDATE SET last_access = excluded.last_access, "
+            "size_bytes = size_bytes + excluded.size_bytes",
+            (conv_key, time.time(), added),
+        )
+        self.db.commit()
+        self.evict(keep=conv_key)
+
+    def touch(self, conv_key: str):
+        self.db.execute(
+            "INSERT INTO conversations (conv_key, last_access) VALUES (?, ?) "
+            "ON CONFLICT(conv_key) DO UPDATE SET last_access = excluded.last_access",
+            (conv_key, time.time()),
+        )
+        self.db.commit()
+
+    def drop(self, conv_key: str):
+        self.db.execute("DELETE FROM messages WHERE conv_key = ?", (conv_key,))
+        self.db.execute("DELETE FROM attachments WHERE conv_key = ?", (conv_key,))
+        self.db.execute("DELETE FROM conversations WHERE conv_key = ?", (conv_key,))
+        self.db.commit()
+
+    def total_bytes(self) -> int:
+        row = self.db.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM conversations").fetchone()
+        return row[0]
+
+    def evict(self, keep: str = None):
+        """Xóa các hội thoại ít được mở gần đây nhất cho tới khi dưới ngưỡng max_bytes."""
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        victims = self.db.execute(
+            "SELECT conv_key, size_bytes FROM conversations ORDER BY last_access ASC"
+        ).fetchall()
+        for key, size in victims:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.db.execute("DELETE FROM messages WHERE conv_key = ?", (key,))
+            self.db.execute("DELETE FROM attachments WHERE conv_key = ?", (key,))
+            self.db.execute("DELETE FROM conversations WHERE conv_key = ?", (key,))
+            total -= size
+        self.db.commit()
+        # Trả lại dung lượng cho hệ điều hành khi file đã phình to
+        if os.path.getsize(self.path) > 2 * self.max_bytes:
+            self.db.execute("VACUUM")
@@ -0,0 +1,332 @@
+import json
+import random
+import socket
+import threading
+from collections import deque
+from contextlib import suppress
+
+from wire import FrameDecoder, negotiate_request
+
+# Tự kết nối lại: chờ ngẫu nhiên trong [0, min(MAX, BASE * 2^lần thử)] (full jitter)
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30.0
+CONNECT_TIMEOUT = 10.0
+OUTBOX_LIMIT = 1000
+
+
+class NetworkClient:
+    """Toàn bộ I/O socket của client chạy ngoài UI thread.
+
+    - Thread "net-conn": kết nối, bắt tay (negotiate + login lại nếu đã đăng nhập), đọc dữ liệu,
+      mất kết nối thì tự kết nối lại với backoff lũy thừa có jitter.
+    - Thread "net-writer": lấy request từ hàng đợi gửi đi và ghi vào socket.
+    - Mọi thứ nhận được được đẩy vào `incoming` (queue) dưới dạng (kind, payload) cho UI thread.
+
+    send() không bao giờ chặn: request được xếp hàng và gửi khi kết nối sẵn sàng.
+    """
+
+    def __init__(self, host, port, incoming):
+        self.host = host
+        self.port = port
+        self.incoming = incoming
+
+        self.sock = None
+        self.decoder = FrameDecoder()
+        self.connected = False
+        self.ready = False                # đã kết nối và (nếu có) đã đăng nhập lại xong
+        self.logged_in = False
+
+        self._credentials = None          # (username, password) để đăng nhập lại khi reconnect
+        self._login_req_id = None
+        self._reconnecting = False        # lần đăng nhập tiếp theo là đăng nhập lại tự động
+
+        self._outbox = deque()
+        self._cond = threading.Condition()
+        self._sock_lock = threading.Lock()
+        self._req_seq = 0
+        self._pending = {}                # req_id -> loại reply mong đợi
+
+        self._stop = None                 # Event của phiên hiện tại; None = chưa chạy
+        self._delay_next = None           # server yêu cầu chờ trước khi kết nối lại
+
+    # ========================= vòng đời =========================
+    @property
+    def running(self) -> bool:
+        return self._stop is not None and not self._stop.is_set()
+
+    def start(self):
+        """Chạy thread kết nối + thread ghi. Mỗi phiên có Event dừng riêng nên thread cũ
+        (nếu còn đang kẹt trong connect) không thể sống lại sau logout."""
+        if self.running:
+            return
+        stop = self._stop = threading.Event()
+        with self._cond:
+            self._outbox.clear()
+            self._pending.clear()
+        threading.Thread(target=self._run, args=(stop,), name="net-conn", daemon=True).start()
+        threading.Thread(target=self._writer, args=(stop,), name="net-writer", daemon=True).start()
+
+    def stop(self):
+        """Dừng hẳn (không tự kết nối lại)."""
+        if self._stop is not None:
+            self._stop.set()
+        self._credentials = None
+        self.logged_in = False
+        with self._cond:
+            self.ready = False
+            self._outbox.clear()
+            self._cond.notify_all()
+        self._close_socket()
+
+    def login(self, username, password):
+        """Đăng nhập; thông tin được giữ trong RAM để đăng nhập lại sau khi mất kết nối."""
+        self._credentials = (username, password)
+        self._reconnecting = False
+        self.start()
+        if self.connected:
+            self._send_login()
+
+    def logout(self):
+        if self.connected and self.logged_in:
+            with suppress(Exception):
+                self._write({"action": "logout", "req_id": self._next_req_id()})
+        self.stop()
+
+    def reconnect_after(self, delay: float):
+        """Server đang drain: đóng kết nối hiện tại, chờ `delay` giây rồi kết nối lại."""
+        self._delay_next = delay
+        self._close_socket()
+
+    # ========================= gửi =========================
+    def _next_req_id(self, kind=None):
+        with self._cond:
+            self._req_seq += 1
+            if kind:
+                self._pending[self._req_seq] = kind
+            return self._req_seq
+
+    def send(self, payload: dict, kind: str = None) -> bool:
+        """Xếp request vào hàng đợi (kèm req_id). False nếu chưa start hoặc hàng đợi đầy."""
+        if not self.running:
+            return False
+        with self._cond:
+            if len(self._outbox) >= OUTBOX_LIMIT:
+                return False
+            self._req_seq += 1
+            if kind:
+                self._pending[self._req_seq] = kind
+            self._outbox.append({**payload, "req_id": self._req_seq})
+            self._cond.notify()
+        return True
+
+    def send_batch(self, items, concurrent=False) -> bool:
+        """Gửi nhiều request trong 1 frame "batch"; items: list (payload, kind)."""
+        subs = [{**payload, "req_id": self._next_req_id(kind)} for payload, kind in items]
+        return self.send({"action": "batch", "requests": subs, "concurrent": concurrent})
+
+    def _write(self, obj: dict):
+        data = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._sock_lock:
+            sock = self.sock
+            if sock is None:
+                raise ConnectionError("not connected")
+            sock.sendall(data)
+
+    def _writer(self, stop):
+        while not stop.is_set():
+            with self._cond:
+                while not stop.is_set() and not (self.ready and self._outbox):
+                    self._cond.wait()
+                if stop.is_set():
+                    return
+                item = self._outbox.popleft()
+            try:
+                self._write(item)
+            except Exception:
+                # Giữ lại request, gửi lại sau khi kết nối lại
+                with self._cond:
+                    self._outbox.appendleft(item)
+                    self.ready = False
+                self._close_socket()
+
+    # ========================= kết nối / đọc =========================
+    def _emit(self, kind, payload=None):
+        self.incoming.put((kind, payload))
+
+    def _set_ready(self, value):
+        with self._cond:
+            self.ready = value
+            self._cond.notify_all()
+
+    def _close_socket(self):
+        with self._sock_lock:
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            with suppress(Exception):
+                sock.shutdown(socket.SHUT_RDWR)
+            with suppress(Exception):
+                sock.close()
+
+    def _send_login(self):
+        creds = self._credentials
+        if not creds:
+            return
+        username, password = creds
+        self._login_req_id = self._next_req_id()
+        with suppress(Exception):
+            self._write({"action": "login", "username": username, "password": password,
+                         "req_id": self._login_req_id})
+
+    def _run(self, stop):
+        attempt = 0
+        while not stop.is_set():
+            if self._delay_next is not None:
+                delay, self._delay_next = self._delay_next, None
+                self._emit("net", f"Server bảo trì, kết nối lại sau {delay:.0f} giây...")
+                if stop.wait(delay):
+                    break
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+                sock.settimeout(None)
+            except OSError as e:
+                attempt += 1
+                delay = random.uniform(0, min(RECONNECT_MAX, RECONNECT_BASE * (2 ** attempt)))
+                self._emit("net", f"Không kết nối được server ({e}), thử lại sau {delay:.1f} giây")
+                stop.wait(delay)
+                continue
+
+            attempt = 0
+            with self._sock_lock:
+                if stop.is_set():
+                    sock.close()
+                    break
+                self.sock = sock
+            self.decoder = FrameDecoder()
+            self.connected = True
+            self._emit("net", "Đã kết nối")
+            # Bắt tay: đề xuất nén, rồi đăng nhập lại nếu trước đó đã đăng nhập
+            with suppress(Exception):
+                self._write({**negotiate_request(), "req_id": self._next_req_id()})
+            if self._credentials:
+                self._send_login()
+            else:
+                self._set_ready(True)
+
+            self._read_loop(sock, stop)
+
+            self.connected = False
+            self._set_ready(False)
+            self._close_socket()
+            if stop.is_set():
+                break
+            if self.logged_in:
+                self._reconnecting = True
+            self.logged_in = False
+            self._emit("net", "Mất kết nối tới server, đang kết nối lại...")
+            if self._delay_next is None:
+                stop.wait(random.uniform(0, RECONNECT_BASE))
+
+    def _read_loop(self, sock, stop):
+        buffer = ""
+        while not stop.is_set():
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data.decode("utf-8", errors="ignore")
+            while "\n" in buffer:
+                line, buffer = buffer.split("\n", 1)
+                if not line.strip():
+                    continue
+                try:
+                    line = self.decoder.decode(line)
+                    self._route(json.loads(line), line, sock)
+                except ValueError:   # JSON lỗi hoặc frame nén hỏng
+                    self._emit("status", line)
+
+    def _route(self, obj, line, sock):
+        """Định tuyến 1 frame đã giải mã về hàng đợi UI (chạy trên thread kết nối)."""
+        if isinstance(obj, list):
+            self._emit("history", obj)
+            return
+        if not isinstance(obj, dict):
+            self._emit("status", line)
+            return
+
+        action = obj.get("action")
+        req_id = obj.get("req_id")
+        kind = self._pending.pop(req_id, None) if req_id is not None else None
+
+        if action == "ping":
+            # Heartbeat: trả lời ngay, không qua hàng đợi gửi
+            with suppress(Exception):
+                with self._sock_lock:
+                    sock.sendall(b'{"action": "pong"}\n')
+        elif action == "negotiate_result":
+            self.decoder.configure(obj)
+        elif action == "reconnect":
+            # Server sắp tắt/khởi động lại: mỗi client được hẹn 1 thời điểm khác nhau để kết nối lại
+            self.reconnect_after(float(obj.get("after") or 0))
+        elif action == "login_result" and req_id == self._login_req_id:
+            if obj.get("ok"):
+                self.logged_in = True
+                self._set_ready(True)
+            else:
+                # Sai thông tin: không tự đăng nhập lại nữa
+                self._credentials = None
+                self._set_ready(True)
+            self._emit("login_result", {**obj, "reconnected": self._reconnecting})
+            self._reconnecting = False
+        elif action == "rate_limited":
+            self._emit("rate_limited", obj)
+        elif action == "batch_result":
+            for frames in obj.get("results", []):
+                for sub in frames:
+                    self._route(sub, json.dumps(sub, ensure_ascii=False), sock)
+        elif action == "text":
+            # Reply dạng text của server (được bọc JSON vì request có req_id)
+            self._emit(kind or "status", obj.get("message", ""))
+        elif action == "message_list":
+            self._emit("history", obj.get("messages", []))
+        elif action == "receive_message":
+            self._emit("chat", obj)
+        elif action == "offline_messages":
+            self._emit("offline", obj)
+        elif action == "unread_counts":
+            self._emit("unread", obj.get("counts") or {})
+        elif action == "mark_read_result":
+            self._emit("mark_read_result", obj)
+        elif action == "search_result":
+            self._emit("search", obj)
+        elif action in ("send_message_result", "send_private_result"):
+            self._emit("send_result", obj)
+        elif action == "presence_update":
+            self._emit("presence", obj)
+        elif action == "room_history":
+            self._emit("room_history", obj)
+        elif action == "dm_history":
+            self._emit("dm_history", obj)
+        elif kind == "rooms" or "chat_rooms" in obj:
+            self._emit("rooms", obj.get("chat_rooms", []))
+        elif kind == "friends" or "friends" in obj:
+            self._emit("friends", obj.get("friends", []))
+        elif kind == "friend_requests" or "requests" in obj:
+            self._emit("friend_requests", obj.get("requests", []))
+        elif action == "friend_request":
+            self._emit("friend_request_notify", obj)
+        elif action == "remove_friend_result":
+            self._emit("remove_friend_result", obj)
+        elif action == "leave_room_result":
+            self._emit("leave_room_result", obj)
+        elif action == "attach_begin_result":
+            self._emit("attach_begin", obj)
+        elif action == "attach_ticket_result":
+            self._emit("attach_ticket", obj)
+        elif action == "set_room_retention_result":
+            self._emit("retention_result", obj)
+        elif action == "friend_removed_notify":
+            self._emit("friend_removed_notify", obj)
+        else:
+            self._emit("status", line)
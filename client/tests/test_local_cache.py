@@ -0,0 +1,32 @@
+"""size_bytes của hội thoại chỉ tăng theo tin thực sự được chèn vào cache."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_cache import LocalCache, _row_size, room_key  # noqa: E402
+
+
+def msg(i, content="x"):
+    return {"id": i, "sender_id": 1, "sender_name": "A", "room_id": 5, "content": content, "sent_at": "2025-01-01 00:00:00"}
+
+
+def size_of(cache, key):
+    return cache.db.execute("SELECT size_bytes FROM conversations WHERE conv_key = ?", (key,)).fetchone()[0]
+
+
+def test_store_counts_only_new_rows(tmp_path):
+    cache = LocalCache(1, base_dir=str(tmp_path))
+    key = room_key(5)
+    first = [msg(1, "a" * 10), msg(2, "b" * 20)]
+    cache.store(key, first)
+    assert size_of(cache, key) == sum(_row_size(m) for m in first)
+
+    # Trang chồng lên phần đã có: chỉ tin 3 là mới
+    cache.store(key, first + [msg(3, "c" * 30)])
+    assert size_of(cache, key) == sum(_row_size(m) for m in first) + _row_size(msg(3, "c" * 30))
+
+    # Toàn bộ đã có -> không đổi
+    cache.store(key, first)
+    assert size_of(cache, key) == sum(_row_size(m) for m in first) + _row_size(msg(3, "c" * 30))
+    cache.close()
@@ -0,0 +1,98 @@
+"""Giao tin offline theo lô + ack: tin realtime đến giữa lúc đang nhận lô không làm mất tin còn chờ.
+
+Server được mô phỏng đúng như ack_delivery / deliver_offline_messages: con trỏ
+GREATEST(last_delivered_id, up_to), lô sau là các DM có id > con trỏ.
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("tkinter")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import ChatClient  # noqa: E402
+from conversation_buffers import ConversationBuffers  # noqa: E402
+
+
+class FakeRoot:
+    def __init__(self):
+        self.timers = []
+
+    def after(self, ms, fn):
+        self.timers.append(fn)
+        return len(self.timers)
+
+
+class FakeServer:
+    def __init__(self, pending, batch=2):
+        self.pending = sorted(pending)
+        self.batch = batch
+        self.cursor = 0
+
+    def offline_batch(self):
+        rows = [i for i in self.pending if i > self.cursor][:self.batch + 1]
+        msgs = [{"id": i, "sender_id": 7, "content": f"m{i}"} for i in rows[:self.batch]]
+        return {"messages": msgs, "more": len(rows) > self.batch}
+
+    def ack(self, up_to):
+        self.cursor = max(self.cursor, up_to)
+
+
+def make_client():
+    c = ChatClient.__new__(ChatClient)
+    c.root = FakeRoot()
+    c.user_id = 1
+    c.buffers = ConversationBuffers()
+    c.friend_map = {7: "Bob"}
+    c.current_dm_user_id = None
+    c.unread = {}
+    c._files = {}
+    c._draining = True             # login_result vừa đến: lô gửi bù đầu tiên đang tới
+    c._ack_up_to = 0
+    c._ack_timer = None
+    c.sent = []
+    c._send = lambda payload, kind=None: c.sent.append(payload)
+    c._render_friend_list = lambda: None
+    return c
+
+
+def run_drain(client, server, realtime_before_batch):
+    """Chạy hết các lô; ngay trước lô thứ realtime_before_batch có 1 DM realtime (id lớn) đến và timer ack nổ."""
+    payload, n = server.offline_batch(), 0
+    while True:
+        n += 1
+        if n == realtime_before_batch:
+            client._receive_dm({"id": 100, "sender_id": 7, "content": "realtime"})
+            client._schedule_ack(100)
+            client.root.timers[-1]()
+        client._on_offline_batch(payload)
+        ack = client.sent.pop(0) if client.sent else None
+        if ack is None:
+            return
+        server.ack(ack["up_to"])
+        if not ack.get("next"):
+            return
+        payload = server.offline_batch()
+
+
+@pytest.mark.parametrize("realtime_before_batch", [1, 2, 3])
+def test_realtime_dm_during_multi_batch_drain(realtime_before_batch):
+    server = FakeServer(pending=[10, 11, 12, 13, 14], batch=2)
+    client = make_client()
+    run_drain(client, server, realtime_before_batch)
+    # Mọi tin chờ đều được giao, rồi mới ack tin realtime
+    assert client.unread[7] == 6
+    assert server.cursor == 100
+    assert client._ack_up_to == 0 and not client._draining
+
+
+def test_realtime_ack_flushes_after_drain():
+    server = FakeServer(pending=[10], batch=2)
+    client = make_client()
+    client._on_offline_batch(server.offline_batch())
+    server.ack(client.sent.pop(0)["up_to"])
+    client._schedule_ack(100)
+    client.root.timers[-1]()
+    assert client.sent == [{"action": "ack_delivery", "up_to": 100}]
@@ -0,0 +1,106 @@
+"""Truyền tệp đính kèm qua kênh riêng của server (xem server/attachments.py).
+
+Chạy trên thread nền; không dùng socket chat nên tệp lớn không làm chậm tin nhắn.
+Upload / download đều tiếp tục được từ chỗ dừng: upload theo "offset" server trả về,
+download theo kích thước tệp <đích>.part đã có trên đĩa (range request).
+"""
+import hashlib
+import json
+import os
+import socket
+
+CONNECT_TIMEOUT = 10.0
+IO_TIMEOUT = 30.0
+_IO_CHUNK = 256 * 1024
+
+
+class TransferError(Exception):
+    def __init__(self, error, offset=None):
+        super().__init__(error)
+        self.error = error
+        self.offset = offset
+
+
+def sha256_file(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _connect(host, port):
+    sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+    sock.settimeout(IO_TIMEOUT)
+    return sock
+
+
+def _send_header(sock, obj):
+    sock.sendall((json.dumps(obj) + "\n").encode("utf-8"))
+
+
+def _read_reply(reader) -> dict:
+    line = reader.readline(4096)
+    if not line:
+        raise TransferError("connection_closed")
+    return json.loads(line)
+
+
+def upload(host, port, ticket, path, offset, size, chunk, progress=None) -> int:
+    """Gửi phần [offset, size) của tệp theo từng chunk; trả về offset cuối (= size khi xong).
+
+    progress(đã_gửi, tổng) được gọi sau mỗi chunk. Lỗi -> TransferError (kèm offset server đang có).
+    """
+    sock = _connect(host, port)
+    reader = sock.makefile("rb")
+    try:
+        with open(path, "rb") as f:
+            while offset < size:
+                length = min(chunk, size - offset)
+                _send_header(sock, {"op": "put", "ticket": ticket, "offset": offset, "length": length})
+                # sendfile: hệ điều hành chép thẳng từ tệp ra socket
+                sock.sendfile(f, offset, length)
+                reply = _read_reply(reader)
+                if not reply.get("ok"):
+                    raise TransferError(reply.get("error"), reply.get("offset"))
+                offset = reply.get("offset", offset + length)
+                if progress:
+                    progress(offset, size)
+                if reply.get("complete"):
+                    return size
+        return offset
+    finally:
+        reader.close()
+        sock.close()
+
+
+def download(host, port, ticket, dest, size, progress=None):
+    """Tải blob về `dest`; phần đã tải nằm ở dest + ".part", lần sau chỉ xin phần còn thiếu."""
+    part = dest + ".part"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > size:
+        os.remove(part)
+        offset = 0
+    if offset < size:
+        sock = _connect(host, port)
+        reader = sock.makefile("rb")
+        try:
+            _send_header(sock, {"op": "get", "ticket": ticket, "offset": offset, "length": size - offset})
+            reply = _read_reply(reader)
+            if not reply.get("ok"):
+                raise TransferError(reply.get("error"))
+            remaining = reply["length"]
+            with open(part, "ab") as f:
+                while remaining:
+                    data = reader.read(min(_IO_CHUNK, remaining))
+                    if not data:
+                        raise TransferError("connection_closed", offset)
+                    f.write(data)
+                    offset += len(data)
+                    remaining -= len(data)
+                    if progress:
+                        progress(offset, size)
+        finally:
+            reader.close()
+            sock.close()
+    os.replace(part, dest)
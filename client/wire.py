@@ -0,0 +1,72 @@
+import base64
+import zlib
+from datetime import datetime
+
+# Frame nén: PREFIX + base64(raw deflate(json)) — xem server/compression.py
+PREFIX = "Z:"
+
+# PHẢI giống hệt ZDICTS trong server/compression.py (khớp theo tên phiên bản khi thỏa thuận)
+ZDICTS = {
+    "v1": (
+        b'{"action": "send_message_result", "ok": true, "ok": false, "error": "exception", '
+        b'{"action": "presence_update", "user_id": , "status": "online"}, "status": "offline"}'
+        b'{"chat_rooms": [{"room_id": , "room_name": "'
+        b'{"requests": [{"id": , "display_name": "'
+        b'{"friends": [{"id": , "display_name": "", "status": "offline"}, '
+        b'{"action": "dm_history", "peer_id": , "after_id": 0, "limit": 300, "latest": true, "before_id": '
+        b'"messages": [{"id": , "sender_id": , "receiver_id": , "content": "", "sent_at": "20'
+        b'[{"id": , "sender_id": , "receiver_id": null, "content": "", "sent_at": "20, "room_id": null}, '
+        b'{"action": "receive_message", "id": , "sender_id": , "sender_name": "", "content": "", "sent_at": "20'
+        b'{"action": "room_history", "room_id": , "after_id": 0, "limit": 300, "messages": [{"id": '
+        b'}, {"id": , "sender_id": , "sender_name": "", "content": "", "sent_at": "20'
+    ),
+}
+
+
+def negotiate_request() -> dict:
+    """Request đề xuất nén gửi ngay sau khi kết nối."""
+    return {"action": "negotiate", "compression": ["deflate"], "zdict": list(ZDICTS)}
+
+
+class FrameDecoder:
+    """Giải nén frame theo kết quả thỏa thuận; frame thường đi qua nguyên vẹn."""
+
+    def __init__(self):
+        self.zdict = None
+
+    def configure(self, negotiate_result: dict):
+        self.zdict = ZDICTS.get(negotiate_result.get("zdict"))
+
+    def decode(self, line: str) -> str:
+        if not line.startswith(PREFIX):
+            return line
+        try:
+            raw = base64.b64decode(line[len(PREFIX):])
+            d = zlib.decompressobj(-15, zdict=self.zdict) if self.zdict else zlib.decompressobj(-15)
+            return (d.decompress(raw) + d.flush()).decode("utf-8")
+        except zlib.error as e:
+            raise ValueError(f"bad compressed frame: {e}")
+
+
+def _fmt_ms(ms) -> str:
+    # Epoch ms (xem server/history_format.py) -> giờ địa phương của máy client
+    return datetime.fromtimestamp(ms / 1000).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def expand_history(payload: dict) -> list:
+    """Chuyển payload room_history/dm_history (dạng rows hoặc columnar) thành list dict tin nhắn."""
+    if payload.get("format") != "columnar":
+        return payload.get("messages", [])
+    names = payload.get("sender_names") or {}
+    msgs = [
+        {"id": i, "sender_id": s, "sender_name": names.get(str(s), s), "content": c, "sent_at": _fmt_ms(t)}
+        for i, s, c, t in zip(payload.get("ids", []), payload.get("sender_ids", []),
+                              payload.get("contents", []), payload.get("sent_at_ms", []))
+    ]
+    # Tệp đính kèm: {id: meta} (khóa JSON là chuỗi)
+    files = payload.get("attachments") or {}
+    for m in msgs:
+        meta = files.get(str(m["id"]))
+        if meta:
+            m["attachment"] = meta
+    return msgs
@@ -0,0 +1,212 @@
+"""Kênh quản trị nội bộ: TCP chỉ trên loopback, JSON theo dòng, mọi lệnh phải kèm token.
+
+Request: {"cmd": "...", "token": "...", ...tham số}  ->  Reply: {"ok": true/false, ...}
+Token lấy từ ADMIN_TOKEN, hoặc server tự sinh và ghi vào ADMIN_TOKEN_FILE (quyền 0600)
+để chỉ người có quyền đọc file trên máy chủ mới gọi được.
+
+Module khác thêm lệnh bằng decorator @command("tên"); hàm nhận dict request, trả dict reply.
+Kênh chạy trên thread riêng, không đụng vào luồng xử lý client.
+
+Dùng từ dòng lệnh (trên máy chạy server):
+    python admin.py ping
+    python admin.py profile_start '{"duration": 30}'
+    python admin.py log_level '{"level": "debug"}'
+"""
+import hmac
+import ipaddress
+import json
+import os
+import secrets
+import socket
+import sys
+import threading
+
+import log
+import metrics
+from config import ADMIN_HOST, ADMIN_PORT, ADMIN_TOKEN, ADMIN_TOKEN_FILE, PROFILE_INTERVAL_MS
+from profiler import profiler
+
+COMMANDS = {}
+
+
+def command(name: str):
+    def register(fn):
+        COMMANDS[name] = fn
+        return fn
+    return register
+
+
+# ------------------ Lệnh ------------------
+@command("help")
+def _help(request):
+    return {"ok": True, "commands": sorted(COMMANDS)}
+
+
+@command("ping")
+def _ping(request):
+    return {"ok": True, "pong": True}
+
+
+@command("metrics")
+def _metrics(request):
+    return {"ok": True, "metrics": metrics.snapshot()}
+
+
+@command("log_level")
+def _log_level(request):
+    level = request.get("level")
+    if level is not None and not log.set_level(level):
+        return {"ok": False, "error": "invalid_level", "levels": list(log.LEVELS)}
+    return {"ok": True, "level": log.get_level()}
+
+
+@command("profile_start")
+def _profile_start(request):
+    return profiler.start(request.get("duration", 30), request.get("interval_ms", PROFILE_INTERVAL_MS))
+
+
+@command("profile_stop")
+def _profile_stop(request):
+    return profiler.stop()
+
+
+@command("profile_status")
+def _profile_status(request):
+    return {"ok": True, **profiler.status()}
+
+
+# ------------------ Server ------------------
+def _load_token() -> str:
+    if ADMIN_TOKEN:
+        return ADMIN_TOKEN
+    token = secrets.token_hex(16)
+    os.makedirs(os.path.dirname(ADMIN_TOKEN_FILE) or ".", mode=0o700, exist_ok=True)
+    fd = os.open(ADMIN_TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    return token
+
+
+def _handle(sock, token):
+    sock.settimeout(60)
+    buffer = b""
+    try:
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return
+            buffer += chunk
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                if not line.strip():
+                    continue
+                reply = _dispatch(line, token)
+                sock.sendall((json.dumps(reply, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
+    except (OSError, socket.timeout):
+        pass
+    finally:
+        sock.close()
+
+
+def _dispatch(line: bytes, token: str) -> dict:
+    try:
+        request = json.loads(line)
+    except json.JSONDecodeError:
+        return {"ok": False, "error": "invalid_json"}
+    if not isinstance(request, dict):
+        return {"ok": False, "error": "invalid_json"}
+    if not hmac.compare_digest(str(request.get("token", "")), token):
+        log.warning("admin_auth_failed", cmd=request.get("cmd"))
+        return {"ok": False, "error": "unauthorized"}
+    name = request.get("cmd")
+    fn = COMMANDS.get(name)
+    if fn is None:
+        return {"ok": False, "error": "unknown_command", "commands": sorted(COMMANDS)}
+    log.info("admin_command", cmd=name)
+    try:
+        return fn(request)
+    except Exception as e:
+        log.error("admin_command_error", exc=e, cmd=name)
+        return {"ok": False, "error": str(e)}
+
+
+_listener = None
+
+
+def _serve(listener, token):
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except OSError as e:
+            if listener is not _listener:
+                return      # stop() đã đóng cổng
+            log.error("admin_accept_error", exc=e)
+            continue
+        threading.Thread(target=_handle, args=(sock, token), name="admin-conn", daemon=True).start()
+
+
+def start():
+    """Mở kênh quản trị (bỏ qua nếu ADMIN_PORT = 0 hoặc ADMIN_HOST không phải loopback)."""
+    global _listener
+    if ADMIN_PORT <= 0:
+        return None
+    try:
+        loopback = ipaddress.ip_address(ADMIN_HOST).is_loopback
+    except ValueError:
+        loopback = ADMIN_HOST == "localhost"
+    if not loopback:
+        log.error("admin_disabled", reason="ADMIN_HOST must be a loopback address", host=ADMIN_HOST)
+        return None
+    try:
+        token = _load_token()
+        listener = socket.socket(socket.AF_INET6 if ":" in ADMIN_HOST else socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((ADMIN_HOST, ADMIN_PORT))
+        listener.listen(8)
+    except OSError as e:
+        log.error("admin_start_error", exc=e)
+        return None
+    _listener = listener
+    threading.Thread(target=_serve, args=(listener, token), name="admin", daemon=True).start()
+    log.info("admin_started", host=ADMIN_HOST, port=ADMIN_PORT)
+    return listener
+
+
+def stop():
+    """Nhả cổng quản trị (process mới khi restart cần bind lại); các phiên admin đang mở vẫn chạy tiếp."""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        try:
+            listener.shutdown(socket.SHUT_RDWR)     # đánh thức accept() đang chờ, nếu không cổng chưa được nhả
+        except OSError:
+            pass
+        try:
+            listener.close()
+        except OSError:
+            pass
+
+
+# ------------------ Client dòng lệnh ------------------
+def call(cmd: str, **params) -> dict:
+    token = ADMIN_TOKEN
+    if not token:
+        with open(ADMIN_TOKEN_FILE, encoding="utf-8") as f:
+            token = f.read().strip()
+    with socket.create_connection((ADMIN_HOST, ADMIN_PORT), timeout=30) as sock:
+        sock.sendall((json.dumps({"cmd": cmd, "token": token, **params}) + "\n").encode("utf-8"))
+        buffer = b""
+        while b"\n" not in buffer:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            buffer += chunk
+    return json.loads(buffer.split(b"\n", 1)[0])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    params = json.loads(sys.argv[2]) if len(sys.argv) > 2 else {}
+    print(json.dumps(call(sys.argv[1], **params), indent=1, ensure_ascii=False))
@@ -0,0 +1,723 @@
+"""Phân vùng bảng messages theo tháng + lưu trữ lạnh (archive) ra file nén trên đĩa.
+
+Phân vùng: RANGE theo id (PRIMARY KEY giữ nguyên là id). Mỗi partition "pYYYYMM" chứa tin
+của 1 tháng, ranh giới = id đầu tiên của tháng sau; "pmax" nhận tin mới. Đầu mỗi tháng job
+tách các tin của tháng trước khỏi pmax thành partition riêng. Vì id tăng theo thời gian, cursor
+after_id/before_id của lịch sử trùng khớp với ranh giới partition.
+
+Archive: partition cũ hơn ARCHIVE_AFTER_MONTHS tháng được ghi ra ARCHIVE_DIR/messages-YYYYMM.jsonl.gz
+(mỗi dòng 1 tin, ghi 1 lần rồi không sửa), ghi vào manifest.json, rồi DROP PARTITION.
+Trong file, tin được gom theo hội thoại, mỗi hội thoại là 1 gzip member riêng (cả file vẫn là 1 .jsonl.gz hợp lệ);
+messages-YYYYMM.idx.json ghi vị trí (offset, độ dài) của từng hội thoại -> đọc 1 trang lịch sử chỉ giải nén đúng
+phần của hội thoại đó. File archive kiểu cũ (theo id, chưa có index) được job ghi lại dần, mỗi lượt 1 file.
+Tệp đính kèm đi theo tin vào archive ("attachment" trong dòng); messages-YYYYMM.files.json ghi sha256 -> các
+hội thoại có nó (quyền tải tệp của tin đã archive, gc giữ blob). Dòng message_attachments của tin đã archive bị
+xóa khỏi DB (file cũ chưa mang tệp đính kèm: job ghi lại file, lấy tệp từ DB rồi mới xóa).
+Lịch sử (before_id / latest / after_id cũ) tự đọc tiếp từ archive khi cursor đi qua vùng đã archive.
+
+Chuyển bảng sang dạng phân vùng 1 lần: python archive.py partition [--drop-fks]
+(InnoDB không cho bảng có partition dùng khóa ngoại).
+"""
+import bisect
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+from config import ARCHIVE_DIR, ARCHIVE_AFTER_MONTHS, ARCHIVE_CHECK_INTERVAL
+from database import get_connection
+import directory
+import log
+
+MANIFEST = "manifest.json"
+_COLUMNS = ("id", "sender_id", "receiver_id", "room_id", "content", "sent_at")
+
+
+def conv_of(room_id, sender_id, receiver_id) -> str:
+    """Khóa hội thoại trong archive: "room:<id>" hoặc "dm:<nhỏ>-<lớn>"."""
+    if room_id is not None:
+        return f"room:{room_id}"
+    a, b = sorted((sender_id, receiver_id))
+    return f"dm:{a}-{b}"
+
+
+def _month_index(name: str) -> int:
+    """"p202510" -> 2025 * 12 + 9; partition không theo tháng -> -1."""
+    if len(name) != 7 or not name[1:].isdigit():
+        return -1
+    return int(name[1:5]) * 12 + int(name[5:7]) - 1
+
+
+def _month_name(index: int) -> str:
+    return f"p{index // 12:04d}{index % 12 + 1:02d}"
+
+
+def _now_month() -> int:
+    now = datetime.now()
+    return now.year * 12 + now.month - 1
+
+
+def _index_name(filename: str) -> str:
+    """"messages-202510.jsonl.gz" -> "messages-202510.idx.json"."""
+    return filename[:-len(".jsonl.gz")] + ".idx.json"
+
+
+def _files_name(filename: str) -> str:
+    """"messages-202510.jsonl.gz" -> "messages-202510.files.json"."""
+    return filename[:-len(".jsonl.gz")] + ".files.json"
+
+
+def _fsync_replace(tmp, path):
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class _SegmentWriter:
+    """Ghi tin (đã gom theo hội thoại, trong mỗi hội thoại theo id tăng) thành các gzip member + index."""
+
+    def __init__(self, f):
+        self.f = f
+        self.index = {}            # conv -> [offset, độ dài nén, số tin]
+        self.files = {}            # sha256 -> {conv...} (tin có tệp đính kèm)
+        self.rows = 0
+        self.min_id = None
+        self.max_id = None
+        self._conv = None
+        self._comp = None
+        self._start = 0
+        self._count = 0
+
+    def write(self, row):
+        conv = conv_of(row["room_id"], row["sender_id"], row["receiver_id"])
+        if conv != self._conv:
+            self._close_segment()
+            if conv in self.index:
+                raise ValueError(f"archive rows not grouped by conversation: {conv}")
+            self._conv, self._start, self._count = conv, self.f.tell(), 0
+            self._comp = zlib.compressobj(6, zlib.DEFLATED, 31)     # wbits 31 = định dạng gzip
+        self.f.write(self._comp.compress((json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")))
+        if row.get("attachment"):
+            self.files.setdefault(row["attachment"]["sha256"], set()).add(conv)
+        self._count += 1
+        self.rows += 1
+        self.min_id = row["id"] if self.min_id is None else min(self.min_id, row["id"])
+        self.max_id = row["id"] if self.max_id is None else max(self.max_id, row["id"])
+
+    def _close_segment(self):
+        if self._comp is not None:
+            self.f.write(self._comp.flush())
+            self.index[self._conv] = [self._start, self.f.tell() - self._start, self._count]
+            self._comp = None
+
+    def finish(self):
+        self._close_segment()
+
+
+def _write_json(path, obj):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+
+
+def _write_archive(path, rows) -> _SegmentWriter:
+    """Ghi file archive + index + files cạnh nó (tmp -> fsync -> replace; người đọc giữ khóa file, xem _segment)."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        writer = _SegmentWriter(f)
+        for row in rows:
+            writer.write(row)
+        writer.finish()
+    if writer.rows == 0:
+        os.remove(tmp)
+        return writer
+    idx_path, files_path = _index_name(path), _files_name(path)
+    _write_json(idx_path, writer.index)
+    _write_json(files_path, {sha: sorted(convs) for sha, convs in writer.files.items()})
+    _fsync_replace(tmp, path)
+    _fsync_replace(idx_path + ".tmp", idx_path)
+    _fsync_replace(files_path + ".tmp", files_path)
+    return writer
+
+
+def _close(cur, conn):
+    try:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+    except Exception:
+        pass
+
+
+# ------------------ Đọc archive ------------------
+class ArchiveStore:
+    """Đọc các file archive theo hội thoại; giữ các đoạn (tháng, hội thoại) đã giải nén gần nhất trong RAM (LRU)."""
+
+    def __init__(self, base_dir=ARCHIVE_DIR, cache_segments=512):
+        self.base_dir = base_dir
+        self.cache_segments = cache_segments
+        self._lock = threading.Lock()
+        self._segments = OrderedDict()   # (file, conv) -> ([id...], [row...]) theo id tăng
+        self._indexes = {}               # file -> {conv: [offset, độ dài, số tin]}
+        self._files = {}                 # file -> {sha256: [conv...]}
+        self._file_locks = {}            # file -> khóa: nhiều request cùng trượt cache chỉ đọc đĩa 1 lần
+        self.entries = []                # manifest, sắp theo max_id tăng
+        self.reads = 0
+        self.loads = 0
+        self.legacy_loads = 0
+        self.reload()
+
+    def reload(self):
+        path = os.path.join(self.base_dir, MANIFEST)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries = []
+        except Exception as e:
+            log.error("archive_manifest_error", exc=e)
+            entries = []
+        with self._lock:
+            self.entries = sorted(entries, key=lambda e: e["max_id"])
+            # File được ghi lại (vd. thêm index) thì đoạn cũ trong cache không còn khớp offset
+            self._indexes.clear()
+            self._files.clear()
+            self._segments.clear()
+
+    @property
+    def max_id(self) -> int:
+        """Mọi tin có id <= max_id đã nằm trong archive (0 = chưa archive gì)."""
+        return self.entries[-1]["max_id"] if self.entries else 0
+
+    def _file_lock(self, key) -> threading.Lock:
+        with self._lock:
+            lock = self._file_locks.get(key)
+            if lock is None:
+                lock = self._file_locks[key] = threading.Lock()
+            return lock
+
+    def forget(self, key, conv=None):
+        """File vừa được ghi lại (gọi khi giữ khóa file): offset cũ không còn đúng -> bỏ index khỏi cache,
+        cùng đoạn của `conv` (đoạn của hội thoại khác vẫn đúng nội dung) hoặc mọi đoạn của file."""
+        with self._lock:
+            self._indexes.pop(key, None)
+            self._files.pop(key, None)
+            for k in [k for k in self._segments if k[0] == key and (conv is None or k[1] == conv)]:
+                del self._segments[k]
+
+    def _cached(self, key, conv):
+        with self._lock:
+            seg = self._segments.get((key, conv))
+            if seg is not None:
+                self._segments.move_to_end((key, conv))
+            return seg
+
+    def _put(self, key, conv, seg):
+        with self._lock:
+            self._segments[(key, conv)] = seg
+            while len(self._segments) > self.cache_segments:
+                self._segments.popitem(last=False)
+
+    def _segment(self, entry, conv):
+        """([id...], [row...]) của `conv` trong 1 file archive."""
+        key = entry["file"]
+        seg = self._cached(key, conv)
+        if seg is not None:
+            return seg
+        with self._file_lock(key):
+            seg = self._cached(key, conv)          # request khác vừa nạp xong trong lúc chờ khóa
+            if seg is not None:
+                return seg
+            if not entry.get("index"):
+                return self._load_legacy(entry, conv)
+            index = self._indexes.get(key)
+            if index is None:
+                with open(os.path.join(self.base_dir, entry["index"]), encoding="utf-8") as f:
+                    index = self._indexes[key] = json.load(f)
+            pos = index.get(conv)
+            if pos is None:
+                seg = ((), ())
+            else:
+                with open(os.path.join(self.base_dir, key), "rb") as f:
+                    f.seek(pos[0])
+                    data = f.read(pos[1])
+                rows = [json.loads(line) for line in gzip.decompress(data).decode("utf-8").splitlines()]
+                seg = ([r["id"] for r in rows], rows)
+                self.loads += 1
+            self._put(key, conv, seg)
+            return seg
+
+    def _load_legacy(self, entry, conv):
+        """File kiểu cũ (theo id, không index): giải nén cả tháng 1 lần, cache mọi hội thoại của nó."""
+        key = entry["file"]
+        month = {}
+        with gzip.open(os.path.join(self.base_dir, key), "rt", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                ids, rows = month.setdefault(conv_of(row["room_id"], row["sender_id"], row["receiver_id"]), ([], []))
+                ids.append(row["id"])
+                rows.append(row)
+        self.legacy_loads += 1
+        for c, seg in month.items():
+            self._put(key, c, seg)
+        seg = month.get(conv, ((), ()))
+        self._put(key, conv, seg)
+        return seg
+
+    def before(self, conv: str, before_id: int, limit: int) -> list:
+        """Tối đa `limit` tin cũ nhất-gần before_id (id < before_id), trả về theo id tăng."""
+        self.reads += 1
+        out = []
+        for entry in reversed(self.entries):
+            if entry["min_id"] >= before_id:
+                continue
+            ids, rows = self._segment(entry, conv)
+            i = bisect.bisect_left(ids, before_id)
+            take = list(rows[max(0, i - (limit - len(out))):i])
+            out = take + out
+            if len(out) >= limit:
+                break
+        return out
+
+    def after(self, conv: str, after_id: int, limit: int) -> list:
+        """Tối đa `limit` tin có id > after_id, theo id tăng."""
+        self.reads += 1
+        out = []
+        for entry in self.entries:
+            if entry["max_id"] <= after_id:
+                continue
+            ids, rows = self._segment(entry, conv)
+            i = bisect.bisect_right(ids, after_id)
+            out.extend(rows[i:i + limit - len(out)])
+            if len(out) >= limit:
+                break
+        return out
+
+    def attachments(self, conv: str, ids) -> dict:
+        """{id: meta} cho các tin đã archive của `conv` trong `ids` có tệp đính kèm."""
+        out = {}
+        entries = self.entries
+        max_ids = [e["max_id"] for e in entries]
+        for mid in ids:
+            i = bisect.bisect_left(max_ids, mid) if mid is not None else len(entries)
+            if i == len(entries) or entries[i]["min_id"] > mid:
+                continue
+            seg_ids, rows = self._segment(entries[i], conv)
+            j = bisect.bisect_left(seg_ids, mid)
+            if j < len(seg_ids) and seg_ids[j] == mid and rows[j].get("attachment"):
+                out[mid] = rows[j]["attachment"]
+        return out
+
+    def _blob_index(self, entry) -> dict:
+        key = entry["file"]
+        if not entry.get("files"):
+            return {}
+        with self._lock:
+            found = self._files.get(key)
+        if found is None:
+            with open(os.path.join(self.base_dir, entry["files"]), encoding="utf-8") as f:
+                found = json.load(f)
+            with self._lock:
+                self._files[key] = found
+        return found
+
+    def blob_conversations(self, sha: str) -> set:
+        """Các hội thoại có tin (đã archive) đính kèm blob `sha`."""
+        out = set()
+        for entry in list(self.entries):
+            out.update(self._blob_index(entry).get(sha, ()))
+        return out
+
+    def blob_refs(self) -> set:
+        """Mọi sha256 còn được tin trong archive tham chiếu (gc không được xóa)."""
+        out = set()
+        for entry in list(self.entries):
+            out.update(self._blob_index(entry))
+        return out
+
+    def report(self) -> dict:
+        return {
+            "files": len(self.entries),
+            "max_id": self.max_id,
+            "rows": sum(e.get("rows", 0) for e in self.entries),
+            "reads": self.reads,
+            "segment_loads": self.loads,
+            "legacy_month_loads": self.legacy_loads,
+            "cached_segments": len(self._segments),
+            "unindexed_files": len([e for e in self.entries if not e.get("index")]),
+        }
+
+
+store = ArchiveStore()
+
+
+def history_rows(conv, page, after_id, order, rows, limit, room=True, not_before=None):
+    """Đọc tiếp từ archive cho 1 trang lịch sử đã lấy từ DB (rows theo id tăng).
+
+    - Trang cũ hơn / mới nhất (DESC) chưa đủ `limit`: DB đã hết tin cũ hơn -> lấy phần còn lại từ archive.
+    - Delta after_id nằm trong vùng đã archive: tin trong archive đứng trước tin trong DB.
+    - not_before ("YYYY-MM-DD HH:MM:SS", chính sách lưu giữ của phòng): bỏ tin gửi trước mốc này
+      (hết hạn nhưng job retention chưa kịp xóa khỏi file, xem Archiver.purge).
+    Trả về cùng dạng tuple với truy vấn DB: room (id, sender_id, display_name, content, ts) /
+    dm (id, sender_id, receiver_id, content, sent_at).
+    """
+    if not store.entries:
+        return rows
+    if order == "DESC":
+        if len(rows) >= limit:
+            return rows
+        cursor = rows[0][0] if rows else (page.get("before_id") or store.max_id + 1)
+        extra = store.before(conv, min(cursor, store.max_id + 1), limit - len(rows))
+    else:
+        if after_id >= store.max_id:
+            return rows
+        extra = store.after(conv, after_id, limit)
+    if not_before:
+        # Tin theo id tăng = theo thời gian: phần hết hạn luôn nằm ở đầu
+        extra = [r for r in extra if r["sent_at"] >= not_before]
+    if not extra:
+        return rows
+    names = directory.names({r["sender_id"] for r in extra}) if room else {}
+
+    def shape(r):
+        if room:
+            return (r["id"], r["sender_id"], names.get(r["sender_id"], f"User {r['sender_id']}"), r["content"],
+                    r["sent_at"])
+        return (r["id"], r["sender_id"], r["receiver_id"], r["content"], r["sent_at"])
+
+    return ([shape(r) for r in extra] + list(rows))[:limit]
+
+
+# ------------------ Job phân vùng + archive ------------------
+class Archiver:
+    """Chạy mỗi ARCHIVE_CHECK_INTERVAL giây: tách partition tháng mới, archive partition quá cũ."""
+
+    def __init__(self, after_months=ARCHIVE_AFTER_MONTHS, interval=ARCHIVE_CHECK_INTERVAL, archive_store=store):
+        self.after_months = after_months
+        self.interval = interval
+        self.store = archive_store
+        self.rollovers = 0
+        self.archived_partitions = 0
+        self.archived_rows = 0
+        self.last_run = None
+        self.last_error = None
+        self.on_archived = []          # callback(ids) sau khi DROP (dọn chỉ mục tìm kiếm...)
+        self._lock = threading.Lock()  # job archive và retention (purge) không cùng ghi manifest
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        threading.Thread(target=self._loop, name="archiver", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                log.error("archiver_error", exc=e)
+            time.sleep(self.interval)
+
+    @staticmethod
+    def partitions(cur) -> list:
+        """[(tên, giới hạn LESS THAN)] của bảng messages; [] nếu bảng chưa phân vùng."""
+        cur.execute(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages' AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION"
+        )
+        return cur.fetchall()
+
+    def run_once(self):
+        with self._lock:
+            self._run_once()
+
+    def _run_once(self):
+        self.last_run = time.time()
+        conn = get_connection()
+        if not conn:
+            return
+        cur = None
+        try:
+            cur = conn.cursor()
+            try:
+                self._reindex_one(conn, cur)
+            except Exception as e:
+                self.last_error = str(e)
+                log.error("archive_reindex_error", exc=e)
+            parts = self.partitions(cur)
+            if not parts:
+                return   # chưa chuyển sang dạng phân vùng
+            self._rollover(cur, parts)
+            if self.after_months > 0:
+                cutoff = _now_month() - self.after_months
+                for name, _ in self.partitions(cur):
+                    month = _month_index(name)
+                    if 0 <= month <= cutoff:
+                        self._archive_partition(conn, cur, name)
+        finally:
+            _close(cur, conn)
+
+    def _rollover(self, cur, parts):
+        """pmax còn tin của tháng trước -> tách chúng ra partition riêng (tên theo tháng trước)."""
+        months = [_month_index(name) for name, _ in parts if _month_index(name) >= 0]
+        prev = _now_month() - 1
+        if months and max(months) >= prev:
+            return
+        now = datetime.now()
+        cur.execute(
+            "SELECT MAX(id) FROM messages PARTITION (pmax) WHERE sent_at < %s",
+            (datetime(now.year, now.month, 1),),
+        )
+        (last_old,) = cur.fetchone()
+        if last_old is None:
+            return
+        name = _month_name(prev)
+        cur.execute(
+            f"ALTER TABLE messages REORGANIZE PARTITION pmax INTO "
+            f"(PARTITION {name} VALUES LESS THAN ({int(last_old) + 1}), PARTITION pmax VALUES LESS THAN MAXVALUE)"
+        )
+        self.rollovers += 1
+        log.info("archive_partition_created", partition=name, last_id=int(last_old))
+
+    def _archive_partition(self, conn, cur, name):
+        filename = f"messages-{name[1:]}.jsonl.gz"
+        os.makedirs(self.store.base_dir, exist_ok=True)
+        path = os.path.join(self.store.base_dir, filename)
+        entry = next((e for e in self.store.entries if e["file"] == filename), None)
+        ids = []
+        if entry is None:
+            # Gom theo hội thoại (mỗi hội thoại 1 gzip member, xem đầu file), trong hội thoại theo id
+            cur.execute(
+                f"SELECT m.id, m.sender_id, m.receiver_id, m.room_id, m.content, m.sent_at, "
+                f"ma.sha256, ma.file_name, ma.size, ma.mime "
+                f"FROM messages PARTITION ({name}) m "
+                f"LEFT JOIN message_attachments ma ON ma.message_id = m.id "
+                f"ORDER BY m.room_id IS NULL, m.room_id, LEAST(m.sender_id, m.receiver_id), "
+                f"GREATEST(m.sender_id, m.receiver_id), m.id"
+            )
+
+            def rows():
+                while True:
+                    chunk = cur.fetchmany(5000)
+                    if not chunk:
+                        return
+                    for r in chunk:
+                        row = dict(zip(_COLUMNS, r))
+                        if r[len(_COLUMNS)]:
+                            row["attachment"] = dict(zip(("sha256", "name", "size", "mime"), r[len(_COLUMNS):]))
+                        t = row["sent_at"]
+                        row["sent_at"] = t.isoformat(sep=" ") if hasattr(t, "isoformat") else str(t)
+                        ids.append(row["id"])
+                        yield row
+            written = _write_archive(path, rows())
+            if written.rows:
+                entry = {"partition": name, "file": filename, "index": _index_name(filename),
+                         "files": _files_name(filename), "rows": written.rows,
+                         "min_id": written.min_id, "max_id": written.max_id, "archived_at": int(time.time())}
+                self._write_manifest(self.store.entries + [entry])
+                self.store.reload()
+                self.archived_rows += written.rows
+        # File đã an toàn trên đĩa (hoặc partition rỗng) -> bỏ partition khỏi DB
+        cur.execute(f"ALTER TABLE messages DROP PARTITION {name}")
+        conn.commit()
+        self.archived_partitions += 1
+        for callback in self.on_archived:
+            try:
+                callback(ids)
+            except Exception as e:
+                log.error("archiver_callback_error", exc=e)
+        log.info("archive_partition_archived", partition=name, file=filename)
+
+    def _reindex_one(self, conn, cur):
+        """Ghi lại 1 file archive kiểu cũ (chưa gom theo hội thoại / chưa mang tệp đính kèm), cả tháng trong RAM 1 lần.
+
+        Tệp đính kèm lấy từ message_attachments (file = 1 partition = 1 khoảng id liền), ghi vào file rồi mới
+        xóa các dòng đó khỏi DB.
+        """
+        entry = next((e for e in self.store.entries if not e.get("index") or not e.get("files")), None)
+        if entry is None:
+            return
+        path = os.path.join(self.store.base_dir, entry["file"])
+        cur.execute("SELECT message_id, sha256, file_name, size, mime FROM message_attachments "
+                    "WHERE message_id BETWEEN %s AND %s", (entry["min_id"], entry["max_id"]))
+        found = {r[0]: dict(zip(("sha256", "name", "size", "mime"), r[1:])) for r in cur.fetchall()}
+        month = {}
+        # File đã có index vẫn đọc tuần tự được: các gzip member nối tiếp nhau
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                if row["id"] in found and not row.get("attachment"):
+                    row["attachment"] = found[row["id"]]
+                month.setdefault(conv_of(row["room_id"], row["sender_id"], row["receiver_id"]), []).append(row)
+        with self.store._file_lock(entry["file"]):
+            written = _write_archive(path, (row for rows in month.values()
+                                            for row in sorted(rows, key=lambda r: r["id"])))
+            self.store.forget(entry["file"])
+        updated = dict(entry, index=_index_name(entry["file"]), files=_files_name(entry["file"]))
+        self._write_manifest([updated if e is entry else e for e in self.store.entries])
+        self.store.reload()
+        ids = sorted(found)
+        for i in range(0, len(ids), 1000):
+            chunk = ids[i:i + 1000]
+            cur.execute(f"DELETE FROM message_attachments WHERE message_id IN ({', '.join(['%s'] * len(chunk))})",
+                        tuple(chunk))
+        conn.commit()
+        log.info("archive_reindexed", file=entry["file"], rows=written.rows, conversations=len(month),
+                 attachments=len(found))
+
+    def purge(self, conv, not_before) -> int:
+        """Xóa khỏi archive các tin của `conv` gửi trước not_before ("YYYY-MM-DD HH:MM:SS"); trả về số tin đã xóa.
+
+        Chỉ ghi lại đoạn của hội thoại đó: các gzip member khác được chép nguyên byte sang file mới.
+        File kiểu cũ (chưa có index) bỏ qua tới khi _reindex_one ghi lại; trong lúc đó history_rows lọc khi đọc.
+        """
+        cutoff_month = _month_index(f"p{not_before[:4]}{not_before[5:7]}")
+        removed = 0
+        with self._lock:
+            entries = list(self.store.entries)
+            changed = {}
+            for entry in entries:
+                if not entry.get("index") or _month_index(entry.get("partition", "")) > cutoff_month:
+                    continue
+                n = self._purge_file(entry, conv, not_before)
+                if n:
+                    changed[entry["file"]] = dict(entry, rows=entry["rows"] - n)
+                    removed += n
+            if changed:
+                self._write_manifest([changed.get(e["file"], e) for e in entries])
+                self.store.reload()
+        if removed:
+            log.info("archive_purged", conv=conv, rows=removed, not_before=not_before)
+        return removed
+
+    def _purge_file(self, entry, conv, not_before) -> int:
+        key = entry["file"]
+        path = os.path.join(self.store.base_dir, key)
+        idx_path = os.path.join(self.store.base_dir, entry["index"])
+        with self.store._file_lock(key):
+            with open(idx_path, encoding="utf-8") as f:
+                index = json.load(f)
+            pos = index.get(conv)
+            if pos is None:
+                return 0
+            with open(path, "rb") as src:
+                src.seek(pos[0])
+                rows = [json.loads(line) for line in gzip.decompress(src.read(pos[1])).decode("utf-8").splitlines()]
+                keep = [r for r in rows if r["sent_at"] >= not_before]
+                if len(keep) == len(rows):
+                    return 0
+                new_index = {}
+                with open(path + ".tmp", "wb") as dst:
+                    for c, (offset, length, count) in sorted(index.items(), key=lambda kv: kv[1][0]):
+                        if c != conv:
+                            src.seek(offset)
+                            new_index[c] = [dst.tell(), length, count]
+                            dst.write(src.read(length))
+                        elif keep:
+                            writer = _SegmentWriter(dst)
+                            for row in keep:
+                                writer.write(row)
+                            writer.finish()
+                            new_index[c] = writer.index[c]
+            files = None
+            if entry.get("files"):
+                # Blob chỉ còn được tin đã xóa của hội thoại này tham chiếu -> bỏ conv khỏi danh sách của blob
+                files_path = os.path.join(self.store.base_dir, entry["files"])
+                with open(files_path, encoding="utf-8") as f:
+                    files = json.load(f)
+                kept = {r["attachment"]["sha256"] for r in keep if r.get("attachment")}
+                for sha in {r["attachment"]["sha256"] for r in rows if r.get("attachment")} - kept:
+                    convs = [c for c in files.get(sha, ()) if c != conv]
+                    if convs:
+                        files[sha] = convs
+                    else:
+                        files.pop(sha, None)
+                _write_json(files_path, files)
+            _write_json(idx_path, new_index)
+            _fsync_replace(path + ".tmp", path)
+            _fsync_replace(idx_path + ".tmp", idx_path)
+            if files is not None:
+                _fsync_replace(files_path + ".tmp", files_path)
+            self.store.forget(key, conv)
+        return len(rows) - len(keep)
+
+    def _write_manifest(self, entries):
+        path = os.path.join(self.store.base_dir, MANIFEST)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(sorted(entries, key=lambda e: e["max_id"]), f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def report(self) -> dict:
+        return {
+            "rollovers": self.rollovers,
+            "archived_partitions": self.archived_partitions,
+            "archived_rows": self.archived_rows,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+            "store": self.store.report(),
+        }
+
+
+archiver = Archiver()
+
+
+def partition_table(drop_fks=False):
+    """Chuyển messages sang RANGE(id) theo tháng từ dữ liệu hiện có (chạy 1 lần, có thể lâu)."""
+    conn = get_connection()
+    if not conn:
+        print("partition: không kết nối được DB")
+        return
+    cur = conn.cursor()
+    try:
+        if Archiver.partitions(cur):
+            print("partition: bảng messages đã được phân vùng")
+            return
+        cur.execute(
+            "SELECT CONSTRAINT_NAME FROM information_schema.TABLE_CONSTRAINTS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages' AND CONSTRAINT_TYPE = 'FOREIGN KEY'"
+        )
+        fks = [r[0] for r in cur.fetchall()]
+        if fks and not drop_fks:
+            print("partition: messages có khóa ngoại", fks, "- chạy lại với --drop-fks để bỏ")
+            return
+        for fk in fks:
+            cur.execute(f"ALTER TABLE messages DROP FOREIGN KEY `{fk}`")
+        cur.execute(
+            "SELECT YEAR(sent_at) * 12 + MONTH(sent_at) - 1 AS m, MIN(id) FROM messages "
+            "GROUP BY m ORDER BY m"
+        )
+        months = cur.fetchall()
+        current = _now_month()
+        parts = []
+        # Partition của tháng m kết thúc ở id đầu tiên của tháng kế tiếp; tháng hiện tại nằm trong pmax
+        for (m, _), (_, next_min) in zip(months, months[1:]):
+            if m < current:
+                parts.append(f"PARTITION {_month_name(m)} VALUES LESS THAN ({int(next_min)})")
+        parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        cur.execute(f"ALTER TABLE messages PARTITION BY RANGE (id) ({', '.join(parts)})")
+        conn.commit()
+        print(f"partition: đã tạo {len(parts)} partition")
+    finally:
+        _close(cur, conn)
+
+
+# python archive.py partition [--drop-fks]  -> chuyển bảng sang phân vùng theo tháng
+# python archive.py run                     -> chạy job archive 1 lần
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ["partition"]:
+        partition_table(drop_fks="--drop-fks" in sys.argv)
+    elif sys.argv[1:2] == ["run"]:
+        archiver.run_once()
+        print(json.dumps(archiver.report(), indent=1))
+    else:
+        print(__doc__)
@@ -0,0 +1,555 @@
+"""Tệp đính kèm: kho blob theo nội dung (sha256) + kênh truyền riêng, tách khỏi socket chat.
+
+Kho (ATTACH_DIR): blob nằm ở ab/cd/<sha256>, ghi 1 lần rồi không sửa; 2 người gửi cùng 1 tệp
+chỉ tốn 1 bản (dedup). Upload dở nằm ở tmp/<sha256>-<user_id>.part. Ai đã upload xong blob nào được ghi
+ở owners/ab/<sha256>/<user_id>: biết sha256 thôi thì không đính kèm / xác nhận được blob của người khác.
+
+Luồng upload:
+1. Kênh chat: {"action": "attach_begin", "sha256", "size", "name"} -> nếu blob đã có và user đã upload nó
+   hoặc thấy được tin có nó thì xong ngay ("exists": true), ngược lại trả "offset" (số byte đã nhận từ lần
+   trước) + vé "put": user phải gửi đủ byte, server kiểm tra hash rồi bỏ bản trùng, chỉ ghi nhận người upload.
+2. Kênh truyền (ATTACH_PORT): mỗi chunk là 1 dòng JSON {"op": "put", "ticket", "offset", "length"}
+   rồi đúng `length` byte thô; server trả {"ok", "offset"}. Mất kết nối thì attach_begin lại và
+   gửi tiếp từ "offset". Chunk cuối: server kiểm tra sha256 rồi chuyển vào kho ("complete": true).
+3. Gửi tin bình thường kèm "attachment": {"sha256", "name", "mime"}.
+
+Tải về: {"action": "attach_ticket", "sha256"} -> vé "get" (chỉ cấp cho người thấy được tin có tệp
+đó); kênh truyền: {"op": "get", "ticket", "offset", "length"} -> 1 dòng JSON rồi dữ liệu, gửi bằng
+sendfile (không copy qua Python). offset/length = range, client tải tiếp phần còn thiếu.
+
+Dọn kho: python attachments.py gc (blob không còn tin nào tham chiếu - trong DB lẫn archive - và upload dở
+quá ATTACH_PART_TTL).
+"""
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import re
+import secrets
+import shutil
+import socket
+import threading
+import time
+
+import log
+import statements
+from config import (ATTACH_DIR, ATTACH_HOST, ATTACH_PORT, ATTACH_MAX_BYTES, ATTACH_CHUNK, ATTACH_MAX_TRANSFERS,
+                    ATTACH_SECRET, ATTACH_TICKET_TTL, ATTACH_PART_TTL, SOCKET_TIMEOUT)
+
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+_IO_CHUNK = 256 * 1024
+_MAX_HEADER = 4096
+
+
+def valid_sha(value) -> bool:
+    return isinstance(value, str) and _SHA256.match(value) is not None
+
+
+# ------------------ Kho blob ------------------
+class BlobStore:
+    def __init__(self, root=ATTACH_DIR):
+        self.root = root
+        self.tmp = os.path.join(root, "tmp")
+        self._part_locks = {}
+        self._locks_lock = threading.Lock()
+
+    def path(self, sha: str) -> str:
+        return os.path.join(self.root, sha[:2], sha[2:4], sha)
+
+    def exists(self, sha: str) -> bool:
+        return valid_sha(sha) and os.path.isfile(self.path(sha))
+
+    def size(self, sha: str) -> int:
+        return os.path.getsize(self.path(sha))
+
+    def owner_path(self, sha: str, user_id: int) -> str:
+        return os.path.join(self.root, "owners", sha[:2], sha, str(int(user_id)))
+
+    def uploaded_by(self, sha: str, user_id: int) -> bool:
+        return valid_sha(sha) and os.path.exists(self.owner_path(sha, user_id))
+
+    def add_uploader(self, sha: str, user_id: int):
+        path = self.owner_path(sha, user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "a").close()
+
+    def remove(self, sha: str):
+        """Xóa blob cùng danh sách người đã upload nó (gc)."""
+        os.remove(self.path(sha))
+        shutil.rmtree(os.path.dirname(self.owner_path(sha, 0)), ignore_errors=True)
+
+    def part_path(self, sha: str, user_id: int) -> str:
+        return os.path.join(self.tmp, f"{sha}-{int(user_id)}.part")
+
+    def part_size(self, sha: str, user_id: int) -> int:
+        try:
+            return os.path.getsize(self.part_path(sha, user_id))
+        except OSError:
+            return 0
+
+    def part_lock(self, sha: str, user_id: int) -> threading.Lock:
+        """1 khóa cho mỗi upload dở: 2 kết nối cùng ghi 1 tệp .part không được xen kẽ."""
+        key = (sha, user_id)
+        with self._locks_lock:
+            lock = self._part_locks.get(key)
+            if lock is None:
+                lock = self._part_locks[key] = threading.Lock()
+            return lock
+
+    def release_lock(self, sha: str, user_id: int):
+        with self._locks_lock:
+            self._part_locks.pop((sha, user_id), None)
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        """sha256 của cả tệp, đọc qua mmap (không nạp tệp lớn vào RAM)."""
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    h.update(mm)
+        return h.hexdigest()
+
+    def commit(self, part: str, sha: str):
+        """Chuyển upload đã đủ + đúng hash vào kho (os.replace: nguyên tử, người đọc không thấy tệp dở)."""
+        dest = self.path(sha)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.exists(dest):
+            os.remove(part)        # người khác vừa upload xong cùng nội dung
+        else:
+            os.replace(part, dest)
+
+    def blobs(self):
+        """(sha256, đường dẫn) của mọi blob trong kho."""
+        for top in os.listdir(self.root) if os.path.isdir(self.root) else ():
+            if len(top) != 2:
+                continue
+            for mid in os.listdir(os.path.join(self.root, top)):
+                folder = os.path.join(self.root, top, mid)
+                for name in os.listdir(folder):
+                    if valid_sha(name):
+                        yield name, os.path.join(folder, name)
+
+
+store = BlobStore()
+
+
+# ------------------ Vé truyền tệp ------------------
+_secret = (ATTACH_SECRET or secrets.token_hex(32)).encode()
+
+
+def _sign(text: str) -> str:
+    return hmac.new(_secret, text.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def issue_ticket(op: str, user_id: int, sha: str, size: int) -> str:
+    body = f"{op}.{int(user_id)}.{sha}.{int(size)}.{int(time.time()) + ATTACH_TICKET_TTL}"
+    return f"{body}.{_sign(body)}"
+
+
+def check_ticket(ticket, op: str):
+    """(user_id, sha256, size) nếu vé hợp lệ, còn hạn và đúng thao tác; ngược lại None."""
+    if not isinstance(ticket, str):
+        return None
+    body, _, sig = ticket.rpartition(".")
+    if not hmac.compare_digest(sig, _sign(body)):
+        return None
+    parts = body.split(".")
+    if len(parts) != 5 or parts[0] != op or not valid_sha(parts[2]):
+        return None
+    try:
+        user_id, size, expires = int(parts[1]), int(parts[3]), int(parts[4])
+    except ValueError:
+        return None
+    if expires < time.time():
+        return None
+    return user_id, parts[2], size
+
+
+# ------------------ Dùng trong handler ------------------
+def begin_upload(user_id: int, sha, size, can_see=None) -> dict:
+    """Phần dữ liệu của reply attach_begin.
+
+    can_see(): blob đã có trong kho nhưng user chưa upload nó -> user có thấy được tin đính kèm nó không
+    (truy vấn DB, chỉ gọi khi cần). Không thì coi như blob chưa có: không lộ cho người lạ là tệp tồn tại.
+    """
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        return {"ok": False, "error": "invalid_size"}
+    if not valid_sha(sha):
+        return {"ok": False, "error": "invalid_sha256"}
+    if size <= 0 or size > ATTACH_MAX_BYTES:
+        return {"ok": False, "error": "invalid_size", "max_bytes": ATTACH_MAX_BYTES}
+    if ATTACH_PORT <= 0:
+        return {"ok": False, "error": "attachments_disabled"}
+    if store.exists(sha) and (store.uploaded_by(sha, user_id) or (can_see is not None and can_see())):
+        if store.size(sha) != size:
+            return {"ok": False, "error": "size_mismatch"}
+        _stats.dedup_hits += 1
+        return {"ok": True, "sha256": sha, "exists": True}
+    return {
+        "ok": True,
+        "sha256": sha,
+        "exists": False,
+        "offset": min(store.part_size(sha, user_id), size),
+        "ticket": issue_ticket("put", user_id, sha, size),
+        "port": ATTACH_PORT,
+        "chunk": ATTACH_CHUNK,
+    }
+
+
+def download_ticket(user_id: int, sha: str) -> dict:
+    """Phần dữ liệu của reply attach_ticket (quyền tải đã được kiểm tra bằng can_download)."""
+    size = store.size(sha)
+    return {"ok": True, "size": size, "port": ATTACH_PORT, "ticket": issue_ticket("get", user_id, sha, size)}
+
+
+def attachment_meta(raw, user_id: int, conn):
+    """Kiểm tra "attachment" trong request gửi tin -> dict lưu vào DB / gửi cho người nhận.
+
+    None nếu tin không có tệp; ValueError nếu blob chưa được upload xong, hoặc người gửi chưa tự upload
+    blob đó và cũng không thấy được tin nào có nó (chỉ biết sha256 thì không được đính kèm).
+    """
+    if not raw:
+        return None
+    sha = raw.get("sha256") if isinstance(raw, dict) else None
+    if not store.exists(sha):
+        raise ValueError("attachment_missing")
+    if not store.uploaded_by(sha, user_id) and not can_download(conn, user_id, sha):
+        raise ValueError("attachment_missing")
+    name = os.path.basename(str(raw.get("name") or sha[:12]).replace("\\", "/"))[:255] or sha[:12]
+    mime = str(raw.get("mime") or "application/octet-stream")[:100]
+    return {"sha256": sha, "name": name, "size": store.size(sha), "mime": mime}
+
+
+def save(conn, message_id: int, meta: dict):
+    statements.execute(conn, "insert_attachment",
+                       (message_id, meta["sha256"], meta["name"], meta["size"], meta["mime"]))
+
+
+def lookup(conn, ids) -> dict:
+    """{message_id: meta} cho các tin trong `ids` có đính kèm (1 truy vấn IN theo id cho mỗi 1024 tin)."""
+    ids = sorted({i for i in ids if i is not None})
+    out = {}
+    step = statements.ID_LIST_SIZES[-1]
+    for start in range(0, len(ids), step):
+        name, params = statements.id_list_statement("attachments_for_ids", ids[start:start + step])
+        for mid, sha, file_name, size, mime in statements.fetch_all(conn, name, params):
+            out[mid] = {"sha256": sha, "name": file_name, "size": size, "mime": mime}
+    return out
+
+
+def can_download(conn, user_id: int, sha: str) -> bool:
+    """User thấy được 1 tin có blob `sha`: tin còn trong DB, hoặc tin đã archive (xem _archived_access)."""
+    return _live_access(conn, user_id, sha) or _archived_access(conn, user_id, sha)
+
+
+def _archived_access(conn, user_id: int, sha: str) -> bool:
+    """Tin đã archive không còn trong bảng messages: xét theo các hội thoại trong archive có blob đó."""
+    import archive
+    import directory
+    rooms = None
+    for conv in archive.store.blob_conversations(sha):
+        kind, _, ident = conv.partition(":")
+        if kind == "dm":
+            if str(user_id) in ident.split("-"):
+                return True
+            continue
+        if rooms is None:
+            rooms = directory.rooms(conn, user_id)
+        if int(ident) in rooms:
+            return True
+    return False
+
+
+def _live_access(conn, user_id: int, sha: str) -> bool:
+    import shards
+    if not shards.enabled:
+        return statements.fetch_one(conn, "attachment_access", (sha, user_id, user_id, user_id)) is not None
+    # Shard không có room_members: lấy phòng của user trước, hỏi mọi shard
+    import directory
+    rooms = sorted(directory.rooms(conn, user_id))
+    room_cond = f" OR m.room_id IN ({', '.join(['%s'] * len(rooms))})" if rooms else ""
+    sql = (f"SELECT 1 FROM message_attachments ma JOIN messages m ON m.id = ma.message_id "
+           f"WHERE ma.sha256 = %s AND (m.sender_id = %s OR m.receiver_id = %s{room_cond}) LIMIT 1")
+
+    def run(c):
+        cur = c.cursor()
+        try:
+            cur.execute(sql, (sha, user_id, user_id, *rooms))
+            return cur.fetchone() is not None
+        finally:
+            cur.close()
+    return any(shards.fan_in(run, conn))
+
+
+def on_delete(cur, ids):
+    """Tin bị xóa (retention) hoặc đã archive (tệp đính kèm đi theo tin vào file archive): bỏ tham chiếu trong DB;
+    blob không còn ai dùng được gc dọn sau."""
+    if ids:
+        cur.execute(
+            f"DELETE FROM message_attachments WHERE message_id IN ({', '.join(['%s'] * len(ids))})",
+            tuple(ids),
+        )
+
+
+# ------------------ Kênh truyền tệp ------------------
+class _Stats:
+    def __init__(self):
+        self.uploads = 0
+        self.downloads = 0
+        self.dedup_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.hash_mismatches = 0
+        self.rejected = 0
+
+
+_stats = _Stats()
+
+
+class TransferServer:
+    """TCP riêng cho dữ liệu tệp: mỗi kết nối 1 thread, truyền lớn không làm chậm tin chat."""
+
+    def __init__(self, blob_store=store):
+        self.store = blob_store
+        self._listener = None
+        self._slots = threading.BoundedSemaphore(ATTACH_MAX_TRANSFERS)
+        self._active = 0
+
+    def start(self):
+        if ATTACH_PORT <= 0 or self._listener is not None:
+            return None
+        try:
+            os.makedirs(self.store.tmp, exist_ok=True)
+            listener = socket.socket(socket.AF_INET6 if ":" in ATTACH_HOST else socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((ATTACH_HOST, ATTACH_PORT))
+            listener.listen(32)
+        except OSError as e:
+            log.error("attach_start_error", exc=e)
+            return None
+        self._listener = listener
+        threading.Thread(target=self._serve, args=(listener,), name="attach", daemon=True).start()
+        log.info("attach_started", host=ATTACH_HOST, port=ATTACH_PORT, dir=self.store.root)
+        return listener
+
+    def stop(self):
+        """Nhả cổng (restart: process mới bind lại); các lượt truyền đang chạy vẫn tiếp tục."""
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            try:
+                listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                listener.close()
+            except OSError:
+                pass
+
+    def _serve(self, listener):
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except OSError as e:
+                if listener is not self._listener:
+                    return
+                log.error("attach_accept_error", exc=e)
+                time.sleep(0.1)
+                continue
+            if not self._slots.acquire(blocking=False):
+                _stats.rejected += 1
+                self._reply_and_close(sock, {"ok": False, "error": "busy"})
+                continue
+            threading.Thread(target=self._handle, args=(sock, addr), name="attach-conn", daemon=True).start()
+
+    @staticmethod
+    def _reply(sock, obj):
+        sock.sendall((json.dumps(obj) + "\n").encode("utf-8"))
+
+    def _reply_and_close(self, sock, obj):
+        try:
+            self._reply(sock, obj)
+        except OSError:
+            pass
+        sock.close()
+
+    def _handle(self, sock, addr):
+        self._active += 1
+        try:
+            sock.settimeout(SOCKET_TIMEOUT)
+            reader = sock.makefile("rb")
+            while True:
+                line = reader.readline(_MAX_HEADER)
+                if not line:
+                    return
+                if not line.strip():
+                    continue
+                try:
+                    header = json.loads(line)
+                    op = header.get("op")
+                except (ValueError, AttributeError):
+                    self._reply(sock, {"ok": False, "error": "invalid_json"})
+                    return
+                ticket = check_ticket(header.get("ticket"), op)
+                if ticket is None:
+                    self._reply(sock, {"ok": False, "error": "invalid_ticket"})
+                    return
+                if op == "put":
+                    keep = self._put(sock, reader, ticket, header)
+                else:
+                    keep = self._get(sock, ticket, header)
+                if not keep:
+                    return
+        except (OSError, ValueError) as e:
+            log.debug("attach_connection_error", exc=e, peer=str(addr))
+        except Exception as e:
+            log.error("attach_handler_error", exc=e, peer=str(addr))
+        finally:
+            self._active -= 1
+            self._slots.release()
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def _put(self, sock, reader, ticket, header) -> bool:
+        """Nhận 1 chunk; False = đóng kết nối (dữ liệu còn lại của chunk không đọc được nữa)."""
+        user_id, sha, size = ticket
+        offset, length = int(header.get("offset", -1)), int(header.get("length", -1))
+        if offset < 0 or length < 0 or offset + length > size:
+            self._reply(sock, {"ok": False, "error": "bad_range"})
+            return False
+        with self.store.part_lock(sha, user_id):
+            if self.store.uploaded_by(sha, user_id):
+                # Kết nối khác của chính user này vừa upload xong
+                self._reply(sock, {"ok": True, "offset": size, "complete": True})
+                return False
+            part = self.store.part_path(sha, user_id)
+            current = self.store.part_size(sha, user_id)
+            if offset != current:
+                self._reply(sock, {"ok": False, "error": "offset_mismatch", "offset": current})
+                return False
+            with open(part, "ab") as f:
+                remaining = length
+                while remaining:
+                    data = reader.read(min(_IO_CHUNK, remaining))
+                    if not data:
+                        raise ConnectionError("upload interrupted")
+                    f.write(data)
+                    remaining -= len(data)
+                    _stats.bytes_in += len(data)
+            current += length
+            if current < size:
+                self._reply(sock, {"ok": True, "offset": current})
+                return True
+            digest = self.store.hash_file(part)
+            if digest != sha:
+                os.remove(part)
+                self.store.release_lock(sha, user_id)
+                _stats.hash_mismatches += 1
+                log.warning("attach_hash_mismatch", user_id=user_id, sha256=sha)
+                self._reply(sock, {"ok": False, "error": "hash_mismatch", "offset": 0})
+                return False
+            # Kho đã có blob (người khác upload trước): commit bỏ bản vừa nhận, chỉ ghi nhận người upload
+            self.store.commit(part, sha)
+            self.store.add_uploader(sha, user_id)
+        self.store.release_lock(sha, user_id)
+        _stats.uploads += 1
+        log.info("attach_uploaded", user_id=user_id, sha256=sha, size=size)
+        self._reply(sock, {"ok": True, "offset": size, "complete": True})
+        return True
+
+    def _get(self, sock, ticket, header) -> bool:
+        _user_id, sha, _ = ticket
+        if not self.store.exists(sha):
+            self._reply(sock, {"ok": False, "error": "not_found"})
+            return False
+        path = self.store.path(sha)
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = int(header.get("offset") or 0)
+            length = header.get("length")
+            length = size - offset if length is None else min(int(length), size - offset)
+            if offset < 0 or offset > size or length < 0:
+                self._reply(sock, {"ok": False, "error": "bad_range", "size": size})
+                return False
+            self._reply(sock, {"ok": True, "size": size, "offset": offset, "length": length})
+            # sendfile: kernel chép thẳng từ page cache ra socket
+            sent = sock.sendfile(f, offset, length) if length else 0
+        _stats.bytes_out += sent
+        if offset + length >= size:
+            _stats.downloads += 1
+        return True
+
+    def report(self) -> dict:
+        return {
+            "port": ATTACH_PORT,
+            "active": self._active,
+            "uploads": _stats.uploads,
+            "downloads": _stats.downloads,
+            "dedup_hits": _stats.dedup_hits,
+            "bytes_in": _stats.bytes_in,
+            "bytes_out": _stats.bytes_out,
+            "hash_mismatches": _stats.hash_mismatches,
+            "rejected_busy": _stats.rejected,
+        }
+
+
+server = TransferServer()
+
+
+# ------------------ Dọn kho ------------------
+def gc(dry_run=False) -> dict:
+    """Xóa blob không còn tin nào tham chiếu (đã tồn tại quá ATTACH_PART_TTL) và upload dở quá hạn."""
+    now = time.time()
+    removed_parts = 0
+    if os.path.isdir(store.tmp):
+        for name in os.listdir(store.tmp):
+            path = os.path.join(store.tmp, name)
+            if now - os.path.getmtime(path) > ATTACH_PART_TTL:
+                if not dry_run:
+                    os.remove(path)
+                removed_parts += 1
+    import archive
+    import shards
+    referenced = archive.store.blob_refs()
+    # Tham chiếu nằm trên mọi shard tin nhắn: thiếu 1 shard thì không xóa blob nào
+    for shard in shards.shards:
+        conn = shard.connect()
+        if not conn:
+            return {"ok": False, "error": "db_connect_failed", "removed_parts": removed_parts}
+        cur = None
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT DISTINCT sha256 FROM message_attachments")
+            referenced.update(row[0] for row in cur.fetchall())
+        finally:
+            try:
+                if cur:
+                    cur.close()
+                conn.close()
+            except Exception:
+                pass
+    removed, freed = 0, 0
+    for sha, path in list(store.blobs()):
+        # Blob mới upload có thể chưa kịp gắn vào tin -> chỉ xóa blob đủ cũ
+        if sha in referenced or now - os.path.getmtime(path) < ATTACH_PART_TTL:
+            continue
+        freed += os.path.getsize(path)
+        if not dry_run:
+            store.remove(sha)
+        removed += 1
+    return {"ok": True, "removed_blobs": removed, "freed_bytes": freed, "removed_parts": removed_parts}
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ["gc"]:
+        print(json.dumps(gc(dry_run="--dry-run" in sys.argv), indent=1))
+        sys.exit(0)
+    print(__doc__)
+    sys.exit(1)
@@ -0,0 +1,160 @@
+"""Đếm số truy vấn / commit / kết nối DB cho mỗi lần chạy 1 action (kiểm soát số round trip).
+
+- Dispatch bọc mỗi handler bằng `with audit.action(tên)`; database.py và statements.py báo về
+  frame đang mở của thread (note_query/note_commit/note_connection). Ngoài action thì không đếm.
+- Action lồng nhau (sub-request của batch) cộng dồn vào action cha.
+- QUERY_BUDGETS (config) là trần cho từng action; vượt thì tăng "violations" và ghi log cảnh báo lần đầu.
+- Dùng trong test: `with audit.expect(queries=2, commits=1, connections=1): handler(...)`
+  ném AssertionError nếu khối lệnh vượt ngân sách.
+"""
+import threading
+from contextlib import contextmanager
+
+import log
+from config import QUERY_AUDIT, QUERY_BUDGETS
+
+_local = threading.local()
+
+# Số action tối đa được thống kê riêng (action lạ từ client gom vào "other")
+_MAX_ACTIONS = 64
+
+
+class Frame:
+    __slots__ = ("name", "queries", "commits", "connections")
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.commits = 0
+        self.connections = 0
+
+    def counts(self) -> tuple:
+        return self.queries, self.commits, self.connections
+
+    def __repr__(self):
+        return f"{self.name}: queries={self.queries} commits={self.commits} connections={self.connections}"
+
+
+def _stack() -> list:
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def current():
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else None
+
+
+def note_query(n=1):
+    frame = current()
+    if frame is not None:
+        frame.queries += n
+
+
+def note_commit():
+    frame = current()
+    if frame is not None:
+        frame.commits += 1
+
+
+def note_connection():
+    frame = current()
+    if frame is not None:
+        frame.connections += 1
+
+
+def over_budget(name, counts) -> bool:
+    budget = QUERY_BUDGETS.get(name)
+    return budget is not None and any(n > limit for n, limit in zip(counts, budget))
+
+
+class _Agg:
+    __slots__ = ("calls", "totals", "maxes", "violations")
+
+    def __init__(self):
+        self.calls = 0
+        self.totals = [0, 0, 0]
+        self.maxes = [0, 0, 0]
+        self.violations = 0
+
+
+_aggs = {}
+_aggs_lock = threading.Lock()
+
+
+def _record(frame):
+    counts = frame.counts()
+    violated = over_budget(frame.name, counts)
+    with _aggs_lock:
+        name = frame.name if frame.name in _aggs or len(_aggs) < _MAX_ACTIONS else "other"
+        agg = _aggs.get(name)
+        if agg is None:
+            agg = _aggs[name] = _Agg()
+        agg.calls += 1
+        for i, n in enumerate(counts):
+            agg.totals[i] += n
+            agg.maxes[i] = max(agg.maxes[i], n)
+        if violated:
+            agg.violations += 1
+            first = agg.violations == 1
+    if violated and first:
+        log.warning("query_budget_exceeded", action=frame.name, queries=frame.queries, commits=frame.commits,
+                    connections=frame.connections, budget=QUERY_BUDGETS[frame.name])
+
+
+@contextmanager
+def action(name):
+    """Đếm cho 1 lần chạy action `name` trên thread hiện tại."""
+    if not QUERY_AUDIT:
+        yield None
+        return
+    frame = Frame(str(name))
+    stack = _stack()
+    stack.append(frame)
+    try:
+        yield frame
+    finally:
+        stack.pop()
+        if stack:
+            parent = stack[-1]
+            parent.queries += frame.queries
+            parent.commits += frame.commits
+            parent.connections += frame.connections
+        _record(frame)
+
+
+@contextmanager
+def expect(queries=None, commits=None, connections=None, name="expect"):
+    """Khẳng định khối lệnh không vượt số truy vấn / commit / kết nối cho trước (dùng trong test)."""
+    frame = Frame(name)
+    stack = _stack()
+    stack.append(frame)
+    try:
+        yield frame
+    finally:
+        stack.pop()
+    for label, n, limit in (("queries", frame.queries, queries), ("commits", frame.commits, commits),
+                            ("connections", frame.connections, connections)):
+        if limit is not None and n > limit:
+            raise AssertionError(f"{frame!r}: {label} {n} > {limit}")
+
+
+def report() -> dict:
+    with _aggs_lock:
+        items = [(name, agg.calls, list(agg.totals), list(agg.maxes), agg.violations)
+                 for name, agg in _aggs.items()]
+    out = {}
+    for name, calls, totals, maxes, violations in sorted(items):
+        out[name] = {
+            "calls": calls,
+            "avg_queries": round(totals[0] / calls, 2),
+            "max_queries": maxes[0],
+            "avg_commits": round(totals[1] / calls, 2),
+            "max_commits": maxes[1],
+            "max_connections": maxes[2],
+            "budget": QUERY_BUDGETS.get(name),
+            "violations": violations,
+        }
+    return out
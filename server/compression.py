@@ -0,0 +1,151 @@
+import base64
+import threading
+import time
+import zlib
+
+from config import COMPRESSION_THRESHOLD, COMPRESSION_LEVEL
+
+# Frame nén được gửi thành 1 dòng: PREFIX + base64(raw deflate(json)).
+# Dòng JSON luôn bắt đầu bằng '{' hoặc '[', text của server không bắt đầu bằng "Z:".
+PREFIX = "Z:"
+
+# Từ điển dùng chung (preset dictionary) cho deflate: các khóa/giá trị lặp lại nhiều nhất
+# trong frame lịch sử và danh sách. PHẢI giống hệt ZDICTS trong client/wire.py.
+# Chuỗi hay gặp nhất đặt ở cuối (deflate tham chiếu khoảng cách ngắn rẻ hơn).
+ZDICTS = {
+    "v1": (
+        b'{"action": "send_message_result", "ok": true, "ok": false, "error": "exception", '
+        b'{"action": "presence_update", "user_id": , "status": "online"}, "status": "offline"}'
+        b'{"chat_rooms": [{"room_id": , "room_name": "'
+        b'{"requests": [{"id": , "display_name": "'
+        b'{"friends": [{"id": , "display_name": "", "status": "offline"}, '
+        b'{"action": "dm_history", "peer_id": , "after_id": 0, "limit": 300, "latest": true, "before_id": '
+        b'"messages": [{"id": , "sender_id": , "receiver_id": , "content": "", "sent_at": "20'
+        b'[{"id": , "sender_id": , "receiver_id": null, "content": "", "sent_at": "20, "room_id": null}, '
+        b'{"action": "receive_message", "id": , "sender_id": , "sender_name": "", "content": "", "sent_at": "20'
+        b'{"action": "room_history", "room_id": , "after_id": 0, "limit": 300, "messages": [{"id": '
+        b'}, {"id": , "sender_id": , "sender_name": "", "content": "", "sent_at": "20'
+    ),
+}
+
+SUPPORTED = ("deflate",)
+
+
+# ------------------ Thống kê theo loại frame ------------------
+class CompressionStats:
+    """Đếm số frame, byte gốc / byte trên dây và CPU nén theo từng loại frame."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_type = {}
+
+    def record(self, frame_type, raw_bytes, wire_bytes, cpu_seconds, compressed):
+        with self._lock:
+            s = self._by_type.get(frame_type)
+            if s is None:
+                s = self._by_type[frame_type] = {
+                    "frames": 0, "compressed": 0, "raw_bytes": 0, "wire_bytes": 0, "cpu_seconds": 0.0,
+                }
+            s["frames"] += 1
+            s["raw_bytes"] += raw_bytes
+            s["wire_bytes"] += wire_bytes
+            if compressed:
+                s["compressed"] += 1
+                s["cpu_seconds"] += cpu_seconds
+
+    def report(self) -> dict:
+        with self._lock:
+            items = {k: dict(v) for k, v in self._by_type.items()}
+        for s in items.values():
+            s["ratio"] = round(s["wire_bytes"] / s["raw_bytes"], 3) if s["raw_bytes"] else 1.0
+            s["cpu_us_per_frame"] = round(s["cpu_seconds"] * 1e6 / s["compressed"], 1) if s["compressed"] else 0.0
+            s["cpu_seconds"] = round(s["cpu_seconds"], 6)
+        return items
+
+
+stats = CompressionStats()
+
+
+# ------------------ Nén / giải nén ------------------
+def compress_text(text: str, zdict: bytes = None, level: int = COMPRESSION_LEVEL) -> str:
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = c.compress(text.encode("utf-8")) + c.flush()
+    return PREFIX + base64.b64encode(data).decode("ascii")
+
+
+def decompress_text(line: str, zdict: bytes = None) -> str:
+    raw = base64.b64decode(line[len(PREFIX):])
+    d = zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+    return (d.decompress(raw) + d.flush()).decode("utf-8")
+
+
+class FrameCompressor:
+    """Bộ nén của 1 kết nối (sau khi client thỏa thuận)."""
+
+    name = "deflate"
+
+    def __init__(self, zdict_name=None, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        self.zdict_name = zdict_name
+        self.zdict = ZDICTS.get(zdict_name) if zdict_name else None
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, text: str, frame_type: str = "text") -> str:
+        raw_len = len(text.encode("utf-8"))
+        if raw_len < self.threshold:
+            stats.record(frame_type, raw_len, raw_len, 0.0, False)
+            return text
+        t0 = time.thread_time()
+        out = compress_text(text, self.zdict, self.level)
+        cpu = time.thread_time() - t0
+        if len(out) >= raw_len:
+            # Không lợi thì gửi bản gốc
+            stats.record(frame_type, raw_len, raw_len, cpu, False)
+            return text
+        stats.record(frame_type, raw_len, len(out), cpu, True)
+        return out
+
+
+def choose_compressor(offered, zdicts=None):
+    """Chọn thuật toán/từ điển từ danh sách client đề xuất; None nếu không khớp."""
+    if isinstance(offered, str):
+        offered = [offered]
+    if isinstance(zdicts, str):
+        zdicts = [zdicts]
+    if not offered or not any(o in SUPPORTED for o in offered):
+        return None
+    zdict_name = next((z for z in (zdicts or []) if z in ZDICTS), None)
+    return FrameCompressor(zdict_name)
+
+
+# Đo nhanh tỉ lệ nén / CPU để chỉnh ngưỡng: python compression.py
+if __name__ == "__main__":
+    import json
+    import random
+
+    names = ["Hoàng", "Bảo", "Tiến", "Trí", "Lan", "Minh"]
+    words = "xin chào mọi người hôm nay họp lúc mấy giờ nhé ok được rồi deadline tuần sau".split()
+
+    def fake_room_history(n):
+        msgs = [{
+            "id": 1000 + i,
+            "sender_id": 1 + i % len(names),
+            "sender_name": names[i % len(names)],
+            "content": " ".join(random.choice(words) for _ in range(random.randint(2, 14))),
+            "sent_at": f"2025-10-{1 + i % 28:02d} 1{i % 10}:{i % 60:02d}:{(i * 7) % 60:02d}",
+        } for i in range(n)]
+        return json.dumps({"action": "room_history", "room_id": 3, "after_id": 0, "limit": 300, "messages": msgs})
+
+    for n in (1, 5, 20, 100, 300):
+        text = fake_room_history(n)
+        raw = len(text.encode("utf-8"))
+        for zname in (None, "v1"):
+            t0 = time.perf_counter()
+            out = compress_text(text, ZDICTS.get(zname) if zname else None)
+            dt = time.perf_counter() - t0
+            assert decompress_text(out, ZDICTS.get(zname) if zname else None) == text
+            print(f"{n:4d} msgs  raw={raw:7d}B  zdict={zname or '-':3s}  wire={len(out):7d}B  "
+                  f"ratio={len(out) / raw:.3f}  cpu={dt * 1e6:8.1f}us")
@@ -10,3 +10,221 @@ DB_PORT = int(os.getenv("DB_PORT", 3306)) #nếu không có port mặc định s
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME")
+
+# Dữ liệu server ghi lúc chạy (archive, kho tệp, snapshot, token quản trị, profile) nằm ngoài thư mục mã nguồn
+# như cache của client: `git add -A` không vô tình commit token hay dữ liệu người dùng
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(os.path.expanduser("~"), ".python_socket_chat", "server"))
+
+
+def _data_path(*parts):
+    """Đường dẫn mặc định trong DATA_DIR; bản cài cũ đã có dữ liệu trong server/ thì giữ chỗ cũ (không bỏ rơi archive)."""
+    legacy = os.path.join(os.path.dirname(os.path.abspath(__file__)), *parts)
+    return legacy if os.path.exists(legacy) else os.path.join(DATA_DIR, *parts)
+
+
+# Nén frame (zlib/deflate): chỉ nén frame có kích thước >= ngưỡng (byte)
+COMPRESSION_THRESHOLD = int(os.getenv("COMPRESSION_THRESHOLD", 1024))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+
+# Chu kỳ in thống kê vận hành (giây), 0 = tắt
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL", 60))
+
+# Giới hạn tốc độ (token bucket) theo action: (số request/giây, burst).
+# "*" là giới hạn chung cho mọi action của 1 user (hoặc 1 kết nối khi chưa đăng nhập).
+# Ghi đè bằng biến môi trường, ví dụ: RATE_LIMITS="send_message=2:5,*=10:20"
+RATE_LIMITS = {
+    "*": (20, 40),
+    "register": (0.2, 3),
+    "login": (0.5, 5),
+    "send_message": (5, 10),
+    "send_private_message": (5, 10),
+    "receive_message": (1, 3),
+    "get_room_history": (5, 15),
+    "get_dm_history": (5, 15),
+    "send_friend_request": (1, 5),
+    "create_chat_room": (0.5, 3),
+    "search_messages": (1, 5),
+    "attach_begin": (1, 10),
+    "attach_ticket": (2, 20),
+}
+for _item in filter(None, os.getenv("RATE_LIMITS", "").split(",")):
+    _name, _spec = _item.split("=", 1)
+    _rate, _burst = _spec.split(":", 1)
+    RATE_LIMITS[_name.strip()] = (float(_rate), float(_burst))
+
+# Số lần liên tiếp bị chặn trước khi tạm ngừng đọc socket (đẩy ngược áp lực về TCP)
+RATE_LIMIT_MAX_STRIKES = int(os.getenv("RATE_LIMIT_MAX_STRIKES", 10))
+# Dòng request dài hơn ngưỡng này (chưa thấy '\n') thì đóng kết nối
+MAX_LINE_BYTES = int(os.getenv("MAX_LINE_BYTES", 256 * 1024))
+
+# Heartbeat: kết nối im lặng quá HEARTBEAT_INTERVAL giây sẽ được ping,
+# quá HEARTBEAT_TIMEOUT giây không nhận được gì thì bị đóng và đánh dấu offline
+HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", 30))
+HEARTBEAT_TIMEOUT = int(os.getenv("HEARTBEAT_TIMEOUT", 90))
+# Thời gian tối đa cho 1 lần gửi/nhận trên socket (tránh treo khi peer đã chết)
+SOCKET_TIMEOUT = float(os.getenv("SOCKET_TIMEOUT", 10))
+# TCP keepalive của hệ điều hành (giây / số lần thử)
+TCP_KEEPIDLE = int(os.getenv("TCP_KEEPIDLE", 60))
+TCP_KEEPINTVL = int(os.getenv("TCP_KEEPINTVL", 10))
+TCP_KEEPCNT = int(os.getenv("TCP_KEEPCNT", 5))
+
+# Pipelining: request chỉ-đọc có req_id được xử lý song song trên pool worker
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", 16))
+PIPELINE_MAX_INFLIGHT = int(os.getenv("PIPELINE_MAX_INFLIGHT", 8))   # mỗi kết nối
+
+# Pool kết nối MySQL dùng chung cho các handler
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+
+# Tách đọc/ghi: DB_HOST là primary (mọi lệnh ghi); các action chỉ-đọc (lịch sử, danh sách) đọc từ replica.
+# DB_REPLICAS="host1:3306,host2" (rỗng = đọc luôn từ primary); user/mật khẩu mặc định giống primary.
+DB_REPLICAS = [
+    (_h.rsplit(":", 1)[0], int(_h.rsplit(":", 1)[1])) if ":" in _h else (_h, DB_PORT)
+    for _h in (x.strip() for x in os.getenv("DB_REPLICAS", "").split(",")) if _h
+]
+DB_REPLICA_USER = os.getenv("DB_REPLICA_USER", DB_USER)
+DB_REPLICA_PASSWORD = os.getenv("DB_REPLICA_PASSWORD", DB_PASSWORD)
+DB_REPLICA_POOL_SIZE = int(os.getenv("DB_REPLICA_POOL_SIZE", DB_POOL_SIZE))
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", 2.0))            # giây; trễ hơn thì đọc primary
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", 0.5))  # chu kỳ ghi/đọc heartbeat
+# 1 = các câu SQL nóng (statements.py) chạy bằng prepared statement, giữ qua các request
+DB_PREPARED = os.getenv("DB_PREPARED", "1") == "1"
+
+# Đếm truy vấn / commit / kết nối DB theo từng lần chạy action (audit.py)
+QUERY_AUDIT = os.getenv("QUERY_AUDIT", "1") == "1"
+# Ngân sách mỗi action: (số truy vấn, số commit, số kết nối). Ghi đè: QUERY_BUDGETS="send_message=4:1:1"
+QUERY_BUDGETS = {
+    "register": (2, 1, 1),
+    "login": (5, 1, 3),
+    "create_chat_room": (2, 1, 1),
+    "send_message": (6, 1, 1),
+    "send_private_message": (5, 1, 1),
+    "get_room_history": (3, 0, 2),
+    "get_dm_history": (2, 0, 1),
+    "show_chat_rooms": (1, 0, 1),
+    "show_friends": (1, 0, 1),
+    "attach_begin": (1, 0, 1),
+    "attach_ticket": (1, 0, 1),
+}
+for _item in filter(None, os.getenv("QUERY_BUDGETS", "").split(",")):
+    _name, _spec = _item.split("=", 1)
+    QUERY_BUDGETS[_name.strip()] = tuple(int(x) for x in _spec.split(":", 2))
+
+# Số sub-request tối đa trong 1 request "batch"
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 20))
+
+# Giao tin offline (store-and-forward): số DM tối đa trong 1 frame gửi bù khi đăng nhập
+DELIVERY_BATCH = int(os.getenv("DELIVERY_BATCH", 100))
+
+# Tìm kiếm tin nhắn: "mysql" (FULLTEXT trên bảng message_search) hoặc "memory" (inverted index trong RAM)
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "mysql")
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", 200))        # không phân trang sâu hơn
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", 500))  # backend RAM: số ứng viên chấm điểm
+
+# Lưu trữ lạnh: partition tháng cũ hơn ARCHIVE_AFTER_MONTHS tháng được ghi ra file nén rồi bỏ khỏi DB (0 = tắt)
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", _data_path("archive"))
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", 6))
+ARCHIVE_CHECK_INTERVAL = int(os.getenv("ARCHIVE_CHECK_INTERVAL", 3600))
+
+# Xóa tin hết hạn theo chính sách lưu giữ của phòng (job nền trong server)
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", 300))            # giây giữa các lượt, 0 = tắt
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", 500))                  # số dòng tối đa mỗi lô
+RETENTION_MAX_ROWS_PER_SEC = int(os.getenv("RETENTION_MAX_ROWS_PER_SEC", 2000))
+RETENTION_DUTY = float(os.getenv("RETENTION_DUTY", 0.2))                  # tỉ lệ thời gian tối đa được chạy
+RETENTION_SLOW_BATCH_MS = int(os.getenv("RETENTION_SLOW_BATCH_MS", 50))   # lô chậm hơn -> giảm lô
+RETENTION_MAX_DAYS = int(os.getenv("RETENTION_MAX_DAYS", 3650))          # trần số ngày admin phòng đặt được
+
+# Log JSON (log.py): ghi nền qua hàng đợi, mỗi dòng 1 bản ghi
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")                    # debug / info / warning / error, đổi được lúc chạy
+LOG_FILE = os.getenv("LOG_FILE", "")                          # rỗng = stdout
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))   # vượt thì xoay file (.1, .2, ...)
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 5))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))      # đầy thì bỏ bản ghi (không chặn handler)
+# Lấy mẫu theo loại bản ghi (event): tỉ lệ giữ lại 0..1. Ghi đè: LOG_SAMPLE="connection_open=0.1"
+LOG_SAMPLE = {}
+for _item in filter(None, os.getenv("LOG_SAMPLE", "").split(",")):
+    _name, _rate = _item.split("=", 1)
+    LOG_SAMPLE[_name.strip()] = float(_rate)
+# Giới hạn tốc độ mỗi event: (bản ghi/giây, burst); "*" là mặc định. Ghi đè: LOG_RATES="handler_error=5:20"
+LOG_RATES = {"*": (50, 200)}
+for _item in filter(None, os.getenv("LOG_RATES", "").split(",")):
+    _name, _spec = _item.split("=", 1)
+    _rate, _burst = _spec.split(":", 1)
+    LOG_RATES[_name.strip()] = (float(_rate), float(_burst))
+
+# Kênh quản trị nội bộ (admin.py): chỉ nghe trên loopback, mọi lệnh phải kèm token
+ADMIN_HOST = os.getenv("ADMIN_HOST", "127.0.0.1")
+ADMIN_PORT = int(os.getenv("ADMIN_PORT", 5001))                 # 0 = tắt
+# Rỗng = server tự sinh token mỗi lần chạy và ghi vào ADMIN_TOKEN_FILE (quyền 0600)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+ADMIN_TOKEN_FILE = os.getenv("ADMIN_TOKEN_FILE", os.path.join(DATA_DIR, "admin_token"))
+
+# Profiler lấy mẫu stack (profiler.py), bật/tắt qua kênh quản trị
+PROFILE_DIR = os.getenv("PROFILE_DIR", _data_path("profiles"))
+PROFILE_INTERVAL_MS = int(os.getenv("PROFILE_INTERVAL_MS", 10))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", 300))
+
+# Drain / restart không gián đoạn (drain.py): SIGTERM = drain rồi thoát, SIGHUP = chuyển socket cho process mới
+DRAIN_WINDOW = float(os.getenv("DRAIN_WINDOW", 30))                 # client kết nối lại rải đều trong khoảng này
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 15))               # chờ client tự đóng trước khi ngắt
+DRAIN_HANDOFF_TIMEOUT = float(os.getenv("DRAIN_HANDOFF_TIMEOUT", 30))   # chờ process mới sẵn sàng
+
+# Tệp đính kèm (attachments.py): kho blob theo sha256 + kênh truyền riêng (không chiếm socket chat)
+ATTACH_DIR = os.getenv("ATTACH_DIR", _data_path("blobs"))
+ATTACH_HOST = os.getenv("ATTACH_HOST", "0.0.0.0")
+ATTACH_PORT = int(os.getenv("ATTACH_PORT", 5002))                   # 0 = tắt
+ATTACH_MAX_BYTES = int(os.getenv("ATTACH_MAX_BYTES", 100 * 1024 * 1024))
+ATTACH_CHUNK = int(os.getenv("ATTACH_CHUNK", 1024 * 1024))          # client gửi mỗi lần tối đa chừng này byte
+ATTACH_MAX_TRANSFERS = int(os.getenv("ATTACH_MAX_TRANSFERS", 64))   # số kết nối truyền tệp cùng lúc
+# Khóa ký vé truyền tệp; rỗng = sinh ngẫu nhiên mỗi lần chạy (client xin vé mới sau restart)
+ATTACH_SECRET = os.getenv("ATTACH_SECRET", "")
+ATTACH_TICKET_TTL = int(os.getenv("ATTACH_TICKET_TTL", 600))
+ATTACH_PART_TTL = int(os.getenv("ATTACH_PART_TTL", 7 * 86400))      # upload dở quá hạn thì gc xóa
+
+# Chỉ mục trong RAM (directory.py): thành viên phòng, bạn bè, tên hiển thị; snapshot xuống đĩa để khởi động ấm
+DIRECTORY_ENABLED = os.getenv("DIRECTORY_ENABLED", "1") == "1"
+DIRECTORY_SNAPSHOT = os.getenv("DIRECTORY_SNAPSHOT", _data_path("snapshots", "directory.snap"))
+DIRECTORY_SNAPSHOT_INTERVAL = int(os.getenv("DIRECTORY_SNAPSHOT_INTERVAL", 300))    # giây, 0 = chỉ ghi khi tắt
+DIRECTORY_SNAPSHOT_MAX_AGE = int(os.getenv("DIRECTORY_SNAPSHOT_MAX_AGE", 7 * 86400))  # cũ hơn thì nạp lại từ DB
+DIRECTORY_BATCH = int(os.getenv("DIRECTORY_BATCH", 5000))            # số dòng mỗi truy vấn khi nạp / đối chiếu
+DIRECTORY_PAUSE_MS = int(os.getenv("DIRECTORY_PAUSE_MS", 20))        # nghỉ giữa các lô (không dồn tải lên DB)
+
+# Chia bảng messages theo hội thoại ra nhiều DB (shards.py). Thứ tự = số hiệu shard, chỉ được thêm vào cuối;
+# "primary" = DB chính (DB_HOST). Vd. MESSAGE_SHARDS="primary,db2:3306/chat,db3/chat". Mặc định chỉ có primary.
+def _shard_spec(spec):
+    if spec == "primary":
+        return None
+    addr, _, name = spec.partition("/")
+    host, _, port = addr.partition(":")
+    return host, int(port or DB_PORT), name or DB_NAME
+
+
+MESSAGE_SHARDS = [_shard_spec(x.strip()) for x in os.getenv("MESSAGE_SHARDS", "primary").split(",") if x.strip()]
+MESSAGE_SHARD_USER = os.getenv("MESSAGE_SHARD_USER", DB_USER)
+MESSAGE_SHARD_PASSWORD = os.getenv("MESSAGE_SHARD_PASSWORD", DB_PASSWORD)
+MESSAGE_SHARD_POOL_SIZE = int(os.getenv("MESSAGE_SHARD_POOL_SIZE", DB_POOL_SIZE))
+MESSAGE_SHARD_BUCKETS = int(os.getenv("MESSAGE_SHARD_BUCKETS", 1024))        # cố định sau khi đã chia
+MESSAGE_SHARD_MAP_REFRESH = float(os.getenv("MESSAGE_SHARD_MAP_REFRESH", 2.0))  # giây, đọc lại bảng phân bucket
+MESSAGE_SHARD_COPY_BATCH = int(os.getenv("MESSAGE_SHARD_COPY_BATCH", 5000))   # khoảng id mỗi lô khi chuyển bucket
+MESSAGE_FANIN_WORKERS = int(os.getenv("MESSAGE_FANIN_WORKERS", 8))
+if len(MESSAGE_SHARDS) > 1:
+    # Tin nằm trên shard, badge chưa đọc trên primary: thêm 1 kết nối (+1 commit khi gửi);
+    # lịch sử phòng lấy tên người gửi riêng (directory, thiếu thì 1 truy vấn)
+    for _name, _extra in (("send_message", (0, 1, 1)), ("send_private_message", (0, 1, 1)),
+                          ("get_room_history", (1, 0, 1)), ("get_dm_history", (0, 0, 1))):
+        QUERY_BUDGETS[_name] = tuple(a + b for a, b in zip(QUERY_BUDGETS[_name], _extra))
+
+# Bus vô hiệu hóa cache thành viên / bạn bè / tên giữa các process server (invalidation.py).
+# "db": bảng cache_events trên primary (mọi process cùng đọc); "local": chỉ trong 1 process (test / máy dev).
+INVALIDATION_BUS = os.getenv("INVALIDATION_BUS", "db")
+INVALIDATION_POLL = float(os.getenv("INVALIDATION_POLL", 0.5))                 # giây giữa các lần đọc sự kiện
+INVALIDATION_BATCH = int(os.getenv("INVALIDATION_BATCH", 500))                 # số sự kiện tối đa mỗi lần đọc
+INVALIDATION_GAP_TIMEOUT = float(os.getenv("INVALIDATION_GAP_TIMEOUT", 10.0))  # chờ version bị thiếu (tx chưa commit)
+INVALIDATION_RETENTION = int(os.getenv("INVALIDATION_RETENTION", 3600))        # giây giữ sự kiện trong bảng
+INVALIDATION_CHECK_INTERVAL = int(os.getenv("INVALIDATION_CHECK_INTERVAL", 30))  # đối chiếu mẫu ngẫu nhiên, 0 = tắt
+INVALIDATION_CHECK_SAMPLE = int(os.getenv("INVALIDATION_CHECK_SAMPLE", 20))      # số phòng / user mỗi lần đối chiếu
+INVALIDATION_FULL_CHECK = int(os.getenv("INVALIDATION_FULL_CHECK", 3600))        # quét đối chiếu toàn bộ, 0 = tắt
+if INVALIDATION_BUS == "db":
+    # Handler đổi thành viên / tên ghi thêm 1 dòng sự kiện trong cùng transaction
+    for _name in ("register", "create_chat_room"):
+        QUERY_BUDGETS[_name] = (QUERY_BUDGETS[_name][0] + 1, *QUERY_BUDGETS[_name][1:])
@@ -0,0 +1,199 @@
+import itertools
+import select
+import socket
+import threading
+import time
+
+try:
+    import fcntl
+    import termios
+except ImportError:          # Windows: không đọc được hàng đợi gửi của kernel
+    fcntl = termios = None
+
+import log
+from config import SOCKET_TIMEOUT, TCP_KEEPIDLE, TCP_KEEPINTVL, TCP_KEEPCNT, PIPELINE_MAX_INFLIGHT
+
+
+def configure_socket(sock):
+    """Bật TCP keepalive (nếu HĐH hỗ trợ) và timeout cho socket của client."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for opt, value in (("TCP_KEEPIDLE", TCP_KEEPIDLE),
+                           ("TCP_KEEPINTVL", TCP_KEEPINTVL),
+                           ("TCP_KEEPCNT", TCP_KEEPCNT)):
+            if hasattr(socket, opt):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+    except OSError as e:
+        log.warning("keepalive_error", exc=e)
+    # recv hết timeout chỉ là "chưa có dữ liệu"; sendall hết timeout = peer không đọc nữa
+    sock.settimeout(SOCKET_TIMEOUT)
+
+
+def _writable(sock) -> bool:
+    """Bộ đệm gửi còn chỗ ngay lúc này (không chờ). poll nếu có: select() không nhận fd >= FD_SETSIZE."""
+    try:
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(sock, select.POLLOUT)
+            return any(ev & select.POLLOUT for _, ev in poller.poll(0))
+        return bool(select.select([], [sock], [], 0)[1])
+    except (OSError, ValueError):
+        return False
+
+
+class ClientConnection:
+    """Bọc socket của 1 client.
+
+    - Khóa ghi: nhiều thread (broadcast, presence...) có thể cùng đẩy dữ liệu vào 1 socket,
+      khóa giữ cho mỗi dòng được ghi trọn vẹn, không bị xen kẽ.
+    - Giữ trạng thái đã thỏa thuận của kết nối (nén frame).
+    - Gửi lỗi (timeout, peer đã chết) thì kết nối bị hủy để handler dọn dẹp.
+    """
+
+    def __init__(self, sock, address=None):
+        self.id = next(_ids)
+        self.sock = sock
+        self.address = address
+        self.user_id = None
+        self.compressor = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connected_at = time.time()
+        self.last_recv = self.connected_at
+        self.last_send = None
+        self.closed = False
+        self.close_reason = None
+        self._send_lock = threading.Lock()
+        # Giới hạn số request pipelined đang xử lý của kết nối (hết chỗ thì ngừng đọc socket)
+        self.inflight = threading.BoundedSemaphore(PIPELINE_MAX_INFLIGHT)
+
+    def recv(self, bufsize: int) -> bytes:
+        data = self.sock.recv(bufsize)
+        self.bytes_in += len(data)
+        self.last_recv = time.time()
+        return data
+
+    def send_line(self, text: str, frame_type: str = "text"):
+        """Gửi 1 frame (1 dòng), nén nếu kết nối đã bật nén."""
+        if self.closed:
+            raise ConnectionError("connection closed")
+        if self.compressor is not None:
+            text = self.compressor.encode(text, frame_type)
+        data = (text + "\n").encode("utf-8")
+        with self._send_lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                # Frame có thể đã gửi dở -> luồng dữ liệu hỏng, hủy kết nối
+                self.abort("send_failed")
+                raise
+        self.bytes_out += len(data)
+        self.last_send = time.time()
+
+    def try_send_line(self, text: str, frame_type: str = "text") -> bool:
+        """Gửi 1 frame nhỏ (ping) mà không chờ; False = chưa gửi, để lượt sau.
+
+        Thread khác đang gửi (giữ _send_lock, có thể đang kẹt trong sendall tới peer không đọc) hoặc bộ đệm
+        gửi của kernel đầy thì bỏ qua ngay. Chỉ gửi được 1 phần frame thì luồng dữ liệu hỏng -> hủy kết nối.
+        """
+        if self.closed:
+            return False
+        if self.compressor is not None:
+            text = self.compressor.encode(text, frame_type)
+        data = (text + "\n").encode("utf-8")
+        if not self._send_lock.acquire(blocking=False):
+            return False
+        try:
+            if not _writable(self.sock):
+                return False
+            try:
+                sent = self.sock.send(data)
+            except OSError:
+                self.abort("send_failed")
+                return False
+            if sent < len(data):
+                self.abort("send_stalled")
+                return False
+        finally:
+            self._send_lock.release()
+        self.bytes_out += len(data)
+        self.last_send = time.time()
+        return True
+
+    def outbound_backlog(self):
+        """Số byte đã ghi vào socket nhưng peer chưa nhận (hàng đợi gửi của kernel); None nếu không đọc được."""
+        if fcntl is None or not hasattr(termios, "TIOCOUTQ") or self.closed:
+            return None
+        try:
+            buf = fcntl.ioctl(self.sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0")
+            return int.from_bytes(buf, "little", signed=True)
+        except (OSError, ValueError):
+            return None
+
+    def inflight_count(self) -> int:
+        """Số request pipelined đang chạy trên pool worker."""
+        return PIPELINE_MAX_INFLIGHT - getattr(self.inflight, "_value", PIPELINE_MAX_INFLIGHT)
+
+    def abort(self, reason: str):
+        """Đóng cứng kết nối; recv() của handler sẽ trả về rỗng/lỗi và handler tự dọn dẹp."""
+        if self.closed:
+            return
+        self.closed = True
+        self.close_reason = reason
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+# ------------------ Registry mọi kết nối đang mở ------------------
+_ids = itertools.count(1)
+_connections = set()
+_registry_lock = threading.Lock()
+
+
+def register(conn: ClientConnection):
+    with _registry_lock:
+        _connections.add(conn)
+
+
+def unregister(conn: ClientConnection):
+    with _registry_lock:
+        _connections.discard(conn)
+
+
+def all_connections() -> list:
+    with _registry_lock:
+        return list(_connections)
+
+
+# ------------------ Ngữ cảnh request đang xử lý (theo thread) ------------------
+_ctx = threading.local()
+
+
+def set_request(conn, req_id):
+    """Ghi nhận request đang xử lý trên thread hiện tại: reply gửi về `conn` sẽ kèm req_id."""
+    _ctx.conn = conn
+    _ctx.req_id = req_id
+
+
+def current_req_id(conn):
+    """req_id cần echo nếu đang gửi reply về chính kết nối đã gửi request, ngược lại None."""
+    if getattr(_ctx, "conn", None) is conn:
+        return _ctx.req_id
+    return None
+
+
+def current_user():
+    """user_id của kết nối đang được xử lý trên thread hiện tại (None nếu chưa đăng nhập / ngoài request)."""
+    return getattr(getattr(_ctx, "conn", None), "user_id", None)
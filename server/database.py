@@ -1,23 +1,486 @@
-from mysql.connector import Error
+from mysql.connector import Error, pooling
+import itertools
 import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
 import mysql.connector
-from config import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME
+import audit
+import log
+from config import DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, DB_POOL_SIZE
+from config import (DB_REPLICAS, DB_REPLICA_USER, DB_REPLICA_PASSWORD, DB_REPLICA_POOL_SIZE,
+                    DB_REPLICA_MAX_LAG, DB_REPLICA_CHECK_INTERVAL)
+from connection import current_user
 
-def get_connection():
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+def _db_params():
+    return dict(host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD, database=DB_NAME)
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # Không reset session khi trả kết nối: giữ prepared statements (statements.py) qua các request
+                _pool = pooling.MySQLConnectionPool(pool_name="chat", pool_size=DB_POOL_SIZE,
+                                                    pool_reset_session=False, **_db_params())
+    return _pool
+
+def _new_connection():
+    """Lấy 1 kết nối từ pool (close() trả về pool); pool cạn thì mở kết nối riêng."""
     try:
-        connection = mysql.connector.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            database=DB_NAME
-        )
+        return _get_pool().get_connection()
+    except pooling.PoolError:
+        return mysql.connector.connect(**_db_params())
+
+class _CountingCursor:
+    """Cursor báo mỗi lần execute cho audit (chỉ dùng khi đang trong 1 action)."""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, *args, **kwargs):
+        audit.note_query()
+        return self._cur.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        audit.note_query()
+        return self._cur.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+class _Session:
+    """Kết nối pool của 1 handler: close() kết thúc transaction đang mở rồi mới trả về pool.
+
+    Pool không reset session nữa nên phải tự rollback, tránh handler sau đọc snapshot cũ
+    của transaction chỉ-đọc mà handler trước bỏ ngỏ.
+    """
+
+    def __init__(self, conn, target=None):
+        self._conn = conn
+        self.target = target        # DbTarget (replica / shard) nếu không phải primary
+
+    def cursor(self, *args, **kwargs):
+        cur = self._conn.cursor(*args, **kwargs)
+        return _CountingCursor(cur) if audit.current() is not None else cur
+
+    def commit(self):
+        audit.note_commit()
+        self._conn.commit()
+        if self.target is None:
+            _note_write()
+
+    def close(self):
+        try:
+            if self._conn.in_transaction:
+                self._conn.rollback()
+        except Error:
+            pass
+        self._conn.close()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class _PinnedConnection:
+    """Kết nối dùng chung cho nhiều handler trong 1 phạm vi: close() của handler không đóng thật."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+def connect_primary():
+    """Kết nối primary cho job nền / công cụ (không gắn với action, không đếm audit); người gọi tự close()."""
+    return _new_connection()
+
+def get_connection(read_only=False):
+    """Kết nối cho 1 handler. read_only=True: đọc từ replica nếu có replica đủ mới (xem bên dưới),
+    ngược lại dùng primary. Trong khối pinned_connection: kết nối đã ghim của loại đó."""
+    pinned = getattr(_local, "pinned", None)
+    if pinned is None:
+        return _session(read_only)
+    key = "read" if read_only and _replicas else "primary"
+    conn = pinned.get(key)
+    if conn is None:
+        session = _session(read_only and bool(_replicas))
+        if session is None:
+            return None
+        conn = pinned[key] = _PinnedConnection(session)
+        if session.target is None:
+            pinned.setdefault("primary", conn)   # đọc quay về primary (replica trễ / lỗi): ghi dùng chung
+    return conn
+
+def _session(read_only):
+    if read_only and _replicas:
+        conn = _read_connection()
+        if conn is not None:
+            return conn
+    try:
+        connection = _new_connection()
         if connection.is_connected():
-            return connection
+            audit.note_connection()
+            return _Session(connection)
     except Error as e:
-        print(f"Lỗi kết nối MySQL: {e}")
+        log.error("db_connect_error", exc=e)
+        return None
+
+@contextmanager
+def pinned_connection():
+    """Trong khối with, các get_connection() trên thread này dùng chung kết nối từ pool: 1 kết nối đọc
+    (get_connection(read_only=True): replica nếu có, như ngoài khối) và 1 kết nối primary, mở khi dùng lần đầu."""
+    if getattr(_local, "pinned", None) is not None:
+        yield
+        return
+    _local.pinned = {}
+    try:
+        yield
+    finally:
+        pinned, _local.pinned = _local.pinned, None
+        for conn in {id(c): c for c in pinned.values()}.values():
+            try:
+                conn._conn.close()
+            except Exception:
+                pass
+
+# ------------------ Replica đọc ------------------
+# Độ trễ đo bằng heartbeat: primary ghi giờ hiện tại vào replica_heartbeat mỗi DB_REPLICA_CHECK_INTERVAL,
+# đọc lại dòng đó trên từng replica -> `visible_until` = mốc mới nhất replica đã áp dụng.
+# Read-your-writes: commit trên primary ghi lại thời điểm theo user đang được xử lý; lần đọc sau của user
+# chỉ đi replica khi visible_until >= thời điểm đó (replica đã có bản ghi của chính họ), không thì primary.
+# Replica trễ quá DB_REPLICA_MAX_LAG, lỗi kết nối hoặc lâu không đo được cũng quay về primary.
+_HEARTBEAT_SOURCE = socket.gethostname()[:64]
+_STALE_PROBE = 3 * DB_REPLICA_CHECK_INTERVAL + 1.0   # quá lâu không đo được -> coi như không dùng được
+
+
+class DbTarget:
+    """1 máy MySQL ngoài primary (replica đọc, shard tin nhắn): pool riêng, tạo khi dùng lần đầu."""
+
+    def __init__(self, pool_name, host, port, user, password, database, pool_size):
+        self.pool_name = pool_name
+        self.name = f"{host}:{port}/{database}"
+        self.host = host
+        self.port = port
+        self._params = dict(host=host, port=port, user=user, password=password, database=database)
+        self._pool_size = pool_size
+        self._pool = None
+
+    def connect(self):
+        """Kết nối thật từ pool (close() trả về pool); pool cạn thì mở kết nối riêng. Lỗi -> mysql Error."""
+        if self._pool is None:
+            with _pool_lock:
+                if self._pool is None:
+                    self._pool = pooling.MySQLConnectionPool(pool_name=self.pool_name, pool_size=self._pool_size,
+                                                             pool_reset_session=False, **self._params)
+        try:
+            return self._pool.get_connection()
+        except pooling.PoolError:
+            return mysql.connector.connect(**self._params)
+
+    def session(self):
+        """Kết nối cho handler (bọc như get_connection(): close() rollback rồi trả về pool)."""
+        raw = self.connect()
+        audit.note_connection()
+        return _Session(raw, target=self)
+
+
+class _Replica(DbTarget):
+    def __init__(self, index, host, port):
+        super().__init__(f"chat-replica-{index}", host, port, DB_REPLICA_USER, DB_REPLICA_PASSWORD, DB_NAME,
+                         DB_REPLICA_POOL_SIZE)
+        self.name = f"{host}:{port}"
+        self.visible_until = 0.0
+        self.lag = None
+        self.checked_at = 0.0
+        self.healthy = False
+        self.reads = 0
+        self.errors = 0
+        self.last_error = None
+
+    def fail(self, e):
+        self.healthy = False
+        self.errors += 1
+        self.last_error = str(e)
+
+    def state(self, now, since):
+        """None nếu đọc được cho user có lần ghi cuối lúc `since`; ngược lại lý do phải về primary."""
+        if not self.healthy or now - self.checked_at > _STALE_PROBE:
+            return "down"
+        if self.lag > DB_REPLICA_MAX_LAG:
+            return "lag"
+        if self.visible_until < since:
+            return "read_your_writes"
         return None
 
+
+_replicas = [_Replica(i, host, port) for i, (host, port) in enumerate(DB_REPLICAS)]
+_rr = itertools.count()
+_writes = {}                 # user_id -> thời điểm commit gần nhất trên primary
+_writes_lock = threading.Lock()
+_routes = {"replica": 0, "primary_down": 0, "primary_lag": 0, "primary_read_your_writes": 0}
+
+
+def _note_write():
+    user_id = current_user()
+    if user_id and _replicas:
+        with _writes_lock:
+            _writes[user_id] = time.time()
+
+
+def _pick_replica(user_id):
+    now = time.time()
+    with _writes_lock:
+        since = _writes.get(user_id, 0.0) if user_id else 0.0
+    start = next(_rr)
+    reasons = []
+    for i in range(len(_replicas)):
+        replica = _replicas[(start + i) % len(_replicas)]
+        reason = replica.state(now, since)
+        if reason is None:
+            return replica
+        reasons.append(reason)
+    # Báo lý do "gần dùng được" nhất: còn replica khỏe thì do trễ / read-your-writes
+    for reason in ("read_your_writes", "lag", "down"):
+        if reason in reasons:
+            _routes["primary_" + reason] += 1
+            return None
+
+
+def _read_connection():
+    replica = _pick_replica(current_user())
+    if replica is None:
+        return None
+    try:
+        raw = replica.connect()
+        if raw.is_connected():
+            audit.note_connection()
+            replica.reads += 1
+            _routes["replica"] += 1
+            return _Session(raw, target=replica)
+    except Error as e:
+        replica.fail(e)
+        log.error("db_replica_connect_error", exc=e, replica=replica.name)
+    _routes["primary_down"] += 1
+    return None
+
+
+def _monitor_once():
+    now = time.time()
+    try:
+        raw = _new_connection()
+        try:
+            cur = raw.cursor()
+            cur.execute("INSERT INTO replica_heartbeat (source, ts) VALUES (%s, %s) "
+                        "ON DUPLICATE KEY UPDATE ts = VALUES(ts)", (_HEARTBEAT_SOURCE, now))
+            raw.commit()
+            cur.close()
+        finally:
+            raw.close()
+    except Error as e:
+        log.error("db_heartbeat_error", exc=e)
+    for replica in _replicas:
+        try:
+            raw = replica.connect()
+            try:
+                cur = raw.cursor()
+                cur.execute("SELECT ts FROM replica_heartbeat WHERE source = %s", (_HEARTBEAT_SOURCE,))
+                row = cur.fetchone()
+                cur.close()
+                if raw.in_transaction:
+                    raw.rollback()
+            finally:
+                raw.close()
+        except Error as e:
+            if replica.healthy:
+                log.warning("db_replica_down", replica=replica.name, error=str(e))
+            replica.fail(e)
+            continue
+        checked = time.time()
+        if row is None:
+            replica.healthy = False
+            replica.last_error = "no_heartbeat"
+            continue
+        replica.visible_until = float(row[0])
+        replica.lag = round(max(0.0, checked - replica.visible_until), 3)
+        replica.checked_at = checked
+        if not replica.healthy:
+            log.info("db_replica_up", replica=replica.name, lag=replica.lag)
+        replica.healthy = True
+    # Lần ghi đủ cũ thì replica nào đọc được cũng đã có -> bỏ khỏi bảng theo dõi
+    cutoff = now - DB_REPLICA_MAX_LAG - _STALE_PROBE
+    with _writes_lock:
+        for uid in [uid for uid, ts in _writes.items() if ts < cutoff]:
+            del _writes[uid]
+
+
+def start_replica_monitor():
+    """Ghi/đọc heartbeat định kỳ trên thread nền (không làm gì nếu không cấu hình DB_REPLICAS)."""
+    if not _replicas:
+        return None
+
+    def loop():
+        while True:
+            try:
+                _monitor_once()
+            except Exception as e:
+                log.error("db_replica_monitor_error", exc=e)
+            time.sleep(DB_REPLICA_CHECK_INTERVAL)
+
+    t = threading.Thread(target=loop, name="db-replicas", daemon=True)
+    t.start()
+    return t
+
+
+def replica_report() -> dict:
+    now = time.time()
+    with _writes_lock:
+        tracked = len(_writes)
+    return {
+        "replicas": [{
+            "name": r.name,
+            "healthy": r.healthy,
+            "lag": r.lag,
+            "checked_s": round(now - r.checked_at, 1) if r.checked_at else None,
+            "reads": r.reads,
+            "errors": r.errors,
+            "last_error": r.last_error,
+        } for r in _replicas],
+        "routes": dict(_routes),
+        "recent_writers": tracked,
+        "max_lag": DB_REPLICA_MAX_LAG,
+    }
+
+
+# Bảng phụ do server tự tạo (bảng gốc users/messages/... tạo bằng script SQL của nhóm)
+_TABLES = {
+    "delivery_cursors": """
+        CREATE TABLE IF NOT EXISTS delivery_cursors (
+            user_id           INT         NOT NULL PRIMARY KEY,
+            last_delivered_id BIGINT      NOT NULL DEFAULT 0,
+            updated_at        TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """,
+    # Mốc đã đọc + số tin chưa đọc theo hội thoại ("room:<id>" / "dm:<peer>")
+    "read_markers": """
+        CREATE TABLE IF NOT EXISTS read_markers (
+            user_id      INT         NOT NULL,
+            conv_key     VARCHAR(32) NOT NULL,
+            last_read_id BIGINT      NOT NULL DEFAULT 0,
+            unread       INT         NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, conv_key)
+        )
+    """,
+    # Nội dung tin đã bỏ dấu để tìm kiếm (search.py); tin cũ: python search.py backfill
+    "message_search": """
+        CREATE TABLE IF NOT EXISTS message_search (
+            message_id   BIGINT NOT NULL PRIMARY KEY,
+            content_norm TEXT   NOT NULL,
+            FULLTEXT KEY ft_content_norm (content_norm)
+        ) ENGINE=InnoDB
+    """,
+    # Chính sách lưu giữ tin theo phòng (retention.py)
+    "room_retention": """
+        CREATE TABLE IF NOT EXISTS room_retention (
+            room_id        INT       NOT NULL PRIMARY KEY,
+            retention_days INT       NOT NULL,
+            updated_at     TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """,
+    # Tin nhắn -> blob đính kèm (nội dung nằm trong kho ATTACH_DIR theo sha256, xem attachments.py)
+    "message_attachments": """
+        CREATE TABLE IF NOT EXISTS message_attachments (
+            message_id BIGINT       NOT NULL PRIMARY KEY,
+            sha256     CHAR(64)     NOT NULL,
+            file_name  VARCHAR(255) NOT NULL,
+            size       BIGINT       NOT NULL,
+            mime       VARCHAR(100) NOT NULL DEFAULT 'application/octet-stream',
+            KEY idx_sha256 (sha256)
+        )
+    """,
+    # Heartbeat đo độ trễ replica (mỗi máy chạy server 1 dòng, ghi trên primary)
+    "replica_heartbeat": """
+        CREATE TABLE IF NOT EXISTS replica_heartbeat (
+            source VARCHAR(64) NOT NULL PRIMARY KEY,
+            ts     DOUBLE      NOT NULL
+        )
+    """,
+    # Bucket hội thoại -> shard giữ tin (shards.py); bucket không có dòng nào thuộc primary
+    "message_shard_map": """
+        CREATE TABLE IF NOT EXISTS message_shard_map (
+            bucket      INT       NOT NULL PRIMARY KEY,
+            shard       INT       NOT NULL,
+            moving_from INT       NULL,
+            updated_at  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """,
+    # Bộ cấp id tin nhắn dùng chung khi có nhiều shard (shards.IdAllocator)
+    "message_id_seq": """
+        CREATE TABLE IF NOT EXISTS message_id_seq (
+            name    VARCHAR(32) NOT NULL PRIMARY KEY,
+            next_id BIGINT      NOT NULL
+        )
+    """,
+    # Sự kiện vô hiệu hóa cache thành viên / bạn bè / tên giữa các process (invalidation.py)
+    "cache_events": """
+        CREATE TABLE IF NOT EXISTS cache_events (
+            version BIGINT      NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            source  VARCHAR(64) NOT NULL,
+            kind    VARCHAR(16) NOT NULL,
+            a       INT         NOT NULL,
+            b       INT         NULL,
+            ts      DOUBLE      NOT NULL,
+            KEY idx_ts (ts)
+        )
+    """,
+}
+
+# Chạy 1 lần ngay sau khi tạo bảng (dữ liệu khởi tạo cho user đã có sẵn)
+_BACKFILL = {
+    # User cũ coi như đã nhận hết: không gửi bù toàn bộ lịch sử DM ở lần đăng nhập đầu tiên
+    "delivery_cursors": """
+        INSERT IGNORE INTO delivery_cursors (user_id, last_delivered_id)
+        SELECT u.user_id, (SELECT COALESCE(MAX(id), 0) FROM messages) FROM users u
+    """,
+}
+
+def ensure_tables():
+    """Tạo các bảng phụ nếu chưa có (CREATE TABLE IF NOT EXISTS), gọi lúc server khởi động."""
+    conn = get_connection()
+    if not conn:
+        return False
+    cur = None
+    try:
+        cur = conn.cursor()
+        for name, ddl in _TABLES.items():
+            cur.execute("SHOW TABLES LIKE %s", (name,))
+            existed = cur.fetchone() is not None
+            cur.execute(ddl)
+            if not existed and name in _BACKFILL:
+                cur.execute(_BACKFILL[name])
+        conn.commit()
+        return True
+    except Error as e:
+        log.error("db_ddl_error", exc=e)
+        return False
+    finally:
+        try:
+            if cur:
+                cur.close()
+            conn.close()
+        except Exception:
+            pass
+
 # Test kết nối
 if __name__ == "__main__":
     conn = get_connection()
@@ -25,4 +488,4 @@ if __name__ == "__main__":
         print("Kết nối MySQL thành công!")
         conn.close()
     else:
-        print("Kết nối MySQL thất bại!")
\ No newline at end of file
+        print("Kết nối MySQL thất bại!")
@@ -0,0 +1,713 @@
+"""Chỉ mục trong RAM cho các tra cứu nóng + snapshot xuống đĩa để khởi động ấm.
+
+Chỉ mục: thành viên phòng (room_id -> {user_id: role} và user_id -> {room_id}), bạn bè đã chấp nhận
+(user_id -> {friend_id}), tên hiển thị (user_id <-> display_name). Handler dùng chúng thay cho truy vấn
+fan-out / presence / tra tên; khi chưa sẵn sàng (`ready` = False) handler quay về truy vấn DB như cũ.
+Handler commit xong thì gọi add_user / add_member / remove_member / add_friends / remove_friends;
+thay đổi từ process khác (hoặc sửa DB bằng tay) tới qua invalidation.py -> invalidate_many().
+
+Khởi động:
+- Có snapshot hợp lệ, chưa quá DIRECTORY_SNAPSHOT_MAX_AGE: mmap tệp, dựng chỉ mục -> sẵn sàng ngay;
+  bus vô hiệu hóa đọc lại mọi sự kiện sau version ghi trong snapshot (thay đổi process cũ làm sau khi chụp,
+  vd. trong lúc drain). Sự kiện đó đã bị dọn (INVALIDATION_RETENTION) thì coi như không có snapshot;
+  thread nền đối chiếu với DB: trước tiên phần mới (user / phòng có id lớn hơn lúc chụp), sau đó quét
+  từng bảng theo khóa chính, mỗi lô DIRECTORY_BATCH dòng, nghỉ DIRECTORY_PAUSE_MS giữa các lô, sửa chỗ lệch.
+- Không có / hỏng / quá cũ: nạp từ DB bằng đúng cách quét theo lô đó (không dồn tải lên MySQL),
+  sẵn sàng khi nạp xong.
+Chỗ nào handler vừa sửa trong lúc quét thì lô đang quét không ghi đè (giá trị trong RAM mới hơn).
+Snapshot ghi định kỳ (DIRECTORY_SNAPSHOT_INTERVAL, chỉ khi có thay đổi), trước khi chuyển socket
+cho process mới và khi tắt server.
+
+Định dạng snapshot (số nguyên theo byte order của máy ghi, có lưu trong header):
+    header | members int64 x3 (room, user, chỉ số role) | friends int64 x2 (user1, user2)
+    | user_ids int64 | name_offsets int64 (n+1) | names utf-8 | meta JSON (roles, max id, version bus)
+CRC32 trên toàn bộ phần sau header; ghi ra tệp tạm rồi os.replace nên không đọc phải tệp dở dang.
+
+Dùng từ dòng lệnh (kiểm tra 1 snapshot):
+    python directory.py inspect [đường_dẫn]
+"""
+import array
+import bisect
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from config import (DIRECTORY_ENABLED, DIRECTORY_SNAPSHOT, DIRECTORY_SNAPSHOT_INTERVAL,
+                    DIRECTORY_SNAPSHOT_MAX_AGE, DIRECTORY_BATCH, DIRECTORY_PAUSE_MS)
+from database import get_connection
+import invalidation
+import log
+
+MAGIC = b"CHATDIR\x01"
+_HEADER = struct.Struct("<8s8sdQQQQQI4x")    # magic, byteorder, created_at, 5 độ dài, crc; 72 byte
+
+# Mỗi bảng: truy vấn lấy lô kế tiếp sau khóa `last` (theo khóa chính, không OFFSET)
+_WALKS = {
+    "users": (
+        "SELECT user_id, display_name FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s",
+        lambda last: (last[0],),
+    ),
+    "members": (
+        "SELECT room_id, user_id, role FROM room_members "
+        "WHERE room_id > %s OR (room_id = %s AND user_id > %s) ORDER BY room_id, user_id LIMIT %s",
+        lambda last: (last[0], last[0], last[1]),
+    ),
+    "friends": (
+        "SELECT user1_id, user2_id, 1 FROM user_relationships "
+        "WHERE status = 'accepted' AND (user1_id > %s OR (user1_id = %s AND user2_id > %s)) "
+        "ORDER BY user1_id, user2_id LIMIT %s",
+        lambda last: (last[0], last[0], last[1]),
+    ),
+}
+_START = {"users": (0,), "members": (0, 0), "friends": (0, 0)}
+
+
+def _close(cur, conn):
+    try:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+    except Exception:
+        pass
+
+
+class Directory:
+    def __init__(self, path=DIRECTORY_SNAPSHOT, enabled=DIRECTORY_ENABLED):
+        self.path = path
+        self.enabled = enabled
+        self.ready = False
+        self._lock = threading.RLock()
+        self._members = {}         # room_id -> {user_id: role}
+        self._rooms = {}           # user_id -> {room_id}
+        self._pairs = set()        # (user1_id, user2_id) như trong user_relationships
+        self._friends = {}         # user_id -> {friend_id}
+        self._names = {}           # user_id -> display_name
+        self._ids = {}             # display_name -> user_id
+        self._max_user = 0         # id lớn nhất lúc chụp snapshot (đối chiếu phần mới trước)
+        self._max_room = 0
+
+        # Thay đổi từ handler trong lúc đang quét: khóa -> số thứ tự thay đổi
+        self._seq = 0
+        self._walking = 0
+        self._touched = {}
+
+        self._started_at = None
+        self._snapshot_seq = 0
+        self._wake = threading.Event()
+        self._pending_reconcile = False
+        self.source = None
+        self.time_to_ready_ms = None
+        self.snapshot_load_ms = None
+        self.snapshot_age_s = None
+        self.snapshot_error = None
+        self.snapshots_written = 0
+        self.last_snapshot_ms = None
+        self.last_snapshot_bytes = None
+        self.reconcile_ms = None
+        self.reconcile_rows = 0
+        self.fixed = {"users": 0, "members": 0, "friends": 0}
+        self.last_error = None
+
+    # ------------------ Tra cứu (None = chưa sẵn sàng, handler dùng DB) ------------------
+    def fanout(self, room_id, sender_id):
+        """(tên người gửi, danh sách thành viên phòng) như truy vấn room_fanout."""
+        if not self.ready:
+            return None
+        with self._lock:
+            return self._names.get(sender_id) or f"User {sender_id}", list(self._members.get(room_id, ()))
+
+    def friends_of(self, user_id):
+        if not self.ready:
+            return None
+        with self._lock:
+            return list(self._friends.get(user_id, ()))
+
+    def rooms_of(self, user_id):
+        if not self.ready:
+            return None
+        with self._lock:
+            return set(self._rooms.get(user_id, ()))
+
+    def display_names(self, user_ids):
+        """{user_id: display_name} cho các id đã biết (id chưa biết thì người gọi tự tra DB)."""
+        if not self.ready:
+            return {}
+        with self._lock:
+            return {uid: self._names[uid] for uid in user_ids if uid in self._names}
+
+    def user_id(self, display_name):
+        """(True, user_id hoặc None) khi đã sẵn sàng; (False, None) -> người gọi tra DB."""
+        if not self.ready:
+            return False, None
+        with self._lock:
+            return True, self._ids.get(display_name)
+
+    # ------------------ Cập nhật sau khi handler commit ------------------
+    def _touch(self, key):
+        self._seq += 1
+        if self._walking:
+            self._touched[key] = self._seq
+
+    def add_user(self, user_id, display_name):
+        with self._lock:
+            self._touch(("users", (user_id,)))
+            self._set_user(user_id, display_name)
+
+    def add_member(self, room_id, user_id, role):
+        with self._lock:
+            self._touch(("members", (room_id, user_id)))
+            self._set_member(room_id, user_id, role)
+
+    def remove_member(self, room_id, user_id):
+        with self._lock:
+            self._touch(("members", (room_id, user_id)))
+            self._drop_member(room_id, user_id)
+
+    def add_friends(self, user1_id, user2_id):
+        with self._lock:
+            self._touch(("friends", (user1_id, user2_id)))
+            self._set_pair(user1_id, user2_id)
+
+    def remove_friends(self, a, b):
+        """remove_friend xóa quan hệ theo cả 2 chiều."""
+        with self._lock:
+            for key in ((a, b), (b, a)):
+                self._touch(("friends", key))
+                self._drop_pair(*key)
+
+    def _set_user(self, user_id, name):
+        old = self._names.get(user_id)
+        if old is not None and self._ids.get(old) == user_id:
+            del self._ids[old]
+        if name:
+            self._names[user_id] = name
+            self._ids[name] = user_id
+        else:
+            self._names.pop(user_id, None)
+
+    def _drop_user(self, user_id):
+        self._set_user(user_id, None)
+
+    def _set_member(self, room_id, user_id, role):
+        self._members.setdefault(room_id, {})[user_id] = role
+        self._rooms.setdefault(user_id, set()).add(room_id)
+
+    def _drop_member(self, room_id, user_id):
+        members = self._members.get(room_id)
+        if members and members.pop(user_id, None) is not None and not members:
+            del self._members[room_id]
+        rooms = self._rooms.get(user_id)
+        if rooms is not None:
+            rooms.discard(room_id)
+            if not rooms:
+                del self._rooms[user_id]
+
+    def _set_pair(self, a, b):
+        self._pairs.add((a, b))
+        self._friends.setdefault(a, set()).add(b)
+        self._friends.setdefault(b, set()).add(a)
+
+    def _drop_pair(self, a, b):
+        self._pairs.discard((a, b))
+        if (b, a) in self._pairs:
+            return          # còn quan hệ chiều ngược lại -> vẫn là bạn
+        for x, y in ((a, b), (b, a)):
+            friends = self._friends.get(x)
+            if friends is not None:
+                friends.discard(y)
+                if not friends:
+                    del self._friends[x]
+
+    # ------------------ Đối chiếu với DB ------------------
+    def _items(self, kind) -> dict:
+        """Bản sao khóa -> giá trị của 1 bảng trong RAM, cùng dạng với dòng DB."""
+        if kind == "users":
+            return {(uid,): name for uid, name in self._names.items()}
+        if kind == "members":
+            return {(r, u): role for r, m in self._members.items() for u, role in m.items()}
+        return {pair: 1 for pair in self._pairs}
+
+    def _apply(self, kind, sets, drops, since):
+        """Ghi kết quả 1 lô; bỏ qua khóa handler đã sửa sau khi lô bắt đầu đọc (RAM mới hơn)."""
+        fixed = 0
+        with self._lock:
+            for key, value in sets.items():
+                if self._touched.get((kind, key), 0) > since:
+                    continue
+                if kind == "users":
+                    self._set_user(key[0], value)
+                elif kind == "members":
+                    self._set_member(key[0], key[1], value)
+                else:
+                    self._set_pair(*key)
+                fixed += 1
+            for key in drops:
+                if self._touched.get((kind, key), 0) > since:
+                    continue
+                if kind == "users":
+                    self._drop_user(key[0])
+                elif kind == "members":
+                    self._drop_member(*key)
+                else:
+                    self._drop_pair(*key)
+                fixed += 1
+        return fixed
+
+    def _walk(self, conn, kind, start=None, pause=True) -> int:
+        """Quét 1 bảng theo khóa chính từ sau `start`, từng lô; sửa chỗ lệch, trả về số chỗ đã sửa."""
+        sql, params = _WALKS[kind]
+        last = start or _START[kind]
+        with self._lock:
+            mem = self._items(kind)
+        keys = sorted(k for k in mem if k > last)
+        fixed = 0
+        cur = conn.cursor()
+        try:
+            while True:
+                with self._lock:
+                    since = self._seq
+                cur.execute(sql, (*params(last), DIRECTORY_BATCH))
+                rows = cur.fetchall()
+                self.reconcile_rows += len(rows)
+                db = {tuple(r[:-1]): r[-1] for r in rows if r[-1] is not None}
+                # Lô chưa đủ -> đã tới cuối bảng: mọi khóa còn lại trong RAM thuộc phạm vi lô này
+                hi = tuple(rows[-1][:-1]) if len(rows) >= DIRECTORY_BATCH else None
+                lo_i = bisect.bisect_right(keys, last)
+                hi_i = bisect.bisect_right(keys, hi) if hi is not None else len(keys)
+                sets = {k: v for k, v in db.items() if k not in mem or mem[k] != v}
+                drops = [k for k in keys[lo_i:hi_i] if k not in db]
+                if sets or drops:
+                    fixed += self._apply(kind, sets, drops, since)
+                if hi is None:
+                    return fixed
+                last = hi
+                if pause and DIRECTORY_PAUSE_MS > 0:
+                    time.sleep(DIRECTORY_PAUSE_MS / 1000)
+        finally:
+            cur.close()
+
+    def _begin_walk(self):
+        with self._lock:
+            self._walking += 1
+
+    def _end_walk(self):
+        with self._lock:
+            self._walking -= 1
+            if not self._walking:
+                self._touched.clear()
+
+    def reconcile(self, delta_only=False) -> dict:
+        """Đối chiếu toàn bộ chỉ mục với DB (delta_only: chỉ user / phòng mới hơn snapshot)."""
+        conn = get_connection()
+        if not conn:
+            raise RuntimeError("db_connect_failed")
+        t0 = time.perf_counter()
+        fixed = {}
+        self._begin_walk()
+        try:
+            if delta_only:
+                fixed["users"] = self._walk(conn, "users", (self._max_user,), pause=False)
+                fixed["members"] = self._walk(conn, "members", (self._max_room, sys.maxsize), pause=False)
+            else:
+                for kind in ("users", "members", "friends"):
+                    fixed[kind] = self._walk(conn, kind)
+        finally:
+            self._end_walk()
+            _close(None, conn)
+        for kind, n in fixed.items():
+            self.fixed[kind] += n
+        elapsed = round((time.perf_counter() - t0) * 1000, 1)
+        if not delta_only:
+            self.reconcile_ms = elapsed
+        log.info("directory_reconciled", delta_only=delta_only, fixed=fixed, ms=elapsed)
+        return fixed
+
+    # ------------------ Làm tươi theo khóa (sự kiện từ invalidation.py) ------------------
+    def _scope(self, kind, a, b):
+        """(câu SQL, tham số, giá trị trong RAM) của 1 khóa: dòng DB và RAM cùng dạng như khi quét."""
+        if kind == "users":
+            mem = {(a,): self._names[a]} if a in self._names else {}
+            return "SELECT user_id, display_name FROM users WHERE user_id = %s", (a,), mem
+        if kind == "members":
+            members = self._members.get(a, {})
+            if b is None:
+                return ("SELECT room_id, user_id, role FROM room_members WHERE room_id = %s", (a,),
+                        {(a, u): role for u, role in members.items()})
+            return ("SELECT room_id, user_id, role FROM room_members WHERE room_id = %s AND user_id = %s", (a, b),
+                    {(a, b): members[b]} if b in members else {})
+        if kind == "friends":
+            sql = "SELECT user1_id, user2_id, 1 FROM user_relationships WHERE status = 'accepted' AND "
+            others = self._friends.get(a, ()) if b is None else (b,)
+            mem = {k: 1 for f in others for k in ((a, f), (f, a)) if k in self._pairs}
+            if b is None:
+                return sql + "(user1_id = %s OR user2_id = %s)", (a, a), mem
+            return sql + "((user1_id = %s AND user2_id = %s) OR (user1_id = %s AND user2_id = %s))", (a, b, b, a), mem
+        raise ValueError(f"unknown kind: {kind}")
+
+    def invalidate_many(self, keys, conn=None) -> int:
+        """Đọc lại từ DB các khóa (kind, a, b) rồi sửa chỉ mục; trả về số chỗ đã sửa.
+
+        users: user a; members: phòng a (b: chỉ user b); friends: cặp a-b cả 2 chiều (b None: mọi bạn của a).
+        Handler của process này vừa sửa cùng khóa trong lúc đọc thì giữ giá trị trong RAM (mới hơn).
+        """
+        if not self.enabled or not keys:
+            return 0
+        own = conn is None
+        conn = conn or get_connection()
+        if not conn:
+            raise RuntimeError("db_connect_failed")
+        cur = None
+        fixed = 0
+        self._begin_walk()
+        try:
+            cur = conn.cursor()
+            for kind, a, b in keys:
+                with self._lock:
+                    since = self._seq
+                    sql, params, mem = self._scope(kind, a, b)
+                cur.execute(sql, params)
+                db = {tuple(r[:-1]): r[-1] for r in cur.fetchall() if r[-1] is not None}
+                sets = {k: v for k, v in db.items() if mem.get(k) != v}
+                drops = [k for k in mem if k not in db]
+                if sets or drops:
+                    fixed += self._apply(kind, sets, drops, since)
+        finally:
+            self._end_walk()
+            _close(cur, conn if own else None)
+        return fixed
+
+    def check_sample(self, n) -> tuple:
+        """Đối chiếu n phòng + n user ngẫu nhiên với DB (sửa luôn chỗ lệch); trả về (số khóa đã kiểm, số khóa lệch)."""
+        if not self.enabled or not self.ready:
+            return 0, 0
+        with self._lock:
+            rooms = random.sample(list(self._members), min(n, len(self._members)))
+            users = random.sample(list(self._names), min(n, len(self._names)))
+        keys = ([("members", r, None) for r in rooms] + [("friends", u, None) for u in users]
+                + [("users", u, None) for u in users])
+        conn = get_connection()
+        if not conn:
+            raise RuntimeError("db_connect_failed")
+        try:
+            stale = sum(1 for key in keys if self.invalidate_many([key], conn))
+        finally:
+            _close(None, conn)
+        return len(keys), stale
+
+    def check_full(self) -> int:
+        """Quét đối chiếu toàn bộ (bắt cả thay đổi không có sự kiện, vd. sửa DB bằng tay); trả về số chỗ đã sửa."""
+        if not self.enabled or not self.ready:
+            return 0
+        return sum(self.reconcile().values())
+
+    # ------------------ Snapshot ------------------
+    def write_snapshot(self, force=False):
+        """Ghi snapshot nếu đã sẵn sàng và có thay đổi từ lần ghi trước (force: ghi cả khi không đổi)."""
+        if not self.enabled or not self.ready:
+            return False
+        t0 = time.perf_counter()
+        # Lấy mốc trước khi chụp: sự kiện <= mốc đã có trong chỉ mục, phần sau process mới đọc lại
+        bus_version = invalidation.bus.applied_through()
+        with self._lock:
+            seq = self._seq
+            if not force and seq == self._snapshot_seq and self.snapshots_written:
+                return False
+            members = [(r, u, role) for r, m in self._members.items() for u, role in m.items()]
+            pairs = list(self._pairs)
+            names = list(self._names.items())
+        roles = sorted({role for _, _, role in members}, key=str)
+        role_idx = {role: i for i, role in enumerate(roles)}
+
+        m = array.array("q")
+        for r, u, role in members:
+            m.extend((r, u, role_idx[role]))
+        p = array.array("q")
+        for a, b in pairs:
+            p.extend((a, b))
+        ids = array.array("q", (uid for uid, _ in names))
+        offsets = array.array("q", [0])
+        blob = bytearray()
+        for _, name in names:
+            blob += name.encode("utf-8")
+            offsets.append(len(blob))
+        meta = json.dumps({
+            "roles": roles,
+            "max_user": max((uid for uid, _ in names), default=0),
+            "max_room": max((r for r, _, _ in members), default=0),
+            "bus_version": bus_version,
+        }).encode("utf-8")
+
+        parts = (m.tobytes(), p.tobytes(), ids.tobytes(), offsets.tobytes(), bytes(blob), meta)
+        crc = 0
+        for part in parts:
+            crc = zlib.crc32(part, crc)
+        header = _HEADER.pack(MAGIC, sys.byteorder.encode(), time.time(), len(members), len(pairs),
+                              len(names), len(blob), len(meta), crc)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(header)
+            for part in parts:
+                f.write(part)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._snapshot_seq = seq
+        self.snapshots_written += 1
+        self.last_snapshot_ms = round((time.perf_counter() - t0) * 1000, 1)
+        self.last_snapshot_bytes = _HEADER.size + sum(len(part) for part in parts)
+        log.info("directory_snapshot_written", bytes=self.last_snapshot_bytes, ms=self.last_snapshot_ms,
+                 members=len(members), friends=len(pairs), users=len(names))
+        return True
+
+    def load_snapshot(self) -> bool:
+        """Dựng chỉ mục từ snapshot (mmap, không đọc cả tệp vào bộ nhớ trước). False nếu không dùng được."""
+        t0 = time.perf_counter()
+        try:
+            data = read_snapshot(self.path)
+        except FileNotFoundError:
+            self.snapshot_error = "missing"
+            return False
+        except (OSError, ValueError) as e:
+            self.snapshot_error = str(e)
+            log.warning("directory_snapshot_invalid", path=self.path, error=str(e))
+            return False
+        age = time.time() - data["created_at"]
+        if age > DIRECTORY_SNAPSHOT_MAX_AGE:
+            self.snapshot_error = "too_old"
+            log.info("directory_snapshot_stale", age_s=round(age))
+            return False
+        bus_version = data["meta"].get("bus_version")
+        try:
+            resumed = invalidation.bus.resume_from(bus_version, data["created_at"])
+        except Exception as e:
+            log.error("invalidation_error", exc=e)
+            resumed = False
+        if not resumed:
+            # Không đọc lại được thay đổi từ lúc chụp -> snapshot có thể thiếu chúng, nạp lại từ DB
+            self.snapshot_error = "bus_gap"
+            log.info("directory_snapshot_stale", age_s=round(age), bus_version=bus_version)
+            return False
+        with self._lock:
+            for r, u, role in data["members"]:
+                self._set_member(r, u, role)
+            for a, b in data["friends"]:
+                self._set_pair(a, b)
+            for uid, name in data["users"]:
+                self._set_user(uid, name)
+            self._max_user = data["meta"].get("max_user", 0)
+            self._max_room = data["meta"].get("max_room", 0)
+            self._snapshot_seq = self._seq
+        self.snapshot_age_s = round(age, 1)
+        self.snapshot_load_ms = round((time.perf_counter() - t0) * 1000, 1)
+        return True
+
+    # ------------------ Vòng đời ------------------
+    def start(self, started_at=None):
+        """Gọi lúc khởi động server (trước khi accept). Nạp snapshot đồng bộ, phần còn lại chạy nền."""
+        self._started_at = started_at or time.time()
+        if not self.enabled:
+            return
+        if self.load_snapshot():
+            self._mark_ready("snapshot")
+        threading.Thread(target=self._loop, name="directory", daemon=True).start()
+
+    def _mark_ready(self, source):
+        self.source = source
+        self.ready = True
+        self.time_to_ready_ms = round((time.time() - self._started_at) * 1000, 1)
+        with self._lock:
+            sizes = {"rooms": len(self._members), "friend_pairs": len(self._pairs), "users": len(self._names)}
+        log.info("directory_ready", source=source, time_to_ready_ms=self.time_to_ready_ms,
+                 snapshot_load_ms=self.snapshot_load_ms, **sizes)
+
+    def _loop(self):
+        # 1. Sẵn sàng: từ snapshot (đối chiếu phần mới ngay, rồi quét đủ) hoặc nạp từ DB theo lô
+        delay = 1.0
+        while True:
+            try:
+                if self.ready:
+                    self.reconcile(delta_only=True)
+                    self.reconcile()
+                else:
+                    self.reconcile()
+                    self._mark_ready("db")
+                    self.write_snapshot(force=True)
+                self.last_error = None
+                break
+            except Exception as e:
+                self.last_error = str(e)
+                log.error("directory_reconcile_error", exc=e)
+                time.sleep(delay)
+                delay = min(delay * 2, 60.0)
+        # 2. Ghi snapshot định kỳ (hoặc khi được đánh thức)
+        while True:
+            self._wake.wait(DIRECTORY_SNAPSHOT_INTERVAL if DIRECTORY_SNAPSHOT_INTERVAL > 0 else None)
+            self._wake.clear()
+            try:
+                if self._pending_reconcile:
+                    self._pending_reconcile = False
+                    self.reconcile()
+                if DIRECTORY_SNAPSHOT_INTERVAL > 0:
+                    self.write_snapshot()
+            except Exception as e:
+                self.last_error = str(e)
+                log.error("directory_snapshot_error", exc=e)
+
+    def trigger_reconcile(self):
+        """Quét đối chiếu lại trên thread nền (sau khi sửa DB bằng tay...)."""
+        self._pending_reconcile = True
+        self._wake.set()
+
+    def save(self):
+        """Ghi snapshot ngay (trước khi chuyển socket cho process mới / khi tắt)."""
+        try:
+            self.write_snapshot()
+        except Exception as e:
+            log.error("directory_snapshot_error", exc=e)
+
+    def report(self) -> dict:
+        with self._lock:
+            sizes = {"rooms": len(self._members), "memberships": sum(len(m) for m in self._members.values()),
+                     "friend_pairs": len(self._pairs), "users": len(self._names)}
+            dirty = self._seq != self._snapshot_seq
+        return {
+            "enabled": self.enabled,
+            "ready": self.ready,
+            "source": self.source,
+            "time_to_ready_ms": self.time_to_ready_ms,
+            "snapshot_load_ms": self.snapshot_load_ms,
+            "snapshot_age_s": self.snapshot_age_s,
+            "snapshot_error": self.snapshot_error,
+            "snapshots_written": self.snapshots_written,
+            "last_snapshot_ms": self.last_snapshot_ms,
+            "last_snapshot_bytes": self.last_snapshot_bytes,
+            "dirty": dirty,
+            "reconcile_ms": self.reconcile_ms,
+            "reconcile_rows": self.reconcile_rows,
+            "fixed": dict(self.fixed),
+            "last_error": self.last_error,
+            **sizes,
+        }
+
+
+def read_snapshot(path) -> dict:
+    """Đọc + kiểm tra snapshot qua mmap; ValueError nếu tệp hỏng / khác định dạng."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < _HEADER.size:
+            raise ValueError("truncated")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    views = []
+    try:
+        magic, order, created_at, n_members, n_pairs, n_users, names_len, meta_len, crc = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError("bad_magic")
+        if order.rstrip(b"\0").decode() != sys.byteorder:
+            raise ValueError("byteorder_mismatch")
+        ints = 3 * n_members + 2 * n_pairs + 2 * n_users + 1
+        if size != _HEADER.size + 8 * ints + names_len + meta_len:
+            raise ValueError("size_mismatch")
+        view = memoryview(mm)
+        views.append(view)
+        if zlib.crc32(view[_HEADER.size:]) != crc:
+            raise ValueError("crc_mismatch")
+
+        pos = _HEADER.size
+
+        def section(n, fmt="q"):
+            nonlocal pos
+            width = 8 if fmt == "q" else 1
+            v = view[pos:pos + n * width]
+            views.append(v)
+            pos += n * width
+            if fmt == "q":
+                v = v.cast("q")
+                views.append(v)
+            return v
+
+        members = section(3 * n_members)
+        pairs = section(2 * n_pairs)
+        ids = section(n_users)
+        offsets = section(n_users + 1)
+        names = bytes(section(names_len, "B"))
+        meta = json.loads(bytes(section(meta_len, "B")))
+        roles = meta.get("roles", [])
+        it = iter(members)
+        member_rows = [(r, u, roles[i]) for r, u, i in zip(it, it, it)]
+        it = iter(pairs)
+        pair_rows = list(zip(it, it))
+        user_rows = [(ids[i], names[offsets[i]:offsets[i + 1]].decode("utf-8")) for i in range(n_users)]
+    finally:
+        for v in reversed(views):
+            v.release()
+        mm.close()
+    return {"created_at": created_at, "members": member_rows, "friends": pair_rows,
+            "users": user_rows, "meta": meta}
+
+
+index = Directory()
+
+
+def names(user_ids) -> dict:
+    """{user_id: display_name}: từ chỉ mục, id chưa có (hoặc chỉ mục chưa sẵn sàng) thì tra bảng users."""
+    found = index.display_names(user_ids)
+    missing = tuple(uid for uid in user_ids if uid not in found)
+    if not missing:
+        return found
+    conn = get_connection()
+    if not conn:
+        return found
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT user_id, display_name FROM users WHERE user_id IN ({', '.join(['%s'] * len(missing))})",
+            missing,
+        )
+        found.update(cur.fetchall())
+        return found
+    except Exception as e:
+        log.error("directory_names_error", exc=e)
+        return found
+    finally:
+        _close(cur, conn)
+
+
+def rooms(conn, user_id) -> set:
+    """Các phòng của user: từ chỉ mục, chưa sẵn sàng thì tra room_members trên `conn`."""
+    found = index.rooms_of(user_id)
+    if found is not None:
+        return found
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT room_id FROM room_members WHERE user_id = %s", (user_id,))
+        return {r[0] for r in cur.fetchall()}
+    finally:
+        cur.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "inspect":
+        print(__doc__)
+        sys.exit(1)
+    path = sys.argv[2] if len(sys.argv) > 2 else DIRECTORY_SNAPSHOT
+    t0 = time.perf_counter()
+    snap = read_snapshot(path)
+    print(json.dumps({
+        "path": path,
+        "bytes": os.path.getsize(path),
+        "age_s": round(time.time() - snap["created_at"], 1),
+        "members": len(snap["members"]),
+        "friend_pairs": len(snap["friends"]),
+        "users": len(snap["users"]),
+        "meta": snap["meta"],
+        "read_ms": round((time.perf_counter() - t0) * 1000, 1),
+    }, indent=1, ensure_ascii=False))
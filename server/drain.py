@@ -0,0 +1,164 @@
+"""Drain + khởi động lại không gián đoạn.
+
+Trình tự khi drain (SIGTERM, SIGHUP hoặc lệnh admin "drain"):
+1. (handoff) Chạy process server mới, truyền fd của socket đang listen qua biến môi trường
+   CHAT_LISTEN_FD (pass_fds). Process cũ vẫn accept cho tới khi process mới báo sẵn sàng qua
+   pipe CHAT_READY_FD -> không có khoảng trống không ai accept.
+2. Ngừng accept, đóng bản sao socket listen của process này.
+3. Gửi {"action": "reconnect", "after": giây} cho mọi kết nối; độ trễ rải đều trong DRAIN_WINDOW
+   nên client không đăng nhập lại cùng lúc. Trạng thái online được giữ nguyên (không bắn presence
+   'offline' rồi 'online' cho bạn bè); process mới đối chiếu lại sau khi hết cửa sổ.
+4. Chờ client tự đóng (tối đa DRAIN_TIMEOUT), ngắt các kết nối còn lại, chờ request pipelined
+   chạy xong, flush log rồi thoát.
+"""
+import os
+import random
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import connection
+import log
+from config import DRAIN_WINDOW, DRAIN_TIMEOUT, DRAIN_HANDOFF_TIMEOUT
+
+LISTEN_FD_ENV = "CHAT_LISTEN_FD"
+READY_FD_ENV = "CHAT_READY_FD"
+RECONCILE_ENV = "CHAT_RECONCILE_AFTER"
+
+
+def inherited_listener():
+    """fd socket listen do process cũ truyền sang (None nếu khởi động bình thường)."""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    return int(fd) if fd else None
+
+
+def reconcile_delay() -> float:
+    """Process mới: sau bao nhiêu giây thì mọi client của process cũ đã kịp kết nối lại."""
+    return float(os.environ.pop(RECONCILE_ENV, DRAIN_WINDOW + DRAIN_TIMEOUT) or 0) + 5
+
+
+def signal_ready():
+    """Process mới báo cho process cũ: đã sẵn sàng accept."""
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if not fd:
+        return
+    try:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+    except OSError as e:
+        log.error("drain_ready_signal_error", exc=e)
+
+
+class Drainer:
+    def __init__(self):
+        self.stop_accepting = threading.Event()
+        self.draining = False
+        self.window = DRAIN_WINDOW
+        self.successor = None
+        self._lock = threading.Lock()
+        self._requested = False
+        self._before_handoff = []     # callback chạy ngay trước khi tạo process mới (vd. nhả cổng admin)
+        self._handoff_failed = []     # ... và khi process mới không lên được (mở lại cổng admin)
+        self._drained = []            # callback chạy sau khi mọi kết nối đã đóng, trước khi thoát
+
+    def before_handoff(self, fn):
+        self._before_handoff.append(fn)
+
+    def on_handoff_failed(self, fn):
+        self._handoff_failed.append(fn)
+
+    def after_drain(self, fn):
+        self._drained.append(fn)
+
+    def request(self, listener, handoff=False, window=None) -> dict:
+        """Bắt đầu drain (gọi được từ signal handler / thread admin). Chỉ có hiệu lực 1 lần."""
+        with self._lock:
+            if self._requested:
+                return {"ok": False, "error": "already_draining"}
+            self._requested = True
+        if window is not None:
+            self.window = max(0.0, float(window))
+        log.info("drain_requested", handoff=handoff, window=self.window)
+        threading.Thread(target=self._prepare, args=(listener, handoff), name="drain", daemon=True).start()
+        return {"ok": True, "handoff": handoff, "window": self.window}
+
+    def _prepare(self, listener, handoff):
+        if handoff:
+            try:
+                self.successor = self._spawn(listener)
+            except Exception as e:
+                # Không có process thay thế: không drain nữa, tiếp tục phục vụ
+                log.error("drain_handoff_failed", exc=e)
+                for fn in self._handoff_failed:
+                    fn()
+                with self._lock:
+                    self._requested = False
+                return
+        self.draining = True
+        self.stop_accepting.set()
+
+    def _spawn(self, listener):
+        for fn in self._before_handoff:
+            fn()
+        fd = listener.fileno()
+        os.set_inheritable(fd, True)
+        r, w = os.pipe()
+        env = {**os.environ, LISTEN_FD_ENV: str(fd), READY_FD_ENV: str(w),
+               RECONCILE_ENV: str(self.window + DRAIN_TIMEOUT)}
+        child = subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0]), *sys.argv[1:]],
+                                 env=env, pass_fds=(fd, w))
+        os.close(w)
+        try:
+            ready, _, _ = select.select([r], [], [], DRAIN_HANDOFF_TIMEOUT)
+            if not ready or not os.read(r, 1):
+                child.kill()
+                raise RuntimeError("successor did not become ready")
+        finally:
+            os.close(r)
+        log.info("drain_handoff_ready", pid=child.pid)
+        return child
+
+    def run(self, listener, wait_idle=None):
+        """Chạy trên main thread sau khi ngừng accept: báo client, chờ đóng, dọn dẹp."""
+        try:
+            listener.close()
+        except OSError:
+            pass
+        conns = connection.all_connections()
+        random.shuffle(conns)
+        n = len(conns)
+        for i, c in enumerate(conns):
+            # Rải đều trong cửa sổ + chút nhiễu để các client cùng lúc không trùng nhịp
+            delay = self.window * i / max(n, 1) + random.uniform(0, min(1.0, self.window / max(n, 1)))
+            try:
+                c.send_line(f'{{"action": "reconnect", "after": {delay:.2f}, "reason": "drain"}}', "reconnect")
+            except Exception:
+                pass
+        log.info("drain_notified", connections=n, window=self.window)
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while connection.all_connections() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        remaining = connection.all_connections()
+        for c in remaining:
+            c.abort("drain")
+        if wait_idle:
+            wait_idle()
+        for fn in self._drained:
+            fn()
+        log.info("drain_done", forced=len(remaining))
+        log.flush()
+
+
+drainer = Drainer()
+
+
+def install_signals(listener):
+    """SIGTERM: drain rồi thoát; SIGHUP: drain + chuyển socket cho process mới (restart không gián đoạn)."""
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, lambda *_: drainer.request(listener, handoff=False))
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda *_: drainer.request(listener, handoff=True))
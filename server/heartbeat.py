@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+
+from config import HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT
+import connection
+import log
+
+
+class Heartbeat:
+    """Ping các kết nối im lặng và đóng các kết nối chết (half-open, NAT timeout...).
+
+    Kết nối bị đóng bằng ClientConnection.abort(): handle_client thoát khỏi recv và
+    tự dọn dẹp như một lần ngắt kết nối bình thường (bỏ khỏi user_sockets, offline, báo bạn bè).
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self.pings_sent = 0
+        self.pings_skipped = 0
+        self.reaped = 0
+        self.reaped_logged_in = 0
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._loop, name="heartbeat", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        # Quét dày hơn interval để thời điểm ping/reap không lệch quá nửa chu kỳ
+        tick = max(1.0, self.interval / 2)
+        while True:
+            time.sleep(tick)
+            try:
+                self.sweep()
+            except Exception as e:
+                log.error("heartbeat_error", exc=e)
+
+    def sweep(self, now=None):
+        now = now or time.time()
+        for conn in connection.all_connections():
+            idle = now - conn.last_recv
+            if idle >= self.timeout:
+                self.reaped += 1
+                if conn.user_id:
+                    self.reaped_logged_in += 1
+                conn.abort("heartbeat_timeout")
+            elif idle >= self.interval:
+                # Không chờ: 1 peer kẹt (hoặc handler đang kẹt ghi tới nó) không được làm trễ ping / reap của
+                # mọi kết nối khác. Chưa gửi được thì lượt sau thử lại; im lặng quá timeout thì bị reap như thường
+                try:
+                    if conn.try_send_line(json.dumps({"action": "ping", "ts": int(now)}), "ping"):
+                        self.pings_sent += 1
+                    else:
+                        self.pings_skipped += 1
+                except Exception:
+                    self.pings_skipped += 1
+
+    def report(self) -> dict:
+        return {
+            "connections": len(connection.all_connections()),
+            "pings_sent": self.pings_sent,
+            "pings_skipped": self.pings_skipped,
+            "reaped": self.reaped,
+            "reaped_logged_in": self.reaped_logged_in,
+        }
+
+
+heartbeat = Heartbeat()
@@ -0,0 +1,136 @@
+"""Định dạng payload lịch sử chat.
+
+- "rows" (mặc định): list các dict, mỗi tin 1 dict, sent_at dạng chuỗi ISO.
+- "columnar" (client tự chọn bằng "format": "columnar"): các mảng song song
+  ids / sender_ids / contents / sent_at_ms (epoch mili-giây, UTC)
+  và từ điển sender_names {sender_id: display_name} thay cho sender_name lặp lại mỗi dòng.
+- sent_at trong DB là DATETIME không múi giờ, theo giờ địa phương của máy chạy server (xem server._sent_at):
+  dạng rows gửi nguyên chuỗi đó, dạng columnar đổi sang epoch thật ở đây (epoch_ms) để client hiển thị theo
+  múi giờ của mình. Không dùng UNIX_TIMESTAMP của MySQL: kết quả phụ thuộc múi giờ session.
+- Tin có tệp đính kèm: "attachment" trong dict của tin (rows) / "attachments" {id: meta} (columnar).
+"""
+
+from datetime import datetime
+
+COLUMNAR = "columnar"
+
+
+def wants_columnar(request) -> bool:
+    return request.get("format") == COLUMNAR
+
+
+def epoch_ms(t) -> int:
+    """sent_at (datetime hoặc chuỗi "YYYY-MM-DD HH:MM:SS" của archive; không múi giờ = giờ máy server) -> epoch ms."""
+    if not hasattr(t, "timestamp"):
+        t = datetime.fromisoformat(str(t))
+    return int(t.timestamp() * 1000)
+
+
+def _iso(t):
+    return t.isoformat(sep=" ") if hasattr(t, "isoformat") else str(t)
+
+
+def _attach(messages: list, attachments) -> list:
+    """Gắn "attachment" (xem attachments.lookup) vào các tin có tệp."""
+    if attachments:
+        for m in messages:
+            meta = attachments.get(m["id"])
+            if meta:
+                m["attachment"] = meta
+    return messages
+
+
+# ------------------ rows ------------------
+def room_rows(rows, attachments=None) -> list:
+    """rows: (id, sender_id, display_name, content, sent_at)"""
+    return _attach([{"id": _id, "sender_id": s, "sender_name": name, "content": c, "sent_at": _iso(t)}
+                    for _id, s, name, c, t in rows], attachments)
+
+
+def dm_rows(rows, attachments=None) -> list:
+    """rows: (id, sender_id, receiver_id, content, sent_at)"""
+    return _attach([{"id": _id, "sender_id": s, "receiver_id": r, "content": c, "sent_at": _iso(t)}
+                    for _id, s, r, c, t in rows], attachments)
+
+
+# ------------------ columnar ------------------
+def room_columnar(rows, attachments=None) -> dict:
+    """rows: (id, sender_id, display_name, content, sent_at) -> các cột + sender_names."""
+    if not rows:
+        return {"format": COLUMNAR, "ids": [], "sender_ids": [], "contents": [], "sent_at_ms": [],
+                "sender_names": {}}
+    ids, sender_ids, names, contents, ts = zip(*rows)
+    return _attach_columnar({
+        "format": COLUMNAR,
+        "ids": ids,
+        "sender_ids": sender_ids,
+        "contents": contents,
+        "sent_at_ms": [epoch_ms(t) for t in ts],
+        "sender_names": dict(zip(sender_ids, names)),
+    }, attachments)
+
+
+def dm_columnar(rows, attachments=None) -> dict:
+    """rows: (id, sender_id, receiver_id, content, sent_at); người nhận luôn là đầu còn lại."""
+    if not rows:
+        return {"format": COLUMNAR, "ids": [], "sender_ids": [], "contents": [], "sent_at_ms": []}
+    ids, sender_ids, _receivers, contents, ts = zip(*rows)
+    return _attach_columnar({"format": COLUMNAR, "ids": ids, "sender_ids": sender_ids, "contents": contents,
+                             "sent_at_ms": [epoch_ms(t) for t in ts]}, attachments)
+
+
+def _attach_columnar(payload: dict, attachments) -> dict:
+    """Tệp đính kèm thưa (ít tin có tệp) -> từ điển {id: meta} riêng thay vì thêm 1 cột."""
+    if attachments:
+        found = {i: attachments[i] for i in payload["ids"] if i in attachments}
+        if found:
+            payload["attachments"] = found
+    return payload
+
+
+# So sánh thời gian encode và số byte: python history_format.py
+if __name__ == "__main__":
+    import json
+    import random
+    import time
+    import zlib
+    from datetime import datetime, timedelta
+
+    names = ["Nguyễn Hữu Hoàng", "Ngô Gia Bảo", "Đỗ Thanh Tiến", "Mai Đại Trí"]
+    words = "xin chào mọi người hôm nay họp lúc mấy giờ nhé ok được rồi deadline tuần sau".split()
+    base = datetime(2025, 10, 1, 8, 0, 0)
+
+    def make_rows(n):
+        rows_dt, rows_ms = [], []
+        for i in range(n):
+            sid = 1 + i % len(names)
+            c = " ".join(random.choice(words) for _ in range(random.randint(2, 14)))
+            t = base + timedelta(seconds=37 * i)
+            rows_dt.append((10_000 + i, sid, names[sid - 1], c, t))
+            rows_ms.append((10_000 + i, sid, names[sid - 1], c, int(t.timestamp() * 1000)))
+        return rows_dt, rows_ms
+
+    def bench(fn, repeat):
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            out = fn()
+            best = min(best, time.perf_counter() - t0)
+        return best, out
+
+    header = {"action": "room_history", "room_id": 1, "after_id": 0, "limit": 300}
+    for n in (300, 5000):
+        rows_dt, rows_ms = make_rows(n)
+        repeat = 50 if n <= 300 else 10
+        cases = [
+            ("rows", lambda: json.dumps({**header, "messages": room_rows(rows_dt)})),
+            ("columnar (ms từ DB)", lambda: json.dumps({**header, **room_columnar(rows_ms)})),
+            ("columnar (ms trong Python)", lambda: json.dumps({**header, **room_columnar(
+                [(a, b, c, d, int(t.timestamp() * 1000)) for a, b, c, d, t in rows_dt])})),
+        ]
+        print(f"--- {n} tin ---")
+        for label, fn in cases:
+            dt, text = bench(fn, repeat)
+            raw = len(text.encode("utf-8"))
+            z = len(zlib.compress(text.encode("utf-8"), 6))
+            print(f"{label:28s} encode={dt * 1e3:7.2f}ms  bytes={raw:8d}  deflate={z:7d}")
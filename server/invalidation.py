@@ -0,0 +1,371 @@
+"""Bus vô hiệu hóa cache thành viên phòng / bạn bè / tên hiển thị giữa các process server.
+
+Chỉ mục trong RAM (directory.py) của mỗi process chỉ tự thấy thay đổi do chính nó làm. Thay đổi từ
+process / máy khác (join / leave phòng, chấp nhận / xóa bạn, đăng ký) đi qua 1 luồng sự kiện có version:
+- Handler ghi sự kiện (kind, a, b) bằng bus.publish(cur, ...) trong cùng transaction với thay đổi,
+  nên sự kiện có khi và chỉ khi thay đổi đã commit.
+- Mỗi process đọc sự kiện mới mỗi INVALIDATION_POLL giây (theo version tăng dần), bỏ qua sự kiện của chính nó,
+  gọi subscriber (directory.index.invalidate_many: đọc lại đúng các khóa đó từ primary).
+  -> dữ liệu cũ trong RAM bị thay trong khoảng INVALIDATION_POLL + thời gian đọc lại.
+- Version do AUTO_INCREMENT cấp nên có thể commit không theo thứ tự: version bị nhảy qua được chờ tối đa
+  INVALIDATION_GAP_TIMEOUT giây (transaction đang mở) trước khi coi là đã rollback.
+- Sửa DB bằng tay (không có sự kiện): `python invalidation.py publish <kind> <a> [b]` để báo ngay; nếu quên,
+  đối chiếu mẫu ngẫu nhiên mỗi INVALIDATION_CHECK_INTERVAL và quét toàn bộ mỗi INVALIDATION_FULL_CHECK giây
+  sẽ sửa (độ trễ tối đa = INVALIDATION_FULL_CHECK). Tỉ lệ khóa lệch tìm thấy nằm trong metrics "invalidation".
+
+Kind: "users" (a = user_id), "members" (a = room_id, b = user_id hoặc None = cả phòng),
+"friends" (a, b = cặp user, b None = mọi bạn của a).
+
+Hai transport (INVALIDATION_BUS):
+- "db": bảng cache_events trên primary, dọn sự kiện cũ hơn INVALIDATION_RETENTION giây.
+- "local": danh sách trong RAM dùng chung cho mọi Bus trong process (test: mỗi Bus có source riêng
+  giả làm 1 process, LocalTransaction giả transaction chưa commit -> version bị nhảy qua).
+
+Dòng lệnh:
+    python invalidation.py publish members 12        # phòng 12 vừa được sửa tay
+    python invalidation.py tail [n]                  # n sự kiện gần nhất
+"""
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+from config import (INVALIDATION_BUS, INVALIDATION_POLL, INVALIDATION_BATCH, INVALIDATION_GAP_TIMEOUT,
+                    INVALIDATION_RETENTION, INVALIDATION_CHECK_INTERVAL, INVALIDATION_CHECK_SAMPLE,
+                    INVALIDATION_FULL_CHECK)
+import log
+
+KINDS = ("users", "members", "friends")
+Event = namedtuple("Event", "version source kind a b ts")
+
+
+# ------------------ Transport ------------------
+class LocalTransport:
+    """Luồng sự kiện trong RAM (1 process). Version cấp lúc append như AUTO_INCREMENT; publish trên
+    LocalTransaction chỉ hiện ra khi commit() (test: commit không theo thứ tự version), cur khác thì hiện ngay."""
+
+    name = "local"
+
+    def __init__(self):
+        self._events = {}              # version -> Event đã commit
+        self._next = 1
+        self._lock = threading.Lock()
+
+    def append(self, cur, source, kind, a, b, ts):
+        with self._lock:
+            event = Event(self._next, source, kind, a, b, ts)
+            self._next += 1
+            if not isinstance(cur, LocalTransaction):
+                self._events[event.version] = event
+                return
+        cur.events.append(event)
+
+    def _commit(self, events):
+        with self._lock:
+            for e in events:
+                self._events[e.version] = e
+
+    def read(self, after, limit) -> list:
+        with self._lock:
+            return [self._events[v] for v in sorted(v for v in self._events if v > after)[:limit]]
+
+    def read_versions(self, versions) -> list:
+        with self._lock:
+            return [self._events[v] for v in versions if v in self._events]
+
+    def head(self) -> int:
+        with self._lock:
+            return max(self._events, default=0)
+
+    def oldest(self) -> int:
+        with self._lock:
+            return min(self._events, default=1)
+
+    def prune(self, before_ts) -> int:
+        with self._lock:
+            head = max(self._events, default=0)
+            old = [v for v, e in self._events.items() if e.ts < before_ts and v < head]
+            for v in old:
+                del self._events[v]
+            return len(old)
+
+
+class LocalTransaction:
+    """`cur` cho LocalTransport: sự kiện publish qua nó giữ version đã cấp nhưng chỉ đọc được sau commit()."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.events = []
+
+    def commit(self):
+        self.transport._commit(self.events)
+        self.events = []
+
+
+class DbTransport:
+    """Bảng cache_events trên primary; append chạy trên cursor của handler (cùng transaction)."""
+
+    name = "db"
+
+    def append(self, cur, source, kind, a, b, ts):
+        cur.execute("INSERT INTO cache_events (source, kind, a, b, ts) VALUES (%s, %s, %s, %s, %s)",
+                    (source, kind, a, b, ts))
+
+    def _query(self, sql, params=(), write=False):
+        from database import connect_primary
+        raw = connect_primary()
+        try:
+            cur = raw.cursor()
+            cur.execute(sql, params)
+            result = cur.rowcount if write else cur.fetchall()
+            cur.close()
+            if write:
+                raw.commit()
+            else:
+                raw.rollback()      # kết thúc snapshot đọc để lần sau thấy sự kiện mới
+            return result
+        finally:
+            raw.close()
+
+    def read(self, after, limit) -> list:
+        rows = self._query("SELECT version, source, kind, a, b, ts FROM cache_events WHERE version > %s "
+                           "ORDER BY version LIMIT %s", (after, limit))
+        return [Event(*r) for r in rows]
+
+    def read_versions(self, versions) -> list:
+        rows = self._query(f"SELECT version, source, kind, a, b, ts FROM cache_events "
+                           f"WHERE version IN ({', '.join(['%s'] * len(versions))})", tuple(versions))
+        return [Event(*r) for r in rows]
+
+    def head(self) -> int:
+        return self._query("SELECT COALESCE(MAX(version), 0) FROM cache_events")[0][0]
+
+    def oldest(self) -> int:
+        """Version nhỏ nhất còn trong bảng (1 nếu bảng rỗng: chưa từng có sự kiện, prune luôn giữ sự kiện cuối)."""
+        return self._query("SELECT COALESCE(MIN(version), 1) FROM cache_events")[0][0]
+
+    def prune(self, before_ts) -> int:
+        # Giữ lại sự kiện mới nhất: head() không lùi về 0 khi hệ thống im lặng lâu (snapshot vẫn nối tiếp được)
+        head = self.head()
+        return self._query("DELETE FROM cache_events WHERE ts < %s AND version < %s LIMIT 10000",
+                           (before_ts, head), write=True)
+
+
+# ------------------ Bus ------------------
+class Bus:
+    def __init__(self, transport, source=None, poll=INVALIDATION_POLL, batch=INVALIDATION_BATCH,
+                 gap_timeout=INVALIDATION_GAP_TIMEOUT):
+        self.transport = transport
+        self.source = source or f"{socket.gethostname()}:{os.getpid()}"[:64]
+        self.poll = poll
+        self.batch = batch
+        self.gap_timeout = gap_timeout
+        self.version = None            # đã xử lý mọi sự kiện <= version (trừ các version trong _gaps)
+        self._gaps = {}                # version bị nhảy qua -> lúc phát hiện
+        self._subscribers = []         # fn([(kind, a, b)]) -> số chỗ đã sửa
+        self._checks = []              # (tên, fn mẫu(n) -> (đã kiểm, lệch), fn toàn bộ() -> số chỗ sửa)
+        self._lock = threading.Lock()
+        self._started = False
+
+        self.published = 0
+        self.received = 0
+        self.applied = 0
+        self.fixed = 0
+        self.polls = 0
+        self.gaps_expired = 0
+        self.last_error = None
+        self._delays = deque(maxlen=500)
+        self.checked = 0
+        self.stale = 0
+        self.full_checks = 0
+        self.full_fixed = 0
+        self.last_check = None
+        self.last_full_check = None
+
+    def subscribe(self, fn):
+        self._subscribers.append(fn)
+
+    def add_check(self, name, sample_fn, full_fn=None):
+        self._checks.append((name, sample_fn, full_fn))
+
+    def publish(self, cur, kind, a, b=None):
+        """Gọi trước commit, trên cursor của transaction đã đổi dữ liệu."""
+        if kind not in KINDS:
+            raise ValueError(f"unknown kind: {kind}")
+        self.transport.append(cur, self.source, kind, a, b, time.time())
+        self.published += 1
+
+    # ------------------ Nhận sự kiện ------------------
+    def poll_once(self) -> int:
+        """Đọc và áp dụng sự kiện mới (kể cả version trước đó bị nhảy qua); trả về số sự kiện mới đã đọc."""
+        with self._lock:
+            if self.version is None:
+                self.version = self.transport.head()
+                return 0
+            now = time.time()
+            for v, seen in list(self._gaps.items()):
+                if now - seen > self.gap_timeout:
+                    del self._gaps[v]
+                    self.gaps_expired += 1
+            late = self.transport.read_versions(sorted(self._gaps)[:self.batch]) if self._gaps else []
+            for e in late:
+                del self._gaps[e.version]
+            events = self.transport.read(self.version, self.batch)
+            self.polls += 1
+            for e in events:
+                for missing in range(self.version + 1, e.version):
+                    self._gaps[missing] = now
+                self.version = e.version
+            fresh = late + events
+            self.received += len(fresh)
+            others = [e for e in fresh if e.source != self.source]
+            if others:
+                keys = list(dict.fromkeys((e.kind, e.a, e.b) for e in others))
+                try:
+                    for fn in self._subscribers:
+                        self.fixed += fn(keys) or 0
+                except Exception:
+                    # Đọc lại các sự kiện này ở lần sau (như version bị nhảy qua) thay vì bỏ mất
+                    for e in others:
+                        self._gaps[e.version] = now
+                    raise
+                done = time.time()
+                self._delays.extend((done - e.ts) * 1000 for e in others)
+                self.applied += len(others)
+            return len(events)
+
+    def applied_through(self):
+        """Mọi sự kiện có version <= giá trị này đã được áp dụng (None nếu bus chưa có mốc).
+
+        Ghi kèm snapshot chỉ mục: process mới đọc lại sự kiện từ đây (resume_from) thay vì từ head.
+        """
+        with self._lock:
+            if self.version is None:
+                return None
+            return min(self._gaps) - 1 if self._gaps else self.version
+
+    def resume_from(self, version, written_at) -> bool:
+        """Đọc lại sự kiện sau `version` (mốc của snapshot ghi lúc `written_at`); False nếu không nối tiếp được:
+        sự kiện sau mốc có thể đã bị dọn (INVALIDATION_RETENTION) hoặc mốc không thuộc luồng sự kiện này."""
+        with self._lock:
+            head = self.transport.head()
+            if version is None or version > head:
+                return False
+            recent = time.time() - written_at < INVALIDATION_RETENTION - 60
+            if version < head and not recent and self.transport.oldest() > version + 1:
+                return False
+            self.version = version
+            self._gaps.clear()
+            return True
+
+    # ------------------ Đối chiếu ------------------
+    def check_once(self, full=False):
+        """Đối chiếu mẫu (hoặc toàn bộ) cache với DB; chỗ lệch được sửa và đếm vào stale / full_fixed."""
+        for name, sample_fn, full_fn in self._checks:
+            if full and full_fn:
+                fixed = full_fn() or 0
+                self.full_checks += 1
+                self.full_fixed += fixed
+                self.last_full_check = time.time()
+                if fixed:
+                    log.warning("cache_stale_entries", cache=name, fixed=fixed, full=True)
+                continue
+            checked, stale = sample_fn(INVALIDATION_CHECK_SAMPLE)
+            self.checked += checked
+            self.stale += stale
+            self.last_check = time.time()
+            if stale:
+                log.warning("cache_stale_entries", cache=name, checked=checked, stale=stale)
+
+    def start(self):
+        """Gọi lúc khởi động server, trước khi nạp cache: mọi sự kiện từ đây về sau đều được áp dụng."""
+        if self._started:
+            return
+        self._started = True
+        try:
+            with self._lock:
+                if self.version is None:       # resume_from (snapshot) đã đặt mốc thì giữ
+                    self.version = self.transport.head()
+        except Exception as e:
+            log.error("invalidation_error", exc=e)      # lần đọc đầu tiên sẽ lấy lại mốc
+        threading.Thread(target=self._loop, name="invalidation", daemon=True).start()
+
+    def _loop(self):
+        next_check = time.time() + INVALIDATION_CHECK_INTERVAL if INVALIDATION_CHECK_INTERVAL > 0 else None
+        next_full = time.time() + INVALIDATION_FULL_CHECK if INVALIDATION_FULL_CHECK > 0 else None
+        next_prune = time.time()
+        while True:
+            try:
+                # Vòng đầu không chờ: sự kiện cần đọc lại sau snapshot (resume_from) được áp dụng ngay
+                while self.poll_once() >= self.batch:
+                    pass
+                now = time.time()
+                if next_full is not None and now >= next_full:
+                    next_full = now + INVALIDATION_FULL_CHECK
+                    self.check_once(full=True)
+                elif next_check is not None and now >= next_check:
+                    next_check = now + INVALIDATION_CHECK_INTERVAL
+                    self.check_once()
+                if now >= next_prune:
+                    next_prune = now + 60
+                    self.transport.prune(now - INVALIDATION_RETENTION)
+                self.last_error = None
+            except Exception as e:
+                if self.last_error is None:
+                    log.error("invalidation_error", exc=e)
+                self.last_error = str(e)
+            time.sleep(self.poll)
+
+    def report(self) -> dict:
+        delays = sorted(self._delays)
+        return {
+            "transport": self.transport.name,
+            "source": self.source,
+            "version": self.version,
+            "gaps_open": len(self._gaps),
+            "gaps_expired": self.gaps_expired,
+            "published": self.published,
+            "received": self.received,
+            "applied": self.applied,
+            "entries_fixed": self.fixed,
+            "delay_ms_p50": round(delays[len(delays) // 2], 1) if delays else 0.0,
+            "delay_ms_p99": round(delays[int(len(delays) * 0.99)], 1) if delays else 0.0,
+            "delay_ms_max": round(delays[-1], 1) if delays else 0.0,
+            "checked": self.checked,
+            "stale": self.stale,
+            "stale_rate": round(self.stale / self.checked, 4) if self.checked else 0.0,
+            "full_checks": self.full_checks,
+            "full_fixed": self.full_fixed,
+            "last_check": self.last_check,
+            "last_full_check": self.last_full_check,
+            "last_error": self.last_error,
+        }
+
+
+bus = Bus(DbTransport() if INVALIDATION_BUS == "db" else LocalTransport())
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["publish"] and len(args) in (3, 4) and args[1] in KINDS:
+        from database import connect_primary
+        raw = connect_primary()
+        try:
+            cur = raw.cursor()
+            bus.source = "cli"
+            bus.publish(cur, args[1], int(args[2]), int(args[3]) if len(args) == 4 else None)
+            raw.commit()
+            cur.close()
+        finally:
+            raw.close()
+        print("published")
+    elif args[:1] == ["tail"]:
+        n = int(args[1]) if len(args) > 1 else 20
+        head = bus.transport.head()
+        for e in bus.transport.read(max(head - n, 0), n):
+            print(e.version, time.strftime("%H:%M:%S", time.localtime(e.ts)), e.source, e.kind, e.a, e.b)
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,240 @@
+"""Log có cấu trúc (JSON, mỗi dòng 1 bản ghi), ghi nền qua hàng đợi.
+
+- Thread handler chỉ kiểm tra level, lấy mẫu, giới hạn tốc độ rồi put_nowait vào hàng đợi;
+  không bao giờ chờ I/O. Hàng đợi đầy thì bỏ bản ghi và đếm "dropped".
+- Mỗi loại bản ghi (event) có tỉ lệ lấy mẫu (LOG_SAMPLE) và token bucket riêng (LOG_RATES):
+  khi có bão lỗi (vd. mất DB) chỉ vài chục dòng/giây được ghi, bản ghi kế tiếp của event
+  mang "suppressed" = số bản ghi đã bị bỏ.
+- Bản ghi tự kèm ngữ cảnh của thread: action đang chạy, user_id, req_id.
+- Thread ghi gom nhiều bản ghi mỗi lần write, xoay file theo kích thước (LOG_MAX_BYTES / LOG_BACKUPS).
+- set_level() đổi level lúc đang chạy; `kill -USR1 <pid>` bật/tắt debug.
+"""
+import json
+import os
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+
+import audit
+import connection
+from config import LOG_LEVEL, LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS, LOG_QUEUE_SIZE, LOG_SAMPLE, LOG_RATES
+from ratelimit import TokenBucket
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+_level = LEVELS.get(LOG_LEVEL.lower(), 20)
+_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_buckets = {}
+_suppressed = {}
+_lock = threading.RLock()   # RLock: handler SIGUSR1 có thể chạy giữa lúc main thread đang giữ khóa
+_writer = None
+
+_written = 0
+_dropped = 0
+_rotations = 0
+
+
+def set_level(name: str) -> bool:
+    global _level
+    value = LEVELS.get(str(name).lower())
+    if value is None:
+        return False
+    _level = value
+    return True
+
+
+def get_level() -> str:
+    return next(name for name, value in LEVELS.items() if value == _level)
+
+
+def install_signal_toggle():
+    """SIGUSR1: chuyển qua lại giữa debug và LOG_LEVEL cấu hình (gọi từ main thread)."""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    def toggle(*_):
+        set_level(LOG_LEVEL if get_level() == "debug" else "debug")
+        info("log_level_changed", level=get_level())
+
+    signal.signal(signal.SIGUSR1, toggle)
+
+
+def enabled(level: str) -> bool:
+    return LEVELS[level] >= _level
+
+
+def _admit(event: str):
+    """(được ghi?, số bản ghi cùng event đã bị bỏ trước đó)."""
+    sample = LOG_SAMPLE.get(event)
+    if sample is not None and random.random() >= sample:
+        return False, 0
+    with _lock:
+        bucket = _buckets.get(event)
+        if bucket is None:
+            bucket = _buckets[event] = TokenBucket(*LOG_RATES.get(event, LOG_RATES["*"]))
+        ok, _ = bucket.take(time.monotonic())
+        if not ok:
+            _suppressed[event] = _suppressed.get(event, 0) + 1
+            return False, 0
+        return True, _suppressed.pop(event, 0)
+
+
+def _context(record: dict):
+    frame = audit.current()
+    if frame is not None:
+        record["action"] = frame.name
+    conn = getattr(connection._ctx, "conn", None)
+    if conn is not None:
+        if getattr(conn, "user_id", None):
+            record["user_id"] = conn.user_id
+        req_id = getattr(connection._ctx, "req_id", None)
+        if req_id is not None:
+            record["req_id"] = req_id
+
+
+def emit(level: str, event: str, exc=None, **fields):
+    global _dropped
+    if LEVELS[level] < _level:
+        return
+    ok, suppressed = _admit(event)
+    if not ok:
+        return
+    record = {"ts": time.time(), "level": level, "event": event, "thread": threading.current_thread().name}
+    _context(record)
+    if exc is not None:
+        record["error"] = str(exc)
+        record["error_type"] = type(exc).__name__
+    if suppressed:
+        record["suppressed"] = suppressed
+    record.update(fields)
+    _ensure_writer()
+    try:
+        _queue.put_nowait(record)
+    except queue.Full:
+        _dropped += 1
+
+
+def debug(event, **fields):
+    emit("debug", event, **fields)
+
+
+def info(event, **fields):
+    emit("info", event, **fields)
+
+
+def warning(event, exc=None, **fields):
+    emit("warning", event, exc=exc, **fields)
+
+
+def error(event, exc=None, **fields):
+    emit("error", event, exc=exc, **fields)
+
+
+# ------------------ Thread ghi ------------------
+class _Writer:
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = 0
+
+    def _open(self):
+        if not self.path:
+            self.file = sys.stdout
+            return
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.size = self.file.tell()
+
+    def _rotate(self):
+        global _rotations
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        _rotations += 1
+        self._open()
+
+    def write(self, lines: list):
+        global _written
+        if self.file is None:
+            self._open()
+        text = "".join(lines)
+        self.file.write(text)
+        self.file.flush()
+        _written += len(lines)
+        if self.path:
+            self.size += len(text.encode("utf-8"))
+            if self.max_bytes > 0 and self.size >= self.max_bytes:
+                self._rotate()
+
+    def run(self):
+        while True:
+            items = [_queue.get()]
+            # Gom mọi bản ghi đang chờ -> 1 lần write + flush
+            while len(items) < 1000:
+                try:
+                    items.append(_queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines, waiters = [], []
+            for item in items:
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    continue
+                item["ts"] = datetime.fromtimestamp(item["ts"]).isoformat(timespec="milliseconds")
+                try:
+                    lines.append(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+                except Exception as e:
+                    lines.append(json.dumps({"ts": item["ts"], "level": "error", "event": "log_encode_error",
+                                             "error": str(e), "for": item.get("event")}) + "\n")
+            try:
+                if lines:
+                    self.write(lines)
+            except Exception as e:
+                sys.stderr.write(f"log write error: {e}\n")
+            for w in waiters:
+                w.set()
+
+
+def _ensure_writer():
+    global _writer
+    if _writer is None:
+        with _lock:
+            if _writer is None:
+                _writer = _Writer(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS)
+                threading.Thread(target=_writer.run, name="log-writer", daemon=True).start()
+
+
+def flush(timeout: float = 2.0) -> bool:
+    """Chờ thread ghi xử lý hết các bản ghi đã xếp hàng (dùng khi tắt server)."""
+    if _writer is None:
+        return True
+    done = threading.Event()
+    try:
+        _queue.put(done, timeout=timeout)
+    except queue.Full:
+        return False
+    return done.wait(timeout)
+
+
+def report() -> dict:
+    with _lock:
+        suppressed = dict(_suppressed)
+    return {
+        "level": get_level(),
+        "written": _written,
+        "dropped": _dropped,
+        "queued": _queue.qsize(),
+        "rotations": _rotations,
+        "suppressed": suppressed,
+    }
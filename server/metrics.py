@@ -0,0 +1,41 @@
+import threading
+import time
+
+import log
+
+# Các nguồn thống kê: tên -> hàm trả về dict (mỗi module tự đăng ký)
+_providers = {}
+_lock = threading.Lock()
+
+
+def register(name: str, fn):
+    """Đăng ký 1 nguồn thống kê để in định kỳ / cho admin xem."""
+    with _lock:
+        _providers[name] = fn
+
+
+def snapshot() -> dict:
+    with _lock:
+        providers = list(_providers.items())
+    out = {"ts": time.time()}
+    for name, fn in providers:
+        try:
+            out[name] = fn()
+        except Exception as e:
+            out[name] = {"error": str(e)}
+    return out
+
+
+def start_reporter(interval: int):
+    """Ghi snapshot thống kê vào log mỗi `interval` giây (0 = tắt)."""
+    if interval <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            log.info("stats", stats=snapshot())
+
+    t = threading.Thread(target=loop, name="stats-reporter", daemon=True)
+    t.start()
+    return t
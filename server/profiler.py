@@ -0,0 +1,124 @@
+"""Profiler lấy mẫu stack (wall-clock) của mọi thread, bật theo yêu cầu qua kênh quản trị.
+
+- Khi tắt: không có thread nào chạy, không hook nào được cài -> không tốn gì.
+- Khi bật: 1 thread nền đọc sys._current_frames() mỗi `interval_ms`, gộp stack giống nhau.
+  Thread đang chờ (recv, khóa, DB) cũng được đếm, nên thấy được thời gian chờ lẫn thời gian CPU.
+- Kết thúc (hết `duration` hoặc stop()) thì ghi file collapsed stacks vào PROFILE_DIR:
+  mỗi dòng "thread;hàm (file:dòng);... số_mẫu", đưa thẳng vào flamegraph.pl / speedscope.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import log
+from config import PROFILE_DIR, PROFILE_INTERVAL_MS, PROFILE_MAX_SECONDS
+
+# "Thread-12 (handle_client)" -> "handle_client": gộp các thread cùng loại vào 1 gốc
+_THREAD_NAME = re.compile(r"^Thread-\d+ \((.+)\)$")
+
+
+def thread_label(name: str) -> str:
+    m = _THREAD_NAME.match(name)
+    return m.group(1) if m else re.sub(r"_\d+$", "", name)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+    def __init__(self, out_dir=PROFILE_DIR):
+        self.out_dir = out_dir
+        self._lock = threading.Lock()
+        self._stop = None
+        self._thread = None
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.duration = 0
+        self.interval = PROFILE_INTERVAL_MS / 1000
+        self.last_file = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration=30, interval_ms=PROFILE_INTERVAL_MS) -> dict:
+        duration = max(1, min(int(duration), PROFILE_MAX_SECONDS))
+        interval_ms = max(1, int(interval_ms))
+        with self._lock:
+            if self.running:
+                return {"ok": False, "error": "already_running", **self.status()}
+            self.stacks = Counter()
+            self.samples = 0
+            self.started_at = time.time()
+            self.duration = duration
+            self.interval = interval_ms / 1000
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop,), name="profiler", daemon=True)
+            self._thread.start()
+        log.info("profile_started", duration=duration, interval_ms=interval_ms)
+        return {"ok": True, **self.status()}
+
+    def stop(self, timeout=5.0) -> dict:
+        with self._lock:
+            thread, stop = self._thread, self._stop
+        if thread is None or not thread.is_alive():
+            return {"ok": False, "error": "not_running", "file": self.last_file}
+        stop.set()
+        thread.join(timeout)
+        return {"ok": True, "file": self.last_file, "samples": self.samples}
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "samples": self.samples,
+            "distinct_stacks": len(self.stacks),
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "interval_ms": round(self.interval * 1000),
+            "last_file": self.last_file,
+        }
+
+    def _run(self, stop):
+        me = threading.get_ident()
+        deadline = time.monotonic() + self.duration
+        try:
+            while not stop.is_set() and time.monotonic() < deadline:
+                self._sample(me)
+                stop.wait(self.interval)
+        finally:
+            self._dump()
+
+    def _sample(self, me):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(thread_label(names.get(ident, str(ident))))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _dump(self):
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            path = os.path.join(self.out_dir, f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded")
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            self.last_file = path
+            log.info("profile_written", file=path, samples=self.samples, distinct_stacks=len(self.stacks))
+        except Exception as e:
+            log.error("profile_write_error", exc=e)
+
+
+profiler = Profiler()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+from config import RATE_LIMITS
+
+# Số action tối đa được đếm riêng (action lạ từ client gom vào "other", như audit.py)
+_MAX_ACTIONS = 64
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float):
+        """Lấy 1 token. Trả (True, 0) nếu được phép, ngược lại (False, số giây cần chờ)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0.0
+        return False, (1 - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+
+class RateLimiter:
+    """Token bucket theo (chủ thể, action) + 1 bucket chung "*" cho mỗi chủ thể.
+
+    Chủ thể là user_id sau khi đăng nhập (dùng chung cho mọi kết nối của user),
+    hoặc id kết nối trước khi đăng nhập. Mọi thứ nằm trong RAM, 1 khóa, O(1) mỗi request.
+    """
+
+    IDLE_SECONDS = 600   # bucket không dùng quá lâu thì dọn
+
+    def __init__(self, limits=None):
+        self.limits = dict(RATE_LIMITS if limits is None else limits)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._allowed = {}
+        self._limited = {}
+        self.paused = 0
+        self._next_sweep = time.monotonic() + self.IDLE_SECONDS
+
+    def _bucket(self, subject, action, now):
+        spec = self.limits.get(action)
+        if spec is None:
+            return None
+        key = (subject, action)
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = TokenBucket(*spec)
+        return b
+
+    def check(self, subject, action):
+        """Trả (True, 0) nếu request được xử lý, hoặc (False, retry_after giây)."""
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            for name in (action, "*"):
+                b = self._bucket(subject, name, now)
+                if b is None:
+                    continue
+                ok, retry_after = b.take(now)
+                if not ok:
+                    name = self._counter_name(action)
+                    self._limited[name] = self._limited.get(name, 0) + 1
+                    return False, retry_after
+            name = self._counter_name(action)
+            self._allowed[name] = self._allowed.get(name, 0) + 1
+            return True, 0.0
+
+    def _counter_name(self, action):
+        """Tên dùng để đếm: action có giới hạn riêng / đã được đếm giữ nguyên, chuỗi tùy ý từ client thì có trần."""
+        if action in self.limits or action in self._allowed or action in self._limited:
+            return action
+        return action if len(self._allowed.keys() | self._limited.keys()) < _MAX_ACTIONS else "other"
+
+    def forget(self, subject):
+        """Bỏ các bucket của 1 chủ thể (vd: kết nối chưa đăng nhập đã đóng)."""
+        with self._lock:
+            for key in [k for k in self._buckets if k[0] == subject]:
+                del self._buckets[key]
+
+    def note_pause(self):
+        with self._lock:
+            self.paused += 1
+
+    def _sweep(self, now):
+        idle = [k for k, b in self._buckets.items() if now - b.updated > self.IDLE_SECONDS]
+        for k in idle:
+            del self._buckets[k]
+        self._next_sweep = now + self.IDLE_SECONDS
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "buckets": len(self._buckets),
+                "paused_connections": self.paused,
+                "limited": dict(self._limited),
+                "allowed": dict(self._allowed),
+            }
+
+
+limiter = RateLimiter()
@@ -0,0 +1,278 @@
+"""Chính sách lưu giữ tin theo phòng + job xóa tin hết hạn chạy nền trong server.
+
+- Chính sách: bảng room_retention (room_id, retention_days); admin phòng đặt bằng action
+  "set_room_retention". Phòng không có chính sách thì giữ mãi (vẫn được archive theo tháng).
+- Tin đã archive (partition cũ ra file, xem archive.py) cũng hết hạn: mỗi lượt job ghi lại đoạn của phòng
+  trong các file archive (Archiver.purge); lịch sử đọc từ archive lọc theo not_before() cho phần chưa kịp xóa.
+- Xóa theo lô nhỏ theo khóa chính: lấy tối đa `batch` id hết hạn của phòng rồi
+  DELETE ... WHERE id IN (...), commit từng lô -> mỗi lần chỉ khóa vài trăm dòng trong vài ms.
+- Nhường tải cho request của client: giới hạn số dòng/giây, chỉ chạy tối đa RETENTION_DUTY
+  phần thời gian, lô chậm (DB đang bận) thì giảm kích thước lô và nghỉ lâu hơn.
+"""
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from config import (RETENTION_INTERVAL, RETENTION_BATCH, RETENTION_MAX_ROWS_PER_SEC,
+                    RETENTION_DUTY, RETENTION_SLOW_BATCH_MS)
+from archive import archiver, conv_of
+from database import get_connection
+import log
+import shards
+
+
+def _close(cur, conn):
+    try:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+    except Exception:
+        pass
+
+
+def id_before(cur, ts):
+    """id lớn nhất có sent_at < ts (0 nếu không có), tìm nhị phân trên khóa chính.
+
+    id tăng theo thời gian gửi nên chỉ cần O(log n) lần đọc theo PRIMARY KEY,
+    không cần index trên sent_at và không quét bảng.
+    """
+    cur.execute("SELECT MIN(id), MAX(id) FROM messages")
+    lo, hi = cur.fetchone()
+    if lo is None:
+        return 0
+    best = 0
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        cur.execute("SELECT id, sent_at FROM messages WHERE id >= %s ORDER BY id LIMIT 1", (mid,))
+        row = cur.fetchone()
+        if row is None:
+            hi = mid - 1
+        elif row[1] < ts:
+            best = row[0]
+            lo = row[0] + 1
+        else:
+            hi = mid - 1
+    return best
+
+
+class RetentionJob:
+    def __init__(self, interval=RETENTION_INTERVAL, batch=RETENTION_BATCH,
+                 max_rows_per_sec=RETENTION_MAX_ROWS_PER_SEC, duty=RETENTION_DUTY,
+                 slow_batch_ms=RETENTION_SLOW_BATCH_MS):
+        self.interval = interval
+        self.max_batch = batch
+        self.batch = batch
+        self.max_rows_per_sec = max_rows_per_sec
+        self.duty = duty
+        self.slow_batch_ms = slow_batch_ms
+        self.on_delete = []            # callback(cur, ids) trong cùng transaction (chỉ mục tìm kiếm...)
+
+        self.rows_purged = 0
+        self.batches = 0
+        self.slow_batches = 0
+        self.backlog = {}              # room_id -> số tin hết hạn còn lại (ước lượng đầu mỗi lượt)
+        self.days = {}                 # room_id -> số ngày lưu giữ (bản sao room_retention, cho lịch sử archive)
+        self.archive_purged = 0
+        self.last_run = None
+        self.last_error = None
+        self._latencies = deque(maxlen=200)
+        self._wake = threading.Event()
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        threading.Thread(target=self._loop, name="retention", daemon=True).start()
+
+    def trigger(self):
+        """Chạy sớm (vd. vừa đổi chính sách)."""
+        self._wake.set()
+
+    def policy_changed(self, room_id, days):
+        """Admin vừa đổi chính sách (đã commit): cập nhật bản sao ngay, có hạn thì chạy sớm."""
+        if days:
+            self.days[room_id] = days
+            self.trigger()
+        else:
+            self.days.pop(room_id, None)
+
+    def not_before(self, room_id):
+        """Mốc "YYYY-MM-DD HH:MM:SS": tin của phòng gửi trước mốc này đã hết hạn; None = giữ mãi."""
+        days = self.days.get(room_id)
+        if not days:
+            return None
+        return (datetime.now() - timedelta(days=days)).isoformat(sep=" ", timespec="seconds")
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                log.error("retention_error", exc=e)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def policies(self, cur) -> list:
+        cur.execute("SELECT room_id, retention_days FROM room_retention WHERE retention_days > 0")
+        return cur.fetchall()
+
+    def run_once(self):
+        self.last_run = time.time()
+        conn = get_connection()
+        if not conn:
+            return
+        cur = None
+        try:
+            cur = conn.cursor()
+            policies = self.policies(cur)
+            self.days = dict(policies)
+            self.backlog = {}
+            if policies and not shards.enabled:
+                self._run_on(conn, cur, policies)
+        finally:
+            _close(cur, conn)
+        if policies and shards.enabled:
+            self._run_sharded(policies)
+        self._purge_archive(policies)
+
+    def _run_sharded(self, policies):
+        # Nhiều shard: tin của phòng nằm trên shard giữ phòng, mỗi shard tự tìm ranh giới id của mình
+        for shard, group in shards.by_shard(policies, lambda p: conv_of(p[0], None, None)).items():
+            sconn = shard.connect()
+            if not sconn:
+                continue
+            scur = None
+            try:
+                scur = sconn.cursor()
+                self._run_on(sconn, scur, group)
+            except Exception as e:
+                self.last_error = str(e)
+                log.error("retention_error", exc=e, shard=shard.index)
+            finally:
+                _close(scur, sconn)
+
+    def _run_on(self, conn, cur, policies):
+        # Mỗi số ngày chỉ tìm ranh giới id 1 lần (nhiều phòng thường dùng chung 30/7 ngày)
+        # Lỗi của 1 chính sách (vd. số ngày không hợp lệ sửa tay trong DB) chỉ bỏ qua phòng đó
+        cutoffs = {}
+        for room_id, days in policies:
+            if days not in cutoffs:
+                try:
+                    cutoffs[days] = id_before(cur, datetime.now() - timedelta(days=days))
+                except Exception as e:
+                    cutoffs[days] = 0
+                    self._policy_error(conn, e, room_id, days)
+        backlog = {}
+        for room_id, days in policies:
+            if cutoffs[days]:
+                cur.execute("SELECT COUNT(*) FROM messages WHERE room_id = %s AND id <= %s",
+                            (room_id, cutoffs[days]))
+                backlog[room_id] = cur.fetchone()[0]
+        self.backlog.update(backlog)
+        conn.commit()   # kết thúc snapshot đọc trước khi xóa
+        for room_id, days in policies:
+            if backlog.get(room_id):
+                try:
+                    self._purge_room(conn, cur, room_id, cutoffs[days])
+                except Exception as e:
+                    self._policy_error(conn, e, room_id, days)
+
+    def _purge_archive(self, policies):
+        """Tin hết hạn đã nằm trong file archive (partition cũ hơn ARCHIVE_AFTER_MONTHS, hoặc archive trước khi
+        đặt chính sách): DELETE trên messages không chạm tới, phải ghi lại file."""
+        if not archiver.store.entries:
+            return
+        for room_id, days in policies:
+            try:
+                self.archive_purged += archiver.purge(conv_of(room_id, None, None), self.not_before(room_id))
+            except Exception as e:
+                self.last_error = str(e)
+                log.error("retention_policy_error", exc=e, room_id=room_id, days=days, source="archive")
+
+    def _policy_error(self, conn, e, room_id, days):
+        self.last_error = str(e)
+        log.error("retention_policy_error", exc=e, room_id=room_id, days=days)
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+
+    def _purge_room(self, conn, cur, room_id, max_id):
+        while True:
+            t0 = time.perf_counter()
+            cur.execute(
+                "SELECT id FROM messages WHERE room_id = %s AND id <= %s ORDER BY id LIMIT %s",
+                (room_id, max_id, self.batch),
+            )
+            ids = [r[0] for r in cur.fetchall()]
+            if not ids:
+                conn.commit()
+                self.backlog.pop(room_id, None)
+                return
+            placeholders = ", ".join(["%s"] * len(ids))
+            cur.execute(f"DELETE FROM messages WHERE id IN ({placeholders})", tuple(ids))
+            for callback in self.on_delete:
+                callback(cur, ids)
+            conn.commit()
+            elapsed = time.perf_counter() - t0
+            self._record(room_id, len(ids), elapsed)
+            time.sleep(self._pause(len(ids), elapsed))
+
+    def _record(self, room_id, rows, elapsed):
+        self.rows_purged += rows
+        self.batches += 1
+        self._latencies.append(elapsed * 1000)
+        if room_id in self.backlog:
+            self.backlog[room_id] = max(0, self.backlog[room_id] - rows)
+        # Lô chậm = DB đang bận phục vụ client -> thu nhỏ lô; lô nhanh thì tăng dần lại
+        if elapsed * 1000 > self.slow_batch_ms:
+            self.slow_batches += 1
+            self.batch = max(10, self.batch // 2)
+        elif self.batch < self.max_batch:
+            self.batch = min(self.max_batch, self.batch + max(1, self.batch // 4))
+
+    def _pause(self, rows, elapsed) -> float:
+        """Thời gian nghỉ sau 1 lô: đủ để không vượt rows/giây và không chạy quá `duty` thời gian."""
+        by_rate = rows / self.max_rows_per_sec if self.max_rows_per_sec > 0 else 0.0
+        by_duty = elapsed * (1 - self.duty) / self.duty if 0 < self.duty < 1 else 0.0
+        return max(by_rate - elapsed, by_duty, 0.0)
+
+    def report(self) -> dict:
+        lat = sorted(self._latencies)
+        return {
+            "rows_purged": self.rows_purged,
+            "archive_rows_purged": self.archive_purged,
+            "batches": self.batches,
+            "slow_batches": self.slow_batches,
+            "batch_size": self.batch,
+            "batch_ms_p50": round(lat[len(lat) // 2], 2) if lat else 0.0,
+            "batch_ms_max": round(lat[-1], 2) if lat else 0.0,
+            "backlog_rows": sum(self.backlog.values()),
+            "backlog_rooms": len([v for v in self.backlog.values() if v]),
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+        }
+
+
+job = RetentionJob()
+
+
+def set_policy(cur, room_id, user_id, days):
+    """Admin phòng đặt số ngày lưu giữ (0/None = giữ mãi). Trả về mã lỗi hoặc None."""
+    cur.execute("SELECT role FROM room_members WHERE room_id = %s AND user_id = %s", (room_id, user_id))
+    row = cur.fetchone()
+    if not row:
+        return "not_member"
+    if row[0] != "admin":
+        return "not_admin"
+    if not days:
+        cur.execute("DELETE FROM room_retention WHERE room_id = %s", (room_id,))
+    else:
+        cur.execute(
+            "INSERT INTO room_retention (room_id, retention_days) VALUES (%s, %s) "
+            "ON DUPLICATE KEY UPDATE retention_days = VALUES(retention_days)",
+            (room_id, days),
+        )
+    return None
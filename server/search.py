@@ -0,0 +1,465 @@
+"""Tìm kiếm tin nhắn (action "search_messages").
+
+Không dò `LIKE '%...%'` trên messages.content: mọi truy vấn đi qua chỉ mục.
+Tiếng Việt được chuẩn hóa bỏ dấu (NFD, bỏ dấu thanh, đ -> d, chữ thường)
+ở cả lúc ghi lẫn lúc tìm, nên "duoc" khớp "được" và "Đà" khớp "da".
+
+Hai backend (chọn bằng SEARCH_BACKEND):
+- "mysql": bảng message_search (message_id, content_norm) có FULLTEXT index trên nội dung đã chuẩn hóa,
+  ghi cùng transaction với INSERT tin nhắn. Nên đặt innodb_ft_min_token_size=1 (hoặc 2)
+  vì từ tiếng Việt rất ngắn ("an", "di").
+- "memory": inverted index trong RAM (token -> danh sách id tăng dần), nạp từ DB lúc khởi động,
+  dùng cho máy dev / test không có FULLTEXT.
+
+Cả hai trả về (id, score) đã xếp hạng; handler lấy nội dung tin theo id từ bảng messages.
+"""
+import bisect
+import heapq
+import math
+import re
+import threading
+import time
+import unicodedata
+
+from config import SEARCH_BACKEND, SEARCH_MAX_CANDIDATES
+import directory
+import log
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize(text: str) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt (kể cả đ -> d)."""
+    text = (text or "").lower().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def tokenize(text: str) -> list:
+    return _TOKEN_RE.findall(normalize(text))
+
+
+def _scope_sql(user_id, rooms=None, alias="m"):
+    """Điều kiện "tin user được xem": phòng mình là thành viên hoặc DM của mình -> (sql, tham số).
+
+    rooms: danh sách phòng đã biết trước (shard tin nhắn không có bảng room_members, xem shards.py).
+    """
+    dm = f"({alias}.room_id IS NULL AND (%s IN ({alias}.sender_id, {alias}.receiver_id)))"
+    if rooms is None:
+        return f"({alias}.room_id IN (SELECT room_id FROM room_members WHERE user_id = %s) OR {dm})", (user_id, user_id)
+    if not rooms:
+        return dm, (user_id,)
+    return f"({alias}.room_id IN ({', '.join(['%s'] * len(rooms))}) OR {dm})", (*rooms, user_id)
+
+
+def _conv_sql(conv, user_id, alias="m"):
+    """Lọc thêm theo 1 hội thoại ("room:<id>" / "dm:<peer>"); ("", ()) nếu không lọc."""
+    kind, _, ident = str(conv or "").partition(":")
+    if not ident.isdigit():
+        return "", ()
+    if kind == "room":
+        return f" AND {alias}.room_id = %s", (int(ident),)
+    if kind == "dm":
+        peer = int(ident)
+        return (f" AND {alias}.room_id IS NULL AND "
+                f"(({alias}.sender_id = %s AND {alias}.receiver_id = %s) OR "
+                f"({alias}.sender_id = %s AND {alias}.receiver_id = %s))"), (user_id, peer, peer, user_id)
+    return "", ()
+
+
+# ------------------ MySQL FULLTEXT ------------------
+class MySQLFulltextBackend:
+    name = "mysql"
+
+    def __init__(self, messages_table="messages", search_table="message_search"):
+        # Tên bảng đổi được để `python search.py bench-mysql` đo trên bảng nháp, không đụng dữ liệu thật
+        self.messages_table = messages_table
+        self.search_table = search_table
+
+    def warm(self):
+        pass
+
+    def on_insert(self, cur, msg_id, content, room_id, sender_id, receiver_id):
+        """Gọi trong transaction INSERT tin nhắn (trước commit)."""
+        cur.execute(
+            "INSERT INTO message_search (message_id, content_norm) VALUES (%s, %s)",
+            (msg_id, " ".join(tokenize(content))),
+        )
+
+    def on_delete(self, cur, ids):
+        """Xóa cùng lúc với tin gốc (không dùng khóa ngoại: bảng messages có thể được partition)."""
+        if ids:
+            cur.execute(
+                f"DELETE FROM message_search WHERE message_id IN ({', '.join(['%s'] * len(ids))})",
+                tuple(ids),
+            )
+
+    def search(self, cur, user_id, query, limit, offset, conv=None, rooms=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return [], False
+        # Mọi từ đều phải có; từ cuối khớp theo tiền tố (đang gõ dở)
+        boolean = " ".join(f"+{t}" for t in tokens[:-1]) + f" +{tokens[-1]}*"
+        scope, scope_args = _scope_sql(user_id, rooms)
+        conv_cond, conv_args = _conv_sql(conv, user_id)
+        cur.execute(
+            f"""
+            SELECT s.message_id, MATCH(s.content_norm) AGAINST (%s IN BOOLEAN MODE) AS score
+            FROM {self.search_table} s
+            JOIN {self.messages_table} m ON m.id = s.message_id
+            WHERE MATCH(s.content_norm) AGAINST (%s IN BOOLEAN MODE)
+              AND {scope}{conv_cond}
+            ORDER BY score DESC, s.message_id DESC
+            LIMIT %s OFFSET %s
+            """,
+            (boolean, boolean, *scope_args, *conv_args, limit + 1, offset),
+        )
+        rows = cur.fetchall()
+        return [(mid, float(score)) for mid, score in rows[:limit]], len(rows) > limit
+
+    def report(self) -> dict:
+        return {"backend": self.name}
+
+
+# ------------------ Inverted index trong RAM ------------------
+class InvertedIndexBackend:
+    """token -> list id tăng dần; mỗi tin lưu (room_id, sender_id, receiver_id, số token).
+
+    Xếp hạng: tổng idf của các từ khớp, chia theo độ dài tin (tin ngắn, từ hiếm lên trước),
+    hòa điểm thì tin mới hơn trước. Chỉ chấm điểm tối đa SEARCH_MAX_CANDIDATES ứng viên mới nhất.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_candidates=SEARCH_MAX_CANDIDATES):
+        self.max_candidates = max_candidates
+        self._lock = threading.RLock()
+        self._postings = {}
+        self._docs = {}
+        self._vocab = []          # token đã sắp xếp, cho khớp tiền tố
+        self._vocab_dirty = False
+        self.ready = False
+
+    def __len__(self):
+        return len(self._docs)
+
+    def report(self) -> dict:
+        return {"backend": self.name, "ready": self.ready, "messages": len(self._docs),
+                "tokens": len(self._postings)}
+
+    def add(self, msg_id, content, room_id, sender_id, receiver_id):
+        tokens = tokenize(content)
+        with self._lock:
+            if msg_id in self._docs:
+                return
+            self._docs[msg_id] = (room_id, sender_id, receiver_id, max(len(tokens), 1))
+            for t in set(tokens):
+                plist = self._postings.get(t)
+                if plist is None:
+                    self._postings[t] = [msg_id]
+                    self._vocab_dirty = True
+                elif plist[-1] < msg_id:
+                    plist.append(msg_id)
+                else:
+                    bisect.insort(plist, msg_id)
+
+    def on_insert(self, cur, msg_id, content, room_id, sender_id, receiver_id):
+        self.add(msg_id, content, room_id, sender_id, receiver_id)
+
+    def on_delete(self, cur, ids):
+        """Bỏ tin khỏi kết quả (id vẫn nằm trong posting nhưng bị bỏ qua khi tìm)."""
+        with self._lock:
+            for mid in ids:
+                self._docs.pop(mid, None)
+
+    def warm(self, batch=50_000):
+        """Nạp toàn bộ tin từ DB (mọi shard tin nhắn, xem shards.py) theo lô id tăng dần."""
+        import shards
+        ok = True
+        for shard in shards.shards:
+            ok = self._warm_from(shard, batch) and ok
+        if ok:
+            self.ready = True
+            log.info("search_index_ready", messages=len(self._docs), tokens=len(self._postings))
+
+    def _warm_from(self, shard, batch) -> bool:
+        conn = shard.connect()
+        if not conn:
+            return False
+        cur = None
+        try:
+            cur = conn.cursor()
+            last = 0
+            while True:
+                cur.execute(
+                    "SELECT id, content, room_id, sender_id, receiver_id FROM messages "
+                    "WHERE id > %s ORDER BY id LIMIT %s",
+                    (last, batch),
+                )
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    self.add(*row)
+                last = rows[-1][0]
+            return True
+        except Exception as e:
+            log.error("search_warm_error", exc=e, shard=shard.index)
+            return False
+        finally:
+            try:
+                if cur:
+                    cur.close()
+                conn.close()
+            except Exception:
+                pass
+
+    def _expand_prefix(self, prefix):
+        if self._vocab_dirty:
+            self._vocab = sorted(self._postings)
+            self._vocab_dirty = False
+        i = bisect.bisect_left(self._vocab, prefix)
+        out = []
+        while i < len(self._vocab) and self._vocab[i].startswith(prefix):
+            out.append(self._vocab[i])
+            i += 1
+        return out
+
+    def _lookup(self, tokens):
+        """Mỗi từ -> (các list id khớp, tổng số id, idf); từ cuối lấy mọi token có tiền tố đó."""
+        n = max(len(self._docs), 1)
+        groups = []
+        for i, t in enumerate(tokens):
+            if i == len(tokens) - 1 and len(t) >= 2:
+                lists = [self._postings[w] for w in self._expand_prefix(t)]
+            else:
+                lists = [self._postings[t]] if t in self._postings else []
+            df = sum(len(ids) for ids in lists)
+            if not df:
+                return None
+            groups.append((lists, df, math.log(1 + n / df)))
+        return groups
+
+    @staticmethod
+    def _contains(lists, mid):
+        for ids in lists:
+            i = bisect.bisect_left(ids, mid)
+            if i < len(ids) and ids[i] == mid:
+                return True
+        return False
+
+    @staticmethod
+    def _newest_first(lists):
+        if len(lists) == 1:
+            yield from reversed(lists[0])
+            return
+        last = None
+        for mid in heapq.merge(*(reversed(ids) for ids in lists), reverse=True):
+            if mid != last:
+                last = mid
+                yield mid
+
+    def search_ids(self, tokens, allowed, limit, offset):
+        """allowed(room_id, sender_id, receiver_id) -> bool lọc phạm vi."""
+        with self._lock:
+            groups = self._lookup(tokens)
+            if not groups:
+                return [], False
+            # Duyệt từ id mới nhất của từ hiếm nhất; các từ còn lại kiểm tra bằng tìm nhị phân
+            groups.sort(key=lambda g: g[1])
+            base = groups[0][0]
+            others = [lists for lists, _, _ in groups[1:]]
+            idf = sum(w for _, _, w in groups)
+            scored = []
+            for mid in self._newest_first(base):
+                if not all(self._contains(lists, mid) for lists in others):
+                    continue
+                doc = self._docs.get(mid)
+                if doc is None or not allowed(doc[0], doc[1], doc[2]):
+                    continue
+                scored.append((idf / (1 + math.log(doc[3])), mid))
+                if len(scored) >= self.max_candidates:
+                    break
+        scored.sort(key=lambda x: (-x[0], -x[1]))
+        page = scored[offset:offset + limit + 1]
+        return [(mid, round(score, 4)) for score, mid in page[:limit]], len(page) > limit
+
+    def search(self, cur, user_id, query, limit, offset, conv=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return [], False
+        rooms = directory.index.rooms_of(user_id)
+        if rooms is None:
+            cur.execute("SELECT room_id FROM room_members WHERE user_id = %s", (user_id,))
+            rooms = {r[0] for r in cur.fetchall()}
+        kind, _, ident = str(conv or "").partition(":")
+        target = int(ident) if ident.isdigit() else None
+
+        def allowed(room_id, sender_id, receiver_id):
+            if room_id is not None:
+                return room_id in rooms and (kind != "dm") and (kind != "room" or room_id == target)
+            if user_id not in (sender_id, receiver_id) or kind == "room":
+                return False
+            return kind != "dm" or target in (sender_id, receiver_id)
+
+        return self.search_ids(tokens, allowed, limit, offset)
+
+
+def _make_backend():
+    if SEARCH_BACKEND == "memory":
+        return InvertedIndexBackend()
+    return MySQLFulltextBackend()
+
+
+backend = _make_backend()
+
+
+def backfill(batch=5000):
+    """Điền message_search cho tin có sẵn trước khi bật tìm kiếm (chạy 1 lần, có thể chạy lại)."""
+    from database import get_connection
+    conn = get_connection()
+    if not conn:
+        print("backfill: không kết nối được DB")
+        return
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT COALESCE(MAX(message_id), 0) FROM message_search")
+        (last,) = cur.fetchone()
+        total = 0
+        while True:
+            cur.execute("SELECT id, content FROM messages WHERE id > %s ORDER BY id LIMIT %s", (last, batch))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            cur.executemany(
+                "INSERT IGNORE INTO message_search (message_id, content_norm) VALUES (%s, %s)",
+                [(mid, " ".join(tokenize(c))) for mid, c in rows],
+            )
+            conn.commit()
+            last = rows[-1][0]
+            total += len(rows)
+            print(f"backfill: {total} tin (tới id {last})")
+    finally:
+        cur.close()
+        conn.close()
+
+
+_BENCH_WORDS = ("xin chào mọi người hôm nay họp lúc mấy giờ nhé ok được rồi deadline tuần sau "
+                "Đà Nẵng Hà Nội Sài Gòn đi ăn phở cà phê sáng mai nộp báo cáo đồ án mạng máy tính "
+                "server client socket lỗi kết nối database mysql thầy cô điểm thi cuối kì nhóm").split()
+_BENCH_QUERIES = ["ma", "duoc roi", "Đà Nẵng", "bao cao do an", "ket noi database", "mã5000", "phở",
+                  "xin chao moi nguoi"]
+_BENCH_ROOMS = set(range(1, 26))      # user đo là thành viên phòng 1..25 + DM của user 5
+_BENCH_ME = 5
+
+
+def _bench_corpus(n):
+    """(id, nội dung, room_id, sender_id, receiver_id) giả cho bench; phân bố Zipf như hội thoại thật."""
+    import random
+    weights = [1 / (i + 1) for i in range(len(_BENCH_WORDS))]
+    rnd = random.Random(7)
+    for i in range(1, n + 1):
+        c = " ".join(rnd.choices(_BENCH_WORDS, weights, k=rnd.randint(3, 15)))
+        if i % 1000 == 0:
+            c += f" mã{i}"     # token rất hiếm
+        room_id = 1 + i % 50 if i % 3 else None
+        yield i, c, room_id, i % 200 + 1, None if room_id else (i * 7) % 200 + 1
+
+
+def _bench_timed(fn, runs=5):
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return result, times[len(times) // 2] * 1e3, times[-1] * 1e3
+
+
+def bench_memory(n):
+    idx = InvertedIndexBackend()
+    contents = []
+    t0 = time.perf_counter()
+    for i, c, room_id, sender_id, receiver_id in _bench_corpus(n):
+        contents.append(c)
+        idx.add(i, c, room_id, sender_id, receiver_id)
+    build = time.perf_counter() - t0
+    print(f"{n} tin: build={build:.1f}s  tokens={len(idx._postings)}  max_candidates={idx.max_candidates}")
+
+    def allowed(room_id, s, r):
+        return room_id in _BENCH_ROOMS if room_id is not None else _BENCH_ME in (s, r)
+
+    for q in _BENCH_QUERIES:
+        toks = tokenize(q)
+        (res, _more), p50, worst = _bench_timed(lambda: idx.search_ids(toks, allowed, 20, 0))
+        print(f"index  {q!r:24s} p50={p50:8.2f}ms  max={worst:8.2f}ms  hits={len(res)}")
+
+    # So sánh: quét tuần tự (tương đương LIKE '%...%' trên cột đã bỏ dấu)
+    sample = contents[: min(n, 1_000_000)]
+    for q in ("Đà Nẵng", "mã5000"):
+        qn = normalize(q)
+        t0 = time.perf_counter()
+        hits = sum(1 for c in sample if qn in normalize(c))
+        dt = time.perf_counter() - t0
+        print(f"scan   {q!r:24s} {len(sample)} tin: {dt * 1e3:8.0f}ms  hits={hits}")
+
+
+def bench_mysql(n, keep=False, batch=5000):
+    """Đo backend FULLTEXT trên MySQL thật, trong 2 bảng nháp bench_messages / bench_message_search
+    (tạo LIKE messages / message_search, cùng index và tham số FULLTEXT của server); xóa bảng khi xong."""
+    from datetime import datetime
+    from database import connect_primary
+    raw = connect_primary()
+    cur = raw.cursor()
+    try:
+        for table, like in (("bench_messages", "messages"), ("bench_message_search", "message_search")):
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {table} LIKE {like}")
+            cur.execute(f"TRUNCATE TABLE {table}")
+        t0 = time.perf_counter()
+        now = datetime.now().replace(microsecond=0)
+        rows = []
+
+        def flush():
+            cur.executemany("INSERT INTO bench_messages (id, sender_id, receiver_id, room_id, content, sent_at) "
+                            "VALUES (%s, %s, %s, %s, %s, %s)", [r[:6] for r in rows])
+            cur.executemany("INSERT INTO bench_message_search (message_id, content_norm) VALUES (%s, %s)",
+                            [(r[0], r[6]) for r in rows])
+            raw.commit()
+            rows.clear()
+        for i, c, room_id, sender_id, receiver_id in _bench_corpus(n):
+            rows.append((i, sender_id, receiver_id, room_id, c, now, " ".join(tokenize(c))))
+            if len(rows) >= batch:
+                flush()
+        if rows:
+            flush()
+        print(f"{n} tin: load={time.perf_counter() - t0:.1f}s (bench_messages / bench_message_search)")
+
+        fulltext = MySQLFulltextBackend("bench_messages", "bench_message_search")
+        rooms = sorted(_BENCH_ROOMS)
+        for q in _BENCH_QUERIES:
+            for offset in (0, 100):
+                (res, _more), p50, worst = _bench_timed(
+                    lambda: fulltext.search(cur, _BENCH_ME, q, 20, offset, rooms=rooms))
+                print(f"mysql  {q!r:24s} offset={offset:<4d} p50={p50:8.2f}ms  max={worst:8.2f}ms  hits={len(res)}")
+        raw.rollback()
+    finally:
+        if not keep:
+            cur.execute("DROP TABLE IF EXISTS bench_message_search")
+            cur.execute("DROP TABLE IF EXISTS bench_messages")
+        cur.close()
+        raw.close()
+
+
+# python search.py backfill                   -> điền bảng message_search cho tin cũ
+# python search.py bench [N]                  -> đo index RAM trên N tin giả (mặc định 1.000.000)
+# python search.py bench-mysql [N] [--keep]   -> đo FULLTEXT MySQL trên N tin giả trong bảng nháp (mặc định 200.000)
+if __name__ == "__main__":
+    import sys
+
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if args[:1] == ["backfill"]:
+        backfill()
+    elif args[:1] == ["bench-mysql"]:
+        bench_mysql(int(args[1]) if len(args) > 1 else 200_000, keep="--keep" in sys.argv)
+    else:
+        bench_memory(int(args[1]) if args[:1] == ["bench"] and len(args) > 1 else 1_000_000)
@@ -1,12 +1,42 @@
 import socket
 import threading
 import json
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
-from database import get_connection
+from database import get_connection, pinned_connection, ensure_tables, start_replica_monitor, replica_report
+from config import STATS_INTERVAL, RATE_LIMIT_MAX_STRIKES, MAX_LINE_BYTES, PIPELINE_WORKERS, BATCH_MAX_REQUESTS, DELIVERY_BATCH
+from config import SEARCH_PAGE_SIZE, SEARCH_MAX_OFFSET, RETENTION_MAX_DAYS
+import connection
+from connection import ClientConnection, configure_socket, set_request, current_req_id
+from heartbeat import heartbeat
+from compression import choose_compressor, stats as compression_stats
+import metrics
+import history_format
+import unread
+import search
+import archive
+import retention
+import attachments
+import directory
+import invalidation
+import shards
+import statements
+import audit
+import log
+import admin
+import drain
+from drain import drainer
+import profiler
+from ratelimit import limiter
 
 # Lưu socket theo user_id sau khi đăng nhập
 user_sockets = {}
 
+# Số tin tối đa trả về cho mỗi lần lấy lịch sử (client lấy tiếp bằng after_id nếu đủ trang)
+HISTORY_LIMIT = 300
+
 # ------------------ Helpers ------------------
 def hash_password(password: str) -> str:
     return sha256(password.encode()).hexdigest()
@@ -23,44 +53,69 @@ def _safe_close(cur=None, conn=None):
     except:
         pass
 
-def _send_text(client_socket, text: str):
-    """Gửi text có newline (framing theo dòng)."""
+def _frame_type(obj) -> str:
+    """Tên loại frame (dùng cho thống kê nén)."""
+    if isinstance(obj, list):
+        return "message_list"
+    return obj.get("action") or next(iter(obj), "json")
+
+def _send_line(client_socket, text: str, frame_type: str):
     try:
-        client_socket.sendall((text + "\n").encode("utf-8"))
+        client_socket.send_line(text, frame_type)
     except:
         pass
 
+def _send_text(client_socket, text: str):
+    """Gửi text có newline (framing theo dòng).
+
+    Request có req_id thì reply text được bọc thành JSON {"action": "text", "message", "req_id"}.
+    """
+    req_id = current_req_id(client_socket)
+    if req_id is not None:
+        _send_json(client_socket, {"action": "text", "message": text})
+        return
+    _send_line(client_socket, text, "text")
+
 def _send_json(client_socket, obj: dict):
-    """Gửi JSON + newline (framing theo dòng)."""
-    try:
-        client_socket.sendall((json.dumps(obj) + "\n").encode("utf-8"))
-    except:
-        pass
+    """Gửi JSON + newline (framing theo dòng); echo req_id nếu là reply cho request có req_id."""
+    req_id = current_req_id(client_socket)
+    if req_id is not None:
+        if isinstance(obj, list):
+            obj = {"action": "message_list", "messages": obj}
+        obj = {**obj, "req_id": req_id}
+    _send_line(client_socket, json.dumps(obj), _frame_type(obj))
+
+def _history_page(request, col="id"):
+    """Đọc tham số phân trang lịch sử.
+
+    - after_id: các tin mới hơn after_id (delta fetch), id tăng dần.
+    - before_id: trang tin cũ hơn before_id (client cuộn lên đầu).
+    - latest: trang mới nhất.
+    Trả về (phần echo trong reply, điều kiện SQL, tham số, chiều ORDER BY); id không phải số -> ValueError /
+    TypeError (handler trả "invalid_request").
+    """
+    after_id = int(request.get("after_id") or 0)
+    before_id = int(request.get("before_id") or 0)
+    page = {"after_id": after_id, "limit": HISTORY_LIMIT}
+    if before_id:
+        page["before_id"] = before_id
+        return page, f"{col} < %s", (before_id,), "DESC"
+    if request.get("latest"):
+        page["latest"] = True
+        return page, f"{col} > %s", (0,), "DESC"
+    return page, f"{col} > %s", (after_id,), "ASC"
 
 # ------------------ Presence notify ------------------
 def notify_friends_presence(user_id: int, new_status: str):
     """Đẩy realtime 'presence_update' cho toàn bộ bạn bè đã kết bạn (nếu họ đang online)."""
-    conn = get_connection()
-    if not conn:
+    friends = directory.index.friends_of(user_id)
+    conn = get_connection() if friends is None else None
+    if friends is None and not conn:
         return
-    cur = None
     try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT u.user_id
-            FROM users u
-            JOIN user_relationships ur
-              ON (
-                   (u.user_id = ur.user2_id AND ur.user1_id = %s)
-                OR (u.user_id = ur.user1_id AND ur.user2_id = %s)
-                 )
-            WHERE ur.status = 'accepted'
-            """,
-            (user_id, user_id),
-        )
-        rows = cur.fetchall()
-        for (fid,) in rows:
+        if friends is None:
+            friends = [fid for (fid,) in statements.fetch_all(conn, "friend_ids", (user_id, user_id))]
+        for fid in friends:
             sock = user_sockets.get(fid)
             if sock:
                 _send_json(sock, {
@@ -69,27 +124,83 @@ def notify_friends_presence(user_id: int, new_status: str):
                     "status": new_status
                 })
     except Exception as e:
-        print("notify_friends_presence error:", e)
+        log.error("handler_error", exc=e, handler="notify_friends_presence")
     finally:
-        _safe_close(cur, conn)
+        _safe_close(None, conn)
 
-# ------------------ Broadcast / Private ------------------
-def broadcast_message(room_id: int, message: dict, sender_id: int):
-    """Gửi message (JSON) tới tất cả thành viên phòng (trừ người gửi)."""
-    conn = get_connection()
-    if not conn:
-        print("broadcast_message: DB connect failed")
-        return
-    cur = None
+# ------------------ Đọc tin trên nhiều shard ------------------
+def _fetch(conn, sql, params) -> list:
+    cur = conn.cursor()
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT display_name FROM users WHERE user_id = %s", (sender_id,))
-        row = cur.fetchone()
-        sender_name = row[0] if row else f"User {sender_id}"
+        cur.execute(sql, params)
+        return cur.fetchall()
+    finally:
+        cur.close()
+
+def _recent_sharded(conn, user_id) -> list:
+    """recent_for_user trên mọi shard: danh sách phòng lấy trước (shard không có room_members), gộp theo sent_at."""
+    rooms = sorted(directory.rooms(conn, user_id))
+    room_cond = f" OR room_id IN ({', '.join(['%s'] * len(rooms))})" if rooms else ""
+    sql = (f"SELECT id, sender_id, receiver_id, content, sent_at, room_id FROM messages "
+           f"WHERE receiver_id = %s{room_cond} ORDER BY sent_at DESC LIMIT 200")
+    parts = shards.fan_in(lambda c: _fetch(c, sql, (user_id, *rooms)), conn)
+    rows = [r for part in parts for r in part]
+    rows.sort(key=lambda r: (r[4], r[0]), reverse=True)
+    return rows[:200]
+
+def _history_attachments(conv, conn, rows) -> dict:
+    """Tệp đính kèm của 1 trang lịch sử: tin còn trong DB tra message_attachments, tin đã archive lấy từ file."""
+    ids = [r[0] for r in rows]
+    store = archive.store
+    # File archive cũ chưa mang tệp đính kèm (chờ job ghi lại, xem Archiver._reindex_one): tệp vẫn ở DB
+    migrated = all(e.get("files") for e in store.entries)
+    live = [i for i in ids if not migrated or i > store.max_id]
+    files = shards.conv_attachments(conv, conn, live) if live else {}
+    archived = [i for i in ids if i <= store.max_id]
+    if archived:
+        files.update(store.attachments(conv, archived))
+    return files
+
+def _attachments_sharded(conn, ids) -> dict:
+    files = {}
+    if ids:
+        for part in shards.fan_in(lambda c: attachments.lookup(c, ids), conn):
+            files.update(part)
+    return files
+
+def _search_sharded(conn, user_id, query, limit, offset, conv):
+    """FULLTEXT trên từng shard (mỗi shard trả offset + limit ứng viên đầu), gộp theo điểm rồi cắt trang.
+
+    Điểm MATCH tính theo thống kê của từng shard nên thứ hạng giữa các shard chỉ gần đúng.
+    """
+    rooms = sorted(directory.rooms(conn, user_id))
+
+    def run(c):
+        cur = c.cursor()
+        try:
+            return search.backend.search(cur, user_id, query, offset + limit, 0, conv, rooms)
+        finally:
+            cur.close()
+    parts = shards.fan_in(run, conn)
+    hits = sorted((h for part, _ in parts for h in part), key=lambda h: (h[1], h[0]), reverse=True)
+    more = len(hits) > offset + limit or any(m for _, m in parts)
+    return hits[offset:offset + limit], more
+
+def _search_rows_sharded(conn, ids) -> dict:
+    sql = (f"SELECT id, sender_id, NULL, receiver_id, room_id, content, sent_at FROM messages "
+           f"WHERE id IN ({', '.join(['%s'] * len(ids))})")
+    rows = [r for part in shards.fan_in(lambda c: _fetch(c, sql, tuple(ids)), conn) for r in part]
+    names = directory.names({r[1] for r in rows})
+    return {r[0]: (r[0], r[1], names.get(r[1], f"User {r[1]}"), *r[3:]) for r in rows}
 
-        cur.execute("SELECT user_id FROM room_members WHERE room_id = %s", (room_id,))
-        members = cur.fetchall()
-        for (uid,) in members:
+# ------------------ Broadcast / Private ------------------
+def broadcast_message(members, message: dict, sender_id: int, sender_name: str):
+    """Gửi message (JSON) tới các thành viên phòng đang online (trừ người gửi).
+
+    members do send_message đọc sẵn cùng truy vấn lấy tên người gửi -> không mở thêm kết nối DB.
+    """
+    try:
+        for uid in members:
             if uid == sender_id:
                 continue
             sock = user_sockets.get(uid)
@@ -101,9 +212,16 @@ def broadcast_message(room_id: int, message: dict, sender_id: int):
                     **message
                 })
     except Exception as e:
-        print("broadcast_message error:", e)
-    finally:
-        _safe_close(cur, conn)
+        log.error("handler_error", exc=e, handler="broadcast_message")
+
+def _sent_at():
+    """Giờ gửi tin, tính ở server app thay cho NOW() của MySQL (trả sent_at không cần đọc lại dòng vừa ghi).
+
+    Là giờ địa phương của máy chạy server, không múi giờ, như mọi mốc thời gian khác phía Python
+    (retention, archive so với datetime.now()): máy app và session MySQL phải cùng múi giờ, nếu không
+    sent_at lệch so với tin cũ ghi bằng NOW().
+    """
+    return datetime.now().replace(microsecond=0)
 
 def send_private_message(request, client_socket):
     """Gửi DM: lưu DB và push realtime cho receiver (nếu online)."""
@@ -122,25 +240,37 @@ def send_private_message(request, client_socket):
 
     cur = None
     try:
+        try:
+            attachment = attachments.attachment_meta(request.get("attachment"), sender_id, conn)
+        except ValueError as e:
+            _send_json(client_socket, {"action": "send_private_result", "ok": False, "error": str(e)})
+            return
+        if attachment and not content:
+            content = attachment["name"]
+
+        sent_at = _sent_at()
+        with shards.writing(archive.conv_of(None, sender_id, receiver_id), conn) as mconn:
+            msg_id = shards.insert_message(mconn, "insert_dm", (sender_id, receiver_id, content, sent_at))
+            if attachment:
+                attachments.save(mconn, msg_id, attachment)
+            mcur = mconn.cursor()
+            search.backend.on_insert(mcur, msg_id, content, None, sender_id, receiver_id)
+            mcur.close()
         cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO messages (sender_id, receiver_id, content, room_id, sent_at) "
-            "VALUES (%s, %s, %s, %s, NOW())",
-            (sender_id, receiver_id, content, None),
-        )
+        unread.bump_dm(cur, sender_id, receiver_id, msg_id)
         conn.commit()
-
-        cur.execute("SELECT sent_at FROM messages WHERE id = LAST_INSERT_ID()")
-        (sent_at,) = cur.fetchone()
-        ts = sent_at.isoformat(sep=" ") if hasattr(sent_at, "isoformat") else str(sent_at)
+        ts = sent_at.isoformat(sep=" ")
 
         msg_obj = {
+            "id": msg_id,
             "sender_id": sender_id,
             "receiver_id": receiver_id,
             "content": content,
             "sent_at": ts,
             "room_id": None
         }
+        if attachment:
+            msg_obj["attachment"] = attachment
 
         recv_sock = user_sockets.get(receiver_id)
         if recv_sock:
@@ -153,7 +283,7 @@ def send_private_message(request, client_socket):
         })
 
     except Exception as e:
-        print("send_private_message error:", e)
+        log.error("handler_error", exc=e, handler="send_private_message")
         _send_json(client_socket, {
             "action": "send_private_result",
             "ok": False,
@@ -162,6 +292,245 @@ def send_private_message(request, client_socket):
     finally:
         _safe_close(cur, conn)
 
+def deliver_offline_messages(user_id: int, client_socket):
+    """Gửi bù các DM user chưa nhận (id > con trỏ giao hàng), theo thứ tự id, tối đa DELIVERY_BATCH tin.
+
+    Luôn gửi 1 frame "offline_messages" (có thể rỗng); "more": true thì client ack kèm "next"
+    để lấy lô tiếp theo. Con trỏ chỉ tiến khi client ack, nên mất kết nối giữa chừng không mất tin.
+    """
+    reply = {"action": "offline_messages", "messages": [], "more": False}
+    conn = get_connection()
+    if not conn:
+        _send_json(client_socket, reply)
+        return
+
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT last_delivered_id FROM delivery_cursors WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+        cursor_id = row[0] if row else 0
+        sql = """
+            SELECT id, sender_id, receiver_id, content, sent_at
+            FROM messages
+            WHERE receiver_id = %s AND id > %s
+            ORDER BY id
+            LIMIT %s
+        """
+        params = (user_id, cursor_id, DELIVERY_BATCH + 1)
+        if shards.enabled:
+            # DM đến user nằm rải trên mọi shard (theo cặp hội thoại): lấy lô đầu mỗi shard rồi gộp theo id.
+            # Thiếu shard nào thì không gửi (client ack theo id lớn nhất -> tin trên shard thiếu bị bỏ qua)
+            parts = shards.fan_in(lambda c: _fetch(c, sql, params), conn, partial_ok=False)
+            rows = shards.merge_by_id(parts, limit=DELIVERY_BATCH + 1)
+        else:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        more = len(rows) > DELIVERY_BATCH
+        rows = rows[:DELIVERY_BATCH]
+        ids = [r[0] for r in rows]
+        files = _attachments_sharded(conn, ids) if shards.enabled else attachments.lookup(conn, ids)
+        _send_json(client_socket, {**reply, "messages": history_format.dm_rows(rows, files), "more": more})
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="deliver_offline_messages")
+        _send_json(client_socket, reply)
+    finally:
+        _safe_close(cur, conn)
+
+def ack_delivery(request, client_socket):
+    """Client xác nhận đã nhận mọi DM có id <= up_to; "next": true thì gửi tiếp lô sau."""
+    user_id = client_socket.user_id
+    up_to = request.get("up_to")
+    if not user_id or not isinstance(up_to, int):
+        _send_text(client_socket, "Invalid ack.")
+        return
+
+    conn = get_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        # Con trỏ chỉ tiến, không lùi (ack đến trễ / trùng không làm gửi lại tin)
+        cur.execute(
+            "INSERT INTO delivery_cursors (user_id, last_delivered_id) VALUES (%s, %s) "
+            "ON DUPLICATE KEY UPDATE last_delivered_id = GREATEST(last_delivered_id, VALUES(last_delivered_id))",
+            (user_id, up_to),
+        )
+        conn.commit()
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="ack_delivery")
+        return
+    finally:
+        _safe_close(cur, conn)
+    if request.get("next"):
+        deliver_offline_messages(user_id, client_socket)
+
+def get_unread(request, client_socket):
+    """Mọi badge chưa đọc (phòng + DM) trong 1 query: {"counts": {"room:3": 2, "dm:7": 1}}."""
+    user_id = client_socket.user_id
+    conn = get_connection()
+    if not user_id or not conn:
+        _safe_close(None, conn)
+        _send_json(client_socket, {"action": "unread_counts", "counts": {}})
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        _send_json(client_socket, {"action": "unread_counts", "counts": unread.counts(cur, user_id)})
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="get_unread")
+        _send_json(client_socket, {"action": "unread_counts", "counts": {}})
+    finally:
+        _safe_close(cur, conn)
+
+def mark_read(request, client_socket):
+    """Client đã xem hội thoại `conv` tới tin `up_to`; trả lại số tin còn chưa đọc."""
+    user_id = client_socket.user_id
+    conv = request.get("conv")
+    up_to = request.get("up_to")
+    kind, ident = unread.parse_key(conv)
+    if not user_id or kind is None or not isinstance(up_to, int):
+        _send_json(client_socket, {"action": "mark_read_result", "ok": False, "error": "invalid_request"})
+        return
+    conn = get_connection()
+    if not conn:
+        _send_json(client_socket, {"action": "mark_read_result", "ok": False, "error": "db_connect_failed"})
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        # Không phải thành viên: không được xem số tin của phòng, cũng không tạo dòng mốc cho phòng đó
+        if kind == "room" and ident not in directory.rooms(conn, user_id):
+            _send_json(client_socket, {"action": "mark_read_result", "ok": False, "error": "not_member"})
+            return
+        msg_conv = archive.conv_of(ident, None, None) if kind == "room" else archive.conv_of(None, user_id, ident)
+        with shards.reading(msg_conv, conn) as mconn:
+            mcur = mconn.cursor() if mconn is not conn else None
+            try:
+                left = unread.mark_read(cur, user_id, conv, up_to, mcur)
+            finally:
+                if mcur:
+                    mcur.close()
+        conn.commit()
+        _send_json(client_socket, {"action": "mark_read_result", "ok": True, "conv": conv, "unread": left})
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="mark_read")
+        _send_json(client_socket, {"action": "mark_read_result", "ok": False, "error": "exception"})
+    finally:
+        _safe_close(cur, conn)
+
+def search_messages(request, client_socket):
+    """Tìm tin trong các phòng + DM của user, xếp theo độ khớp; phân trang bằng offset.
+
+    request: {"query", "limit"?, "offset"?, "conv"? ("room:<id>" / "dm:<peer>")}
+    """
+    user_id = client_socket.user_id
+    query = str(request.get("query") or "")[:200]
+    conv = request.get("conv")
+    reply = {"action": "search_result", "query": query, "offset": 0, "results": [], "more": False}
+    try:
+        limit = min(max(int(request.get("limit") or SEARCH_PAGE_SIZE), 1), SEARCH_PAGE_SIZE)
+        offset = min(max(int(request.get("offset") or 0), 0), SEARCH_MAX_OFFSET)
+    except (TypeError, ValueError):
+        _send_json(client_socket, {**reply, "error": "invalid_request"})
+        return
+    reply["offset"] = offset
+    if not user_id or not query.strip():
+        _send_json(client_socket, reply)
+        return
+
+    conn = get_connection()
+    if not conn:
+        _send_json(client_socket, {**reply, "error": "db_connect_failed"})
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        if shards.enabled and search.backend.name == "mysql":
+            hits, more = _search_sharded(conn, user_id, query, limit, offset, conv)
+        else:
+            hits, more = search.backend.search(cur, user_id, query, limit, offset, conv)
+        if hits:
+            ids = [mid for mid, _ in hits]
+            if shards.enabled:
+                rows = _search_rows_sharded(conn, ids)
+            else:
+                cur.execute(
+                    f"""
+                    SELECT m.id, m.sender_id, u.display_name, m.receiver_id, m.room_id, m.content, m.sent_at
+                    FROM messages m LEFT JOIN users u ON u.user_id = m.sender_id
+                    WHERE m.id IN ({", ".join(["%s"] * len(ids))})
+                    """,
+                    tuple(ids),
+                )
+                rows = {r[0]: r for r in cur.fetchall()}
+            results = []
+            for mid, score in hits:
+                r = rows.get(mid)
+                if r is None:
+                    continue   # đã bị xóa sau khi index
+                _id, sender_id, name, receiver_id, room_id, content, sent_at = r
+                ts = sent_at.isoformat(sep=" ") if hasattr(sent_at, "isoformat") else str(sent_at)
+                results.append({"id": _id, "sender_id": sender_id, "sender_name": name,
+                                "receiver_id": receiver_id, "room_id": room_id,
+                                "content": content, "sent_at": ts, "score": score})
+            reply.update(results=results, more=more and offset + limit <= SEARCH_MAX_OFFSET)
+        _send_json(client_socket, reply)
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="search_messages")
+        _send_json(client_socket, {**reply, "error": "exception"})
+    finally:
+        _safe_close(cur, conn)
+
+# ------------------ Attachments ------------------
+def attach_begin(request, client_socket):
+    """Bắt đầu / tiếp tục upload 1 tệp (dữ liệu đi qua kênh truyền riêng, xem attachments.py)."""
+    user_id = client_socket.user_id
+    reply = {"action": "attach_begin_result", "sha256": request.get("sha256")}
+    if not user_id:
+        _send_json(client_socket, {**reply, "ok": False, "error": "not_logged_in"})
+        return
+    sha = request.get("sha256")
+
+    def can_see():
+        # Blob đã có nhưng user chưa upload nó: chỉ bỏ qua upload nếu user thấy được tin có blob đó
+        conn = get_connection()
+        if not conn:
+            return False
+        try:
+            return attachments.can_download(conn, user_id, sha)
+        finally:
+            _safe_close(None, conn)
+    _send_json(client_socket, {**reply, **attachments.begin_upload(user_id, sha, request.get("size"), can_see)})
+
+def attach_ticket(request, client_socket):
+    """Cấp vé tải 1 blob cho user thấy được ít nhất 1 tin đính kèm blob đó."""
+    user_id = client_socket.user_id
+    sha = request.get("sha256")
+    reply = {"action": "attach_ticket_result", "sha256": sha}
+    if not user_id:
+        _send_json(client_socket, {**reply, "ok": False, "error": "not_logged_in"})
+        return
+    if not attachments.store.exists(sha):
+        _send_json(client_socket, {**reply, "ok": False, "error": "not_found"})
+        return
+
+    conn = get_connection()
+    if not conn:
+        _send_json(client_socket, {**reply, "ok": False, "error": "db_connect_failed"})
+        return
+    try:
+        if not attachments.can_download(conn, user_id, sha):
+            _send_json(client_socket, {**reply, "ok": False, "error": "forbidden"})
+            return
+        _send_json(client_socket, {**reply, **attachments.download_ticket(user_id, sha)})
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="attach_ticket")
+        _send_json(client_socket, {**reply, "ok": False, "error": "exception"})
+    finally:
+        _safe_close(None, conn)
+
 # ------------------ Handlers ------------------
 def register_user(request, client_socket):
     conn = get_connection()
@@ -177,16 +546,20 @@ def register_user(request, client_socket):
         display_name = request.get("full_name")
 
         cur = conn.cursor()
-        cur.execute("SELECT 1 FROM users WHERE username = %s", (username,))
-        if cur.fetchone():
+        # 1 truy vấn kiểm tra cả 3 cột trùng; ưu tiên báo lỗi theo thứ tự username, email, tên hiển thị
+        cur.execute(
+            "SELECT MAX(username = %s), MAX(email = %s), MAX(display_name = %s) FROM users "
+            "WHERE username = %s OR email = %s OR display_name = %s",
+            (username, email, display_name, username, email, display_name),
+        )
+        taken_username, taken_email, taken_display = cur.fetchone()
+        if taken_username:
             _send_text(client_socket, "Username already exists.")
             return
-        cur.execute("SELECT 1 FROM users WHERE email = %s", (email,))
-        if cur.fetchone():
+        if taken_email:
             _send_text(client_socket, "Email already registered.")
             return
-        cur.execute("SELECT 1 FROM users WHERE display_name = %s", (display_name,))
-        if cur.fetchone():
+        if taken_display:
             _send_text(client_socket, "Display name already registered.")
             return
 
@@ -194,10 +567,13 @@ def register_user(request, client_socket):
             "INSERT INTO users (username, password, email, display_name, status) VALUES (%s, %s, %s, %s, %s)",
             (username, password, email, display_name, "offline"),
         )
+        user_id = cur.lastrowid
+        invalidation.bus.publish(cur, "users", user_id)
         conn.commit()
+        directory.index.add_user(user_id, display_name)
         _send_text(client_socket, "Registration successful.")
     except Exception as e:
-        print(f"Error during registration: {e}")
+        log.error("handler_error", exc=e, handler="register_user")
         _send_text(client_socket, "An error occurred during registration.")
     finally:
         _safe_close(cur, conn)
@@ -213,13 +589,11 @@ def login_user(request, client_socket):
         username = request["username"]
         password = hash_password(request["password"])
 
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE username = %s AND password = %s", (username, password))
-        row = cur.fetchone()
+        row = statements.fetch_one(conn, "user_login", (username, password))
 
         if row:
             user_id = row[0]
-            cur.execute("UPDATE users SET status = 'online' WHERE user_id = %s", (user_id,))
+            _, changed = statements.execute(conn, "user_set_status", ("online", user_id, "online"))
             conn.commit()
             _send_json(client_socket, {
                 "action": "login_result",
@@ -227,13 +601,15 @@ def login_user(request, client_socket):
                 "user_id": user_id,
                 "username": username
             })
-            notify_friends_presence(user_id, "online")
+            # Đã 'online' sẵn (kết nối lại sau drain/restart) thì bạn bè không cần được báo lại
+            if changed:
+                notify_friends_presence(user_id, "online")
             return user_id
         else:
             _send_json(client_socket, {"action": "login_result", "ok": False, "error": "invalid_credentials"})
             return None
     except Exception as e:
-        print(f"Error during login: {e}")
+        log.error("handler_error", exc=e, handler="login_user")
         _send_json(client_socket, {"action": "login_result", "ok": False, "error": "exception"})
         return None
     finally:
@@ -243,16 +619,15 @@ def logout_user(user_id: int):
     conn = get_connection()
     if not conn:
         return
-    cur = None
     try:
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET status = 'offline' WHERE user_id = %s", (user_id,))
+        _, changed = statements.execute(conn, "user_set_status", ("offline", user_id, "offline"))
         conn.commit()
-        notify_friends_presence(user_id, "offline")
+        if changed:
+            notify_friends_presence(user_id, "offline")
     except Exception as e:
-        print("logout_user error:", e)
+        log.error("handler_error", exc=e, handler="logout_user")
     finally:
-        _safe_close(cur, conn)
+        _safe_close(None, conn)
 
 def send_message(request, client_socket):
     sender_id = request.get("sender_id")
@@ -270,37 +645,59 @@ def send_message(request, client_socket):
 
     cur = None
     try:
+        try:
+            attachment = attachments.attachment_meta(request.get("attachment"), sender_id, conn)
+        except ValueError as e:
+            _send_json(client_socket, {"action": "send_message_result", "ok": False, "error": str(e)})
+            return
+        if attachment and not content:
+            content = attachment["name"]
+
+        # Tên người gửi + thành viên phòng (để fan-out): từ chỉ mục trong RAM, chưa sẵn sàng thì 1 truy vấn
+        fanout = directory.index.fanout(room_id, sender_id)
+        if fanout is None:
+            rows = statements.fetch_all(conn, "room_fanout", (room_id, sender_id))
+            fanout = (rows[0][0] if rows else f"User {sender_id}", [uid for _, uid in rows if uid is not None])
+        sender_name, members = fanout
+
+        sent_at = _sent_at()
+        with shards.writing(archive.conv_of(room_id, None, None), conn) as mconn:
+            msg_id = shards.insert_message(mconn, "insert_room_message", (sender_id, content, room_id, sent_at))
+            if attachment:
+                attachments.save(mconn, msg_id, attachment)
+            mcur = mconn.cursor()
+            search.backend.on_insert(mcur, msg_id, content, room_id, sender_id, None)
+            mcur.close()
         cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO messages (sender_id, content, room_id, receiver_id, sent_at) "
-            "VALUES (%s, %s, %s, %s, NOW())",
-            (sender_id, content, room_id, None),
-        )
+        unread.bump_room(cur, room_id, sender_id, msg_id)
         conn.commit()
-
-        cur.execute("SELECT sent_at FROM messages WHERE id = LAST_INSERT_ID()")
-        (sent_at,) = cur.fetchone()
-        ts = sent_at.isoformat(sep=" ") if hasattr(sent_at, "isoformat") else str(sent_at)
-        cur.execute("SELECT display_name FROM users WHERE user_id = %s", (sender_id,))
-        row = cur.fetchone()
-        sender_name = row[0] if row else f"User {sender_id}"
+        ts = sent_at.isoformat(sep=" ")
         message_obj = {
+            "id": msg_id,
             "sender_id": sender_id,
             "sender_name": sender_name,
             "content": content,
             "sent_at": ts,
             "room_id": room_id
         }
+        if attachment:
+            message_obj["attachment"] = attachment
 
-        broadcast_message(room_id, message_obj, sender_id)
+        broadcast_message(members, message_obj, sender_id, sender_name)
 
-        _send_json(client_socket, {
+        reply = {
             "action": "send_message_result",
             "ok": True,
+            "id": msg_id,
+            "room_id": room_id,
+            "content": content,
             "sent_at": ts
-        })
+        }
+        if attachment:
+            reply["attachment"] = attachment
+        _send_json(client_socket, reply)
     except Exception as e:
-        print("send_message error:", e)
+        log.error("handler_error", exc=e, handler="send_message")
         _send_json(client_socket, {
             "action": "send_message_result",
             "ok": False,
@@ -313,26 +710,18 @@ def receive_messages(request, client_socket):
     """Lịch sử chung (DM đến mình + các phòng của mình)."""
     user_id = request.get("user_id")
 
-    conn = get_connection()
+    conn = get_connection(read_only=True)
     if not conn:
         _send_json(client_socket, [])
         return
 
-    cur = None
     try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT id, sender_id, receiver_id, content, sent_at, room_id
-            FROM messages
-            WHERE receiver_id = %s
-               OR room_id IN (SELECT room_id FROM room_members WHERE user_id = %s)
-            ORDER BY sent_at DESC
-            LIMIT 200
-            """,
-            (user_id, user_id),
-        )
-        rows = cur.fetchall()
+        if shards.enabled:
+            rows = _recent_sharded(conn, user_id)
+            files = _attachments_sharded(conn, [r[0] for r in rows])
+        else:
+            rows = statements.fetch_all(conn, "recent_for_user", (user_id, user_id))
+            files = attachments.lookup(conn, [r[0] for r in rows])
 
         message_list = []
         for r in rows:
@@ -346,48 +735,50 @@ def receive_messages(request, client_socket):
                 "sent_at": ts,
                 "room_id": room_id
             })
+            if _id in files:
+                message_list[-1]["attachment"] = files[_id]
         _send_json(client_socket, message_list)
     except Exception as e:
-        print("receive_messages error:", e)
+        log.error("handler_error", exc=e, handler="receive_messages")
         _send_json(client_socket, [])
     finally:
-        _safe_close(cur, conn)
+        _safe_close(None, conn)
 
 def get_dm_history(request, client_socket):
     """Trả lịch sử DM giữa user_id và peer_id (2 chiều)."""
     me = request.get("user_id")
     peer = request.get("peer_id")
+    try:
+        page, cond, cond_args, order = _history_page(request)
+    except (TypeError, ValueError):
+        _send_json(client_socket, {"action": "dm_history", "peer_id": peer, "messages": [], "error": "invalid_request"})
+        return
+    columnar = history_format.wants_columnar(request)
+    reply = {"action": "dm_history", "peer_id": peer, **page}
 
-    conn = get_connection()
+    conn = get_connection(read_only=True)
     if not conn:
-        _send_json(client_socket, {"action": "dm_history", "peer_id": peer, "messages": []})
+        _send_json(client_socket, {**reply, "messages": []})
         return
 
-    cur = None
     try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT sender_id, receiver_id, content, sent_at
-            FROM messages
-            WHERE (sender_id = %s AND receiver_id = %s)
-               OR (sender_id = %s AND receiver_id = %s)
-            ORDER BY sent_at ASC
-            LIMIT 300
-            """,
-            (me, peer, peer, me)
-        )
-        rows = cur.fetchall()
-        out = []
-        for s, r, c, t in rows:
-            ts = t.isoformat(sep=" ") if hasattr(t, "isoformat") else str(t)
-            out.append({"sender_id": s, "receiver_id": r, "content": c, "sent_at": ts})
-        _send_json(client_socket, {"action": "dm_history", "peer_id": peer, "messages": out})
+        conv = archive.conv_of(None, me, peer)
+        name = statements.history_statement("dm", cond.split()[1], order)
+        params = (me, peer, peer, me, *cond_args, HISTORY_LIMIT)
+        rows = shards.conv_rows(conv, conn, lambda c: statements.fetch_all(c, name, params), order, HISTORY_LIMIT)
+        if order == "DESC":
+            rows.reverse()
+        rows = archive.history_rows(conv, page, page["after_id"], order, rows, HISTORY_LIMIT, room=False)
+        files = _history_attachments(conv, conn, rows)
+        if columnar:
+            _send_json(client_socket, {**reply, **history_format.dm_columnar(rows, files)})
+        else:
+            _send_json(client_socket, {**reply, "messages": history_format.dm_rows(rows, files)})
     except Exception as e:
-        print("get_dm_history error:", e)
-        _send_json(client_socket, {"action": "dm_history", "peer_id": peer, "messages": []})
+        log.error("handler_error", exc=e, handler="get_dm_history")
+        _send_json(client_socket, {**reply, "messages": []})
     finally:
-        _safe_close(cur, conn)
+        _safe_close(None, conn)
 
 def create_chat_room(request, client_socket):
     room_name = request.get("room_name", "")
@@ -401,15 +792,17 @@ def create_chat_room(request, client_socket):
     cur = None
     try:
         cur = conn.cursor()
+        # Phòng + admin trong cùng 1 transaction (1 commit; lỗi giữa chừng không để lại phòng mồ côi)
         cur.execute("INSERT INTO chat_rooms (room_name, created_by) VALUES (%s, %s)", (room_name, creator_id))
-        conn.commit()
         room_id = cur.lastrowid
         cur.execute("INSERT INTO room_members (room_id, user_id, role) VALUES (%s, %s, %s)",
                     (room_id, creator_id, "admin"))
+        invalidation.bus.publish(cur, "members", room_id, creator_id)
         conn.commit()
+        directory.index.add_member(room_id, creator_id, "admin")
         _send_text(client_socket, f"Chat room '{room_name}' created successfully.")
     except Exception as e:
-        print("create_chat_room error:", e)
+        log.error("handler_error", exc=e, handler="create_chat_room")
         _send_text(client_socket, "Room name already exists.")
     finally:
         _safe_close(cur, conn)
@@ -425,59 +818,78 @@ def join_chat_room(request, client_socket):
 
     cur = None
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT room_id FROM chat_rooms WHERE room_name = %s", (room_name,))
-        row = cur.fetchone()
+        row = statements.fetch_one(conn, "room_by_name", (room_name,))
         if not row:
             _send_text(client_socket, f"Room '{room_name}' is not exist.")
             return
         room_id = row[0]
 
-        cur.execute("SELECT 1 FROM room_members WHERE room_id = %s AND user_id = %s", (room_id, user_id))
-        if cur.fetchone():
+        if statements.fetch_one(conn, "room_member_role", (room_id, user_id)):
             _send_text(client_socket, f"You have joined the room '{room_name}' already.")
             return
 
+        cur = conn.cursor()
         cur.execute(
             "INSERT INTO room_members (room_id, user_id, role) VALUES (%s, %s, %s)",
             (room_id, user_id, "member"),
         )
+        invalidation.bus.publish(cur, "members", room_id, user_id)
         conn.commit()
+        directory.index.add_member(room_id, user_id, "member")
         _send_text(client_socket, f"Participate in the room '{room_name}' successfully.")
     except Exception as e:
-        print("join_chat_room error:", e)
+        log.error("handler_error", exc=e, handler="join_chat_room")
         _send_text(client_socket, "Join room failed.")
     finally:
         _safe_close(cur, conn)
 
+def set_room_retention(request, client_socket):
+    """Admin phòng đặt thời gian lưu giữ tin: {"room_id", "days"} (0 = giữ mãi)."""
+    room_id = request.get("room_id")
+    days = request.get("days") or 0
+    reply = {"action": "set_room_retention_result", "room_id": room_id, "days": days}
+    if (not client_socket.user_id or not isinstance(room_id, int) or isinstance(days, bool)
+            or not isinstance(days, int) or not 0 <= days <= RETENTION_MAX_DAYS):
+        _send_json(client_socket, {**reply, "ok": False, "error": "invalid_request"})
+        return
+
+    conn = get_connection()
+    if not conn:
+        _send_json(client_socket, {**reply, "ok": False, "error": "db_connect_failed"})
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        err = retention.set_policy(cur, room_id, client_socket.user_id, days)
+        if err:
+            _send_json(client_socket, {**reply, "ok": False, "error": err})
+            return
+        conn.commit()
+        _send_json(client_socket, {**reply, "ok": True})
+        retention.job.policy_changed(room_id, days)
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="set_room_retention")
+        _send_json(client_socket, {**reply, "ok": False, "error": "exception"})
+    finally:
+        _safe_close(cur, conn)
+
 def show_chat_rooms(request, client_socket):
     user_id = request.get("user_id")
 
-    conn = get_connection()
+    conn = get_connection(read_only=True)
     if not conn:
         _send_json(client_socket, {"chat_rooms": []})
         return
 
-    cur = None
     try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT cr.room_id, cr.room_name
-            FROM chat_rooms cr
-            JOIN room_members rm ON cr.room_id = rm.room_id
-            WHERE rm.user_id = %s
-            """,
-            (user_id,),
-        )
-        rows = cur.fetchall()
+        rows = statements.fetch_all(conn, "user_rooms", (user_id,))
         rooms = [{"room_id": r[0], "room_name": r[1]} for r in rows]
         _send_json(client_socket, {"chat_rooms": rooms})
     except Exception as e:
-        print("show_chat_rooms error:", e)
+        log.error("handler_error", exc=e, handler="show_chat_rooms")
         _send_json(client_socket, {"chat_rooms": []})
     finally:
-        _safe_close(cur, conn)
+        _safe_close(None, conn)
 
 def send_friend_request(request, client_socket):
     sender_id = request.get("sender_id")
@@ -491,14 +903,15 @@ def send_friend_request(request, client_socket):
     cur = None
     try:
         cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE display_name = %s", (receiver_name,))
-        row = cur.fetchone()
-        if not row:
+        known, receiver_id = directory.index.user_id(receiver_name)
+        if not known:
+            cur.execute("SELECT user_id FROM users WHERE display_name = %s", (receiver_name,))
+            row = cur.fetchone()
+            receiver_id = row[0] if row else None
+        if receiver_id is None:
             _send_text(client_socket, f"User '{receiver_name}' is not exist.")
             return
 
-        receiver_id = row[0]
-
         cur.execute("""
             SELECT 1 FROM user_relationships
             WHERE (user1_id = %s AND user2_id = %s)
@@ -517,9 +930,11 @@ def send_friend_request(request, client_socket):
 
         recv_sock = user_sockets.get(receiver_id)
         if recv_sock:
-            cur.execute("SELECT display_name FROM users WHERE user_id = %s", (sender_id,))
-            srow = cur.fetchone()
-            sender_name = srow[0] if srow else f"User {sender_id}"
+            sender_name = directory.index.display_names((sender_id,)).get(sender_id)
+            if sender_name is None:
+                cur.execute("SELECT display_name FROM users WHERE user_id = %s", (sender_id,))
+                srow = cur.fetchone()
+                sender_name = srow[0] if srow else f"User {sender_id}"
             _send_json(recv_sock, {
                 "action": "friend_request",
                 "sender_id": sender_id,
@@ -527,7 +942,7 @@ def send_friend_request(request, client_socket):
             })
 
     except Exception as e:
-        print("send_friend_request error:", e)
+        log.error("handler_error", exc=e, handler="send_friend_request")
         _send_text(client_socket, "Send friend request failed.")
     finally:
         _safe_close(cur, conn)
@@ -544,23 +959,29 @@ def accept_friend_request(request, client_socket):
     cur = None
     try:
         cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE display_name = %s", (sender_name,))
-        row = cur.fetchone()
-        if not row:
+        known, sender_id = directory.index.user_id(sender_name)
+        if not known:
+            cur.execute("SELECT user_id FROM users WHERE display_name = %s", (sender_name,))
+            row = cur.fetchone()
+            sender_id = row[0] if row else None
+        if sender_id is None:
             _send_text(client_socket, f"User '{sender_name}' is not exist.")
             return
 
-        sender_id = row[0]
-
         cur.execute(
             "UPDATE user_relationships SET status = 'accepted' "
             "WHERE user1_id = %s AND user2_id = %s AND status = 'pending'",
             (sender_id, receiver_id),
         )
+        accepted = cur.rowcount
+        if accepted:
+            invalidation.bus.publish(cur, "friends", sender_id, receiver_id)
         conn.commit()
+        if accepted:
+            directory.index.add_friends(sender_id, receiver_id)
         _send_text(client_socket, "Friend request accepted.")
     except Exception as e:
-        print("accept_friend_request error:", e)
+        log.error("handler_error", exc=e, handler="accept_friend_request")
         _send_text(client_socket, "Accept friend request failed.")
     finally:
         _safe_close(cur, conn)
@@ -568,7 +989,7 @@ def accept_friend_request(request, client_socket):
 def show_friend_requests(request, client_socket):
     user_id = request.get("user_id")
 
-    conn = get_connection()
+    conn = get_connection(read_only=True)
     if not conn:
         _send_json(client_socket, {"requests": []})
         return
@@ -590,7 +1011,7 @@ def show_friend_requests(request, client_socket):
         requests = [{"id": r[0], "display_name": r[1]} for r in rows]
         _send_json(client_socket, {"requests": requests})
     except Exception as e:
-        print("show_friend_requests error:", e)
+        log.error("handler_error", exc=e, handler="show_friend_requests")
         _send_json(client_socket, {"requests": []})
     finally:
         _safe_close(cur, conn)
@@ -599,75 +1020,65 @@ def show_friends(request, client_socket):
     """Trả về: id, display_name, status (online/offline)"""
     user_id = request.get("user_id")
 
-    conn = get_connection()
+    conn = get_connection(read_only=True)
     if not conn:
         _send_json(client_socket, {"friends": []})
         return
 
-    cur = None
     try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT DISTINCT u.user_id, u.display_name, u.status
-            FROM users u
-            JOIN user_relationships ur
-              ON (
-                   (u.user_id = ur.user2_id AND ur.user1_id = %s)
-                OR (u.user_id = ur.user1_id AND ur.user2_id = %s)
-                 )
-            WHERE ur.status = 'accepted'
-            ORDER BY u.display_name
-            """,
-            (user_id, user_id),
-        )
-        rows = cur.fetchall()
+        rows = statements.fetch_all(conn, "friends_list", (user_id, user_id))
         friends = [{"id": r[0], "display_name": r[1], "status": r[2]} for r in rows]
         _send_json(client_socket, {"friends": friends})
 
     except Exception as e:
-        print("show_friends error:", e)
+        log.error("handler_error", exc=e, handler="show_friends")
         _send_json(client_socket, {"friends": []})
     finally:
-        _safe_close(cur, conn)
+        _safe_close(None, conn)
 
 def get_room_history(request, client_socket):
     """Trả lịch sử chat của 1 phòng (room_id)."""
     room_id = request.get("room_id")
+    try:
+        page, cond, cond_args, order = _history_page(request, col="m.id")
+    except (TypeError, ValueError):
+        _send_json(client_socket, {"action": "room_history", "room_id": room_id, "messages": [],
+                                   "error": "invalid_request"})
+        return
+    columnar = history_format.wants_columnar(request)
+    reply = {"action": "room_history", "room_id": room_id, **page}
     if not room_id:
-        _send_json(client_socket, {"action": "room_history", "room_id": room_id, "messages": []})
+        _send_json(client_socket, {**reply, "messages": []})
         return
 
-    conn = get_connection()
+    conn = get_connection(read_only=True)
     if not conn:
-        _send_json(client_socket, {"action": "room_history", "room_id": room_id, "messages": []})
+        _send_json(client_socket, {**reply, "messages": []})
         return
 
-    cur = None
     try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT m.sender_id, u.display_name, m.content, m.sent_at
-            FROM messages m
-            JOIN users u ON m.sender_id = u.user_id
-            WHERE m.room_id = %s
-            ORDER BY m.sent_at ASC
-            LIMIT 300
-            """,
-            (room_id,)
-        )
-        rows = cur.fetchall()
-        out = []
-        for s, name, c, t in rows:
-            ts = t.isoformat(sep=" ") if hasattr(t, "isoformat") else str(t)
-            out.append({"sender_id": s, "sender_name": name, "content": c, "sent_at": ts})
-        _send_json(client_socket, {"action": "room_history", "room_id": room_id, "messages": out})
+        conv = archive.conv_of(room_id, None, None)
+        # Nhiều shard: shard không có bảng users -> câu không JOIN, tên người gửi lấy từ directory
+        name = statements.history_statement("room_bare" if shards.enabled else "room", cond.split()[1], order)
+        params = (room_id, *cond_args, HISTORY_LIMIT)
+        rows = shards.conv_rows(conv, conn, lambda c: statements.fetch_all(c, name, params), order, HISTORY_LIMIT)
+        if shards.enabled:
+            names = directory.names({r[1] for r in rows})
+            rows = [(r[0], r[1], names.get(r[1], f"User {r[1]}"), r[3], r[4]) for r in rows]
+        if order == "DESC":
+            rows.reverse()
+        rows = archive.history_rows(conv, page, page["after_id"], order, rows, HISTORY_LIMIT, room=True,
+                                    not_before=retention.job.not_before(room_id))
+        files = _history_attachments(conv, conn, rows)
+        if columnar:
+            _send_json(client_socket, {**reply, **history_format.room_columnar(rows, files)})
+        else:
+            _send_json(client_socket, {**reply, "messages": history_format.room_rows(rows, files)})
     except Exception as e:
-        print("get_room_history error:", e)
-        _send_json(client_socket, {"action": "room_history", "room_id": room_id, "messages": []})
+        log.error("handler_error", exc=e, handler="get_room_history")
+        _send_json(client_socket, {**reply, "messages": []})
     finally:
-        _safe_close(cur, conn)
+        _safe_close(None, conn)
 
 def remove_friend(request, client_socket):
     """
@@ -712,11 +1123,14 @@ def remove_friend(request, client_socket):
             (me, fid, fid, me)
         )
         affected = cur.rowcount
+        if affected:
+            invalidation.bus.publish(cur, "friends", me, fid)
         conn.commit()
 
         if affected == 0:
             _send_json(client_socket, {"action": "remove_friend_result", "ok": False, "error": "not_friends"})
             return
+        directory.index.remove_friends(me, fid)
 
         _send_json(client_socket, {"action": "remove_friend_result", "ok": True, "friend_id": fid})
 
@@ -726,7 +1140,7 @@ def remove_friend(request, client_socket):
             _send_json(other_sock, {"action": "friend_removed_notify", "by_user_id": me})
 
     except Exception as e:
-        print("remove_friend error:", e)
+        log.error("handler_error", exc=e, handler="remove_friend")
         _send_json(client_socket, {"action": "remove_friend_result", "ok": False, "error": "exception"})
     finally:
         _safe_close(cur, conn)
@@ -748,112 +1162,338 @@ def leave_chat_room(request, client_socket):
     try:
         cur = conn.cursor()
         cur.execute("DELETE FROM room_members WHERE room_id = %s AND user_id = %s", (room_id, user_id))
+        removed = cur.rowcount
+        if removed:
+            invalidation.bus.publish(cur, "members", room_id, user_id)
         conn.commit()
-        if cur.rowcount == 0:
+        if removed == 0:
             _send_json(client_socket, {"action": "leave_room_result", "ok": False, "error": "not_member", "room_id": room_id})
             return
+        directory.index.remove_member(room_id, user_id)
 
         _send_json(client_socket, {"action": "leave_room_result", "ok": True, "room_id": room_id})
 
     except Exception as e:
-        print("leave_chat_room error:", e)
+        log.error("handler_error", exc=e, handler="leave_chat_room")
         _send_json(client_socket, {"action": "leave_room_result", "ok": False, "error": "exception"})
     finally:
         _safe_close(cur, conn)
 
+def negotiate_connection(request, client_socket):
+    """Thỏa thuận tính năng của kết nối: hiện tại là nén frame (deflate + từ điển dùng chung)."""
+    comp = choose_compressor(request.get("compression"), request.get("zdict"))
+    _send_json(client_socket, {
+        "action": "negotiate_result",
+        "compression": comp.name if comp else None,
+        "zdict": comp.zdict_name if comp else None,
+        "threshold": comp.threshold if comp else None,
+    })
+    # Bật sau khi đã gửi reply: bản thân reply luôn ở dạng chưa nén
+    client_socket.compressor = comp
+
+# ------------------ Pipelining ------------------
+# Các action chỉ đọc: nếu request có req_id thì chạy song song trên pool worker,
+# reply về theo thứ tự hoàn thành (client ghép theo req_id).
+PIPELINE_HANDLERS = {
+    "show_chat_rooms": show_chat_rooms,
+    "show_friends": show_friends,
+    "show_friend_requests": show_friend_requests,
+    "get_room_history": get_room_history,
+    "get_dm_history": get_dm_history,
+    "receive_message": receive_messages,
+    "get_unread": get_unread,
+    "search_messages": search_messages,
+    "attach_ticket": attach_ticket,
+}
+
+pipeline_pool = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+
+def _run_pipelined(handler, request, client_socket):
+    try:
+        set_request(client_socket, request.get("req_id"))
+        with audit.action(request.get("action")):
+            handler(request, client_socket)
+    except Exception as e:
+        log.error("handler_error", exc=e, handler=request.get("action"), mode="pipelined")
+    finally:
+        set_request(None, None)
+        client_socket.inflight.release()
+
+def dispatch_pipelined(handler, request, client_socket):
+    # Hết chỗ thì chờ (ngừng đọc socket) thay vì xếp hàng vô hạn
+    client_socket.inflight.acquire()
+    try:
+        pipeline_pool.submit(_run_pipelined, handler, request, client_socket)
+    except RuntimeError:
+        client_socket.inflight.release()
+        handler(request, client_socket)
+
+# ------------------ Batch ------------------
+class _CaptureConnection:
+    """Thay socket khi chạy sub-request của batch: gom các frame reply thay vì gửi ngay."""
+
+    def __init__(self, real):
+        self.real = real
+        self.user_id = real.user_id
+        self.frames = []
+
+    def send_line(self, text: str, frame_type: str = "text"):
+        self.frames.append(text)
+
+def _run_batch_item(index, sub, client_socket, subject, out):
+    capture = _CaptureConnection(client_socket)
+    # Mỗi sub-request luôn có req_id để mọi reply đều là JSON ghép được vào kết quả
+    req_id = sub.get("req_id") if sub.get("req_id") is not None else index
+    set_request(capture, req_id)
+    try:
+        action = sub.get("action")
+        handler = PIPELINE_HANDLERS.get(action) if isinstance(action, str) else None
+        if handler is None:
+            _send_json(capture, {"action": "error", "error": "not_batchable", "for": action})
+            return
+        ok, retry_after = limiter.check(subject, action)
+        if not ok:
+            _send_json(capture, {"action": "rate_limited", "for": action, "retry_after": round(retry_after, 3)})
+            return
+        with audit.action(action):
+            handler(sub, capture)
+    except Exception as e:
+        log.error("handler_error", exc=e, handler=sub.get("action"), mode="batch")
+    finally:
+        set_request(None, None)
+        out[index] = capture.frames
+
+def _run_batch_slot(index, sub, client_socket, subject, out):
+    try:
+        _run_batch_item(index, sub, client_socket, subject, out)
+    finally:
+        client_socket.inflight.release()
+
+def handle_batch(request, client_socket, subject):
+    """Chạy nhiều request chỉ-đọc trong 1 round trip, trả về 1 frame "batch_result".
+
+    - Mặc định tuần tự, mọi sub-request dùng chung kết nối ghim (pinned_connection): đọc trên replica nếu có.
+    - "concurrent": true -> chạy song song trên pool worker, mỗi sub-request 1 kết nối; tính vào giới hạn
+      PIPELINE_MAX_INFLIGHT của kết nối như request pipelined.
+    results[i] là danh sách reply (thường là 1) của sub-request thứ i.
+    """
+    req_id = current_req_id(client_socket)
+    subs = request.get("requests")
+    if not isinstance(subs, list) or len(subs) > BATCH_MAX_REQUESTS:
+        _send_json(client_socket, {"action": "batch_result", "ok": False, "error": "invalid_batch"})
+        return
+    subs = [sub if isinstance(sub, dict) else {} for sub in subs]
+    out = [[] for _ in subs]
+
+    if request.get("concurrent") and len(subs) > 1:
+        # Mỗi sub-request chiếm 1 chỗ inflight của kết nối như request pipelined: 1 client không chiếm hết pool
+        futures = []
+        for i, sub in enumerate(subs):
+            client_socket.inflight.acquire()
+            try:
+                futures.append(pipeline_pool.submit(_run_batch_slot, i, sub, client_socket, subject, out))
+            except RuntimeError:
+                client_socket.inflight.release()
+                _run_batch_item(i, sub, client_socket, subject, out)
+        for f in futures:
+            f.result()
+    else:
+        with pinned_connection():
+            for i, sub in enumerate(subs):
+                _run_batch_item(i, sub, client_socket, subject, out)
+
+    # Reply con đã là JSON -> ghép chuỗi trực tiếp, không parse lại
+    head = {"action": "batch_result", "ok": True}
+    if req_id is not None:
+        head["req_id"] = req_id
+    results = ",".join("[" + ",".join(frames) + "]" for frames in out)
+    _send_line(client_socket, json.dumps(head)[:-1] + ', "results": [' + results + "]}", "batch_result")
+
 # ------------------ Client loop ------------------
-def handle_client(client_socket):
+def handle_client(client_socket, client_address=None):
     user_id = None
+    configure_socket(client_socket)
+    client_socket = ClientConnection(client_socket, client_address)
+    connection.register(client_socket)
+    conn_subject = f"conn:{id(client_socket)}"
+    strikes = 0   # số request bị chặn liên tiếp
     try:
         buffer = ""
         while True:
-            chunk = client_socket.recv(4096).decode("utf-8", errors="ignore")
+            try:
+                chunk = client_socket.recv(4096).decode("utf-8", errors="ignore")
+            except socket.timeout:
+                # Chưa có dữ liệu; heartbeat sẽ quyết định khi nào kết nối được coi là chết
+                if client_socket.closed:
+                    break
+                continue
             if not chunk:
                 break
             buffer += chunk
+            if len(buffer) > MAX_LINE_BYTES and "\n" not in buffer:
+                set_request(None, None)
+                _send_text(client_socket, "Request too large.")
+                break
 
             while "\n" in buffer:
                 line, buffer = buffer.split("\n", 1)
                 if not line.strip():
                     continue
+                set_request(None, None)
                 try:
                     request = json.loads(line)
                 except json.JSONDecodeError:
                     _send_text(client_socket, "Invalid JSON payload.")
                     continue
+                if not isinstance(request, dict):
+                    _send_text(client_socket, "Invalid JSON payload.")
+                    continue
 
                 action = request.get("action")
+                set_request(client_socket, request.get("req_id"))
+                if not isinstance(action, str):
+                    _send_text(client_socket, f"Unknown action: {action}")
+                    continue
+
+                if action == "pong":
+                    continue   # trả lời heartbeat; last_recv đã được cập nhật khi recv
+
+                # Giới hạn tốc độ theo user (hoặc theo kết nối khi chưa đăng nhập) và theo action
+                if action != "logout":
+                    ok, retry_after = limiter.check(user_id or conn_subject, action)
+                    if not ok:
+                        strikes += 1
+                        _send_json(client_socket, {
+                            "action": "rate_limited",
+                            "for": action,
+                            "retry_after": round(retry_after, 3)
+                        })
+                        if strikes >= RATE_LIMIT_MAX_STRIKES:
+                            # Tạm ngừng đọc socket: client gửi tiếp sẽ bị TCP chặn lại
+                            # thay vì chiếm CPU/DB của các client khác
+                            limiter.note_pause()
+                            time.sleep(min(retry_after, 5.0))
+                            strikes = 0
+                        continue
+                    strikes = 0
+
+                if request.get("req_id") is not None and action in PIPELINE_HANDLERS:
+                    dispatch_pipelined(PIPELINE_HANDLERS[action], request, client_socket)
+                    continue
 
-                if action == "register":
-                    register_user(request, client_socket)
+                # Đếm truy vấn / commit / kết nối DB của lần chạy action này (audit.py)
+                with audit.action(action):
+                    if action == "negotiate":
+                        negotiate_connection(request, client_socket)
 
-                elif action == "login":
-                    user_id = login_user(request, client_socket)
-                    if user_id:
-                        user_sockets[user_id] = client_socket
+                    elif action == "batch":
+                        handle_batch(request, client_socket, user_id or conn_subject)
 
-                elif action == "logout":
-                    if user_id:
-                        logout_user(user_id)
-                        user_sockets.pop(user_id, None)
-                        _send_text(client_socket, "Logout successful.")
-                        return
-                    else:
-                        _send_text(client_socket, "You are not logged in.")
+                    elif action == "register":
+                        register_user(request, client_socket)
 
-                elif action == "send_message":
-                    send_message(request, client_socket)
+                    elif action == "login":
+                        user_id = login_user(request, client_socket)
+                        if user_id:
+                            user_sockets[user_id] = client_socket
+                            client_socket.user_id = user_id
+                            deliver_offline_messages(user_id, client_socket)
 
-                elif action == "send_private_message":
-                    send_private_message(request, client_socket)
+                    elif action == "logout":
+                        if user_id:
+                            logout_user(user_id)
+                            if user_sockets.get(user_id) is client_socket:
+                                user_sockets.pop(user_id, None)
+                            _send_text(client_socket, "Logout successful.")
+                            user_id = None   # đã offline, finally không cần làm lại
+                            return
+                        else:
+                            _send_text(client_socket, "You are not logged in.")
 
-                elif action == "receive_message":
-                    receive_messages(request, client_socket)
+                    elif action == "send_message":
+                        send_message(request, client_socket)
 
-                elif action == "get_dm_history":
-                    get_dm_history(request, client_socket)
+                    elif action == "send_private_message":
+                        send_private_message(request, client_socket)
 
-                elif action == "create_chat_room":
-                    create_chat_room(request, client_socket)
+                    elif action == "receive_message":
+                        receive_messages(request, client_socket)
 
-                elif action == "join_chat_room":
-                    join_chat_room(request, client_socket)
+                    elif action == "ack_delivery":
+                        ack_delivery(request, client_socket)
 
-                elif action == "show_chat_rooms":
-                    show_chat_rooms(request, client_socket)
+                    elif action == "get_unread":
+                        get_unread(request, client_socket)
 
-                elif action == "send_friend_request":
-                    send_friend_request(request, client_socket)
+                    elif action == "mark_read":
+                        mark_read(request, client_socket)
 
-                elif action == "accept_friend_request":
-                    accept_friend_request(request, client_socket)
+                    elif action == "search_messages":
+                        search_messages(request, client_socket)
 
-                elif action == "show_friends":
-                    show_friends(request, client_socket)
+                    elif action == "attach_begin":
+                        attach_begin(request, client_socket)
 
-                elif action == "get_room_history":
-                    get_room_history(request, client_socket)
+                    elif action == "attach_ticket":
+                        attach_ticket(request, client_socket)
 
-                elif action == "show_friend_requests":
-                    show_friend_requests(request, client_socket)
+                    elif action == "set_room_retention":
+                        set_room_retention(request, client_socket)
 
-                elif action == "remove_friend":
-                    remove_friend(request, client_socket)
+                    elif action == "get_dm_history":
+                        get_dm_history(request, client_socket)
 
-                elif action == "leave_chat_room":
-                    leave_chat_room(request, client_socket)
+                    elif action == "create_chat_room":
+                        create_chat_room(request, client_socket)
 
-                elif action == "delete_friend":   # alias cũ
-                    remove_friend(request, client_socket)
+                    elif action == "join_chat_room":
+                        join_chat_room(request, client_socket)
 
-                else:
-                    _send_text(client_socket, f"Unknown action: {action}")
+                    elif action == "show_chat_rooms":
+                        show_chat_rooms(request, client_socket)
+
+                    elif action == "send_friend_request":
+                        send_friend_request(request, client_socket)
+
+                    elif action == "accept_friend_request":
+                        accept_friend_request(request, client_socket)
+
+                    elif action == "show_friends":
+                        show_friends(request, client_socket)
+
+                    elif action == "get_room_history":
+                        get_room_history(request, client_socket)
+
+                    elif action == "show_friend_requests":
+                        show_friend_requests(request, client_socket)
+
+                    elif action == "remove_friend":
+                        remove_friend(request, client_socket)
+
+                    elif action == "leave_chat_room":
+                        leave_chat_room(request, client_socket)
+
+                    elif action == "delete_friend":   # alias cũ
+                        remove_friend(request, client_socket)
+
+                    else:
+                        _send_text(client_socket, f"Unknown action: {action}")
 
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("connection_error", exc=e, peer=str(client_address))
     finally:
+        limiter.forget(conn_subject)
+        connection.unregister(client_socket)
+        log.info("connection_closed", peer=str(client_address), user_id=user_id,
+                 reason=client_socket.close_reason, bytes_in=client_socket.bytes_in,
+                 bytes_out=client_socket.bytes_out,
+                 duration_s=round(time.time() - client_socket.connected_at, 1))
         try:
-            if user_id:
+            # Chỉ offline nếu đây là kết nối hiện hành của user (user có thể đã đăng nhập lại ở nơi khác).
+            # Đang drain thì giữ 'online': client sẽ kết nối lại process mới, tránh bão presence.
+            if user_id and user_sockets.get(user_id) is client_socket and drainer.draining:
+                user_sockets.pop(user_id, None)
+            elif user_id and user_sockets.get(user_id) is client_socket:
                 user_sockets.pop(user_id, None)
                 conn = get_connection()
                 if conn:
@@ -863,23 +1503,266 @@ def handle_client(client_socket):
                     _safe_close(cur, conn)
                 notify_friends_presence(user_id, "offline")
         except Exception as e:
-            print("offline update error:", e)
+            log.error("handler_error", exc=e, handler="offline_update")
         try:
             client_socket.close()
         except:
             pass
 
 # ------------------ Server bootstrap ------------------
+def _forget_archived(ids):
+    """Tin vừa được archive không còn trong bảng messages: bỏ khỏi chỉ mục tìm kiếm và message_attachments
+    (tệp đính kèm đã nằm trong file archive cùng tin)."""
+    conn = get_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        for i in range(0, len(ids), 1000):
+            search.backend.on_delete(cur, ids[i:i + 1000])
+            attachments.on_delete(cur, ids[i:i + 1000])
+            conn.commit()
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="forget_archived")
+    finally:
+        _safe_close(cur, conn)
+
+def reset_presence():
+    """Server vừa khởi động thì chưa ai kết nối: xóa trạng thái 'online' sót lại từ lần chạy trước."""
+    conn = get_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET status = 'offline' WHERE status = 'online'")
+        conn.commit()
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="reset_presence")
+    finally:
+        _safe_close(cur, conn)
+
+def reconcile_presence():
+    """Process nhận socket từ process cũ: user còn 'online' trong DB mà không kết nối lại thì chuyển offline."""
+    conn = get_connection()
+    if not conn:
+        return
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT user_id FROM users WHERE status = 'online'")
+        gone = [uid for (uid,) in cur.fetchall() if uid not in user_sockets]
+        for uid in gone:
+            cur.execute("UPDATE users SET status = 'offline' WHERE user_id = %s", (uid,))
+        conn.commit()
+        log.info("presence_reconciled", offline=len(gone))
+        for uid in gone:
+            notify_friends_presence(uid, "offline")
+    except Exception as e:
+        log.error("handler_error", exc=e, handler="reconcile_presence")
+    finally:
+        _safe_close(cur, conn)
+
+# ------------------ Admin: xem trạng thái kết nối (admin.py) ------------------
+# Các lệnh chỉ đọc snapshot (danh sách kết nối được copy dưới khóa registry), không khóa luồng dữ liệu.
+@admin.command("sessions")
+def _admin_sessions(request):
+    """Mọi kết nối đang mở: user, byte vào/ra, lần hoạt động cuối, hàng đợi gửi, request đang chạy."""
+    now = time.time()
+    only_user = request.get("user_id")
+    limit = int(request.get("limit") or 200)
+    conns = sorted(connection.all_connections(), key=lambda c: c.connected_at)
+    sessions = []
+    for c in conns:
+        if only_user is not None and c.user_id != only_user:
+            continue
+        if len(sessions) >= limit:
+            break
+        sessions.append({
+            "conn_id": c.id,
+            "peer": str(c.address),
+            "user_id": c.user_id,
+            "current": c.user_id is not None and user_sockets.get(c.user_id) is c,
+            "connected_s": round(now - c.connected_at, 1),
+            "idle_s": round(now - c.last_recv, 1),
+            "last_send_s": round(now - c.last_send, 1) if c.last_send else None,
+            "bytes_in": c.bytes_in,
+            "bytes_out": c.bytes_out,
+            "outbound_backlog": c.outbound_backlog(),
+            "inflight": c.inflight_count(),
+            "compression": getattr(c.compressor, "name", None),
+            "closed": c.closed,
+        })
+    return {
+        "ok": True,
+        "connections": len(conns),
+        "logged_in": len(user_sockets),
+        "threads": _admin_thread_counts(),
+        "sessions": sessions,
+    }
+
+def _admin_thread_counts() -> dict:
+    counts = {}
+    for t in threading.enumerate():
+        label = profiler.thread_label(t.name)
+        counts[label] = counts.get(label, 0) + 1
+    return counts
+
+@admin.command("threads")
+def _admin_threads(request):
+    return {"ok": True, "total": threading.active_count(), "by_name": _admin_thread_counts()}
+
+@admin.command("rooms")
+def _admin_rooms(request):
+    """Phòng có fan-out lớn nhất: số thành viên và số thành viên đang online (nhận broadcast)."""
+    limit = int(request.get("limit") or 20)
+    online = list(user_sockets)
+    conn = get_connection()
+    if not conn:
+        return {"ok": False, "error": "db_connect_failed"}
+    cur = None
+    try:
+        cur = conn.cursor()
+        online_expr = f"SUM(user_id IN ({', '.join(['%s'] * len(online))}))" if online else "0"
+        cur.execute(
+            f"SELECT room_id, COUNT(*) AS members, {online_expr} AS online FROM room_members "
+            f"GROUP BY room_id ORDER BY online DESC, members DESC LIMIT %s",
+            (*online, limit),
+        )
+        rooms = [{"room_id": r, "members": m, "online": int(o or 0)} for r, m, o in cur.fetchall()]
+        return {"ok": True, "rooms": rooms}
+    finally:
+        _safe_close(cur, conn)
+
+@admin.command("caches")
+def _admin_caches(request):
+    stmts = statements.report()
+    return {
+        "ok": True,
+        "search": search.backend.report(),
+        "directory": directory.index.report(),
+        "invalidation": invalidation.bus.report(),
+        "archive": archive.store.report(),
+        "statements": {"sessions": stmts["sessions"], "calls": stmts["calls"], "hit_rate": stmts["hit_rate"]},
+        "rate_limit": limiter.report(),
+        "pipeline": {"workers": PIPELINE_WORKERS, "queued": pipeline_pool._work_queue.qsize()},
+    }
+
+@admin.command("directory")
+def _admin_directory(request):
+    """Chỉ mục trong RAM: {"reconcile": true} = quét đối chiếu lại với DB, {"snapshot": true} = ghi snapshot ngay."""
+    if request.get("reconcile"):
+        directory.index.trigger_reconcile()
+    if request.get("snapshot"):
+        directory.index.write_snapshot(force=True)
+    return {"ok": True, **directory.index.report()}
+
+@admin.command("disconnect")
+def _admin_disconnect(request):
+    """Ngắt kết nối theo conn_id hoặc mọi kết nối của user_id; handler của kết nối tự dọn dẹp."""
+    conn_id = request.get("conn_id")
+    uid = request.get("user_id")
+    if conn_id is None and uid is None:
+        return {"ok": False, "error": "conn_id_or_user_id_required"}
+    closed = []
+    for c in connection.all_connections():
+        if (conn_id is not None and c.id == conn_id) or (uid is not None and c.user_id == uid):
+            c.abort("admin_disconnect")
+            closed.append(c.id)
+    log.info("admin_disconnect", conn_ids=closed, user_id=uid)
+    return {"ok": bool(closed), "closed": closed}
+
+@admin.command("drain")
+def _admin_drain(request):
+    """Drain: {"handoff": true} = chuyển socket listen cho process mới; "window" = số giây rải kết nối lại."""
+    return drainer.request(_listener, handoff=bool(request.get("handoff")), window=request.get("window"))
+
+_listener = None
+
 def start_server():
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(("0.0.0.0", 5000))
-    server.listen(5)
-    print("Server started on port 5000...")
-
-    while True:
-        client_socket, client_address = server.accept()
-        print(f"New connection from {client_address}")
-        threading.Thread(target=handle_client, args=(client_socket,), daemon=True).start()
+    global _listener
+    started_at = time.time()
+    inherited = drain.inherited_listener()
+    if inherited is not None:
+        # Restart không gián đoạn: dùng lại socket đang listen của process cũ
+        server = socket.socket(fileno=inherited)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Khởi động lại ngay sau khi drain: cổng còn kết nối TIME_WAIT của process cũ
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("0.0.0.0", 5000))
+        server.listen(5)
+    _listener = server
+    log.info("server_started", port=5000, inherited=inherited is not None)
+    log.install_signal_toggle()
+    drain.install_signals(server)
+    drainer.before_handoff(admin.stop)
+    drainer.on_handoff_failed(admin.start)
+    drainer.before_handoff(attachments.server.stop)
+    drainer.on_handoff_failed(attachments.server.start)
+    drainer.before_handoff(directory.index.save)
+    drainer.after_drain(directory.index.save)
+    ensure_tables()
+    start_replica_monitor()
+    # Nhiều shard tin nhắn: nạp bảng bucket -> shard + bộ cấp id trước khi nhận request
+    shards.start()
+    # Thay đổi thành viên / bạn bè từ process khác: nhận sự kiện từ trước khi nạp chỉ mục (không lọt khoảng giữa)
+    invalidation.bus.subscribe(directory.index.invalidate_many)
+    invalidation.bus.add_check("directory", directory.index.check_sample, directory.index.check_full)
+    invalidation.bus.start()
+    # Chỉ mục thành viên / bạn bè / tên: từ snapshot nếu có (ngay), không thì nạp nền theo lô
+    directory.index.start(started_at)
+    if inherited is None:
+        reset_presence()
+    else:
+        # Giữ trạng thái online của user từ process cũ; ai không quay lại thì đối chiếu sau
+        timer = threading.Timer(drain.reconcile_delay(), reconcile_presence)
+        timer.daemon = True
+        timer.start()
+    threading.Thread(target=search.backend.warm, name="search-warm", daemon=True).start()
+    metrics.register("compression", compression_stats.report)
+    metrics.register("rate_limit", limiter.report)
+    metrics.register("heartbeat", heartbeat.report)
+    metrics.register("archive", archive.archiver.report)
+    metrics.register("retention", retention.job.report)
+    metrics.register("statements", statements.report)
+    metrics.register("query_budget", audit.report)
+    metrics.register("log", log.report)
+    metrics.register("attachments", attachments.server.report)
+    metrics.register("directory", directory.index.report)
+    metrics.register("replicas", replica_report)
+    metrics.register("shards", shards.report)
+    metrics.register("invalidation", invalidation.bus.report)
+    metrics.start_reporter(STATS_INTERVAL)
+    admin.start()
+    attachments.server.start()
+    heartbeat.start()
+    archive.archiver.on_archived.append(_forget_archived)
+    archive.archiver.start()
+    retention.job.on_delete.append(search.backend.on_delete)
+    retention.job.on_delete.append(attachments.on_delete)
+    retention.job.start()
+
+    drain.signal_ready()
+    log.info("server_ready", startup_ms=round((time.time() - started_at) * 1000, 1),
+             directory_ready=directory.index.ready)
+    # Timeout để vòng accept thấy được yêu cầu drain
+    server.settimeout(0.5)
+    while not drainer.stop_accepting.is_set():
+        try:
+            client_socket, client_address = server.accept()
+        except socket.timeout:
+            continue
+        except OSError as e:
+            log.error("accept_error", exc=e)
+            time.sleep(0.1)
+            continue
+        client_socket.settimeout(None)
+        log.info("connection_open", peer=str(client_address))
+        threading.Thread(target=handle_client, args=(client_socket, client_address), daemon=True).start()
+
+    drainer.run(server, wait_idle=lambda: pipeline_pool.shutdown(wait=True))
 
 if __name__ == "__main__":
     start_server()
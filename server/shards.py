@@ -0,0 +1,657 @@
+"""Chia bảng messages theo hội thoại ra nhiều DB (MESSAGE_SHARDS).
+
+- Khóa hội thoại "room:<id>" / "dm:<nhỏ>-<lớn>" (archive.conv_of) -> bucket = CRC32(khóa) % MESSAGE_SHARD_BUCKETS
+  -> shard theo bảng message_shard_map trên primary. Bucket chưa có dòng nào thuộc primary, nên bật nhiều
+  shard không làm đổi chỗ dữ liệu cũ; bucket được chuyển dần bằng công cụ dòng lệnh bên dưới.
+- Mỗi shard giữ messages + các bảng đi theo tin (message_attachments, message_search). users, phòng, bạn bè,
+  badge chưa đọc, con trỏ giao hàng vẫn ở primary.
+- Ghi: `with shards.writing(conv, conn) as mconn` -> kết nối của shard giữ hội thoại (chính `conn` nếu là
+  primary, shard khác thì commit khi ra khỏi khối). Id tin lấy từ bộ cấp id chung (message_id_seq trên primary,
+  1 id mỗi tin) để id vẫn duy nhất trên mọi shard và được cấp theo thứ tự thời gian giữa mọi process, giống
+  AUTO_INCREMENT khi chỉ có 1 DB: con trỏ lịch sử, giao hàng, đã đọc đều dựa vào id. Không xin id theo khối:
+  khối của các process khác nhau xen kẽ nhau làm tin mới có id nhỏ hơn con trỏ giao hàng / after_id đã tiến qua.
+- Đọc 1 hội thoại: conv_rows() trên shard giữ nó; bucket đang chuyển thì đọc cả shard mới lẫn cũ, gộp theo id.
+- Đọc nhiều hội thoại (receive_messages, gửi bù offline, tìm kiếm): fan_in(fn) chạy fn trên mọi shard song song,
+  người gọi gộp kết quả. Shard lỗi bị bỏ qua (log + đếm "partial") thay vì làm hỏng cả request.
+- Chỉ 1 shard (mặc định): mọi hàm đi đúng đường cũ (AUTO_INCREMENT, 1 kết nối, 1 transaction).
+
+Chuyển bucket (online, chạy lại được nếu bị ngắt giữa chừng):
+  1. chép tin của các bucket sang shard đích theo lô khoảng id (INSERT IGNORE), tới id lớn nhất lúc bắt đầu;
+  2. đổi map: ghi vào shard đích, đọc cả 2 shard; chờ mọi server đọc lại map (MESSAGE_SHARD_MAP_REFRESH);
+  3. chép lại toàn bộ khoảng id (INSERT IGNORE bỏ qua tin đã có): tin được cấp id trước mốc của bước 1 nhưng
+     commit sau khi bước 1 quét qua khoảng đó vẫn được chép trước khi bước 4 xóa bản cũ;
+  4. chỉ đọc shard đích; chờ thêm 1 lượt đọc map rồi xóa bản cũ theo lô.
+
+Dòng lệnh:
+    python shards.py init                        # tạo bảng tin trên các shard + khởi tạo bộ cấp id
+    python shards.py status                      # số bucket / số tin (ước lượng) mỗi shard, bucket đang chuyển
+    python shards.py move <shard> <bucket>[,<bucket>...]
+    python shards.py rebalance [--dry-run]       # chia đều bucket cho mọi shard
+    python shards.py cleanup [--dry-run]         # xóa tin nằm sai shard (vd. bước 4 bị ngắt)
+"""
+import re
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from config import (MESSAGE_SHARDS, MESSAGE_SHARD_USER, MESSAGE_SHARD_PASSWORD, MESSAGE_SHARD_POOL_SIZE,
+                    MESSAGE_SHARD_BUCKETS, MESSAGE_SHARD_MAP_REFRESH, MESSAGE_SHARD_COPY_BATCH,
+                    MESSAGE_FANIN_WORKERS)
+import database
+from database import DbTarget, Error, connect_primary, get_connection
+import log
+import statements
+
+# Cùng công thức với bucket_of(), để lọc tin theo bucket ngay trong SQL (MySQL CRC32 = zlib.crc32)
+_BUCKET_SQL = ("CRC32(IF(room_id IS NOT NULL, CONCAT('room:', room_id), "
+               "CONCAT('dm:', LEAST(sender_id, receiver_id), '-', GREATEST(sender_id, receiver_id)))) % "
+               f"{MESSAGE_SHARD_BUCKETS}")
+_SIDE_TABLES = ("message_attachments", "message_search")   # khóa message_id, đi cùng tin khi chuyển shard
+
+
+def bucket_of(conv: str) -> int:
+    return zlib.crc32(conv.encode("utf-8")) % MESSAGE_SHARD_BUCKETS
+
+
+def _placeholders(n) -> str:
+    return ", ".join(["%s"] * n)
+
+
+class Shard:
+    def __init__(self, index, spec):
+        self.index = index
+        self.target = None if spec is None else DbTarget(
+            f"chat-shard-{index}", spec[0], spec[1], MESSAGE_SHARD_USER, MESSAGE_SHARD_PASSWORD, spec[2],
+            MESSAGE_SHARD_POOL_SIZE)
+        self.name = "primary" if spec is None else self.target.name
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+
+    @property
+    def is_primary(self) -> bool:
+        return self.target is None
+
+    def connect(self, read_only=False):
+        """Kết nối cho handler (primary: get_connection như cũ); None nếu không kết nối được."""
+        if self.target is None:
+            return get_connection(read_only)
+        try:
+            return self.target.session()
+        except Error as e:
+            self.errors += 1
+            log.error("shard_connect_error", exc=e, shard=self.index)
+            return None
+
+    def raw(self):
+        """Kết nối cho job nền / công cụ (không đếm audit); người gọi tự close()."""
+        return connect_primary() if self.target is None else self.target.connect()
+
+
+shards = [Shard(i, spec) for i, spec in enumerate(MESSAGE_SHARDS)]
+enabled = len(shards) > 1
+# Shard giữ các bucket chưa được chuyển (dữ liệu có từ trước khi chia)
+HOME = next((s.index for s in shards if s.is_primary), 0)
+
+
+# ------------------ Bucket -> shard ------------------
+class ShardMap:
+    def __init__(self):
+        self._owner = {}           # bucket -> shard (chỉ bucket không thuộc HOME)
+        self._moving = {}          # bucket -> shard cũ còn giữ một phần tin (đang chuyển)
+        self.loaded_at = None
+        self.last_error = None
+
+    def load(self):
+        raw = connect_primary()
+        try:
+            cur = raw.cursor()
+            cur.execute("SELECT bucket, shard, moving_from FROM message_shard_map")
+            rows = cur.fetchall()
+            cur.close()
+            raw.rollback()
+        finally:
+            raw.close()
+        # Thay cả dict 1 lần: luồng đọc không thấy map dở dang
+        self._owner = {b: s for b, s, _ in rows if s != HOME}
+        self._moving = {b: m for b, _, m in rows if m is not None}
+        self.loaded_at = time.time()
+
+    def owner(self, bucket) -> int:
+        return self._owner.get(bucket, HOME)
+
+    def moving_from(self, bucket):
+        return self._moving.get(bucket)
+
+    def write_shard(self, conv) -> Shard:
+        return shards[self.owner(bucket_of(conv))]
+
+    def read_shards(self, conv) -> list:
+        bucket = bucket_of(conv)
+        first = shards[self.owner(bucket)]
+        old = self._moving.get(bucket)
+        return [first] if old is None or old == first.index else [first, shards[old]]
+
+    def counts(self) -> dict:
+        owner = dict(self._owner)
+        out = {s.index: 0 for s in shards}
+        for b in range(MESSAGE_SHARD_BUCKETS):
+            out[owner.get(b, HOME)] += 1
+        return out
+
+    def _loop(self):
+        while True:
+            time.sleep(MESSAGE_SHARD_MAP_REFRESH)
+            try:
+                self.load()
+                self.last_error = None
+            except Exception as e:
+                # Giữ map cũ; bucket chỉ đổi chủ khi chạy công cụ chuyển (có chờ lượt đọc map)
+                if self.last_error is None:
+                    log.error("shard_map_refresh_error", exc=e)
+                self.last_error = str(e)
+
+
+shard_map = ShardMap()
+
+
+# ------------------ Cấp id tin nhắn ------------------
+class IdAllocator:
+    """Cấp id từ message_id_seq trên primary, 1 id mỗi tin (transaction riêng, khóa dòng chỉ trong 1 UPDATE).
+
+    Id được cấp theo thứ tự thời gian trên mọi process như AUTO_INCREMENT; như AUTO_INCREMENT, hai tin gửi cùng lúc
+    vẫn có thể commit khác thứ tự id (chỉ trong khoảng vài ms của 1 lần gửi).
+    """
+
+    def __init__(self):
+        self.allocated = 0
+
+    def next(self) -> int:
+        raw = connect_primary()
+        try:
+            cur = raw.cursor()
+            cur.execute("UPDATE message_id_seq SET next_id = LAST_INSERT_ID(next_id + 1) WHERE name = 'messages'")
+            if cur.rowcount != 1:
+                raise RuntimeError("message_id_seq is not initialized (python shards.py init)")
+            cur.execute("SELECT LAST_INSERT_ID()")
+            (end,) = cur.fetchone()
+            raw.commit()
+            cur.close()
+        finally:
+            raw.close()
+        self.allocated += 1
+        return end - 1
+
+    def seed(self):
+        """next_id luôn lớn hơn mọi id đang có trên primary (tin từ trước khi chia dùng AUTO_INCREMENT)."""
+        raw = connect_primary()
+        try:
+            cur = raw.cursor()
+            cur.execute(
+                "INSERT INTO message_id_seq (name, next_id) SELECT 'messages', COALESCE(MAX(id), 0) + 1 FROM messages "
+                "ON DUPLICATE KEY UPDATE next_id = GREATEST(next_id, VALUES(next_id))"
+            )
+            raw.commit()
+            cur.close()
+        finally:
+            raw.close()
+
+
+ids = IdAllocator()
+
+
+def insert_message(conn, name, params) -> int:
+    """INSERT tin bằng câu `name` (statements); nhiều shard thì id lấy từ bộ cấp id chung. Trả về id tin."""
+    if not enabled:
+        msg_id, _ = statements.execute(conn, name, params)
+        return msg_id
+    msg_id = ids.next()
+    statements.execute(conn, name + "_with_id", (msg_id, *params))
+    return msg_id
+
+
+# ------------------ Định tuyến cho handler ------------------
+@contextmanager
+def writing(conv, conn):
+    """Kết nối để ghi tin của hội thoại `conv`: chính `conn` nếu thuộc primary (người gọi commit như cũ),
+    shard khác thì mở kết nối riêng và commit khi ra khỏi khối (trước khi người gọi commit phần trên primary)."""
+    shard = shard_map.write_shard(conv)
+    shard.writes += 1
+    if shard.is_primary:
+        yield conn
+        return
+    sconn = shard.connect()
+    if sconn is None:
+        raise RuntimeError(f"shard {shard.index} unavailable")
+    try:
+        yield sconn
+        sconn.commit()
+    finally:
+        sconn.close()
+
+
+@contextmanager
+def reading(conv, conn):
+    """Kết nối đọc tin của `conv` trên shard đang giữ nó (shard mới nếu bucket đang chuyển)."""
+    shard = shard_map.read_shards(conv)[0]
+    shard.reads += 1
+    if shard.is_primary:
+        yield conn
+        return
+    sconn = shard.connect(read_only=True)
+    if sconn is None:
+        raise RuntimeError(f"shard {shard.index} unavailable")
+    try:
+        yield sconn
+    finally:
+        sconn.close()
+
+
+def _each_for_conv(conv, conn, fn) -> list:
+    parts = []
+    for shard in shard_map.read_shards(conv):
+        shard.reads += 1
+        if shard.is_primary:
+            parts.append(fn(conn))
+            continue
+        sconn = shard.connect(read_only=True)
+        if sconn is None:
+            raise RuntimeError(f"shard {shard.index} unavailable")
+        try:
+            parts.append(fn(sconn))
+        finally:
+            sconn.close()
+    return parts
+
+
+def merge_by_id(parts, order="ASC", limit=None) -> list:
+    """Gộp các danh sách dòng (cột 0 = id) từ nhiều shard: bỏ trùng, sắp theo id, cắt `limit`."""
+    seen = {}
+    for rows in parts:
+        for r in rows:
+            seen.setdefault(r[0], r)
+    rows = sorted(seen.values(), key=lambda r: r[0], reverse=order == "DESC")
+    return rows[:limit] if limit else rows
+
+
+def conv_rows(conv, conn, fn, order="ASC", limit=None) -> list:
+    """fn(kết nối) -> dòng của hội thoại; đọc trên (các) shard giữ `conv`."""
+    if not enabled:
+        return fn(conn)
+    parts = _each_for_conv(conv, conn, fn)
+    return parts[0] if len(parts) == 1 else merge_by_id(parts, order, limit)
+
+
+def conv_attachments(conv, conn, message_ids) -> dict:
+    """attachments.lookup trên (các) shard giữ `conv`."""
+    import attachments
+    if not enabled:
+        return attachments.lookup(conn, message_ids)
+    out = {}
+    for part in _each_for_conv(conv, conn, lambda c: attachments.lookup(c, message_ids)):
+        out.update(part)
+    return out
+
+
+class _FanInStats:
+    def __init__(self):
+        self.calls = 0
+        self.partial = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+
+_fanin = _FanInStats()
+_pool = ThreadPoolExecutor(max_workers=MESSAGE_FANIN_WORKERS, thread_name_prefix="shard-fanin") if enabled else None
+
+
+def _run_on(shard, fn):
+    sconn = shard.connect(read_only=True)
+    if sconn is None:
+        raise RuntimeError("shard_unavailable")
+    try:
+        return fn(sconn)
+    finally:
+        sconn.close()
+
+
+def fan_in(fn, conn, partial_ok=True) -> list:
+    """Chạy fn(kết nối) trên mọi shard (primary dùng `conn` trên thread hiện tại, shard khác song song).
+
+    Trả về danh sách kết quả của các shard trả lời được; shard lỗi bị bỏ qua và đếm vào "partial".
+    partial_ok=False: shard lỗi -> RuntimeError (người gọi tiến con trỏ theo kết quả, thiếu shard là mất tin).
+    """
+    if not enabled:
+        return [fn(conn)]
+    t0 = time.perf_counter()
+    futures = [(s, _pool.submit(_run_on, s, fn)) for s in shards if not s.is_primary]
+    results = []
+    partial = False
+    for s in shards:
+        if s.is_primary:
+            s.reads += 1
+            results.append(fn(conn))
+    for s, future in futures:
+        s.reads += 1
+        try:
+            results.append(future.result())
+        except Exception as e:
+            s.errors += 1
+            partial = True
+            log.error("shard_fanin_error", exc=e, shard=s.index)
+    elapsed = (time.perf_counter() - t0) * 1000
+    _fanin.calls += 1
+    _fanin.partial += partial
+    _fanin.total_ms += elapsed
+    _fanin.max_ms = max(_fanin.max_ms, elapsed)
+    if partial and not partial_ok:
+        raise RuntimeError("shard_unavailable")
+    return results
+
+
+def by_shard(items, conv_fn) -> dict:
+    """{Shard: [item]} theo shard đang nhận ghi của conv_fn(item); bỏ hội thoại đang chuyển (job nền làm lượt sau)."""
+    out = {}
+    for item in items:
+        bucket = bucket_of(conv_fn(item))
+        if shard_map.moving_from(bucket) is not None:
+            continue
+        out.setdefault(shards[shard_map.owner(bucket)], []).append(item)
+    return out
+
+
+def start():
+    """Gọi lúc khởi động server: nạp map, đảm bảo bộ cấp id, đọc lại map định kỳ (chỉ khi có > 1 shard)."""
+    if not enabled:
+        return
+    ids.seed()
+    shard_map.load()
+    threading.Thread(target=shard_map._loop, name="shard-map", daemon=True).start()
+    log.info("shards_started", shards=[s.name for s in shards], buckets=MESSAGE_SHARD_BUCKETS,
+             moved=len(shard_map._owner), moving=len(shard_map._moving))
+
+
+def report() -> dict:
+    counts = shard_map.counts()
+    return {
+        "enabled": enabled,
+        "shards": [{"index": s.index, "name": s.name, "buckets": counts[s.index], "reads": s.reads,
+                    "writes": s.writes, "errors": s.errors} for s in shards],
+        "moving": len(shard_map._moving),
+        "map_age_s": round(time.time() - shard_map.loaded_at, 1) if shard_map.loaded_at else None,
+        "map_error": shard_map.last_error,
+        "ids_allocated": ids.allocated,
+        "fan_in": {"calls": _fanin.calls, "partial": _fanin.partial, "max_ms": round(_fanin.max_ms, 1),
+                   "avg_ms": round(_fanin.total_ms / _fanin.calls, 1) if _fanin.calls else 0.0},
+    }
+
+
+# ------------------ Công cụ chia lại ------------------
+def _settle():
+    """Chờ mọi server đọc lại map (2 chu kỳ + dư)."""
+    time.sleep(MESSAGE_SHARD_MAP_REFRESH * 2 + 1)
+
+
+def _scalar(raw, sql, params=()):
+    cur = raw.cursor()
+    try:
+        cur.execute(sql, params)
+        row = cur.fetchone()
+        return row[0] if row else None
+    finally:
+        cur.close()
+
+
+def _scan(raw, buckets, lo, hi, fn, pause=0.0):
+    """Gọi fn(rows, cols) cho tin thuộc `buckets` có lo < id <= hi, theo lô khoảng id MESSAGE_SHARD_COPY_BATCH."""
+    cond = f"{_BUCKET_SQL} IN ({_placeholders(len(buckets))})"
+    total = 0
+    last = lo
+    while last < hi:
+        upper = min(last + MESSAGE_SHARD_COPY_BATCH, hi)
+        cur = raw.cursor()
+        cur.execute(f"SELECT * FROM messages WHERE id > %s AND id <= %s AND {cond}", (last, upper, *buckets))
+        rows = cur.fetchall()
+        cols = list(cur.column_names)
+        cur.close()
+        raw.rollback()              # kết thúc snapshot đọc sau mỗi lô
+        if rows:
+            fn(rows, cols)
+            total += len(rows)
+        last = upper
+        if pause:
+            time.sleep(pause)
+    return total
+
+
+def _copy(src, dst, buckets, lo, hi) -> int:
+    s, d = src.raw(), dst.raw()
+    try:
+        def copy(rows, cols):
+            dcur = d.cursor()
+            dcur.executemany(f"INSERT IGNORE INTO messages ({', '.join(cols)}) VALUES ({_placeholders(len(cols))})",
+                             rows)
+            id_pos = cols.index("id")
+            message_ids = [r[id_pos] for r in rows]
+            for table in _SIDE_TABLES:
+                scur = s.cursor()
+                scur.execute(f"SELECT * FROM {table} WHERE message_id IN ({_placeholders(len(message_ids))})",
+                             message_ids)
+                side, side_cols = scur.fetchall(), list(scur.column_names)
+                scur.close()
+                if side:
+                    dcur.executemany(f"INSERT IGNORE INTO {table} ({', '.join(side_cols)}) "
+                                     f"VALUES ({_placeholders(len(side_cols))})", side)
+            d.commit()
+            dcur.close()
+        return _scan(s, buckets, lo, hi, copy)
+    finally:
+        s.close()
+        d.close()
+
+
+def _purge(shard, buckets, pause=0.05) -> int:
+    raw = shard.raw()
+    try:
+        lo = (_scalar(raw, "SELECT MIN(id) FROM messages") or 1) - 1
+        hi = _scalar(raw, "SELECT COALESCE(MAX(id), 0) FROM messages")
+
+        def purge(rows, cols):
+            id_pos = cols.index("id")
+            message_ids = [r[id_pos] for r in rows]
+            cur = raw.cursor()
+            for table in _SIDE_TABLES:
+                cur.execute(f"DELETE FROM {table} WHERE message_id IN ({_placeholders(len(message_ids))})",
+                            message_ids)
+            cur.execute(f"DELETE FROM messages WHERE id IN ({_placeholders(len(message_ids))})", message_ids)
+            raw.commit()
+            cur.close()
+        return _scan(raw, buckets, lo, hi, purge, pause)
+    finally:
+        raw.close()
+
+
+def _set_map(buckets, shard, moving_from):
+    raw = connect_primary()
+    try:
+        cur = raw.cursor()
+        cur.executemany(
+            "INSERT INTO message_shard_map (bucket, shard, moving_from) VALUES (%s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE shard = VALUES(shard), moving_from = VALUES(moving_from)",
+            [(b, shard, moving_from) for b in buckets],
+        )
+        raw.commit()
+        cur.close()
+    finally:
+        raw.close()
+
+
+def move(dst_index, buckets):
+    """Chuyển các bucket sang shard `dst_index` (4 bước ở đầu file); chạy lại an toàn nếu bị ngắt."""
+    dst = shards[dst_index]
+    shard_map.load()
+    groups = {}
+    for b in sorted(set(buckets)):
+        owner, old = shard_map.owner(b), shard_map.moving_from(b)
+        if owner == dst_index and old is None:
+            continue                                  # đã xong
+        if owner == dst_index:
+            groups.setdefault((old, True), []).append(b)    # đã đổi map, còn bước 3-4
+        else:
+            groups.setdefault((owner, False), []).append(b)
+    for (src_index, flipped), group in groups.items():
+        src = shards[src_index]
+        t0 = time.time()
+        print(f"move {len(group)} bucket(s) {src.name} -> {dst.name}")
+        raw = src.raw()
+        try:
+            lo = (_scalar(raw, "SELECT MIN(id) FROM messages") or 1) - 1
+            watermark = _scalar(raw, "SELECT COALESCE(MAX(id), 0) FROM messages")
+        finally:
+            raw.close()
+        if not flipped:
+            copied = _copy(src, dst, group, lo, watermark)
+            print(f"  1. copied {copied} messages (id <= {watermark})")
+            _set_map(group, dst_index, src_index)
+            _settle()
+            print("  2. writes now go to the new shard, reads merge both")
+        raw = src.raw()
+        try:
+            top = _scalar(raw, "SELECT COALESCE(MAX(id), 0) FROM messages")
+        finally:
+            raw.close()
+        # Từ lo chứ không từ watermark: id không commit theo thứ tự, tin id <= watermark có thể commit sau bước 1
+        copied = _copy(src, dst, group, lo, top)
+        print(f"  3. caught up ({copied} messages re-scanned, already copied ones ignored)")
+        _set_map(group, dst_index, None)
+        _settle()
+        removed = _purge(src, group)
+        print(f"  4. removed {removed} messages from {src.name} ({time.time() - t0:.1f}s)")
+        log.info("shard_buckets_moved", src=src_index, dst=dst_index, buckets=len(group))
+
+
+def rebalance(dry_run=False):
+    """Chia đều bucket: shard thừa nhường các bucket số lớn nhất cho shard thiếu."""
+    shard_map.load()
+    owned = {s.index: [] for s in shards}
+    for b in range(MESSAGE_SHARD_BUCKETS):
+        owned[shard_map.owner(b)].append(b)
+    n = len(shards)
+    target = {s.index: MESSAGE_SHARD_BUCKETS // n + (1 if s.index < MESSAGE_SHARD_BUCKETS % n else 0)
+              for s in shards}
+    spare = []
+    for i in owned:
+        extra = len(owned[i]) - target[i]
+        if extra > 0:
+            spare += owned[i][-extra:]
+    plan = {}
+    for i in owned:
+        need = target[i] - len(owned[i])
+        if need > 0:
+            plan[i], spare = spare[:need], spare[need:]
+    for i, group in plan.items():
+        print(f"shard {i} ({shards[i].name}): +{len(group)} bucket(s)")
+        if not dry_run:
+            move(i, group)
+    if not plan:
+        print("already balanced")
+
+
+def cleanup(dry_run=False):
+    """Xóa tin nằm trên shard không còn giữ bucket của nó (vd. lần chuyển bị ngắt ở bước 4)."""
+    shard_map.load()
+    for shard in shards:
+        foreign = [b for b in range(MESSAGE_SHARD_BUCKETS)
+                   if shard_map.owner(b) != shard.index and shard_map.moving_from(b) != shard.index]
+        if not foreign:
+            continue
+        if dry_run:
+            raw = shard.raw()
+            try:
+                n = _scalar(raw, f"SELECT COUNT(*) FROM messages WHERE {_BUCKET_SQL} IN "
+                                 f"({_placeholders(len(foreign))})", foreign)
+            finally:
+                raw.close()
+            print(f"{shard.name}: {n} stray message(s)")
+        else:
+            print(f"{shard.name}: removed {_purge(shard, foreign)} stray message(s)")
+
+
+def _messages_ddl() -> str:
+    """DDL bảng messages lấy từ primary, bỏ khóa ngoại (users/phòng không nằm trên shard) và phân vùng."""
+    raw = connect_primary()
+    try:
+        cur = raw.cursor()
+        cur.execute("SHOW CREATE TABLE messages")
+        ddl = cur.fetchone()[1]
+        cur.close()
+    finally:
+        raw.close()
+    ddl = re.split(r"\n/\*!50100 PARTITION|\nPARTITION BY", ddl)[0]
+    lines = [line for line in ddl.split("\n") if "FOREIGN KEY" not in line]
+    ddl = re.sub(r",\s*\n\)", "\n)", "\n".join(lines))
+    ddl = re.sub(r"AUTO_INCREMENT=\d+ ?", "", ddl)
+    return ddl.replace("CREATE TABLE `messages`", "CREATE TABLE IF NOT EXISTS `messages`", 1)
+
+
+def init():
+    database.ensure_tables()
+    ddl = [_messages_ddl()] + [database._TABLES[t] for t in _SIDE_TABLES]
+    for shard in shards:
+        if shard.is_primary:
+            continue
+        raw = shard.raw()
+        try:
+            cur = raw.cursor()
+            for statement in ddl:
+                cur.execute(statement)
+            raw.commit()
+            cur.close()
+        finally:
+            raw.close()
+        print(f"{shard.name}: tables ready")
+    ids.seed()
+    print("message id sequence ready")
+
+
+def status():
+    shard_map.load()
+    counts = shard_map.counts()
+    for shard in shards:
+        try:
+            raw = shard.raw()
+            try:
+                rows = _scalar(raw, "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'messages'")
+            finally:
+                raw.close()
+        except Error as e:
+            rows = f"error: {e}"
+        print(f"[{shard.index}] {shard.name}: {counts[shard.index]} bucket(s), ~{rows} messages")
+    if shard_map._moving:
+        print("moving:", ", ".join(f"{b}: {old}->{shard_map.owner(b)}" for b, old in sorted(shard_map._moving.items())))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    flags = {a for a in args if a.startswith("--")}
+    args = [a for a in args if not a.startswith("--")]
+    if not args or args[0] not in ("init", "status", "move", "rebalance", "cleanup"):
+        print(__doc__)
+        sys.exit(1)
+    if args[0] == "init":
+        init()
+    elif args[0] == "status":
+        status()
+    elif args[0] == "move" and len(args) == 3:
+        move(int(args[1]), [int(b) for b in args[2].split(",")])
+    elif args[0] == "rebalance":
+        rebalance(dry_run="--dry-run" in flags)
+    elif args[0] == "cleanup":
+        cleanup(dry_run="--dry-run" in flags)
+    else:
+        print(__doc__)
+        sys.exit(1)
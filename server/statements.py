@@ -0,0 +1,281 @@
+"""Danh mục câu SQL "nóng" + chạy bằng prepared statement phía server, cache theo phiên DB.
+
+- Mỗi câu có 1 tên cố định trong STATEMENTS; handler gọi fetch_all/fetch_one/execute(conn, tên, tham số).
+- Phiên = kết nối thật trong pool (database.py không reset session khi trả về pool), nên câu đã
+  PREPARE được dùng lại qua nhiều request: lần đầu trên 1 phiên là "miss" (PREPARE + EXECUTE),
+  các lần sau là "hit" (chỉ EXECUTE, server không parse lại SQL).
+- report(): tỉ lệ hit và thời gian (ms) theo từng câu, đăng ký vào metrics với tên "statements".
+"""
+import threading
+import time
+import weakref
+
+from mysql.connector import Error
+
+import audit
+from config import DB_PREPARED
+
+_HISTORY_ROOM = """
+    SELECT m.id, m.sender_id, u.display_name, m.content, {ts}
+    FROM messages m
+    JOIN users u ON m.sender_id = u.user_id
+    WHERE m.room_id = %s AND m.id {op} %s
+    ORDER BY m.id {order}
+    LIMIT %s
+"""
+
+# Shard không có bảng users: tên người gửi điền sau (directory.names)
+_HISTORY_ROOM_BARE = """
+    SELECT m.id, m.sender_id, NULL, m.content, {ts}
+    FROM messages m
+    WHERE m.room_id = %s AND m.id {op} %s
+    ORDER BY m.id {order}
+    LIMIT %s
+"""
+
+_HISTORY_DM = """
+    SELECT id, sender_id, receiver_id, content, {ts}
+    FROM messages
+    WHERE ((sender_id = %s AND receiver_id = %s)
+        OR (sender_id = %s AND receiver_id = %s))
+      AND id {op} %s
+    ORDER BY id {order}
+    LIMIT %s
+"""
+
+STATEMENTS = {
+    # --- tin nhắn ---
+    # sent_at do server truyền vào -> không cần SELECT lại sau INSERT
+    "insert_room_message":
+        "INSERT INTO messages (sender_id, content, room_id, receiver_id, sent_at) VALUES (%s, %s, %s, NULL, %s)",
+    "insert_dm":
+        "INSERT INTO messages (sender_id, receiver_id, content, room_id, sent_at) VALUES (%s, %s, %s, NULL, %s)",
+    # Nhiều shard: id do bộ cấp id chung (shards.py) cấp, không dùng AUTO_INCREMENT của từng shard
+    "insert_room_message_with_id":
+        "INSERT INTO messages (id, sender_id, content, room_id, receiver_id, sent_at) VALUES (%s, %s, %s, %s, NULL, %s)",
+    "insert_dm_with_id":
+        "INSERT INTO messages (id, sender_id, receiver_id, content, room_id, sent_at) VALUES (%s, %s, %s, %s, NULL, %s)",
+    "recent_for_user": """
+        SELECT id, sender_id, receiver_id, content, sent_at, room_id
+        FROM messages
+        WHERE receiver_id = %s
+           OR room_id IN (SELECT room_id FROM room_members WHERE user_id = %s)
+        ORDER BY sent_at DESC
+        LIMIT 200
+    """,
+    # --- tệp đính kèm (attachments.py) ---
+    "insert_attachment":
+        "INSERT INTO message_attachments (message_id, sha256, file_name, size, mime) VALUES (%s, %s, %s, %s, %s)",
+    # User được tải blob nếu là người gửi/nhận hoặc thành viên phòng của 1 tin có đính kèm blob đó
+    "attachment_access": """
+        SELECT 1
+        FROM message_attachments ma
+        JOIN messages m ON m.id = ma.message_id
+        WHERE ma.sha256 = %s
+          AND (m.sender_id = %s OR m.receiver_id = %s
+               OR m.room_id IN (SELECT room_id FROM room_members WHERE user_id = %s))
+        LIMIT 1
+    """,
+    # --- user ---
+    "user_login":
+        "SELECT user_id FROM users WHERE username = %s AND password = %s",
+    # rowcount = 0 nếu trạng thái không đổi (vd. đăng nhập lại sau drain) -> không báo presence
+    "user_set_status":
+        "UPDATE users SET status = %s WHERE user_id = %s AND status <> %s",
+    # --- phòng / thành viên ---
+    "room_member_role":
+        "SELECT role FROM room_members WHERE room_id = %s AND user_id = %s",
+    # Tên người gửi + danh sách thành viên phòng trong 1 truy vấn (user_id NULL nếu phòng rỗng)
+    "room_fanout": """
+        SELECT u.display_name, rm.user_id
+        FROM users u
+        LEFT JOIN room_members rm ON rm.room_id = %s
+        WHERE u.user_id = %s
+    """,
+    "room_by_name":
+        "SELECT room_id FROM chat_rooms WHERE room_name = %s",
+    "user_rooms": """
+        SELECT cr.room_id, cr.room_name
+        FROM chat_rooms cr
+        JOIN room_members rm ON cr.room_id = rm.room_id
+        WHERE rm.user_id = %s
+    """,
+    # --- bạn bè ---
+    "friend_ids": """
+        SELECT u.user_id
+        FROM users u
+        JOIN user_relationships ur
+          ON (
+               (u.user_id = ur.user2_id AND ur.user1_id = %s)
+            OR (u.user_id = ur.user1_id AND ur.user2_id = %s)
+             )
+        WHERE ur.status = 'accepted'
+    """,
+    "friends_list": """
+        SELECT DISTINCT u.user_id, u.display_name, u.status
+        FROM users u
+        JOIN user_relationships ur
+          ON (
+               (u.user_id = ur.user2_id AND ur.user1_id = %s)
+            OR (u.user_id = ur.user1_id AND ur.user2_id = %s)
+             )
+        WHERE ur.status = 'accepted'
+        ORDER BY u.display_name
+    """,
+}
+
+# Lịch sử: mỗi tổ hợp (chiều so sánh id, ORDER BY) là 1 câu riêng
+for _op, _order in (("<", "DESC"), (">", "DESC"), (">", "ASC")):
+    _suffix = f"{'lt' if _op == '<' else 'gt'}_{_order.lower()}"
+    STATEMENTS[f"room_history_{_suffix}"] = _HISTORY_ROOM.format(ts="m.sent_at", op=_op, order=_order)
+    STATEMENTS[f"room_bare_history_{_suffix}"] = _HISTORY_ROOM_BARE.format(ts="m.sent_at", op=_op, order=_order)
+    STATEMENTS[f"dm_history_{_suffix}"] = _HISTORY_DM.format(ts="sent_at", op=_op, order=_order)
+
+
+# Đính kèm của 1 trang tin: IN theo đúng các id của trang (khóa chính), không quét cả khoảng id giữa tin cũ nhất
+# và mới nhất. Số tham số cố định theo từng cỡ để dùng được prepared statement; danh sách được lặp id cuối cho đủ cỡ.
+ID_LIST_SIZES = tuple(2 ** _i for _i in range(11))          # 1 .. 1024
+for _n in ID_LIST_SIZES:
+    STATEMENTS[f"attachments_for_ids_{_n}"] = (
+        "SELECT message_id, sha256, file_name, size, mime FROM message_attachments "
+        f"WHERE message_id IN ({', '.join(['%s'] * _n)})")
+
+
+def id_list_statement(prefix: str, ids: list):
+    """(tên câu, tham số) cho danh sách id (tối đa ID_LIST_SIZES[-1] phần tử), lấy cỡ nhỏ nhất đủ chứa."""
+    n = next(size for size in ID_LIST_SIZES if size >= len(ids))
+    return f"{prefix}_{n}", tuple(ids) + (ids[-1],) * (n - len(ids))
+
+
+def history_statement(kind: str, op: str, order: str) -> str:
+    """Tên câu lịch sử: kind "room"/"room_bare"/"dm", op "<"/">" (xem _history_page của server)."""
+    return f"{kind}_history_{'lt' if op == '<' else 'gt'}_{order.lower()}"
+
+
+# Kết nối thật -> {tên câu: cursor prepared}; tự mất khi kết nối bị đóng/thu hồi
+_cursors = weakref.WeakKeyDictionary()
+_cursors_lock = threading.Lock()
+
+
+class _Stat:
+    __slots__ = ("calls", "prepares", "errors", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.calls = 0
+        self.prepares = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+
+_stats = {name: _Stat() for name in STATEMENTS}
+_stats_lock = threading.Lock()
+
+
+def _raw(conn):
+    """Bỏ các lớp bọc (pinned/session/pooled) để lấy kết nối MySQL thật giữ prepared statements."""
+    while hasattr(conn, "_conn"):
+        conn = conn._conn
+    return getattr(conn, "_cnx", conn)
+
+
+def _cursor(conn, name):
+    """Cursor prepared của câu `name` trên phiên này; (cursor, True nếu phải PREPARE mới)."""
+    raw = _raw(conn)
+    with _cursors_lock:
+        per_conn = _cursors.get(raw)
+        if per_conn is None:
+            per_conn = _cursors[raw] = {}
+    cur = per_conn.get(name)
+    if cur is not None:
+        return cur, False
+    cur = raw.cursor(prepared=True)
+    per_conn[name] = cur
+    return cur, True
+
+
+def _forget(conn, name):
+    per_conn = _cursors.get(_raw(conn)) or {}
+    cur = per_conn.pop(name, None)
+    try:
+        if cur:
+            cur.close()
+    except Exception:
+        pass
+
+
+def _run(conn, name, params, fetch):
+    """EXECUTE câu `name` (PREPARE nếu phiên chưa có), đọc hết kết quả để phiên sẵn sàng cho câu sau."""
+    sql = STATEMENTS[name]
+    audit.note_query()
+    t0 = time.perf_counter()
+    prepared = False
+    try:
+        if not DB_PREPARED:
+            cur = _raw(conn).cursor()
+            try:
+                cur.execute(sql, params)
+                return cur.fetchall() if fetch else (cur.lastrowid, cur.rowcount)
+            finally:
+                cur.close()
+        cur, prepared = _cursor(conn, name)
+        try:
+            cur.execute(sql, params)
+        except Error as e:
+            # 1243: statement đã bị server thu hồi (restart/reset) -> PREPARE lại 1 lần
+            _forget(conn, name)
+            if getattr(e, "errno", None) != 1243:
+                raise
+            cur, prepared = _cursor(conn, name)
+            cur.execute(sql, params)
+        return cur.fetchall() if fetch else (cur.lastrowid, cur.rowcount)
+    except Exception:
+        with _stats_lock:
+            _stats[name].errors += 1
+        raise
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        with _stats_lock:
+            st = _stats[name]
+            st.calls += 1
+            st.prepares += prepared
+            st.total_ms += ms
+            st.max_ms = max(st.max_ms, ms)
+
+
+def fetch_all(conn, name, params=()) -> list:
+    return _run(conn, name, params, fetch=True)
+
+
+def fetch_one(conn, name, params=()):
+    rows = _run(conn, name, params, fetch=True)
+    return rows[0] if rows else None
+
+
+def execute(conn, name, params=()):
+    """Câu ghi: trả về (lastrowid, rowcount)."""
+    return _run(conn, name, params, fetch=False)
+
+
+def report() -> dict:
+    with _stats_lock:
+        rows = {name: (st.calls, st.prepares, st.errors, st.total_ms, st.max_ms)
+                for name, st in _stats.items() if st.calls}
+    calls = sum(r[0] for r in rows.values())
+    prepares = sum(r[1] for r in rows.values())
+    return {
+        "prepared": DB_PREPARED,
+        "sessions": len(_cursors),
+        "calls": calls,
+        "hit_rate": round(1 - prepares / calls, 4) if calls else 0.0,
+        "by_statement": {
+            name: {
+                "calls": c,
+                "hit_rate": round(1 - p / c, 4),
+                "errors": err,
+                "avg_ms": round(total / c, 3),
+                "max_ms": round(mx, 3),
+            }
+            for name, (c, p, err, total, mx) in sorted(rows.items(), key=lambda kv: -kv[1][3])
+        },
+    }
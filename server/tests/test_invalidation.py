@@ -0,0 +1,124 @@
+"""Bus vô hiệu hóa cache trên LocalTransport: 2 Bus khác source giả làm 2 process dùng chung 1 luồng sự kiện.
+
+Phủ các đường khó thấy khi chạy thật: version commit không theo thứ tự (gap), gap hết hạn, subscriber lỗi
+(sự kiện được đọc lại lần sau) và nối tiếp từ mốc của snapshot (resume_from).
+"""
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from invalidation import Bus, LocalTransaction, LocalTransport  # noqa: E402
+
+
+class Recorder:
+    def __init__(self, fail=0):
+        self.calls = []
+        self.fail = fail
+
+    def __call__(self, keys):
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("subscriber down")
+        self.calls.append(keys)
+        return len(keys)
+
+
+@pytest.fixture
+def pair():
+    transport = LocalTransport()
+    a = Bus(transport, source="a", gap_timeout=60)
+    b = Bus(transport, source="b", gap_timeout=60)
+    seen = Recorder()
+    b.subscribe(seen)
+    a.poll_once()
+    b.poll_once()        # lần đầu: lấy mốc = head
+    return transport, a, b, seen
+
+
+def test_other_process_events_applied_own_skipped(pair):
+    transport, a, b, seen = pair
+    mine = Recorder()
+    a.subscribe(mine)
+    a.publish(None, "members", 3, 7)
+    a.publish(None, "members", 3, 7)
+    a.publish(None, "friends", 1, 2)
+    assert b.poll_once() == 3
+    assert seen.calls == [[("members", 3, 7), ("friends", 1, 2)]]   # khóa trùng gộp lại
+    assert a.poll_once() == 3 and mine.calls == []
+    assert b.applied_through() == a.applied_through() == 3
+
+
+def test_out_of_order_commit_fills_gap(pair):
+    transport, a, b, seen = pair
+    slow = LocalTransaction(transport)
+    a.publish(slow, "members", 1)          # version 1, chưa commit
+    a.publish(None, "members", 2)          # version 2, commit trước
+    b.poll_once()
+    assert seen.calls == [[("members", 2, None)]]
+    assert b.version == 2 and b.applied_through() == 0
+    slow.commit()
+    assert b.poll_once() == 0              # không có version mới, nhưng gap được lấp
+    assert seen.calls[-1] == [("members", 1, None)]
+    assert b.applied_through() == 2 and b.report()["gaps_open"] == 0
+
+
+def test_gap_expires_after_timeout(pair):
+    transport, a, b, seen = pair
+    b.gap_timeout = 0.01
+    rolled_back = LocalTransaction(transport)
+    a.publish(rolled_back, "users", 5)     # version 1 không bao giờ commit (rollback)
+    a.publish(None, "users", 6)
+    b.poll_once()
+    assert b.applied_through() == 0
+    time.sleep(0.02)
+    b.poll_once()
+    assert b.gaps_expired == 1 and b.applied_through() == 2
+    assert all(("users", 5, None) not in keys for keys in seen.calls)
+
+
+def test_subscriber_failure_rereads_events(pair):
+    transport, a, b, seen = pair
+    seen.fail = 1
+    a.publish(None, "friends", 1, 2)
+    with pytest.raises(RuntimeError):
+        b.poll_once()
+    assert seen.calls == [] and b.applied_through() == 0
+    b.poll_once()
+    assert seen.calls == [[("friends", 1, 2)]]
+    assert b.applied == 1 and b.applied_through() == 1
+
+
+def test_resume_from_snapshot_version(pair):
+    transport, a, b, seen = pair
+    a.publish(None, "members", 1)
+    b.poll_once()
+    snap_version, written_at = b.applied_through(), time.time()
+    a.publish(None, "members", 2)          # sau snapshot
+    a.publish(None, "members", 3)
+
+    c = Bus(transport, source="c")
+    replay = Recorder()
+    c.subscribe(replay)
+    assert c.resume_from(snap_version, written_at)
+    c.poll_once()
+    assert replay.calls == [[("members", 2, None), ("members", 3, None)]]
+
+    assert not Bus(transport, source="d").resume_from(transport.head() + 1, written_at)   # mốc của luồng khác
+    assert not Bus(transport, source="e").resume_from(None, written_at)
+
+
+def test_resume_from_pruned_version_is_cold(pair):
+    transport, a, b, seen = pair
+    for room in range(1, 5):
+        a.publish(None, "members", room)
+    old = time.time() - 10 * 86400
+    assert transport.prune(time.time() + 1) == 3       # giữ lại sự kiện mới nhất
+    assert transport.head() == 4 and transport.oldest() == 4
+    assert not Bus(transport, source="c").resume_from(1, old)     # 2, 3 đã bị dọn
+    assert Bus(transport, source="d").resume_from(3, old)         # tiếp ngay trước sự kiện còn lại
@@ -0,0 +1,120 @@
+"""Số truy vấn / commit / kết nối của các handler ghi chính không vượt QUERY_BUDGETS (audit.expect).
+
+Handler chạy trên kết nối giả (không cần MySQL): mỗi execute được ghi lại, kết quả trả về đủ để handler đi
+hết đường thành công. Thêm 1 round trip vào các handler này mà không sửa ngân sách thì test hỏng.
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("mysql.connector")
+pytest.importorskip("dotenv")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import audit  # noqa: E402
+import database  # noqa: E402
+import server  # noqa: E402
+from config import QUERY_BUDGETS  # noqa: E402
+
+
+class FakeCursor:
+    lastrowid = 42
+    rowcount = 1
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, sql, params=()):
+        self.conn.executed.append(" ".join(sql.split()))
+        if "MAX(username" in sql:
+            self.rows = [(None, None, None)]          # register: chưa ai dùng username / email / tên
+        elif "room_members" in sql and "SELECT" in sql:
+            self.rows = [("Alice", 1), ("Alice", 2)]  # room_fanout: tên người gửi + thành viên
+        else:
+            self.rows = []
+
+    def executemany(self, sql, seq):
+        self.conn.executed.append(" ".join(sql.split()))
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    in_transaction = False
+
+    def __init__(self):
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class FakeSocket:
+    user_id = 1
+
+    def __init__(self):
+        self.frames = []
+
+    def send_line(self, text, frame_type="text"):
+        self.frames.append(text)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    conn = FakeConnection()
+    monkeypatch.setattr(database, "_new_connection", lambda: conn)
+    return conn
+
+
+CASES = [
+    ("register", server.register_user,
+     {"username": "alice", "password": "pw", "email": "a@example.com", "full_name": "Alice"},
+     "Registration successful."),
+    ("create_chat_room", server.create_chat_room, {"room_name": "general", "creator_id": 1},
+     "created successfully"),
+    ("send_message", server.send_message, {"sender_id": 1, "room_id": 3, "content": "hi"},
+     '"ok": true'),
+    ("send_private_message", server.send_private_message, {"sender_id": 1, "receiver_id": 2, "content": "hi"},
+     '"ok": true'),
+]
+
+
+@pytest.mark.parametrize("name, handler, request_, reply", CASES, ids=[c[0] for c in CASES])
+def test_handler_within_budget(db, name, handler, request_, reply):
+    queries, commits, connections = QUERY_BUDGETS[name]
+    sock = FakeSocket()
+    with audit.expect(queries=queries, commits=commits, connections=connections, name=name) as frame:
+        handler(request_, sock)
+    # Đi đúng đường thành công (đường lỗi thường ít truy vấn hơn, không chứng minh được gì)
+    assert any(reply in f for f in sock.frames), sock.frames
+    assert frame.queries == len(db.executed) > 0
+    assert frame.commits == db.commits == 1
+
+
+def test_expect_fails_over_budget(db):
+    with pytest.raises(AssertionError, match="queries"):
+        with audit.expect(queries=1):
+            server.send_message({"sender_id": 1, "room_id": 3, "content": "hi"}, FakeSocket())
@@ -0,0 +1,93 @@
+"""Mốc đã đọc + bộ đếm tin chưa đọc theo (user, hội thoại), lưu trong bảng read_markers.
+
+Khóa hội thoại giống client: "room:<room_id>" / "dm:<peer_id>" (peer = đầu bên kia).
+Các hàm nhận cursor của handler để chạy chung transaction với INSERT tin nhắn.
+"""
+
+
+def room_key(room_id) -> str:
+    return f"room:{room_id}"
+
+
+def dm_key(peer_id) -> str:
+    return f"dm:{peer_id}"
+
+
+def parse_key(conv_key):
+    """"room:3" -> ("room", 3); khóa sai -> (None, None)."""
+    kind, _, ident = str(conv_key).partition(":")
+    if kind not in ("room", "dm") or not ident.isdigit():
+        return None, None
+    return kind, int(ident)
+
+
+# Dòng có unread = 0 là của người gửi (đã đọc tới tin mình vừa gửi); các dòng khác +1
+_BUMP = (
+    " ON DUPLICATE KEY UPDATE "
+    "unread = IF(VALUES(unread) = 0, 0, unread + 1), "
+    "last_read_id = GREATEST(last_read_id, VALUES(last_read_id))"
+)
+
+
+def bump_dm(cur, sender_id, receiver_id, msg_id):
+    """DM mới: receiver +1 chưa đọc; sender coi như đã đọc tới msg_id. 1 câu lệnh."""
+    cur.execute(
+        "INSERT INTO read_markers (user_id, conv_key, last_read_id, unread) "
+        "VALUES (%s, %s, 0, 1), (%s, %s, %s, 0)" + _BUMP,
+        (receiver_id, dm_key(sender_id), sender_id, dm_key(receiver_id), msg_id),
+    )
+
+
+def bump_room(cur, room_id, sender_id, msg_id):
+    """Tin phòng mới: mọi thành viên khác +1 chưa đọc, sender đọc tới msg_id. 1 câu lệnh."""
+    cur.execute(
+        "INSERT INTO read_markers (user_id, conv_key, last_read_id, unread) "
+        "SELECT user_id, %s, IF(user_id = %s, %s, 0), IF(user_id = %s, 0, 1) "
+        "FROM room_members WHERE room_id = %s" + _BUMP,
+        (room_key(room_id), sender_id, msg_id, sender_id, room_id),
+    )
+
+
+def mark_read(cur, user_id, conv_key, up_to, msg_cur=None) -> int:
+    """Dời mốc đã đọc tới up_to (chỉ tiến), đếm lại số tin chưa đọc sau mốc; trả về unread.
+
+    msg_cur: cursor trên shard giữ tin của hội thoại (shards.py), mặc định cùng `cur`.
+    Khóa dòng mốc (FOR UPDATE) trước khi đếm: 2 mark_read cùng lúc chạy lần lượt (mốc không lùi), bump_room /
+    bump_dm đến sau phải chờ commit rồi +1 trên số vừa đếm; tin của bump đã commit trước đó thì đã nằm trong số đếm.
+    """
+    kind, ident = parse_key(conv_key)
+    msg_cur = msg_cur or cur
+    cur.execute(
+        "SELECT last_read_id FROM read_markers WHERE user_id = %s AND conv_key = %s FOR UPDATE",
+        (user_id, conv_key),
+    )
+    row = cur.fetchone()
+    last_read = max(row[0] if row else 0, up_to)
+    # Đếm lại thay vì trừ: tin đến giữa lúc client đang đọc vẫn được tính đúng
+    if kind == "room":
+        msg_cur.execute(
+            "SELECT COUNT(*) FROM messages WHERE room_id = %s AND id > %s AND sender_id <> %s",
+            (ident, last_read, user_id),
+        )
+    else:
+        msg_cur.execute(
+            "SELECT COUNT(*) FROM messages WHERE receiver_id = %s AND sender_id = %s AND id > %s",
+            (user_id, ident, last_read),
+        )
+    (unread,) = msg_cur.fetchone()
+    cur.execute(
+        "INSERT INTO read_markers (user_id, conv_key, last_read_id, unread) VALUES (%s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE last_read_id = GREATEST(last_read_id, VALUES(last_read_id)), "
+        "unread = VALUES(unread)",
+        (user_id, conv_key, last_read, unread),
+    )
+    return unread
+
+
+def counts(cur, user_id) -> dict:
+    """{conv_key: unread} của mọi hội thoại còn tin chưa đọc."""
+    cur.execute(
+        "SELECT conv_key, unread FROM read_markers WHERE user_id = %s AND unread > 0",
+        (user_id,),
+    )
+    return {k: n for k, n in cur.fetchall()}